@@ -0,0 +1,126 @@
+from datetime import timedelta
+
+
+class FinancialAnalytics:
+    """Revenue analytics computed with SQLite window functions over the finances ledger"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def rolling_revenue(self, start_date, end_date, windows=(7, 30)):
+        """Daily revenue with trailing rolling sums and averages, one row per day including empty days"""
+        # Start early enough that the first day in range has a full window behind it
+        lead_start = start_date - timedelta(days=max(windows) - 1)
+        rolling_columns = ',\n'.join(
+            f"SUM(revenue) OVER (ORDER BY day ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW) "
+            f"AS rolling_{window}d,\n"
+            f"SUM(revenue) OVER (ORDER BY day ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW) "
+            f"/ {window}.0 AS rolling_{window}d_avg"
+            for window in windows
+        )
+        query = f"""
+            WITH RECURSIVE days(day) AS (
+                SELECT DATE(:lead_start)
+                UNION ALL
+                SELECT DATE(day, '+1 day') FROM days WHERE day < :end_date
+            ),
+            daily AS (
+                SELECT finances.date AS day, SUM(finances.amount) AS revenue
+                FROM {self.db.table_source('finances', lead_start.strftime('%Y-%m-%d'))}
+                WHERE finances.date BETWEEN :lead_start AND :end_date
+                GROUP BY finances.date
+            ),
+            series AS (
+                SELECT days.day, COALESCE(daily.revenue, 0) AS revenue
+                FROM days
+                LEFT JOIN daily ON daily.day = days.day
+            ),
+            rolled AS (
+                SELECT day, revenue,
+                {rolling_columns}
+                FROM series
+            )
+            SELECT * FROM rolled
+            WHERE day >= :start_date
+            ORDER BY day
+        """
+        return self.db._read(query, {
+            'lead_start': lead_start.strftime('%Y-%m-%d'),
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+        }, 'rolling_revenue')
+
+    def month_over_month(self, start_date, end_date):
+        """Monthly revenue with the change against the previous month, including empty months"""
+        first_month = start_date.replace(day=1)
+        # One month of lead-in so the first month in range has a previous month to compare with
+        lead_start = (first_month - timedelta(days=1)).replace(day=1)
+        query = f"""
+            WITH RECURSIVE months(month) AS (
+                SELECT DATE(:lead_start)
+                UNION ALL
+                SELECT DATE(month, '+1 month') FROM months WHERE DATE(month, '+1 month') <= :end_date
+            ),
+            daily AS (
+                -- Grouping on the raw date follows the index, so months are rolled up from days
+                SELECT finances.date AS day, SUM(finances.amount) AS revenue, COUNT(*) AS transactions
+                FROM {self.db.table_source('finances', lead_start.strftime('%Y-%m-%d'))}
+                WHERE finances.date BETWEEN :lead_start AND :end_date
+                GROUP BY finances.date
+            ),
+            monthly AS (
+                SELECT strftime('%Y-%m-01', day) AS month,
+                       SUM(revenue) AS revenue,
+                       SUM(transactions) AS transactions
+                FROM daily
+                GROUP BY month
+            ),
+            compared AS (
+                SELECT months.month,
+                       COALESCE(monthly.revenue, 0) AS revenue,
+                       COALESCE(monthly.transactions, 0) AS transactions,
+                       LAG(COALESCE(monthly.revenue, 0)) OVER w AS previous_revenue
+                FROM months
+                LEFT JOIN monthly ON monthly.month = months.month
+                WINDOW w AS (ORDER BY months.month)
+            )
+            SELECT month, revenue, transactions, previous_revenue,
+                   revenue - previous_revenue AS change,
+                   ROUND(100.0 * (revenue - previous_revenue) / NULLIF(previous_revenue, 0), 1) AS change_pct
+            FROM compared
+            WHERE month >= :first_month
+            ORDER BY month
+        """
+        return self.db._read(query, {
+            'lead_start': lead_start.strftime('%Y-%m-%d'),
+            'first_month': first_month.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+        }, 'month_over_month')
+
+    def revenue_per_doctor(self, start_date, end_date):
+        """Revenue attributed to each patient's assigned doctor, with share of total and rank"""
+        query = f"""
+            WITH per_patient AS (
+                -- Aggregate per patient first so the joins run once per patient, not per payment
+                SELECT finances.patient_id, SUM(finances.amount) AS revenue, COUNT(*) AS transactions
+                FROM {self.db.table_source('finances', start_date.strftime('%Y-%m-%d'))}
+                WHERE finances.date BETWEEN ? AND ?
+                GROUP BY finances.patient_id
+            )
+            SELECT
+                patients.assigned_doctor_id AS doctor_id,
+                COALESCE(users.full_name, 'Unassigned') AS doctor_name,
+                SUM(per_patient.revenue) AS revenue,
+                SUM(per_patient.transactions) AS transactions,
+                COUNT(*) AS patients,
+                ROUND(100.0 * SUM(per_patient.revenue) / SUM(SUM(per_patient.revenue)) OVER (), 1) AS share_pct,
+                RANK() OVER (ORDER BY SUM(per_patient.revenue) DESC) AS rank
+            FROM per_patient
+            JOIN patients ON per_patient.patient_id = patients.id
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            GROUP BY patients.assigned_doctor_id
+            ORDER BY rank
+        """
+        return self.db._read(
+            query, (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')), 'revenue_per_doctor'
+        )
@@ -0,0 +1,488 @@
+"""
+Headless JSON API over the clinic repository, for the lab system and reminder tooling.
+
+Serves on the loopback interface only:
+
+    python api.py --port 8600
+
+or alongside the Streamlit app, sharing its repository and result cache, with
+``CLINIC_API_PORT=8600 streamlit run main.py``.
+
+GET endpoints page with ``limit``/``offset`` (``/finances`` also filters by
+patient_id, recorded_by_id, min_amount, max_amount, type, order and desc), answer ``If-None-Match`` with 304
+and gzip large bodies; they never write. POST endpoints take JSON and return the new row's id. Patient
+metrics are refreshed after every POST and, for writes made elsewhere, every METRICS_REFRESH_SECONDS.
+In the multi-branch mode, ``/directory?search=`` finds a person at every branch they are registered at,
+and ``POST /patients/{id}/visits`` with a branch_id registers them at another branch they visit.
+"""
+import argparse
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import date, time as clock_time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from database import FINANCE_ORDERINGS
+from frames import DATE_COLUMNS
+from recurrence import SERIES_FREQUENCIES, SchedulingConflict
+from repository import ConstraintViolation, InvalidValue, open_repository
+
+API_HOST = '127.0.0.1'
+API_PORT = 8600
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Responses kept per process; entries are dropped once the data version moves on
+CACHE_ENTRIES = 512
+# Bodies smaller than this go out uncompressed, where gzip would cost more than it saves
+GZIP_MIN_SIZE = 1000
+# Seconds between background patient metrics refreshes, which pick up writes made outside the API
+METRICS_REFRESH_SECONDS = 30
+
+# Never served: password hashes stay behind the UI
+HIDDEN_COLUMNS = {'password'}
+
+
+class ApiError(Exception):
+    """A request the API rejects, with the HTTP status to answer it with"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ResultCache:
+    """Serialized responses by request, valid while the repository's data version is unchanged"""
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """Return the cached body for a request at a data version, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, body):
+        """Cache a body, evicting the least recently used entry when full"""
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def _int_param(request, name, default=None, minimum=None, maximum=None):
+    """Read an integer query parameter, rejecting malformed or out-of-range values"""
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ApiError(f"{name} must be an integer")
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise ApiError(f"{name} must be between {minimum} and {maximum}")
+    return value
+
+
+def _float_param(request, name, minimum=None):
+    """Read an optional numeric query parameter"""
+    value = request.query_params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        value = float(value)
+    except ValueError:
+        raise ApiError(f"{name} must be a number")
+    if minimum is not None and value < minimum:
+        raise ApiError(f"{name} must be at least {minimum}")
+    return value
+
+
+def _date_param(request, name):
+    """Read an optional YYYY-MM-DD query parameter"""
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(f"{name} must be a date (YYYY-MM-DD)")
+
+
+def _page_params(request):
+    """Read limit and offset, capping the page size"""
+    limit = _int_param(request, 'limit', DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+    offset = _int_param(request, 'offset', 0, 0)
+    return limit, offset
+
+
+def _page_body(request, frame, limit, offset, extra=None):
+    """Serialize one page of rows with its total, the link to the next page and any extra fields"""
+    # Paged in SQL: the unpaged count rides along in total_rows
+    total = int(frame['total_rows'].iloc[0]) if not frame.empty else 0
+    frame = frame.drop(columns=['total_rows'], errors='ignore')
+    next_url = None
+    if offset + limit < total:
+        next_url = str(request.url.include_query_params(limit=limit, offset=offset + limit))
+    return _rows_body(frame, extra={'total': total, 'limit': limit, 'offset': offset, 'next': next_url, **(extra or {})})
+
+
+def _rows_body(frame, extra=None):
+    """Serialize rows as {"items": [...]} plus extra fields, with NaN written as null"""
+    frame = frame.drop(columns=[column for column in frame.columns if column in HIDDEN_COLUMNS])
+    # Id columns with NULLs come back as floats; keep them integers in the JSON
+    id_columns = [column for column in frame.columns
+                  if (column == 'id' or column.endswith('_id')) and frame[column].dtype.kind == 'f']
+    if id_columns:
+        frame = frame.astype({column: 'Int64' for column in id_columns})
+    # Dates go out as the text the database stores, not as epoch milliseconds
+    for column in frame.columns:
+        if frame[column].dtype.kind == 'M':
+            frame[column] = frame[column].dt.strftime('%Y-%m-%d' if column in DATE_COLUMNS else '%Y-%m-%d %H:%M:%S')
+    fields = ''.join(f',{json.dumps(key)}:{json.dumps(value)}' for key, value in (extra or {}).items())
+    return f'{{"items":{frame.to_json(orient="records")}{fields}}}'.encode()
+
+
+def _require(payload, *names):
+    """Return required fields from a JSON body, rejecting the request if any is missing"""
+    missing = [name for name in names if payload.get(name) in (None, '')]
+    if missing:
+        raise ApiError(f"Missing field(s): {', '.join(missing)}")
+    return [payload[name] for name in names]
+
+
+def _id_field(payload, name):
+    """Read an optional id field from a JSON body as an integer"""
+    value = payload.get(name)
+    if value is None or value == '':
+        return None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    raise ApiError(f"{name} must be an integer")
+
+
+def _parse(parser, value, name):
+    """Parse an ISO date or time field from a JSON body"""
+    try:
+        return parser(value)
+    except (TypeError, ValueError):
+        raise ApiError(f"{name} must be in ISO format, e.g. 2026-10-19 or 14:30")
+
+
+def create_app(repo, cache=None):
+    """Build the API application over a repository and a shared result cache"""
+    cache = cache if cache is not None else ResultCache()
+
+    async def cached_get(request, load):
+        """Answer a GET from the cache or the repository, with an ETag tied to the data version"""
+        key = f"{request.url.path}?{request.url.query}"
+        version = await run_in_threadpool(repo.data_version)
+        if version is None:
+            # The backend can't tell when data changed: always load, and tag the body itself
+            body = await run_in_threadpool(load)
+            etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        else:
+            etag = f'"{hashlib.sha1(repr((version, key)).encode()).hexdigest()[:20]}"'
+            # Checked before loading, so a client whose copy is current costs no query
+            if etag in request.headers.get('if-none-match', ''):
+                return Response(status_code=304, headers={'ETag': etag})
+            body = cache.get(key, version)
+            if body is None:
+                body = await run_in_threadpool(load)
+                cache.put(key, version, body)
+        if etag in request.headers.get('if-none-match', ''):
+            return Response(status_code=304, headers={'ETag': etag})
+        return Response(body, media_type='application/json', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+    async def create(request, write):
+        """Run a write from a JSON body and answer 201 with the new id"""
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise ApiError("Body must be JSON")
+        if not isinstance(payload, dict):
+            raise ApiError("Body must be a JSON object")
+        try:
+            new_id = await run_in_threadpool(write, payload)
+            if isinstance(new_id, Future):
+                # Write-behind mode hands back the id once the batch commits
+                new_id = await run_in_threadpool(new_id.result)
+        except (ConstraintViolation, SchedulingConflict) as e:
+            raise ApiError(str(e), 409)
+        except InvalidValue as e:
+            raise ApiError(str(e))
+        # Every write can change a patient's metrics; only the patients it touched are recomputed
+        await run_in_threadpool(repo.refresh_patient_metrics)
+        return JSONResponse({'id': int(new_id)}, status_code=201)
+
+    # Patients
+    async def list_patients(request):
+        limit, offset = _page_params(request)
+        search = request.query_params.get('search')
+
+        def load():
+            if search:
+                return _page_body(request, repo.search_patients(search, limit, offset), limit, offset)
+            return _page_body(request, repo.get_patients(limit, offset), limit, offset)
+        return await cached_get(request, load)
+
+    async def add_patient(request):
+        def write(payload):
+            name, contact = _require(payload, 'name', 'contact')
+            branch_args = {}
+            branch_id = _id_field(payload, 'branch_id')
+            if branch_id is not None:
+                if not hasattr(repo, 'branches'):
+                    raise ApiError("branch_id is only accepted in the multi-branch mode")
+                if branch_id not in repo.branches:
+                    raise ApiError(f"Unknown branch {branch_id}")
+                branch_args['branch_id'] = branch_id
+            return repo.add_patient(name, contact, payload.get('email'), payload.get('medical_history'),
+                                    _id_field(payload, 'assigned_doctor_id'), **branch_args)
+        return await create(request, write)
+
+    async def patient_metrics(request):
+        patient_id = request.path_params['patient_id']
+
+        def load():
+            # Kept current by the write path, so answering a GET never writes
+            return _rows_body(repo.get_patient_metrics(patient_id))
+        return await cached_get(request, load)
+
+    # Medical records
+    async def list_medical_records(request):
+        limit, offset = _page_params(request)
+        patient_id = _int_param(request, 'patient_id', minimum=1)
+
+        def load():
+            return _page_body(request, repo.get_medical_records(patient_id, limit, offset), limit, offset)
+        return await cached_get(request, load)
+
+    async def add_medical_record(request):
+        def write(payload):
+            _, _, visit_date = _require(payload, 'patient_id', 'doctor_id', 'visit_date')
+            return repo.add_medical_record(
+                _id_field(payload, 'patient_id'), _id_field(payload, 'doctor_id'),
+                _parse(date.fromisoformat, visit_date, 'visit_date'),
+                payload.get('diagnosis'), payload.get('treatment'), payload.get('notes')
+            )
+        return await create(request, write)
+
+    # Appointments
+    async def list_appointments(request):
+        limit, offset = _page_params(request)
+        day = _date_param(request, 'date')
+        staff_id = _int_param(request, 'staff_id', minimum=1)
+        start, end = _date_param(request, 'start'), _date_param(request, 'end')
+        if (start is None) != (end is None):
+            raise ApiError("start and end must be given together")
+
+        def load():
+            if start:
+                appointments = repo.get_appointments_range(start, end, staff_id, limit, offset)
+                return _page_body(request, appointments, limit, offset)
+            appointments = repo.get_appointments(day.strftime('%Y-%m-%d') if day else None, staff_id,
+                                                 limit, offset)
+            return _page_body(request, appointments, limit, offset)
+        return await cached_get(request, load)
+
+    async def add_appointment(request):
+        def write(payload):
+            _, day, at = _require(payload, 'patient_id', 'date', 'time')
+            return repo.add_appointment(
+                _id_field(payload, 'patient_id'), _parse(date.fromisoformat, day, 'date'),
+                _parse(clock_time.fromisoformat, at, 'time'), payload.get('reason'), _id_field(payload, 'assigned_to')
+            )
+        return await create(request, write)
+
+    async def add_appointment_series(request):
+        def write(payload):
+            _, day, at = _require(payload, 'patient_id', 'date', 'time')
+            frequency = payload.get('frequency', 'weekly')
+            if frequency not in SERIES_FREQUENCIES:
+                raise ApiError(f"frequency must be one of: {', '.join(SERIES_FREQUENCIES)}")
+            try:
+                occurrences = int(payload.get('occurrences', 12))
+            except (TypeError, ValueError):
+                raise ApiError("occurrences must be an integer")
+            try:
+                return repo.add_appointment_series(
+                    _id_field(payload, 'patient_id'), _parse(date.fromisoformat, day, 'date'),
+                    _parse(clock_time.fromisoformat, at, 'time'), payload.get('reason'),
+                    _id_field(payload, 'assigned_to'), frequency, occurrences
+                )
+            except ValueError as e:
+                raise ApiError(str(e))
+        return await create(request, write)
+
+    # Finances
+    async def list_finances(request):
+        limit, offset = _page_params(request)
+        order = request.query_params.get('order', 'date')
+        if order not in FINANCE_ORDERINGS:
+            raise ApiError(f"order must be one of: {', '.join(FINANCE_ORDERINGS)}")
+        start, end = _date_param(request, 'start'), _date_param(request, 'end')
+        if (start is None) != (end is None):
+            raise ApiError("start and end must be given together")
+        search = {
+            'start_date': start,
+            'end_date': end,
+            'patient_id': _int_param(request, 'patient_id'),
+            'recorded_by_id': _int_param(request, 'recorded_by_id'),
+            'min_amount': _float_param(request, 'min_amount', 0),
+            'max_amount': _float_param(request, 'max_amount', 0),
+            'transaction_type': request.query_params.get('type') or None,
+            'order_by': order,
+            'descending': request.query_params.get('desc', '').lower() in ('1', 'true', 'yes'),
+        }
+
+        def load():
+            # Filters and paging run in SQL; the filtered sum comes back on every row of the page
+            records = repo.get_financial_records(**search, limit=limit, offset=offset)
+            filtered_total = float(records['filtered_total'].iloc[0]) if not records.empty else 0.0
+            return _page_body(request, records.drop(columns=['filtered_total']), limit, offset,
+                              extra={'filtered_total': filtered_total})
+        return await cached_get(request, load)
+
+    async def record_income(request):
+        def write(payload):
+            day, amount, _ = _require(payload, 'date', 'amount', 'patient_id')
+            try:
+                amount = float(amount)
+            except (TypeError, ValueError):
+                raise ApiError("amount must be a number")
+            return repo.record_income(_parse(date.fromisoformat, day, 'date'), amount, payload.get('description'),
+                                      _id_field(payload, 'patient_id'), _id_field(payload, 'recorded_by_id'))
+        return await create(request, write)
+
+    # Staff and dashboard
+    async def list_staff(request):
+        limit, offset = _page_params(request)
+        search = request.query_params.get('search')
+
+        def load():
+            if search:
+                return _page_body(request, repo.search_users(search, limit, offset), limit, offset)
+            return _page_body(request, repo.get_users(limit, offset), limit, offset)
+        return await cached_get(request, load)
+
+    async def counters(request):
+        day = _date_param(request, 'date')
+        return await cached_get(request, lambda: json.dumps(repo.get_counters(day)).encode())
+
+    # Global patient directory, in the multi-branch mode
+    async def find_directory_patients(request):
+        search = request.query_params.get('search')
+        if not search:
+            raise ApiError("search is required")
+        limit = _int_param(request, 'limit', DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+        return await cached_get(request, lambda: _rows_body(repo.find_patients(search, limit)))
+
+    async def patient_branches(request):
+        patient_id = request.path_params['patient_id']
+        return await cached_get(request, lambda: _rows_body(repo.patient_branches(patient_id)))
+
+    async def register_visit(request):
+        patient_id = request.path_params['patient_id']
+
+        def write(payload):
+            _require(payload, 'branch_id')
+            branch_id = _id_field(payload, 'branch_id')
+            if branch_id not in repo.branches:
+                raise ApiError(f"Unknown branch {branch_id}")
+            try:
+                return repo.register_visit(patient_id, branch_id)
+            except KeyError as e:
+                raise ApiError(e.args[0], 404)
+        return await create(request, write)
+
+    async def api_error(request, exc):
+        return JSONResponse({'error': str(exc)}, status_code=exc.status_code)
+
+    routes = [
+        Route('/patients', list_patients, methods=['GET']),
+        Route('/patients', add_patient, methods=['POST']),
+        Route('/patients/{patient_id:int}/metrics', patient_metrics, methods=['GET']),
+        Route('/medical-records', list_medical_records, methods=['GET']),
+        Route('/medical-records', add_medical_record, methods=['POST']),
+        Route('/appointments', list_appointments, methods=['GET']),
+        Route('/appointments', add_appointment, methods=['POST']),
+        Route('/appointment-series', add_appointment_series, methods=['POST']),
+        Route('/finances', list_finances, methods=['GET']),
+        Route('/finances', record_income, methods=['POST']),
+        Route('/staff', list_staff, methods=['GET']),
+        Route('/counters', counters, methods=['GET']),
+    ]
+    if hasattr(repo, 'branches'):
+        routes += [
+            Route('/directory', find_directory_patients, methods=['GET']),
+            Route('/patients/{patient_id:int}/branches', patient_branches, methods=['GET']),
+            Route('/patients/{patient_id:int}/visits', register_visit, methods=['POST']),
+        ]
+    app = Starlette(
+        routes=routes,
+        middleware=[Middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)],
+        exception_handlers={ApiError: api_error},
+    )
+    app.state.cache = cache
+    return app
+
+
+def start_metrics_refresher(repo, interval_seconds=METRICS_REFRESH_SECONDS, stop_event=None):
+    """Refresh patient metrics periodically on a background thread and return the thread"""
+    stop_event = stop_event or threading.Event()
+
+    def refresh_loop():
+        while not stop_event.wait(interval_seconds):
+            try:
+                repo.refresh_patient_metrics()
+            except Exception as e:
+                print(f"Error refreshing patient metrics: {e}")
+
+    thread = threading.Thread(target=refresh_loop, name="metrics-refresher", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_api_server(repo, port=API_PORT, cache=None):
+    """Serve the API on the loopback interface from a background thread and return the server"""
+    server = uvicorn.Server(uvicorn.Config(
+        create_app(repo, cache), host=API_HOST, port=port, log_level='warning', access_log=False
+    ))
+    thread = threading.Thread(target=server.run, name="api-server", daemon=True)
+    thread.start()
+    start_metrics_refresher(repo)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nani Health Clinic JSON API (local only)")
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--cache-entries", type=int, default=CACHE_ENTRIES, help="0 turns the result cache off")
+    args = parser.parse_args()
+    repo = open_repository()
+    start_metrics_refresher(repo)
+    uvicorn.run(create_app(repo, ResultCache(args.cache_entries)), host=API_HOST, port=args.port, log_level='info')
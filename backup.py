@@ -0,0 +1,320 @@
+"""
+Online backups of the clinic database.
+
+Each backup is a generation directory holding gzip copies of the main and
+archive databases plus a manifest, e.g. ``backups/20261019-030700-123456/``.
+
+    python backup.py create
+    python backup.py list
+    python backup.py verify [GENERATION]
+    python backup.py restore GENERATION
+    python backup.py schedule --interval 21600
+
+Each branch database of the multi-branch mode keeps its generations in its own
+directory, e.g. ``python backup.py --db clinic-north.db --backup-dir backups/branch-1 list``,
+and so does the patient directory, which has no archive:
+``python backup.py --db clinic_directory.db --archive '' --backup-dir backups/directory list``.
+"""
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BACKUP_DIR = 'backups'
+KEEP_GENERATIONS = 7
+BACKUP_INTERVAL = 6 * 3600
+
+# Pages copied per backup step, and the pause between steps that lets writers in
+PAGES_PER_STEP = 256
+STEP_PAUSE = 0.005
+
+# gzip level for generations; compression runs off the live database, so only duration is at stake
+COMPRESS_LEVEL = 6
+
+# Copies restarted by other connections' writes before falling back to a single step
+MAX_RESTARTS = 3
+
+# Unfinished generations older than this were abandoned by an interrupted backup
+STALE_PARTIAL_SECONDS = 24 * 3600
+
+# Database files inside a generation, by schema name on the source connection
+GENERATION_FILES = {'main': 'clinic.db.gz', 'archive': 'clinic_archive.db.gz'}
+
+
+class BackupError(Exception):
+    """A backup or restore could not be completed or failed verification"""
+
+
+class _TooManyRestarts(Exception):
+    """Raised from the progress callback to abandon a stepped copy that keeps restarting"""
+
+
+class BackupManager:
+    """Stepped online backups of the main and archive databases into rotating gzip generations"""
+
+    def __init__(self, db_path='clinic.db', archive_path='clinic_archive.db', backup_dir=BACKUP_DIR,
+                 keep=KEEP_GENERATIONS, pages_per_step=PAGES_PER_STEP, step_pause=STEP_PAUSE, source_conn=None):
+        # A running app passes its own connection (with the archive attached): writes made through
+        # the source connection are folded into a copy in progress, while other connections' writes restart it.
+        # With no archive_path only the main database is backed up
+        self.source_conn = source_conn
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        self.step_pause = step_pause
+
+    def _connect_source(self):
+        """Open a connection of our own to the live databases, so the app's connection is never borrowed"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if self.archive_path:
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        return conn
+
+    def _generation_files(self):
+        """Return the file name per schema a new generation holds"""
+        return {schema: file_name for schema, file_name in GENERATION_FILES.items()
+                if schema == 'main' or self.archive_path}
+
+    def _copy(self, source, schema, target_path):
+        """Copy one schema page by page into a file, verify the copy and return its manifest entry"""
+        progress = {'remaining': None, 'total': 0, 'restarts': 0}
+
+        def on_step(status, remaining, total):
+            # Another connection wrote to the source, so SQLite started the copy again
+            if progress['remaining'] is not None and remaining > progress['remaining']:
+                progress['restarts'] += 1
+                if progress['restarts'] > MAX_RESTARTS:
+                    raise _TooManyRestarts()
+            progress['remaining'], progress['total'] = remaining, total
+            time.sleep(self.step_pause)
+
+        target = sqlite3.connect(target_path)
+        try:
+            started = time.perf_counter()
+            try:
+                # A step that finds the source locked is retried after step_pause, not the default 250 ms
+                source.backup(target, pages=self.pages_per_step, name=schema, progress=on_step,
+                              sleep=self.step_pause)
+            except _TooManyRestarts:
+                # A single step holds the read lock once for the whole copy, which always finishes
+                source.backup(target, pages=-1, name=schema, sleep=self.step_pause)
+            copy_seconds = time.perf_counter() - started
+            # Checked on the copy, so the live database is not read a second time
+            started = time.perf_counter()
+            check = target.execute("PRAGMA integrity_check").fetchall()
+            verify_seconds = time.perf_counter() - started
+        finally:
+            target.close()
+        if check != [('ok',)]:
+            raise BackupError(f"integrity_check failed for {schema}: {check[:5]}")
+        return {
+            'pages': progress['total'],
+            'restarts': progress['restarts'],
+            'copy_seconds': round(copy_seconds, 3),
+            'verify_seconds': round(verify_seconds, 3),
+            'integrity_check': 'ok',
+        }
+
+    def create(self):
+        """Take a new verified, compressed generation, drop the oldest ones, and return its manifest"""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        generation = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        # Built under a hidden name and renamed at the end, so a half-written generation is never listed
+        partial_dir = os.path.join(self.backup_dir, f".{generation}.partial")
+        os.makedirs(partial_dir)
+        started = time.perf_counter()
+        manifest = {'generation': generation, 'created_at': datetime.now().isoformat(), 'files': {}}
+        source = self.source_conn or self._connect_source()
+        try:
+            for schema, file_name in self._generation_files().items():
+                copy_path = os.path.join(partial_dir, file_name[:-len('.gz')])
+                entry = self._copy(source, schema, copy_path)
+                packed_path = os.path.join(partial_dir, file_name)
+                with open(copy_path, 'rb') as raw, gzip.open(packed_path, 'wb', COMPRESS_LEVEL) as packed:
+                    shutil.copyfileobj(raw, packed)
+                manifest['files'][schema] = {
+                    'file': file_name,
+                    **entry,
+                    'size': os.path.getsize(copy_path),
+                    'compressed_size': os.path.getsize(packed_path),
+                }
+                os.remove(copy_path)
+            manifest['duration_seconds'] = round(time.perf_counter() - started, 3)
+            with open(os.path.join(partial_dir, 'manifest.json'), 'w') as handle:
+                json.dump(manifest, handle, indent=2)
+            os.rename(partial_dir, os.path.join(self.backup_dir, generation))
+        except Exception:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            raise
+        finally:
+            if source is not self.source_conn:
+                source.close()
+        self.rotate()
+        return manifest
+
+    def generations(self):
+        """Return the complete generations, newest first"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        return sorted(
+            (name for name in os.listdir(self.backup_dir)
+             if not name.startswith('.') and os.path.isfile(os.path.join(self.backup_dir, name, 'manifest.json'))),
+            reverse=True
+        )
+
+    def manifest(self, generation):
+        """Return the manifest recorded when a generation was taken"""
+        with open(os.path.join(self.backup_dir, generation, 'manifest.json')) as handle:
+            return json.load(handle)
+
+    def rotate(self):
+        """Delete all but the newest `keep` generations and any leftovers of interrupted backups"""
+        for name in self.generations()[self.keep:]:
+            shutil.rmtree(os.path.join(self.backup_dir, name))
+        for name in os.listdir(self.backup_dir):
+            path = os.path.join(self.backup_dir, name)
+            # Recent partial directories may belong to a backup still running in another process
+            if name.endswith('.partial') and time.time() - os.path.getmtime(path) > STALE_PARTIAL_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _unpack(self, generation, workdir):
+        """Decompress a generation into a directory and return the database path per schema"""
+        if generation not in self.generations():
+            raise BackupError(f"No backup generation {generation!r} in {self.backup_dir}")
+        paths = {}
+        for schema, entry in self.manifest(generation)['files'].items():
+            file_name = entry['file']
+            paths[schema] = os.path.join(workdir, file_name[:-len('.gz')])
+            with gzip.open(os.path.join(self.backup_dir, generation, file_name), 'rb') as packed, \
+                    open(paths[schema], 'wb') as raw:
+                shutil.copyfileobj(packed, raw)
+        return paths
+
+    @staticmethod
+    def _integrity(paths):
+        """Run integrity_check on unpacked database copies and return the result lines per schema"""
+        results = {}
+        for schema, path in paths.items():
+            conn = sqlite3.connect(path)
+            try:
+                results[schema] = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+            finally:
+                conn.close()
+        return results
+
+    def verify(self, generation):
+        """Decompress a generation and run integrity_check on each database; return the results"""
+        with tempfile.TemporaryDirectory() as workdir:
+            return self._integrity(self._unpack(generation, workdir))
+
+    def restore(self, generation, safety_backup=True):
+        """Replace the live databases with a verified generation, taking a backup of them first"""
+        live_paths = {'main': self.db_path, 'archive': self.archive_path}
+        with tempfile.TemporaryDirectory() as workdir:
+            # Unpacked before the safety backup, whose rotation may delete this generation
+            paths = self._unpack(generation, workdir)
+            problems = {schema: result for schema, result in self._integrity(paths).items() if result != ['ok']}
+            if problems:
+                raise BackupError(f"Generation {generation} failed verification: {problems}")
+            if safety_backup:
+                self.create()
+            for schema, path in paths.items():
+                # The backup API writes into the live file under SQLite's locks, so connections
+                # that are still open see the restored data instead of a file swapped under them
+                source = sqlite3.connect(path)
+                target = sqlite3.connect(live_paths[schema], timeout=30)
+                try:
+                    source.backup(target)
+                finally:
+                    source.close()
+                    target.close()
+
+    def start_scheduler(self, interval_seconds=BACKUP_INTERVAL, stop_event=None):
+        """Take a backup every interval on a background thread until stop_event is set"""
+        stop_event = stop_event or threading.Event()
+
+        def backup_loop():
+            while not stop_event.wait(interval_seconds):
+                try:
+                    manifest = self.create()
+                    print(f"Backup {manifest['generation']} taken in {manifest['duration_seconds']:.2f}s")
+                except (sqlite3.Error, OSError, BackupError) as e:
+                    print(f"Error taking backup: {e}")
+
+        thread = threading.Thread(target=backup_loop, name="backup-scheduler", daemon=True)
+        thread.start()
+        return thread
+
+
+def describe(manifest):
+    """Return a one-generation summary line for the CLI"""
+    files = manifest['files']
+    size = sum(entry['size'] for entry in files.values())
+    packed = sum(entry['compressed_size'] for entry in files.values())
+    restarts = sum(entry['restarts'] for entry in files.values())
+    return (
+        f"{manifest['generation']}  {manifest['duration_seconds']:>7.2f}s  "
+        f"{size / 1024:>9.0f} KiB -> {packed / 1024:>8.0f} KiB  restarts {restarts}"
+    )
+
+
+if __name__ == "__main__":
+    from database import archive_path_for
+
+    parser = argparse.ArgumentParser(description="Nani Health Clinic database backups")
+    parser.add_argument("--db", default="clinic.db", help="Database to back up or restore")
+    parser.add_argument("--archive", help="Its archive database (default: named after --db, e.g. clinic_archive.db; "
+                                           "'' for none, as with clinic_directory.db)")
+    parser.add_argument("--backup-dir", default=BACKUP_DIR, help="e.g. backups/branch-1 for a branch database")
+    parser.add_argument("--keep", type=int, default=KEEP_GENERATIONS)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("create", help="Take a verified backup now")
+    subparsers.add_parser("list", help="List backup generations, newest first")
+    verify_parser = subparsers.add_parser("verify", help="Run integrity_check on a generation")
+    verify_parser.add_argument("generation", nargs="?", help="Defaults to the newest generation")
+    restore_parser = subparsers.add_parser("restore", help="Restore the live databases from a generation")
+    restore_parser.add_argument("generation")
+    restore_parser.add_argument("--no-safety-backup", action="store_true",
+                                help="Skip backing up the current databases before restoring")
+    schedule_parser = subparsers.add_parser("schedule", help="Take backups periodically until interrupted")
+    schedule_parser.add_argument("--interval", type=int, default=BACKUP_INTERVAL, help="Seconds between backups")
+
+    args = parser.parse_args()
+    archive_path = archive_path_for(args.db) if args.archive is None else args.archive or None
+    backups = BackupManager(args.db, archive_path, args.backup_dir, args.keep)
+
+    if args.command == "create":
+        print(describe(backups.create()))
+    elif args.command == "list":
+        for generation in backups.generations():
+            print(describe(backups.manifest(generation)))
+    elif args.command == "verify":
+        generations = backups.generations()
+        if not args.generation and not generations:
+            parser.error("no backup generations found")
+        generation = args.generation or generations[0]
+        results = backups.verify(generation)
+        for schema, result in results.items():
+            print(f"{generation} {schema}: {'; '.join(result)}")
+        if any(result != ['ok'] for result in results.values()):
+            raise SystemExit(1)
+    elif args.command == "restore":
+        backups.restore(args.generation, safety_backup=not args.no_safety_backup)
+        print(f"Restored {args.generation}")
+    elif args.command == "schedule":
+        stop = threading.Event()
+        backups.start_scheduler(args.interval, stop)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            stop.set()
@@ -0,0 +1,973 @@
+"""
+Performance benchmarks for the clinic data layer.
+
+Run one benchmark at a time, e.g. ``python benchmarks.py writes``.
+Every benchmark works on a throwaway database in a temporary directory.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, time as clock_time
+
+from analytics import FinancialAnalytics
+from backup import BackupManager
+from database import DatabaseManager
+from repository import timeline_cursor
+from sharding import ShardedRepository, open_branches
+
+
+@contextmanager
+def scratch_database(**kwargs):
+    """Yield a DatabaseManager on a fresh database in a temporary directory"""
+    with tempfile.TemporaryDirectory() as workdir:
+        db = DatabaseManager(
+            db_path=os.path.join(workdir, 'clinic.db'),
+            archive_path=os.path.join(workdir, 'clinic_archive.db'),
+            **kwargs
+        )
+        try:
+            yield db
+        finally:
+            db.stop_write_behind()
+            db.close()
+
+
+def seed_ledger(db, rows=200_000, days=3 * 365, patients=2_000, doctors=20):
+    """Bulk-load doctors, patients and finance rows spread over the last `days` days"""
+    doctor_ids = [
+        db.add_user(f'doctor{i}', 'x', f'Doctor {i}', 1) for i in range(doctors)
+    ]
+    with db.conn:
+        db.conn.executemany(
+            "INSERT INTO patients (name, contact, assigned_doctor_id) VALUES (?, ?, ?)",
+            ((f'Patient {i}', f'07{i:08d}', random.choice(doctor_ids)) for i in range(patients))
+        )
+        # Read back rather than assumed to be 1..patients: a sharded branch allocates ids from its own range
+        patient_ids = [row[0] for row in db.conn.execute("SELECT id FROM patients")]
+        db.conn.executemany(
+            "INSERT INTO finances (date, amount, description, patient_id, recorded_by_id) VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    (date.today() - timedelta(days=random.randrange(days))).strftime('%Y-%m-%d'),
+                    round(random.uniform(5, 500), 2),
+                    'benchmark',
+                    random.choice(patient_ids),
+                    random.choice(doctor_ids),
+                )
+                for _ in range(rows)
+            )
+        )
+
+
+def timed(function, repeat=5):
+    """Return the best wall-clock time of several calls, and the last result"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def percentile(samples, pct):
+    """Return the pct-th percentile of a list of numbers"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(title, latencies, elapsed):
+    """Print throughput and latency percentiles for one benchmark run"""
+    print(
+        f"{title:<14} {len(latencies) / elapsed:>9.0f} writes/s   "
+        f"p50 {percentile(latencies, 50) * 1000:>7.2f} ms   "
+        f"p99 {percentile(latencies, 99) * 1000:>7.2f} ms"
+    )
+
+
+def bench_writes(writes=2000, workers=8):
+    """Compare synchronous commits with the write-behind queue under concurrent bursts"""
+    per_worker = writes // workers
+
+    def run_workers(target):
+        latencies = []
+        lock = threading.Lock()
+
+        def worker(index):
+            samples = target(index)
+            with lock:
+                latencies.extend(samples)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, time.perf_counter() - started
+
+    # Synchronous path: one connection per worker, as with one app session each
+    with scratch_database() as db:
+        db.conn.execute("PRAGMA journal_mode=WAL")
+        patient_id = db.add_patient('Benchmark Patient', '0700000000', None, None)
+
+        def sync_worker(index):
+            session = DatabaseManager(db_path=db.db_path, archive_path=db.archive_path)
+            samples = []
+            for i in range(per_worker):
+                started = time.perf_counter()
+                if i % 2:
+                    session.record_income(date.today(), 10.0, 'benchmark', patient_id)
+                else:
+                    session.add_appointment(patient_id, date.today(), clock_time(9, 0), 'benchmark')
+                samples.append(time.perf_counter() - started)
+            session.close()
+            return samples
+
+        latencies, elapsed = run_workers(sync_worker)
+        report("synchronous", latencies, elapsed)
+
+    # Write-behind path: every worker shares one queue and waits on its future
+    with scratch_database(write_behind=True) as db:
+        patient_id = db.add_patient('Benchmark Patient', '0700000000', None, None)
+
+        def queued_worker(index):
+            samples = []
+            for i in range(per_worker):
+                started = time.perf_counter()
+                if i % 2:
+                    future = db.record_income(date.today(), 10.0, 'benchmark', patient_id)
+                else:
+                    future = db.add_appointment(patient_id, date.today(), clock_time(9, 0), 'benchmark')
+                future.result()
+                samples.append(time.perf_counter() - started)
+            return samples
+
+        latencies, elapsed = run_workers(queued_worker)
+        report("write-behind", latencies, elapsed)
+
+
+def bench_analytics(rows=200_000):
+    """Compare the window-function analytics with the equivalent pandas pipeline"""
+    import pandas as pd
+
+    with scratch_database() as db:
+        seed_ledger(db, rows=rows)
+        analytics = FinancialAnalytics(db)
+        end = date.today()
+        start = end - timedelta(days=365)
+        start_str, end_str = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+        def pandas_rolling():
+            lead_start = (start - timedelta(days=29)).strftime('%Y-%m-%d')
+            records = db.get_financial_records(lead_start, end_str)
+            daily = records.groupby(pd.to_datetime(records['date']))['amount'].sum()
+            daily = daily.reindex(pd.date_range(lead_start, end_str), fill_value=0)
+            frame = pd.DataFrame({'revenue': daily})
+            for window in (7, 30):
+                frame[f'rolling_{window}d'] = frame['revenue'].rolling(window, min_periods=1).sum()
+                frame[f'rolling_{window}d_avg'] = frame[f'rolling_{window}d'] / window
+            return frame.loc[start_str:]
+
+        def pandas_month_over_month():
+            records = db.get_financial_records(start_str, end_str)
+            monthly = records.groupby(pd.to_datetime(records['date']).dt.to_period('M'))['amount'].sum()
+            return pd.DataFrame({'revenue': monthly, 'change_pct': monthly.pct_change() * 100})
+
+        def pandas_revenue_per_doctor():
+            records = pd.read_sql_query(
+                "SELECT patient_id, amount FROM finances WHERE date BETWEEN ? AND ?",
+                db.conn, params=(start_str, end_str)
+            )
+            patients = db.get_patients()[['id', 'assigned_doctor_id', 'doctor_name']]
+            merged = records.merge(patients, left_on='patient_id', right_on='id')
+            per_doctor = merged.groupby('doctor_name')['amount'].agg(['sum', 'count'])
+            per_doctor['share_pct'] = per_doctor['sum'] / per_doctor['sum'].sum() * 100
+            return per_doctor.sort_values('sum', ascending=False)
+
+        cases = [
+            ('rolling 7/30d', lambda: analytics.rolling_revenue(start, end), pandas_rolling),
+            ('month over month', lambda: analytics.month_over_month(start, end), pandas_month_over_month),
+            ('revenue/doctor', lambda: analytics.revenue_per_doctor(start, end), pandas_revenue_per_doctor),
+        ]
+        print(f"{rows} finance rows, 1-year analysis window")
+        for title, sql_version, pandas_version in cases:
+            sql_seconds, sql_result = timed(sql_version)
+            pandas_seconds, _ = timed(pandas_version)
+            print(
+                f"{title:<18} SQL {sql_seconds * 1000:>8.1f} ms ({len(sql_result)} rows)   "
+                f"pandas {pandas_seconds * 1000:>8.1f} ms   "
+                f"speed-up x{pandas_seconds / sql_seconds:.1f}"
+            )
+
+
+def bench_finance_search(rows=200_000):
+    """Compare the pushed-down finance search with loading the date range and filtering in pandas"""
+    with scratch_database() as db:
+        seed_ledger(db, rows=rows)
+        end = date.today()
+        start = end - timedelta(days=365)
+        patient_id, staff_id = db.conn.execute("SELECT patient_id, recorded_by_id FROM finances LIMIT 1").fetchone()
+
+        def pandas_search(**filters):
+            records = db.get_financial_records(start, end)
+            for column, value in filters.items():
+                records = records[records[column] == value]
+            records = records.sort_values('date', ascending=False)
+            return records['amount'].sum(), records.head(50)
+
+        cases = [
+            ('patient', {'patient_id': patient_id}),
+            ('staff', {'recorded_by_id': staff_id}),
+            ('unfiltered', {}),
+        ]
+        print(f"{rows} finance rows, 1-year window, first page of 50 newest plus the filtered total")
+        for title, filters in cases:
+            sql_seconds, page = timed(lambda: db.get_financial_records(
+                start, end, **filters, order_by='date', descending=True, limit=50))
+            pandas_seconds, _ = timed(lambda: pandas_search(**filters))
+            print(
+                f"{title:<12} SQL {sql_seconds * 1000:>8.1f} ms ({int(page['total_rows'].iloc[0])} matches)   "
+                f"pandas {pandas_seconds * 1000:>8.1f} ms   "
+                f"speed-up x{pandas_seconds / sql_seconds:.1f}"
+            )
+
+
+def bench_frames(rows=200_000):
+    """Compare memory and read time of raw and typed frames, and the date parsing typing saves later"""
+    import pandas as pd
+
+    from frames import frame_memory
+
+    with scratch_database() as db:
+        seed_ledger(db, rows=rows)
+        patient_ids = db.get_patients()['id'].tolist()
+        staff_ids = db.get_users()['id'].tolist()
+        statuses = ['Scheduled', 'Completed', 'Cancelled', 'No-show']
+        with db.conn:
+            db.conn.executemany(
+                "INSERT INTO appointments (patient_id, appointment_date, reason, status, assigned_to) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    (random.choice(patient_ids),
+                     (datetime.now() - timedelta(minutes=15 * i)).strftime('%Y-%m-%d %H:%M:%S'),
+                     'benchmark', random.choice(statuses), random.choice(staff_ids + [None]))
+                    for i in range(rows // 4)
+                )
+            )
+        end = date.today()
+        start = end - timedelta(days=365)
+        reads = [
+            ('finances year', lambda: db.get_financial_records(start, end)),
+            ('appointments', lambda: db.get_appointments()),
+            ('patients', lambda: db.get_patients()),
+            ('users', lambda: db.get_users()),
+        ]
+        print(f"{rows} finance rows, {rows // 4} appointments")
+        print(f"{'read':<16}{'rows':>8}{'raw MB':>9}{'typed MB':>10}{'raw read':>11}{'typed read':>12}")
+        for title, read in reads:
+            db.typed_frames = False
+            raw_seconds, raw = timed(read, repeat=3)
+            db.typed_frames = True
+            typed_seconds, typed = timed(read, repeat=3)
+            print(
+                f"{title:<16}{len(typed):>8}{frame_memory(raw) / 1e6:>9.1f}{frame_memory(typed) / 1e6:>10.1f}"
+                f"{raw_seconds * 1000:>9.0f}ms{typed_seconds * 1000:>10.0f}ms"
+            )
+
+        # What the pages used to repeat on every rerun: parse the date strings again
+        db.typed_frames = False
+        raw = db.get_appointments()
+        parse_seconds, _ = timed(lambda: pd.to_datetime(raw['appointment_date']).dt.strftime('%I:%M %p'))
+        db.typed_frames = True
+        typed = db.get_appointments()
+        format_seconds, _ = timed(lambda: typed['appointment_date'].dt.strftime('%I:%M %p'))
+        print(f"appointment times: parse+format {parse_seconds * 1000:.0f} ms, format typed {format_seconds * 1000:.0f} ms")
+
+
+
+def bench_deletes(rows=200_000, patients=5_000, batch=500):
+    """Time deleting a batch of patients, cascading to their history, in one call against one call per patient"""
+    with scratch_database() as db:
+        seed_ledger(db, rows=rows, patients=patients)
+        patient_ids = [row[0] for row in db.conn.execute("SELECT id FROM patients")]
+        with db.conn:
+            db.conn.executemany(
+                "INSERT INTO medical_records (patient_id, doctor_id, visit_date, diagnosis) VALUES (?, 1, ?, 'benchmark')",
+                ((random.choice(patient_ids), f"{date.today() - timedelta(days=random.randrange(1000))}")
+                 for _ in range(rows // 4))
+            )
+            db.conn.executemany(
+                "INSERT INTO appointments (patient_id, appointment_date, reason) VALUES (?, ?, 'benchmark')",
+                ((random.choice(patient_ids), f"{datetime.now() - timedelta(minutes=random.randrange(1_500_000))}"[:19])
+                 for _ in range(rows // 4))
+            )
+        db.archive_old_records(horizon_days=365)
+        random.shuffle(patient_ids)
+        one_by_one, together = patient_ids[:batch], patient_ids[batch:2 * batch]
+
+        started = time.perf_counter()
+        for patient_id in one_by_one:
+            db.delete_patients([patient_id])
+        loop_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        deleted = db.delete_patients(together)
+        batch_seconds = time.perf_counter() - started
+        orphans = sum(
+            db.conn.execute(
+                f"SELECT COUNT(*) FROM {table} WHERE patient_id NOT IN (SELECT id FROM patients)"
+            ).fetchone()[0]
+            for table in ('finances', 'medical_records', 'appointments', 'archive.finances', 'archive.appointments')
+        )
+        print(f"delete {batch} patients with ~{(rows + rows // 2) // patients} history rows each: "
+              f"one call per patient {loop_seconds * 1000:.0f} ms, one call {batch_seconds * 1000:.0f} ms "
+              f"({deleted} deleted, {orphans} orphaned rows left)")
+
+
+def bench_dedup(patients=50_000, duplicates=500, probes=200):
+    """Time the add-patient duplicate check against a scan of the register, and the batch cluster job"""
+    from dedup import compare_fingerprints, fingerprint
+
+    rng = random.Random(43)
+    first_names = ['Amina', 'Brian', 'Cynthia', 'David', 'Esther', 'Faith', 'George', 'Hassan', 'Irene', 'James',
+                   'Kevin', 'Lucy', 'Mercy', 'Njeri', 'Otieno', 'Peter', 'Rose', 'Samuel', 'Wanjiru', 'Zawadi']
+    surnames = ['Achieng', 'Baraka', 'Chebet', 'Kamau', 'Kariuki', 'Mutua', 'Mwangi', 'Njoroge', 'Odhiambo',
+                'Ochieng', 'Omondi', 'Wafula', 'Wambui', 'Wanjala', 'Kiprop', 'Korir', 'Nyambura', 'Onyango']
+    register = [
+        (f"{rng.choice(first_names)} {rng.choice(first_names)} {rng.choice(surnames)}", f"07{i:08d}",
+         f"patient{i}@mail.test" if i % 2 else None)
+        for i in range(patients)
+    ]
+
+    def typo(name):
+        position = rng.randrange(len(name))
+        return name[:position] + name[position + 1:]
+
+    # Re-registrations: a typo in the name, the same phone written differently
+    copies = [
+        (typo(name), f"+254 {contact[1:4]} {contact[4:]}", None)
+        for name, contact, _ in rng.sample(register, duplicates)
+    ]
+    with scratch_database() as db:
+        with db.conn:
+            db.conn.executemany("INSERT INTO patients (name, contact, email) VALUES (?, ?, ?)", register + copies)
+        index_seconds, _ = timed(db.index_patients, repeat=1)
+        print(f"{patients} patients + {duplicates} re-registrations, indexed in {index_seconds:.1f} s")
+
+        probe_rows = rng.sample(copies, probes)
+        indexed_seconds, found = timed(
+            lambda: [db.find_similar_patients(name, contact, email) for name, contact, email in probe_rows],
+            repeat=1
+        )
+        # The scan gets every patient already normalized, so only the comparisons are timed
+        everyone = [fingerprint(patient) for patient in db.get_patients().to_dict('records')]
+        scan_rows = probe_rows[:10]
+        scan_seconds, _ = timed(lambda: [
+            [compare_fingerprints(fingerprint({'name': name, 'contact': contact, 'email': email}), other)
+             for other in everyone]
+            for name, contact, email in scan_rows
+        ], repeat=1)
+        recall = sum(not similar.empty for similar in found) / probes
+        print(f"add-patient check: indexed {indexed_seconds / probes * 1000:.2f} ms, "
+              f"full scan {scan_seconds / len(scan_rows) * 1000:.0f} ms per registration; "
+              f"{recall:.0%} of re-registrations caught")
+
+        cluster_seconds, clusters = timed(db.find_duplicate_clusters, repeat=1)
+        print(f"batch job: {clusters['cluster'].nunique() if len(clusters) else 0} clusters "
+              f"({len(clusters)} records) in {cluster_seconds:.1f} s")
+        merge_seconds, merged = timed(lambda: db.merge_duplicate_clusters(clusters), repeat=1)
+        print(f"merged {merged} records in {merge_seconds:.2f} s")
+
+
+def bench_fuzzy_search(patients=500_000, probes=200):
+    """Time misspelled name searches on a large register: the exact scan, then the trigram fallback"""
+    from dedup import name_trigrams, normalize_name
+    from fuzzy import FUZZY_MATCH_LIMIT, substring_distance
+
+    rng = random.Random(44)
+    syllables = ['ka', 'ma', 'wa', 'nji', 'ru', 'ko', 'ri', 'che', 'bet', 'om', 'on', 'di', 'ho', 'ti', 'en',
+                 'mu', 'tu', 'nya', 'am', 'bu', 'ra', 'ki', 'pro', 'op', 'ga', 'le', 'si', 'ke', 'lo', 'ny',
+                 'ja', 'go', 'ze', 'fa', 'he', 'yu', 'ba', 'sha', 'dz', 'we', 'ol', 'ne', 'vi', 'za', 'pe']
+    first_names = ['Amina', 'Brian', 'Cynthia', 'David', 'Esther', 'Faith', 'George', 'Hassan', 'Irene',
+                   'James', 'Kevin', 'Lucy', 'Mercy', 'Njeri', 'Otieno', 'Peter', 'Rose', 'Samuel', 'Grace',
+                   'Joseph', 'Mary', 'John', 'Ann', 'Daniel', 'Sarah', 'Paul', 'Ruth', 'Moses', 'Joy', 'Ali']
+    register = [
+        (f"{rng.choice(first_names)} "
+         f"{''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()}", f"07{i:08d}")
+        for i in range(patients)
+    ]
+
+    def typo(name):
+        position = rng.randrange(1, len(name))
+        edit = rng.choice(['drop', 'swap', 'replace'])
+        if edit == 'drop':
+            return name[:position] + name[position + 1:]
+        if edit == 'swap' and position < len(name) - 1:
+            return name[:position] + name[position + 1] + name[position] + name[position + 2:]
+        return name[:position] + rng.choice('aeiou') + name[position + 1:]
+
+    with scratch_database() as db:
+        with db.conn:
+            db.conn.executemany("INSERT INTO patients (name, contact) VALUES (?, ?)", register)
+        # Filed in bulk: add_patient would also compute duplicate block keys for every patient
+        index_seconds, _ = timed(lambda: db.conn.executemany(
+            "INSERT INTO patient_name_trigrams (trigram, patient_id) VALUES (?, ?)",
+            ((trigram, patient_id) for patient_id, (name, _) in enumerate(register, 1)
+             for trigram in name_trigrams(name))
+        ), repeat=1)
+        db.conn.commit()
+        print(f"{patients} patients, trigram index filled in {index_seconds:.1f} s")
+
+        wanted = [rng.randrange(1, patients + 1) for _ in range(probes)]
+        terms = [typo(register[patient_id - 1][0]) for patient_id in wanted]
+        exact_seconds, _ = timed(lambda: [db.search_patients(term, 50, fuzzy=False) for term in terms[:20]], repeat=1)
+        fuzzy_seconds, found = timed(lambda: [db.fuzzy_search_patients(term) for term in terms], repeat=1)
+        print(f"per search: exact LIKE scan {exact_seconds / 20 * 1000:.1f} ms, "
+              f"trigram fuzzy search {fuzzy_seconds / probes * 1000:.1f} ms")
+        # Misses only count when a closer or equally close name didn't take the patient's place
+        found_patient = crowded_out = 0
+        for patient_id, term, matches in zip(wanted, terms, found):
+            distance = substring_distance(normalize_name(term), normalize_name(register[patient_id - 1][0]))
+            if patient_id in set(matches['id']):
+                found_patient += 1
+            elif len(matches) == FUZZY_MATCH_LIMIT and matches['distance'].max() <= distance:
+                crowded_out += 1
+        print(f"misspelled names: {found_patient / probes:.0%} found the patient, "
+              f"{crowded_out / probes:.0%} returned only names as close to the typo")
+
+def bench_picker(patients=200_000, probes=2_000, edits=500):
+    """Time the patient picker: building its trie, one keystroke's lookup against the SQL search, and edits"""
+    import tracemalloc
+
+    from picker import PatientPicker
+
+    rng = random.Random(45)
+    first_names = ['Amina', 'Brian', 'Cynthia', 'David', 'Esther', 'Faith', 'George', 'Hassan', 'Irene', 'James',
+                   'Kevin', 'Lucy', 'Mercy', 'Njeri', 'Otieno', 'Peter', 'Rose', 'Samuel', 'Wanjiru', 'Zawadi']
+    syllables = ['ka', 'ma', 'wa', 'nji', 'ru', 'ko', 'ri', 'che', 'bet', 'om', 'on', 'di', 'ho', 'ti', 'en',
+                 'mu', 'tu', 'nya', 'am', 'bu', 'ra', 'ki', 'ga', 'le', 'si', 'ke', 'lo', 'ja', 'go', 'ba']
+    register = [
+        (f"{rng.choice(first_names)} "
+         f"{''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()}",
+         f"07{rng.randrange(10 ** 8):08d}")
+        for _ in range(patients)
+    ]
+    # What a receptionist types: the start of a first name or surname, or of a phone number
+    keystrokes = []
+    for name, contact in rng.sample(register, probes):
+        typed = rng.choice([*name.split(' '), contact])
+        keystrokes.append(typed[:rng.randint(1, min(len(typed), 6))].lower())
+
+    with scratch_database() as db:
+        with db.conn:
+            db.conn.executemany("INSERT INTO patients (name, contact) VALUES (?, ?)", register)
+        build_seconds, picker = timed(db.patient_picker, repeat=1)
+        rows = db.conn.execute("SELECT id, name, contact FROM patients").fetchall()
+        tracemalloc.start()
+        copy = PatientPicker(rows)
+        trie_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del copy
+        print(f"{patients} patients, picker built in {build_seconds:.1f} s, {trie_bytes / 2 ** 20:.0f} MiB")
+
+        picker_seconds, _ = timed(lambda: [db.pick_patients(text) for text in keystrokes])
+        trie_seconds, _ = timed(lambda: [picker.search(text) for text in keystrokes])
+        sql_seconds, _ = timed(lambda: [db.search_patients(text, 20, fuzzy=False) for text in keystrokes[:50]],
+                               repeat=1)
+        print(f"per keystroke: trie {trie_seconds / probes * 1e6:.0f} µs, with the generation check "
+              f"{picker_seconds / probes * 1e6:.0f} µs, SQL search {sql_seconds / 50 * 1000:.0f} ms")
+
+        # Edits through the repository move the trie along instead of rebuilding it
+        renamed = rng.sample(range(1, patients + 1), edits)
+        edit_seconds, _ = timed(lambda: [
+            db.update_patient(patient_id, f"Renamed Patient {patient_id}", f"07{patient_id:08d}", None, '')
+            for patient_id in renamed
+        ], repeat=1)
+        rebuilt = db.patient_picker() is not picker
+        first_match = db.pick_patients(f"renamed patient {renamed[0]}")
+        # The trie's share of each rename, applying the same rows again
+        apply_seconds, _ = timed(lambda: [
+            picker.apply(picker.generation, upserts=[(patient_id, f"Renamed Patient {patient_id}", f"07{patient_id:08d}")])
+            for patient_id in renamed
+        ], repeat=1)
+        print(f"{edits} renames: {edit_seconds / edits * 1000:.2f} ms each with the database write, of which the "
+              f"trie {apply_seconds / edits * 1e6:.0f} µs; picker {'rebuilt' if rebuilt else 'kept'}, "
+              f"finds the new name: {first_match[:1] == [(renamed[0], f'Renamed Patient {renamed[0]}', f'07{renamed[0]:08d}')]}")
+
+def bench_reminders(appointments=50_000, batch_size=500):
+    """Time a reminder run over a day of appointments, its peak memory and the app writes it holds up"""
+    import tracemalloc
+
+    from reminders import ReminderScheduler
+
+    with scratch_database() as db:
+        seed_ledger(db, rows=0, patients=5_000)
+        now = datetime.now().replace(microsecond=0)
+        with db.conn:
+            db.conn.executemany(
+                "INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to) VALUES (?, ?, ?, ?)",
+                (
+                    (i % 5_000 + 1, f"{now + timedelta(seconds=1 + i * 86_000 // appointments)}", 'benchmark',
+                     1 if i % 3 else None)
+                    for i in range(appointments)
+                )
+            )
+        scheduler = ReminderScheduler(db.db_path, batch_size=batch_size)
+
+        # The app keeps writing on its own connection during the run
+        stop, write_latencies = threading.Event(), []
+
+        def app_writes():
+            while not stop.is_set():
+                started = time.perf_counter()
+                db.add_appointment(1, now.date(), now.time(), 'walk-in')
+                write_latencies.append(time.perf_counter() - started)
+                time.sleep(0.005)
+
+        writer = threading.Thread(target=app_writes)
+        writer.start()
+        tracemalloc.start()
+        result = scheduler.run(now)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stop.set()
+        writer.join()
+        print(f"{appointments} due appointments: queued {result['queued']} reminders in {result['batches']} batches, "
+              f"{result['seconds']:.2f} s (traced), peak {peak_bytes / 2 ** 20:.1f} MiB")
+        print(f"app writes during the run: {len(write_latencies)}, "
+              f"p99 {percentile(write_latencies, 99) * 1000:.0f} ms, max {max(write_latencies) * 1000:.0f} ms")
+        rerun = scheduler.run(now)
+        print(f"rerun: queued {rerun['queued']} in {rerun['seconds'] * 1000:.0f} ms")
+
+
+def bench_series(appointments=100_000, occurrences=52, runs=5):
+    """Time booking and rescheduling a weekly series against one visit and one check at a time"""
+    with scratch_database() as db:
+        seed_ledger(db, rows=0, patients=5_000)
+        start = datetime.combine(date.today(), clock_time(8, 0))
+        with db.conn:
+            db.conn.executemany(
+                "INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to) VALUES (?, ?, ?, ?)",
+                (
+                    (i % 5_000 + 1, f"{start + timedelta(minutes=30 * (i % 20) + 1440 * (i // 20 % 400))}",
+                     'benchmark', i % 20 + 1)
+                    for i in range(appointments)
+                )
+            )
+        # 06:00 is free for every staff member and patient
+        first_day = date.today() + timedelta(days=1)
+
+        def one_by_one(patient_id):
+            for week in range(occurrences):
+                day = first_day + timedelta(weeks=week)
+                db.appointment_conflicts([(f"{day} 06:00:00", patient_id, 1)])
+                db.add_appointment(patient_id, day, clock_time(6, 0), 'physiotherapy', 1)
+
+        def reschedule_one_by_one(series_id):
+            rows = db.conn.execute(
+                "SELECT id, appointment_date FROM appointments WHERE series_id = ? AND appointment_date >= ?",
+                (series_id, str(first_day + timedelta(weeks=occurrences // 2)))
+            ).fetchall()
+            for appointment_id, appointment_date in rows:
+                db.appointment_conflicts([(appointment_date, 2, 8)], exclude_series=series_id)
+                with db.conn:
+                    db.conn.execute("UPDATE appointments SET assigned_to = 8 WHERE id = ?", (appointment_id,))
+
+        loop_seconds = timed(lambda: one_by_one(1), repeat=1)[0]
+        series_ids = []
+        series_seconds = timed(lambda: series_ids.append(db.add_appointment_series(
+            len(series_ids) + 2, first_day, clock_time(6, 0), 'physiotherapy', len(series_ids) + 3,
+            'weekly', occurrences)), repeat=runs)[0]
+        print(f"book {occurrences} weekly visits: one by one {loop_seconds * 1000:.1f} ms, "
+              f"as a series {series_seconds * 1000:.1f} ms")
+
+        loop_seconds = timed(lambda: reschedule_one_by_one(series_ids[0]), repeat=1)[0]
+        update_seconds = timed(lambda: db.update_appointment_series(
+            series_ids[1], first_day + timedelta(weeks=occurrences // 2), clock_time(6, 0), assigned_to=9
+        ), repeat=1)[0]
+        print(f"change staff on this and following ({occurrences - occurrences // 2} visits): "
+              f"one by one {loop_seconds * 1000:.1f} ms, one UPDATE {update_seconds * 1000:.1f} ms")
+
+
+def bench_status(appointments=200_000, per_day=250):
+    """Time closing out a day's appointments against one edit per row, and the no-show analytics"""
+    with scratch_database() as db:
+        seed_ledger(db, rows=0, patients=5_000)
+        start = datetime.combine(date.today() - timedelta(days=appointments // per_day), clock_time(8, 0))
+        with db.conn:
+            db.conn.executemany(
+                "INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to) VALUES (?, ?, ?, ?)",
+                (
+                    (i % 5_000 + 1, f"{start + timedelta(days=i // per_day, minutes=2 * (i % per_day))}",
+                     'benchmark', i % 20 + 1)
+                    for i in range(appointments)
+                )
+            )
+        days = [(start + timedelta(days=day)).date() for day in range(appointments // per_day)]
+
+        def one_by_one(day):
+            for (appointment_id,) in db.conn.execute(
+                "SELECT id FROM appointments WHERE appointment_date >= ? AND appointment_date < DATE(?, '+1 day') "
+                "AND status = 'Scheduled'", (str(day), str(day))
+            ).fetchall():
+                with db.conn:
+                    db.conn.execute("UPDATE appointments SET status = 'Completed' WHERE id = ?", (appointment_id,))
+
+        loop_seconds = timed(lambda: one_by_one(days[0]), repeat=1)[0]
+        started = time.perf_counter()
+        for number, day in enumerate(days[1:], 1):
+            # Every seventh of each day's appointments missed, the rest seen
+            db.set_appointment_status('No-show', day=day, staff_id=number % 7 + 1)
+            db.set_appointment_status('Completed', day=day)
+        bulk_seconds = (time.perf_counter() - started) / (2 * (len(days) - 1))
+        print(f"close out a day of {per_day} appointments: one by one {loop_seconds * 1000:.1f} ms, "
+              f"one UPDATE {bulk_seconds * 1000:.1f} ms")
+
+        history = db.conn.execute("SELECT COUNT(*) FROM appointment_status_history").fetchone()[0]
+        for by in ('doctor', 'weekday'):
+            seconds, rates = timed(lambda: db.get_no_show_rates(days[0], days[-1], by))
+            print(f"no-show rates per {by} over {history} status changes: {seconds * 1000:.0f} ms, "
+                  f"{len(rates)} rows, overall {rates['no_shows'].sum() / rates['appointments'].sum():.1%}")
+
+
+# Cold-start budgets in seconds, checked by ``python benchmarks.py startup``
+STARTUP_IMPORT_BUDGET = 1.0
+STARTUP_SIDEBAR_BUDGET = 2.0
+
+# Runs in a fresh interpreter so nothing is already imported
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - started
+
+from streamlit.testing.v1 import AppTest
+app_test = AppTest.from_string(
+    "from main import MedicalPracticeApp\\nMedicalPracticeApp().render_sidebar()"
+)
+started = time.perf_counter()
+app_test.run()
+sidebar_seconds = time.perf_counter() - started
+
+print(json.dumps({
+    'import_seconds': import_seconds,
+    'sidebar_seconds': sidebar_seconds,
+    'errors': [str(e.value) for e in app_test.exception],
+    'pandas_loaded': 'pandas' in sys.modules,
+    'plotly_loaded': 'plotly.express' in sys.modules,
+}))
+"""
+
+
+def bench_timeline(rows=200_000, patients=200, probes=50):
+    """Compare a patient's first timeline page, and later ones, with the three per-section queries it replaces"""
+    with scratch_database() as db:
+        seed_ledger(db, rows=rows, patients=patients)
+        patient_ids = [row[0] for row in db.conn.execute("SELECT id FROM patients")]
+        with db.conn:
+            db.conn.executemany(
+                "INSERT INTO medical_records (patient_id, doctor_id, visit_date, diagnosis) VALUES (?, 1, ?, 'benchmark')",
+                ((random.choice(patient_ids), f"{date.today() - timedelta(days=random.randrange(1000))}")
+                 for _ in range(rows // 4))
+            )
+            db.conn.executemany(
+                "INSERT INTO appointments (patient_id, appointment_date, reason) VALUES (?, ?, 'benchmark')",
+                ((random.choice(patient_ids), f"{datetime.now() - timedelta(minutes=random.randrange(1_500_000))}"[:19])
+                 for _ in range(rows // 4))
+            )
+        # Older payments and appointments move to the archive, which the timeline also reads
+        db.archive_old_records(horizon_days=365)
+        probe_ids = random.sample(patient_ids, probes)
+
+        def sections():
+            # The records section, the appointments page and the finance search a doctor went through
+            for patient_id in probe_ids:
+                db.get_medical_records(patient_id)
+                db.get_appointments_range(date.today() - timedelta(days=3 * 365), date.today())
+                db.get_financial_records(patient_id=patient_id, order_by='date', descending=True)
+
+        def first_pages():
+            return [db.get_patient_timeline(patient_id) for patient_id in probe_ids]
+
+        per_patient = (rows + rows // 2) // patients
+        sections_seconds = timed(sections, repeat=1)[0] / probes
+        first_seconds, pages = timed(first_pages, repeat=3)
+        cursors = [timeline_cursor(page) for page in pages]
+        later_seconds = timed(lambda: [
+            db.get_patient_timeline(patient_id, cursor) for patient_id, cursor in zip(probe_ids, cursors)
+        ], repeat=3)[0]
+        print(f"patient history (~{per_patient} entries each): three section queries "
+              f"{sections_seconds * 1000:.1f} ms, first timeline page {first_seconds / probes * 1000:.2f} ms, "
+              f"next page {later_seconds / probes * 1000:.2f} ms")
+
+
+def bench_startup(runs=3):
+    """Measure cold import time and time to first sidebar render, and enforce the startup budget"""
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, '-c', STARTUP_PROBE],
+                cwd=workdir,
+                env={**os.environ, 'PYTHONPATH': repo_dir},
+                capture_output=True,
+                text=True,
+                check=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    import_seconds = min(result['import_seconds'] for result in results)
+    sidebar_seconds = min(result['import_seconds'] + result['sidebar_seconds'] for result in results)
+    last = results[-1]
+    print(f"import main             {import_seconds * 1000:>8.0f} ms   (budget {STARTUP_IMPORT_BUDGET * 1000:.0f} ms)")
+    print(f"first sidebar render    {sidebar_seconds * 1000:>8.0f} ms   (budget {STARTUP_SIDEBAR_BUDGET * 1000:.0f} ms)")
+    print(f"pandas loaded: {last['pandas_loaded']}   plotly loaded: {last['plotly_loaded']}")
+
+    failures = []
+    if import_seconds > STARTUP_IMPORT_BUDGET:
+        failures.append("import time over budget")
+    if sidebar_seconds > STARTUP_SIDEBAR_BUDGET:
+        failures.append("first sidebar render over budget")
+    if last['plotly_loaded']:
+        failures.append("plotly imported before any chart was rendered")
+    if last['errors']:
+        failures.append(f"sidebar render raised: {last['errors']}")
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+def bench_backup(rows=200_000, probes=500):
+    """Time a backup and compare live write and read latency with and without one running"""
+    with scratch_database() as db:
+        seed_ledger(db, rows=rows)
+        backup_dir = os.path.join(os.path.dirname(db.db_path), 'backups')
+        today = date.today()
+
+        def probe_latencies(keep_going):
+            writes, reads = [], []
+            while keep_going(len(writes)):
+                started = time.perf_counter()
+                db.record_income(today, 10.0, 'benchmark', 1)
+                writes.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                db.get_counters()
+                db.get_recent_patients(5)
+                reads.append(time.perf_counter() - started)
+            return writes, reads
+
+        idle_writes, idle_reads = probe_latencies(lambda done: done < probes)
+
+        print(
+            f"idle        write p50 {percentile(idle_writes, 50) * 1000:>6.2f} ms  p99 {percentile(idle_writes, 99) * 1000:>6.2f} ms   "
+            f"read p50 {percentile(idle_reads, 50) * 1000:>6.2f} ms  p99 {percentile(idle_reads, 99) * 1000:>6.2f} ms"
+        )
+
+        # From a separate connection, as the CLI does, and from the app's own connection
+        for title, source_conn in (('cli backup', None), ('app backup', db.conn)):
+            backups = BackupManager(db.db_path, db.archive_path, backup_dir, source_conn=source_conn)
+            manifests = []
+            backup_thread = threading.Thread(target=lambda: manifests.append(backups.create()))
+            backup_thread.start()
+            # Probe for exactly as long as the backup runs
+            writes, reads = probe_latencies(lambda done: backup_thread.is_alive())
+            backup_thread.join()
+
+            files = manifests[0]['files'].values()
+            print(
+                f"{title:<11} write p50 {percentile(writes, 50) * 1000:>6.2f} ms  p99 {percentile(writes, 99) * 1000:>6.2f} ms   "
+                f"read p50 {percentile(reads, 50) * 1000:>6.2f} ms  p99 {percentile(reads, 99) * 1000:>6.2f} ms   "
+                f"{manifests[0]['duration_seconds'] * 1000:.0f} ms total, "
+                f"{sum(f['copy_seconds'] for f in files) * 1000:.0f} ms copying, "
+                f"{sum(f['verify_seconds'] for f in files) * 1000:.0f} ms verifying, "
+                f"{sum(f['restarts'] for f in files)} restarts, "
+                f"{sum(f['size'] for f in files) / 2 ** 20:.1f} -> {sum(f['compressed_size'] for f in files) / 2 ** 20:.1f} MiB"
+            )
+
+
+# Pages with a list view, and the button that has to be pressed before the list shows
+LIST_PAGES = [
+    ("🏥 Patient Management", None),
+    ("👨‍⚕️ Staff Management", None),
+    ("📅 Appointments", None),
+    ("💰 Financial Records", "Search Records"),
+]
+
+
+def bench_render(rows=1_000, runs=3):
+    """Time a rerun of every list page with `rows` rows listed, and count the widgets it creates"""
+    from streamlit.testing.v1 import AppTest
+
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # The app opens clinic.db in the working directory
+        os.chdir(workdir)
+        try:
+            db = DatabaseManager()
+            seed_ledger(db, rows=rows, days=7, patients=rows, doctors=rows // 10)
+            today = date.today().strftime('%Y-%m-%d')
+            with db.conn:
+                db.conn.executemany(
+                    "INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to) VALUES (?, ?, ?, ?)",
+                    ((i % rows + 1, f"{today} {9 + i % 8:02d}:00:00", 'benchmark', 1) for i in range(rows))
+                )
+            db.close()
+
+            print(f"{rows} rows per list")
+            for page, button in LIST_PAGES:
+                app_test = AppTest.from_file(app_path, default_timeout=120)
+                app_test.run()
+                app_test.sidebar.radio[0].set_value(page).run()
+                if button:
+                    next(b for b in app_test.button if b.label == button).click().run()
+                seconds, _ = timed(app_test.run, repeat=runs)
+                if app_test.exception:
+                    print(f"{page}: {[e.value for e in app_test.exception]}")
+                    continue
+                print(f"{page:<24} rerun {seconds * 1000:>8.0f} ms   buttons {len(app_test.button):>5}")
+        finally:
+            os.chdir(previous_dir)
+
+
+def bench_sharding(rows=200_000, branches=4):
+    """Compare cross-branch reads on one database, and on branches read in parallel and one by one"""
+    end = date.today()
+    start = end - timedelta(days=365)
+    with scratch_database() as single, tempfile.TemporaryDirectory() as workdir:
+        seed_ledger(single, rows=rows)
+        paths = {branch: os.path.join(workdir, f'branch{branch}.db') for branch in range(branches)}
+        parallel = ShardedRepository(open_branches(paths), directory_path=os.path.join(workdir, 'directory.db'))
+        for branch in parallel.branches.values():
+            seed_ledger(branch, rows=rows // branches, patients=2_000 // branches)
+        # Same branch connections, read one branch after another
+        sequential = ShardedRepository(parallel.branches, directory_path=os.path.join(workdir, 'directory.db'),
+                                       max_workers=1)
+        cases = [
+            ('counters', lambda repo: repo.get_counters(end)),
+            ('income buckets', lambda repo: repo.get_income_buckets(start, end)),
+            ('breakdown patient', lambda repo: repo.get_income_breakdown(start, end, 'patient')),
+            ('breakdown staff', lambda repo: repo.get_income_breakdown(start, end, 'staff')),
+            ('rolling 7/30d', lambda repo: repo.analytics().rolling_revenue(start, end)),
+            ('month over month', lambda repo: repo.analytics().month_over_month(start, end)),
+            ('revenue/doctor', lambda repo: repo.analytics().revenue_per_doctor(start, end)),
+            ('patients page', lambda repo: repo.get_patients(limit=50, offset=500)),
+        ]
+        print(f"{rows} finance rows: one database vs {branches} branches of {rows // branches}")
+        print(f"{'read':<18}{'single':>10}{'parallel':>10}{'sequential':>12}")
+        for title, read in cases:
+            timings = [timed(lambda: read(repo))[0] * 1000 for repo in (single, parallel, sequential)]
+            print(f"{title:<18}{timings[0]:>8.1f}ms{timings[1]:>8.1f}ms{timings[2]:>10.1f}ms")
+        sequential._pool.shutdown()
+        parallel.close()
+
+
+def bench_api(seconds=5, clients=8, rows=50_000):
+    """Load-test the JSON API without the result cache, with it, and with clients sending ETags"""
+    import http.client
+    import socket
+    from api import CACHE_ENTRIES
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    end = date.today()
+    paths = (
+        [f'/patients?limit=50&offset={page * 50}' for page in range(10)]
+        + [f'/appointments?date={(end + timedelta(days=day)).strftime("%Y-%m-%d")}' for day in range(5)]
+        + [f'/finances?start={(end - timedelta(days=30)).strftime("%Y-%m-%d")}&end={end.strftime("%Y-%m-%d")}'
+           f'&limit=100&offset={page * 100}' for page in range(5)]
+        + ['/counters', '/staff', '/patients?search=Patient%201&limit=20']
+    )
+    with tempfile.TemporaryDirectory() as workdir:
+        db = DatabaseManager(os.path.join(workdir, 'clinic.db'), os.path.join(workdir, 'clinic_archive.db'))
+        seed_ledger(db, rows=rows)
+        db.close()
+        print(f"{rows} finance rows, {clients} clients for {seconds}s each, {len(paths)} distinct GETs")
+        for title, cache_entries, conditional in (
+            ('no cache', 0, False), ('result cache', CACHE_ENTRIES, False), ('cache + ETag', CACHE_ENTRIES, True)
+        ):
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            server = subprocess.Popen(
+                [sys.executable, os.path.join(repo_dir, 'api.py'), '--port', str(port),
+                 '--cache-entries', str(cache_entries)],
+                cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                while True:
+                    try:
+                        socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                        break
+                    except OSError:
+                        time.sleep(0.05)
+                latencies, statuses, sizes = [], [], []
+                deadline = time.perf_counter() + seconds
+
+                def client(seed):
+                    rng = random.Random(seed)
+                    conn = http.client.HTTPConnection('127.0.0.1', port)
+                    etags = {}
+                    while time.perf_counter() < deadline:
+                        path = rng.choice(paths)
+                        headers = {'Accept-Encoding': 'gzip'}
+                        if conditional and path in etags:
+                            headers['If-None-Match'] = etags[path]
+                        started = time.perf_counter()
+                        conn.request('GET', path, headers=headers)
+                        response = conn.getresponse()
+                        body = response.read()
+                        latencies.append(time.perf_counter() - started)
+                        statuses.append(response.status)
+                        sizes.append(len(body))
+                        etags[path] = response.getheader('ETag')
+                    conn.close()
+
+                threads = [threading.Thread(target=client, args=(seed,)) for seed in range(clients)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                server.terminate()
+                server.wait()
+            print(
+                f"{title:<14} {len(latencies) / seconds:>7.0f} req/s   "
+                f"p50 {percentile(latencies, 50) * 1000:>6.1f} ms   p99 {percentile(latencies, 99) * 1000:>6.1f} ms   "
+                f"304s {statuses.count(304) / len(statuses):>4.0%}   avg body {sum(sizes) / len(sizes):>6.0f} B"
+            )
+
+
+BENCHMARKS = {
+    'analytics': bench_analytics,
+    'api': bench_api,
+    'backup': bench_backup,
+    'dedup': bench_dedup,
+    'deletes': bench_deletes,
+    'finance_search': bench_finance_search,
+    'frames': bench_frames,
+    'fuzzy_search': bench_fuzzy_search,
+    'picker': bench_picker,
+    'reminders': bench_reminders,
+    'render': bench_render,
+    'series': bench_series,
+    'sharding': bench_sharding,
+    'startup': bench_startup,
+    'status': bench_status,
+    'timeline': bench_timeline,
+    'writes': bench_writes,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nani Health Clinic performance benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
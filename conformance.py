@@ -0,0 +1,396 @@
+"""
+Conformance suite for the clinic storage backends.
+
+Runs one scenario through the ClinicRepository interface on SQLite, on the
+sharded SQLite router and, when a server is given, on PostgreSQL; every read
+must return the same rows on each. The sharded router also runs a directory
+scenario: a patient registered at a second branch they visit.
+
+    python conformance.py
+    python conformance.py --postgres postgresql://clinic@localhost/clinic --bench
+
+The PostgreSQL run works in a throwaway schema that is dropped afterwards.
+"""
+import argparse
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, timedelta, time as clock_time
+
+import pandas as pd
+
+from benchmarks import scratch_database, timed
+from recurrence import SchedulingConflict
+from repository import ConstraintViolation, InvalidValue, timeline_cursor
+
+# Columns whose values depend on when the scenario ran rather than on the backend
+VOLATILE_COLUMNS = {'created_at'}
+
+# Reads whose row order is not part of the contract (ties in the ORDER BY)
+UNORDERED = {'patient_metrics', 'medical_records', 'patient_records', 'financial_records',
+             'records_after_delete'}
+
+
+@contextmanager
+def postgres_repository(dsn):
+    """Yield a PostgresRepository on a fresh schema, dropping the schema afterwards"""
+    from postgres_backend import PostgresRepository
+
+    schema = f"conformance_{uuid.uuid4().hex[:8]}"
+    repo = PostgresRepository(dsn, schema=schema)
+    try:
+        yield repo
+    finally:
+        repo.conn.execute(f"DROP SCHEMA {schema} CASCADE")
+        repo.conn.close()
+
+
+@contextmanager
+def sharded_repository(branches=2):
+    """Yield a ShardedRepository over fresh branch databases; all but the default branch stay empty"""
+    from sharding import ShardedRepository, open_branches
+
+    with tempfile.TemporaryDirectory() as workdir:
+        repo = ShardedRepository(
+            open_branches({branch: os.path.join(workdir, f'branch{branch}.db') for branch in range(branches)}),
+            directory_path=os.path.join(workdir, 'directory.db')
+        )
+        try:
+            yield repo
+        finally:
+            repo.close()
+
+
+def open_transaction(repo):
+    """Return whether the calling thread's connections to a repository are left inside a transaction"""
+    if hasattr(repo, 'branches'):
+        return repo.directory.in_transaction or any(map(open_transaction, repo.branches.values()))
+    if isinstance(repo.conn, sqlite3.Connection):
+        return repo.conn.in_transaction
+    return repo.conn.info.transaction_status.name != 'IDLE'
+
+
+def refused_writes(repo, today, staff, nurse_role):
+    """Make writes the database must refuse and return, for each, the error raised and whether a transaction was left open"""
+    writes = {
+        'patient_unknown_doctor': lambda: repo.add_patient('Orphan', '0700', None, None, 999999),
+        'user_taken_username': lambda: repo.add_user('nurse0', 'x', 'Nurse Again', nurse_role),
+        'record_unknown_patient': lambda: repo.add_medical_record(999999, staff[0], today, 'Lost', '', ''),
+        'appointment_unknown_patient': lambda: repo.add_appointment(999999, today, clock_time(12, 0), 'Lost'),
+        'payment_unknown_patient': lambda: repo.record_income(today, 10.0, 'Lost', 999999),
+        'payment_text_patient': lambda: repo.record_income(today, 10.0, 'Lost', 'abc'),
+    }
+    outcomes = {}
+    for name, write in writes.items():
+        try:
+            write()
+            outcomes[name] = ('accepted', open_transaction(repo))
+        except (ConstraintViolation, InvalidValue) as e:
+            outcomes[name] = (type(e).__name__, open_transaction(repo))
+    return outcomes
+
+
+def seed(repo, today, patients=40, payments=300):
+    """Load the same staff, patients, records, appointments and payments into a repository"""
+    rng = random.Random(7)
+    roles = repo.get_roles().set_index('role_name')['id']
+    doctors = [
+        repo.add_user(f'doctor{i}', 'x', f'Doctor {chr(65 + i)}', int(roles['doctor']), specialty='General')
+        for i in range(3)
+    ]
+    staff = doctors + [
+        repo.add_user('nurse0', 'x', 'Nurse Ada', int(roles['nurse']), email='ada@clinic.test'),
+        repo.add_user('admin0', 'x', 'Admin Bo', int(roles['admin'])),
+        repo.add_user('desk0', 'x', 'Desk Cy', int(roles['receptionist'])),
+    ]
+    patient_ids = [
+        repo.add_patient(f'{rng.choice(["Ann", "Ben", "Cat", "Dan"])} Patient{i:02d}', f'07{i:08d}',
+                         f'p{i}@mail.test' if i % 3 else None, None, rng.choice(doctors + [None]))
+        for i in range(patients)
+    ]
+    for patient_id in patient_ids[:25]:
+        for _ in range(rng.randint(1, 3)):
+            repo.add_medical_record(patient_id, rng.choice(doctors), today - timedelta(days=rng.randrange(200)),
+                                    'Checkup', 'Rest', '')
+    for _ in range(80):
+        day = today + timedelta(days=rng.randrange(-10, 20))
+        at = clock_time(rng.randrange(8, 17), rng.choice([0, 15, 30, 45]))
+        repo.add_appointment(rng.choice(patient_ids), day, at, 'Consultation', rng.choice(doctors + [None]))
+    for _ in range(payments):
+        repo.record_income(today - timedelta(days=rng.randrange(400)), round(rng.uniform(5, 500), 2), 'Visit',
+                           rng.choice(patient_ids), rng.choice(staff + [None]))
+    return staff, patient_ids
+
+
+def scenario(repo, today):
+    """Seed a repository, exercise every interface method and return the results by name"""
+    staff, patient_ids = seed(repo, today)
+    monday = today - timedelta(days=today.weekday())
+    analytics = repo.analytics()
+    results = {
+        'users': repo.get_users(),
+        'users_page': repo.get_users(limit=3, offset=2),
+        'roles': repo.get_roles(),
+        'search_users': repo.search_users('doc'),
+        'patients_page': repo.get_patients(limit=10, offset=5),
+        'recent_patients': repo.get_recent_patients(),
+        'search_patients': repo.search_patients('ann', limit=5),
+        'fuzzy_patients': repo.search_patients('Patinet07'),
+        'fuzzy_patients_page': repo.search_patients('ben patiant', limit=3, offset=1),
+        'fuzzy_distances': repo.fuzzy_search_patients('Can Patient1'),
+        'fuzzy_users': repo.search_users('Docter B'),
+        'fuzzy_too_short': repo.search_patients('xq'),
+        'pick_patients': repo.pick_patients('patient0'),
+        'pick_patients_phone': repo.pick_patients('070000001'),
+        'pick_patients_first': repo.pick_patients('', limit=5),
+        'medical_records': repo.get_medical_records(),
+        'patient_records': repo.get_medical_records(patient_ids[0]),
+        'medical_records_page': repo.get_medical_records(limit=4, offset=3),
+        'timeline': repo.get_patient_timeline(patient_ids[1], limit=100),
+        'timeline_first_page': repo.get_patient_timeline(patient_ids[1], limit=4),
+        'appointments_today': repo.get_appointments(date=today.strftime('%Y-%m-%d')),
+        'appointments_staff': repo.get_appointments(staff_id=staff[0], limit=7, offset=3),
+        'appointments_range': repo.get_appointments_range(monday, monday + timedelta(days=13)),
+        'appointments_range_page': repo.get_appointments_range(monday, monday + timedelta(days=13), limit=5, offset=2),
+        'week_calendar': repo.get_week_calendar(monday),
+        'week_calendar_staff': repo.get_week_calendar(monday, staff_id=staff[1]),
+        'daily_summary': repo.get_daily_appointment_summary(
+            today.replace(day=1).strftime('%Y-%m-%d'), (today + timedelta(days=31)).strftime('%Y-%m-%d')),
+        'financial_records': repo.get_financial_records(today - timedelta(days=30), today),
+        'finance_patient': repo.get_financial_records(patient_id=patient_ids[1], order_by='date', descending=True),
+        'finance_staff_amounts': repo.get_financial_records(
+            today - timedelta(days=200), today, recorded_by_id=staff[3], min_amount=50, max_amount=300,
+            order_by='amount'),
+        'finance_page': repo.get_financial_records(
+            today - timedelta(days=365), today, order_by='amount', descending=True, limit=15, offset=10),
+        'finance_patient_page': repo.get_financial_records(order_by='patient', limit=20, offset=5),
+        'finance_empty_page': repo.get_financial_records(min_amount=1000, limit=10),
+        'counters': repo.get_counters(today),
+        'breakdown_patient': repo.get_income_breakdown(today - timedelta(days=90), today, 'patient', 5),
+        'breakdown_staff': repo.get_income_breakdown(today - timedelta(days=90), today, 'staff'),
+        'rolling_revenue': analytics.rolling_revenue(today - timedelta(days=60), today),
+        'month_over_month': analytics.month_over_month(today - timedelta(days=365), today),
+        'revenue_per_doctor': analytics.revenue_per_doctor(today - timedelta(days=365), today),
+    }
+    results['timeline_next_page'] = repo.get_patient_timeline(
+        patient_ids[1], timeline_cursor(results['timeline_first_page']), limit=4)
+    for span in (30, 120, 400, 4000):
+        results[f'income_buckets_{span}'] = repo.get_income_buckets(today - timedelta(days=span - 1), today)
+    repo.refresh_patient_metrics()
+    results['patient_metrics'] = repo.get_patient_metrics()
+
+    repo.update_patient(patient_ids[4], 'Renamed Patient04', '0799999999', 'renamed@mail.test', 'Asthma', staff[1])
+    results['patient_after_update'] = repo.search_patients('renamed')
+    results['pick_after_update'] = repo.pick_patients('renamed')
+
+    series_start = today + timedelta(days=1)
+    series_id = repo.add_appointment_series(patient_ids[5], series_start, clock_time(7, 0), 'Physiotherapy',
+                                            staff[0], 'weekly', 6)
+    results['series_moved'] = repo.update_appointment_series(
+        series_id, series_start + timedelta(days=14), clock_time(7, 30), assigned_to=staff[1])
+    results['series_cancelled'] = repo.cancel_appointment_series(series_id, series_start + timedelta(days=28))
+    try:
+        repo.add_appointment_series(patient_ids[6], series_start, clock_time(7, 15), 'Antenatal', staff[0], 'weekly', 4)
+        results['series_clash'] = []
+    except SchedulingConflict as e:
+        results['series_clash'] = e.conflicts
+    results['series_appointments'] = repo.get_appointments_range(series_start, series_start + timedelta(days=42))
+
+    past = repo.get_appointments_range(today - timedelta(days=10), today - timedelta(days=1))['id'].tolist()
+    results['status_selected'] = repo.set_appointment_status('No-show', appointment_ids=past[::3], from_status=None)
+    results['status_day_staff'] = repo.set_appointment_status('Completed', day=today, staff_id=staff[0])
+    results['status_remaining'] = [
+        repo.set_appointment_status('Completed', day=today - timedelta(days=days)) for days in range(1, 11)
+    ]
+    results['status_reverted'] = repo.set_appointment_status('Completed', appointment_ids=past[:2], from_status='No-show')
+    results['no_shows_doctor'] = repo.get_no_show_rates(today - timedelta(days=10), today)
+    results['no_shows_weekday'] = repo.get_no_show_rates(today - timedelta(days=10), today, by='weekday')
+
+    charted = next(patient for patient in patient_ids[3:] if len(repo.get_medical_records(patient)) > 1)
+    records = repo.get_medical_records(charted)['id'].tolist()
+    repo.update_medical_record(records[0], charted, staff[1], today - timedelta(days=1), 'Flu', 'Fluids', 'Review')
+    results['records_after_update'] = repo.get_medical_records(charted)
+    results['delete_medical_records'] = repo.delete_medical_records(records[1:])
+    nurse_role = int(repo.get_roles().set_index('role_name')['id']['nurse'])
+    repo.update_user(staff[2], 'doctor2', '', 'Doctor Zed', nurse_role, 'zed@clinic.test', '0700', 'Surgery')
+    results['users_after_update'] = repo.get_users()
+    results['search_after_update'] = repo.search_users('zed')
+    moved = int(repo.get_appointments(date=today.strftime('%Y-%m-%d'))['id'].iloc[0])
+    repo.update_appointment(moved, patient_ids[8], today + timedelta(days=2), clock_time(16, 45), 'Follow-up',
+                            'Cancelled', staff[2])
+    results['appointment_after_update'] = repo.get_appointments(date=(today + timedelta(days=2)).strftime('%Y-%m-%d'))
+    payment = int(repo.get_financial_records(patient_id=patient_ids[8])['id'].iloc[0])
+    repo.update_financial_record(payment, today, 123.45, 'Corrected', patient_ids[8], staff[3])
+    results['finance_after_update'] = repo.get_financial_records(patient_id=patient_ids[8])
+    results['counters_after_update'] = repo.get_counters(today)
+
+    doomed_appointments = repo.get_appointments(limit=5)['id'].tolist()
+    doomed_payments = repo.get_financial_records()['id'].tolist()[:10]
+    results['delete_users'] = repo.delete_users([staff[-1], staff[-1], 9999])
+    results['delete_appointments'] = repo.delete_appointments(doomed_appointments)
+    results['delete_financial_records'] = repo.delete_financial_records(doomed_payments)
+    results['delete_patients'] = repo.delete_patients(patient_ids[:3])
+    results['users_after_delete'] = repo.get_users()
+    results['patients_after_delete'] = repo.get_patients()
+    results['pick_after_delete'] = repo.pick_patients('patient0')
+    results['records_after_delete'] = repo.get_medical_records()
+    results['counters_after_delete'] = repo.get_counters(today)
+    results['timeline_after_delete'] = repo.get_patient_timeline(patient_ids[1])
+    results['no_shows_after_delete'] = repo.get_no_show_rates(today - timedelta(days=10), today)
+    # The series' patient: their series and its appointments go too
+    results['delete_series_patient'] = repo.delete_patients([patient_ids[5]])
+    results['series_after_delete'] = repo.get_appointments_range(series_start, series_start + timedelta(days=42))
+    repo.refresh_patient_metrics()
+    results['patient_metrics_after_delete'] = repo.get_patient_metrics(limit=10)
+
+    # A namesake of Doctor A ranks on their own takings, not on the two doctors' together
+    namesake = repo.add_user('doctor0b', 'x', 'Doctor A', nurse_role)
+    repo.record_income(today, 77.0, 'Namesake', patient_ids[8], namesake)
+    results['breakdown_staff_namesakes'] = repo.get_income_breakdown(today - timedelta(days=90), today, 'staff')
+
+    # Last, as refused inserts still use up Postgres sequence values. Made on a worker thread, as the API's pool
+    # threads make them; a refused write that left its transaction open would lock out the write after it
+    with ThreadPoolExecutor(max_workers=1) as worker:
+        results['refused_writes'] = worker.submit(refused_writes, repo, today, staff, nurse_role).result()
+    repo.record_income(today, 1.0, 'After refusals', patient_ids[8])
+    results['counters_after_refused'] = repo.get_counters(today)
+    return results
+
+
+def directory_scenario(repo, today):
+    """Register a patient at a second branch through the global directory and return the checks that failed"""
+    from sharding import ShardedRepository
+
+    home, visited = list(repo.branches)[:2]
+    failed = []
+
+    def check(name, passed):
+        if not passed:
+            failed.append(name)
+
+    patient_id = repo.add_patient('Wanda Traveller', '0755500000', 'wanda@mail.test', 'Asthma', branch_id=home)
+    found = repo.find_patients('traveller')
+    check('listed at home', found[['branches', 'patient_ids']].values.tolist() == [[str(home), str(patient_id)]])
+
+    visit_id = repo.register_visit(patient_id, visited)
+    check('registered at visited branch', ShardedRepository.branch_id_of(visit_id) == visited)
+    check('registering again keeps one registration', repo.register_visit(patient_id, visited) == visit_id)
+    check('found at both branches', repo.find_patients('0755500000')[['branches', 'patient_ids']].values.tolist()
+          == [[f'{home},{visited}', f'{patient_id},{visit_id}']])
+    registrations = [[home, patient_id], [visited, visit_id]]
+    check('linked from home', repo.patient_branches(patient_id).values.tolist() == registrations)
+    check('linked from visit', repo.patient_branches(visit_id).values.tolist() == registrations)
+
+    # The visit is recorded under the visited branch's registration
+    repo.record_income(today, 80.0, 'Walk-in visit', visit_id)
+    check('visit recorded', repo.get_financial_records(patient_id=visit_id)['amount'].tolist() == [80.0])
+    check('home history apart', repo.get_financial_records(patient_id=patient_id).empty)
+
+    repo.update_patient(visit_id, 'Wanda Settled', '0755500000', 'wanda@mail.test', 'Asthma')
+    check('renamed in directory', repo.find_patients('settled')['directory_id'].tolist()
+          == found['directory_id'].tolist())
+    repo.delete_patients([visit_id])
+    check('unlinked on delete', repo.patient_branches(patient_id).values.tolist() == registrations[:1])
+    try:
+        repo.register_visit(visit_id, home)
+        check('unknown patient refused', False)
+    except KeyError:
+        pass
+    return failed
+
+
+def normalize(value):
+    """Reduce a result to plain comparable rows: no volatile columns, rounded numbers, None for NULL"""
+    if hasattr(value, 'columns'):
+        frame = value.drop(columns=[column for column in value.columns if column in VOLATILE_COLUMNS])
+        return [list(frame.columns)] + [[normalize(cell) for cell in row] for row in frame.itertuples(index=False)]
+    if isinstance(value, tuple):
+        return [normalize(item) for item in value]
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if hasattr(value, 'item'):
+        value = value.item()
+    if value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(float(value), 6)
+    return value
+
+
+def compare(expected, actual):
+    """Return the names of the reads whose normalized results differ"""
+    mismatches = []
+    for name, value in expected.items():
+        left, right = normalize(value), normalize(actual[name])
+        if name in UNORDERED:
+            left, right = left[:1] + sorted(left[1:], key=repr), right[:1] + sorted(right[1:], key=repr)
+        if left != right:
+            mismatches.append(name)
+    return mismatches
+
+
+def bench(repo, today, rows=2_000):
+    """Time the interface's hot paths on one backend and return seconds per operation"""
+    patient_ids = [repo.add_patient(f'Bench {i}', f'08{i:08d}', None, None) for i in range(200)]
+    write_time, _ = timed(lambda: [
+        repo.record_income(today - timedelta(days=i % 365), 10.0 + i % 90, 'bench', patient_ids[i % 200])
+        for i in range(rows)
+    ], repeat=1)
+    analytics = repo.analytics()
+    year_ago = today - timedelta(days=365)
+    operations = {
+        'record_income': lambda: write_time / rows,
+        'get_patients page': lambda: timed(lambda: repo.get_patients(limit=50, offset=100))[0],
+        'search_patients': lambda: timed(lambda: repo.search_patients('bench 1', limit=50))[0],
+        'get_counters': lambda: timed(lambda: repo.get_counters(today))[0],
+        'get_income_buckets year': lambda: timed(lambda: repo.get_income_buckets(year_ago, today))[0],
+        'get_income_breakdown': lambda: timed(lambda: repo.get_income_breakdown(year_ago, today))[0],
+        'rolling_revenue': lambda: timed(lambda: analytics.rolling_revenue(year_ago, today))[0],
+        'patient_metrics': lambda: timed(lambda: (repo.refresh_patient_metrics(), repo.get_patient_metrics()))[0],
+    }
+    return {name: measure() for name, measure in operations.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nani Health Clinic storage backend conformance")
+    parser.add_argument("--postgres", metavar="DSN", help="Also run against this PostgreSQL server")
+    parser.add_argument("--bench", action="store_true", help="Time the hot paths on each backend afterwards")
+    args = parser.parse_args()
+    today = date.today()
+
+    backends = {'sqlite': scratch_database, 'sharded': sharded_repository}
+    if args.postgres:
+        backends['postgres'] = lambda: postgres_repository(args.postgres)
+
+    results = {}
+    failed = False
+    for name, open_backend in backends.items():
+        with open_backend() as repo:
+            results[name] = scenario(repo, today)
+            print(f"{name}: {len(results[name])} reads")
+            if hasattr(repo, 'register_visit'):
+                directory_failures = directory_scenario(repo, today)
+                failed = failed or bool(directory_failures)
+                print(f"{name} directory: " + (f"FAILED {', '.join(directory_failures)}" if directory_failures else "ok"))
+
+    for name, actual in list(results.items())[1:]:
+        mismatches = compare(results['sqlite'], actual)
+        failed = failed or bool(mismatches)
+        print(f"{name} vs sqlite: " + (f"MISMATCH in {', '.join(mismatches)}" if mismatches else "ok"))
+
+    if args.bench:
+        timings = {}
+        for name, open_backend in backends.items():
+            with open_backend() as repo:
+                timings[name] = bench(repo, today)
+        print(f"\n{'operation':<26}" + ''.join(f"{name:>12}" for name in timings))
+        for operation in next(iter(timings.values())):
+            print(f"{operation:<26}" + ''.join(f"{timings[name][operation] * 1000:>10.2f}ms" for name in timings))
+
+    if failed:
+        raise SystemExit(1)
@@ -1,12 +1,318 @@
+import json
+import os
+import queue
 import sqlite3
-import pandas as pd
-from datetime import datetime
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
+from analytics import FinancialAnalytics
+from dedup import MAX_BLOCK_SIZE, block_keys, cluster_pairs, compare_fingerprints, fingerprint, name_trigrams
+from frames import typed_frame
+from fuzzy import (FUZZY_CANDIDATES, FUZZY_MATCH_LIMIT, FUZZY_MIN_PROBES, FUZZY_PROBE_POSTINGS, closest_names,
+                   order_matches, search_trigrams)
+from lazy_imports import lazy_import
+from picker import PICKER_MATCHES, PatientPicker
+from recurrence import APPOINTMENT_SLOT_MINUTES, SchedulingConflict, series_occurrences
+from repository import APPOINTMENT_STATUSES, TIMELINE_PAGE_SIZE, ClinicRepository, ConstraintViolation, InvalidValue
 
-class DatabaseManager:
-    def __init__(self):
-        """Initialize database connection and create tables if they don't exist"""
-        self.conn = sqlite3.connect('clinic.db', check_same_thread=False)
-        self.create_tables()
+# pandas is only needed once a query result is read, not to connect
+pd = lazy_import('pandas')
+
+# Bumped whenever create_tables changes, so existing databases pick up the change
+SCHEMA_VERSION = 12
+
+# Columns copied between the hot tables and their archive counterparts
+ARCHIVED_COLUMNS = {
+    'finances': ('id', 'date', 'amount', 'description', 'patient_id', 'recorded_by_id',
+                 'transaction_type', 'created_at'),
+    'appointments': ('id', 'patient_id', 'appointment_date', 'reason', 'status',
+                     'assigned_to', 'series_id', 'created_at'),
+}
+
+# Orderings get_financial_records accepts; finances.id breaks ties so pages never overlap
+FINANCE_ORDERINGS = {
+    'date': 'finances.date',
+    'amount': 'finances.amount',
+    'patient': 'patients.name',
+    'id': 'finances.id',
+}
+
+# Date column that decides whether a row is old enough to be archived
+ARCHIVE_DATE_COLUMNS = {
+    'finances': 'date',
+    'appointments': 'appointment_date',
+}
+
+# Per-patient sources merged into the timeline: (kind, table, date column, staff column, and the
+# title, detail, notes, status and amount expressions); visits and payments have no time of day
+TIMELINE_SOURCES = (
+    ('visit', 'main.medical_records', 'visit_date', 'doctor_id',
+     ('entry.diagnosis', 'entry.treatment', 'entry.notes', 'NULL', 'NULL')),
+    ('appointment', 'main.appointments', 'appointment_date', 'assigned_to',
+     ('entry.reason', 'NULL', 'NULL', 'entry.status', 'NULL')),
+    ('appointment', 'archive.appointments', 'appointment_date', 'assigned_to',
+     ('entry.reason', 'NULL', 'NULL', 'entry.status', 'NULL')),
+    ('payment', 'main.finances', 'date', 'recorded_by_id',
+     ('entry.description', 'entry.transaction_type', 'NULL', 'NULL', 'entry.amount')),
+    ('payment', 'archive.finances', 'date', 'recorded_by_id',
+     ('entry.description', 'entry.transaction_type', 'NULL', 'NULL', 'entry.amount')),
+)
+TIMELINE_COLUMNS = ('title', 'detail', 'notes', 'status', 'amount')
+
+# SQL expression mapping a finances date to the first day of its bucket
+INCOME_BUCKETS = {
+    'day': "finances.date",
+    'week': "DATE(finances.date, 'weekday 0', '-6 days')",
+    'month': "strftime('%Y-%m-01', finances.date)",
+    'year': "strftime('%Y-01-01', finances.date)",
+}
+
+# Approximate bucket width in days, used to pick the finest bucket that fits
+BUCKET_DAYS = {'day': 1, 'week': 7, 'month': 30.44, 'year': 365.25}
+
+# Most patients sharing block keys with a new registration that are compared with it
+MAX_DUPLICATE_CANDIDATES = 200
+
+# Pages copied per online-backup step when refreshing the read replica
+REPLICA_PAGES_PER_STEP = 256
+
+# Active staff and doctor membership, evaluated for a NEW or OLD users row
+_STAFF_FLAG = "({row}.active = 1 AND EXISTS (SELECT 1 FROM roles WHERE roles.id = {row}.role_id))"
+_DOCTOR_FLAG = ("({row}.active = 1 AND EXISTS "
+                "(SELECT 1 FROM roles WHERE roles.id = {row}.role_id AND roles.role_name = 'doctor'))")
+
+
+def _bump_counter(key, delta):
+    """Return an upsert statement adding delta to a stats_counters row"""
+    return f'''
+        INSERT INTO stats_counters (counter, value) SELECT {key}, {delta} WHERE true
+        ON CONFLICT (counter) DO UPDATE SET value = value + excluded.value;'''
+
+
+# Triggers keeping stats_counters in step with the hot tables
+COUNTER_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_patients_insert AFTER INSERT ON patients
+        BEGIN {_bump_counter("'patients'", 1)} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_patients_delete AFTER DELETE ON patients
+        BEGIN {_bump_counter("'patients'", -1)} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_users_insert AFTER INSERT ON users
+        BEGIN
+            {_bump_counter("'staff'", _STAFF_FLAG.format(row='NEW'))}
+            {_bump_counter("'doctors'", _DOCTOR_FLAG.format(row='NEW'))}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_users_delete AFTER DELETE ON users
+        BEGIN
+            {_bump_counter("'staff'", '-' + _STAFF_FLAG.format(row='OLD'))}
+            {_bump_counter("'doctors'", '-' + _DOCTOR_FLAG.format(row='OLD'))}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_users_update AFTER UPDATE OF active, role_id ON users
+        BEGIN
+            {_bump_counter("'staff'", _STAFF_FLAG.format(row='NEW') + ' - ' + _STAFF_FLAG.format(row='OLD'))}
+            {_bump_counter("'doctors'", _DOCTOR_FLAG.format(row='NEW') + ' - ' + _DOCTOR_FLAG.format(row='OLD'))}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_appointments_insert AFTER INSERT ON appointments
+        BEGIN {_bump_counter("'appointments:' || DATE(NEW.appointment_date)", 1)} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_appointments_delete AFTER DELETE ON appointments
+        BEGIN {_bump_counter("'appointments:' || DATE(OLD.appointment_date)", -1)} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_appointments_update AFTER UPDATE OF appointment_date ON appointments
+        BEGIN
+            {_bump_counter("'appointments:' || DATE(OLD.appointment_date)", -1)}
+            {_bump_counter("'appointments:' || DATE(NEW.appointment_date)", 1)}
+        END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_finances_insert AFTER INSERT ON finances
+        BEGIN {_bump_counter("'income:' || strftime('%Y-%m', NEW.date)", 'NEW.amount')} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_finances_delete AFTER DELETE ON finances
+        BEGIN {_bump_counter("'income:' || strftime('%Y-%m', OLD.date)", '-OLD.amount')} END''',
+    f'''CREATE TRIGGER IF NOT EXISTS trg_counters_finances_update AFTER UPDATE OF date, amount ON finances
+        BEGIN
+            {_bump_counter("'income:' || strftime('%Y-%m', OLD.date)", '-OLD.amount')}
+            {_bump_counter("'income:' || strftime('%Y-%m', NEW.date)", 'NEW.amount')}
+        END''',
+]
+
+def _mark_patient_dirty(row):
+    """Return a statement flagging a row's patient for the next patient metrics refresh"""
+    return (f"INSERT OR IGNORE INTO patient_metrics_dirty (patient_id) "
+            f"SELECT {row}.patient_id WHERE {row}.patient_id IS NOT NULL;")
+
+
+# Triggers recording which patients' metrics are stale
+PATIENT_METRICS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_patient_metrics_patients_insert AFTER INSERT ON patients
+        BEGIN INSERT OR IGNORE INTO patient_metrics_dirty (patient_id) VALUES (NEW.id); END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_patient_metrics_patients_delete AFTER DELETE ON patients
+        BEGIN INSERT OR IGNORE INTO patient_metrics_dirty (patient_id) VALUES (OLD.id); END''',
+] + [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_patient_metrics_{table}_{event.lower()} AFTER {event} ON {table}
+        BEGIN {' '.join(_mark_patient_dirty(row) for row in rows)} END'''
+    for table in ('finances', 'medical_records', 'appointments')
+    for event, rows in (('INSERT', ['NEW']), ('UPDATE', ['OLD', 'NEW']), ('DELETE', ['OLD']))
+]
+
+# Triggers keeping the number of patients filed under each name trigram, to look up the rarest first
+TRIGRAM_COUNT_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_trigram_counts_insert AFTER INSERT ON patient_name_trigrams
+        BEGIN
+            INSERT INTO patient_trigram_counts (trigram, patients) VALUES (NEW.trigram, 1)
+            ON CONFLICT (trigram) DO UPDATE SET patients = patients + 1;
+        END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_trigram_counts_delete AFTER DELETE ON patient_name_trigrams
+        BEGIN UPDATE patient_trigram_counts SET patients = patients - 1 WHERE trigram = OLD.trigram; END''',
+]
+
+# Triggers moving a dataset's generation on every change an in-process copy of it must follow
+DATA_GENERATION_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_generation_patients_{name} AFTER {event} ON patients
+        BEGIN UPDATE data_generations SET generation = generation + 1 WHERE dataset = 'patients'; END'''
+    for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'), ('rename', 'UPDATE OF name, contact'))
+]
+
+# Every appointment status transition, its creation included, with where and with whom it happened
+APPOINTMENT_STATUS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_status_history_appointments_insert AFTER INSERT ON appointments
+        BEGIN
+            INSERT INTO appointment_status_history (appointment_id, old_status, new_status, appointment_date, assigned_to)
+            VALUES (NEW.id, NULL, NEW.status, NEW.appointment_date, NEW.assigned_to);
+        END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_status_history_appointments_update AFTER UPDATE OF status ON appointments
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            INSERT INTO appointment_status_history (appointment_id, old_status, new_status, appointment_date, assigned_to)
+            VALUES (NEW.id, OLD.status, NEW.status, NEW.appointment_date, NEW.assigned_to);
+        END''',
+]
+
+# Ground truth for every counter, used to detect and repair drift
+COUNTER_RECONCILE_QUERY = '''
+    SELECT 'patients', COUNT(*) FROM main.patients
+    UNION ALL
+    SELECT 'staff', COUNT(*) FROM main.users JOIN main.roles ON users.role_id = roles.id
+    WHERE users.active = 1
+    UNION ALL
+    SELECT 'doctors', COUNT(*) FROM main.users JOIN main.roles ON users.role_id = roles.id
+    WHERE users.active = 1 AND roles.role_name = 'doctor'
+    UNION ALL
+    SELECT 'appointments:' || DATE(appointment_date), COUNT(*) FROM main.appointments
+    GROUP BY DATE(appointment_date)
+    UNION ALL
+    SELECT 'income:' || strftime('%Y-%m', date), SUM(amount) FROM main.finances
+    GROUP BY strftime('%Y-%m', date)
+'''
+
+def archive_path_for(db_path):
+    """Return the archive file kept next to a database file, e.g. clinic_archive.db for clinic.db"""
+    base, ext = os.path.splitext(db_path)
+    return f"{base}_archive{ext}"
+
+
+def refused_write(error):
+    """Return the backend-neutral error for a write SQLite refused with an IntegrityError"""
+    # Text where an INTEGER column expects an id
+    if str(error) == 'datatype mismatch':
+        return InvalidValue(str(error))
+    return ConstraintViolation(str(error))
+
+
+class DatabaseManager(ClinicRepository):
+    # Set to False to get the raw pd.read_sql_query frames, e.g. to measure what typing saves
+    typed_frames = True
+
+
+    def __init__(self, db_path='clinic.db', archive_path='clinic_archive.db', archive_horizon_days=365,
+                 write_behind=False, write_batch_size=100, write_max_latency=0.05,
+                 replica_path='clinic_replica.db', replica_max_staleness=60, read_only=False):
+        """Initialize database connection, attach the archive and create tables if they don't exist"""
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.archive_horizon_days = archive_horizon_days
+        self.read_only = read_only
+        # One connection per thread, so sessions sharing this manager never share a transaction;
+        # a thread's connection is closed once the thread is gone
+        self._connections = weakref.WeakKeyDictionary()
+        self._connections_lock = threading.Lock()
+        self._version_conn = None
+        self._version_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._write_queue = None
+        self._writer_thread = None
+        self.replica_path = replica_path
+        self.replica_max_staleness = replica_max_staleness
+        self._replica_lock = threading.RLock()
+        self._replica = None
+        self._replica_slot = 1
+        self._replica_taken_at = None
+        self._picker_lock = threading.Lock()
+        self._picker = None
+        if not read_only and self.schema_version() < SCHEMA_VERSION:
+            self.create_tables()
+        if write_behind:
+            self.start_write_behind(write_batch_size, write_max_latency)
+
+    @staticmethod
+    def _read_only_uri(path):
+        """Return an SQLite URI that opens a database file read-only"""
+        return f"file:{os.path.abspath(path)}?mode=ro"
+
+    def _connect(self):
+        """Open a connection to the database with the archive attached and foreign keys enforced"""
+        if self.read_only:
+            # Snapshot copies: opened read-only, and never migrated
+            conn = sqlite3.connect(self._read_only_uri(self.db_path), uri=True, check_same_thread=False)
+            conn.execute("ATTACH DATABASE ? AS archive", (self._read_only_uri(self.archive_path),))
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        # Off by default in SQLite; the ON DELETE actions in create_tables rely on it
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    @property
+    def conn(self):
+        """Return the calling thread's connection, opening it on first use"""
+        thread = threading.current_thread()
+        conn = self._connections.get(thread)
+        if conn is None:
+            conn = self._connect()
+            with self._connections_lock:
+                self._connections[thread] = conn
+        return conn
+
+    def close(self):
+        """Close every thread's connection"""
+        with self._connections_lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        with self._version_lock:
+            if self._version_conn is not None:
+                connections.append(self._version_conn)
+                self._version_conn = None
+        for conn in connections:
+            conn.close()
+
+    @contextmanager
+    def _immediate_transaction(self, conn=None):
+        """Run a block in a transaction of its own that holds the write lock from the start, then commit it"""
+        conn = conn or self.conn
+        # Fails rather than committing if the caller left a transaction open on this connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except sqlite3.IntegrityError as e:
+            conn.rollback()
+            raise refused_write(e) from e
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def schema_version(self):
+        """Return the schema version shared by the main and archive databases"""
+        main_version = self.conn.execute("PRAGMA main.user_version").fetchone()[0]
+        archive_version = self.conn.execute("PRAGMA archive.user_version").fetchone()[0]
+        return min(main_version, archive_version)
 
     def create_tables(self):
         """Create all necessary database tables if they don't exist"""
@@ -53,83 +359,666 @@ class DatabaseManager:
             )
         ''')
         
+        # A patient's history goes with them; a departed staff member's or a dropped series' references
+        # are cleared. Tables created before these ON DELETE actions are rebuilt with them
         # Patients table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS patients (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                contact TEXT NOT NULL,
-                email TEXT,
-                medical_history TEXT,
-                assigned_doctor_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (assigned_doctor_id) REFERENCES users (id)
-            )
+        self._create_table('patients', '''
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            email TEXT,
+            medical_history TEXT,
+            assigned_doctor_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (assigned_doctor_id) REFERENCES users (id) ON DELETE SET NULL
         ''')
         
         # Financial records table
+        self._create_table('finances', '''
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date DATE NOT NULL,
+            amount REAL NOT NULL,
+            description TEXT,
+            patient_id INTEGER,
+            recorded_by_id INTEGER,
+            transaction_type TEXT DEFAULT 'payment',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id) ON DELETE CASCADE,
+            FOREIGN KEY (recorded_by_id) REFERENCES users (id) ON DELETE SET NULL
+        ''')
+        
+        # Medical records table
+        self._create_table('medical_records', '''
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            doctor_id INTEGER,
+            visit_date DATE NOT NULL,
+            diagnosis TEXT,
+            treatment TEXT,
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id) ON DELETE CASCADE,
+            FOREIGN KEY (doctor_id) REFERENCES users (id) ON DELETE SET NULL
+        ''')
+        # Recurring appointment series: the rule, expanded into one appointments row per occurrence
+        self._create_table('appointment_series', '''
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            assigned_to INTEGER,
+            reason TEXT,
+            starts_at DATETIME NOT NULL,
+            frequency TEXT NOT NULL,
+            occurrences INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id) ON DELETE CASCADE,
+            FOREIGN KEY (assigned_to) REFERENCES users (id) ON DELETE SET NULL
+        ''')
+
+        # Appointments table
+        self._create_table('appointments', '''
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            appointment_date DATETIME NOT NULL,
+            reason TEXT,
+            status TEXT DEFAULT 'Scheduled',
+            assigned_to INTEGER,
+            series_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id) ON DELETE CASCADE,
+            FOREIGN KEY (assigned_to) REFERENCES users (id) ON DELETE SET NULL,
+            FOREIGN KEY (series_id) REFERENCES appointment_series (id) ON DELETE SET NULL
+        ''')
+
+        # Date indexes used by range queries and by the archival job; the finances
+        # one also covers the columns income aggregates and breakdowns read
+        cursor.execute('DROP INDEX IF EXISTS idx_finances_date')
+        cursor.execute('DROP INDEX IF EXISTS idx_finances_date_amount')
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS finances (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+            CREATE INDEX IF NOT EXISTS idx_finances_date_covering
+            ON finances (date, amount, patient_id, recorded_by_id)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments (appointment_date)')
+
+        # Per-patient indexes for patient metrics and history lookups
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_finances_patient ON finances (patient_id, date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_finances_recorded_by ON finances (recorded_by_id, date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_medical_records_patient ON medical_records (patient_id, visit_date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments (patient_id, appointment_date)')
+        # Cascading a patient delete to their series without a scan
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointment_series_patient ON appointment_series (patient_id)')
+        # "This and following" edits of a series
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_appointments_series ON appointments (series_id, appointment_date)
+            WHERE series_id IS NOT NULL
+        ''')
+        # Status changes for everything a staff member has on, without a date
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_staff ON appointments (assigned_to, appointment_date)')
+
+        # Archive tables (cold store) mirror the hot tables without foreign keys
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive.finances (
+                id INTEGER PRIMARY KEY,
                 date DATE NOT NULL,
                 amount REAL NOT NULL,
                 description TEXT,
                 patient_id INTEGER,
                 recorded_by_id INTEGER,
                 transaction_type TEXT DEFAULT 'payment',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (patient_id) REFERENCES patients (id),
-                FOREIGN KEY (recorded_by_id) REFERENCES users (id)
+                created_at TIMESTAMP
             )
         ''')
-        
-        # Medical records table
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS medical_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+            CREATE TABLE IF NOT EXISTS archive.appointments (
+                id INTEGER PRIMARY KEY,
                 patient_id INTEGER,
-                doctor_id INTEGER,
-                visit_date DATE NOT NULL,
-                diagnosis TEXT,
-                treatment TEXT,
-                notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (patient_id) REFERENCES patients (id),
-                FOREIGN KEY (doctor_id) REFERENCES users (id)
+                appointment_date DATETIME NOT NULL,
+                reason TEXT,
+                status TEXT DEFAULT 'Scheduled',
+                assigned_to INTEGER,
+                series_id INTEGER,
+                created_at TIMESTAMP
             )
         ''')
-        # Appointments table
+        self._add_column('archive', 'appointments', 'series_id', 'INTEGER')
+        cursor.execute('DROP INDEX IF EXISTS archive.idx_finances_date')
+        cursor.execute('DROP INDEX IF EXISTS archive.idx_finances_date_amount')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS archive.idx_finances_date_covering
+            ON finances (date, amount, patient_id, recorded_by_id)
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_appointments_date ON appointments (appointment_date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_finances_patient ON finances (patient_id, date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_finances_recorded_by ON finances (recorded_by_id, date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_appointments_patient ON appointments (patient_id, appointment_date)')
+
+        # Horizon per table: rows dated before archived_before may live in the archive
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive.archive_state (
+                table_name TEXT PRIMARY KEY,
+                archived_before DATE NOT NULL
+            )
+        ''')
+
+        # Dashboard counters, kept current by the triggers below
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                counter TEXT PRIMARY KEY,
+                value NUMERIC NOT NULL DEFAULT 0
+            )
+        ''')
+        for trigger in COUNTER_TRIGGERS:
+            cursor.execute(trigger)
+
+        # Cached per-patient value and visit metrics, refreshed from patient_metrics_dirty
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patient_metrics (
+                patient_id INTEGER PRIMARY KEY,
+                total_revenue REAL NOT NULL DEFAULT 0,
+                payment_count INTEGER NOT NULL DEFAULT 0,
+                appointment_count INTEGER NOT NULL DEFAULT 0,
+                visit_count INTEGER NOT NULL DEFAULT 0,
+                first_visit DATE,
+                last_visit DATE,
+                avg_visit_gap_days REAL,
+                refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patient_metrics_dirty (
+                patient_id INTEGER PRIMARY KEY
+            )
+        ''')
+        for trigger in PATIENT_METRICS_TRIGGERS:
+            cursor.execute(trigger)
+        # Recompute every patient once after a schema upgrade
+        cursor.execute("INSERT OR IGNORE INTO patient_metrics_dirty (patient_id) SELECT id FROM patients")
+
+        # Duplicate detection index: each patient under its phone, email and name MinHash band keys
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS appointments (
+            CREATE TABLE IF NOT EXISTS patient_block_keys (
+                block_key TEXT NOT NULL,
+                patient_id INTEGER NOT NULL,
+                PRIMARY KEY (block_key, patient_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_block_keys_patient ON patient_block_keys (patient_id)')
+
+        # Fuzzy name search indexes: each patient and staff member under their name's trigrams
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patient_name_trigrams (
+                trigram TEXT NOT NULL,
+                patient_id INTEGER NOT NULL,
+                PRIMARY KEY (trigram, patient_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_patient_name_trigrams_patient ON patient_name_trigrams (patient_id)'
+        )
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS patient_trigram_counts (
+                trigram TEXT PRIMARY KEY,
+                patients INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        for trigger in TRIGRAM_COUNT_TRIGGERS:
+            cursor.execute(trigger)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_name_trigrams (
+                trigram TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (trigram, user_id)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_name_trigrams_user ON user_name_trigrams (user_id)')
+
+        # Data generations, telling in-process copies like the patient picker when to rebuild.
+        # Not in stats_counters, whose reconciler rewrites every counter whenever one drifts
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS data_generations (
+                dataset TEXT PRIMARY KEY,
+                generation INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO data_generations (dataset) VALUES ('patients')")
+        for trigger in DATA_GENERATION_TRIGGERS:
+            cursor.execute(trigger)
+
+        # Appointment reminders queued by reminders.py, once per appointment and start time
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reminder_outbox (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER,
+                appointment_id INTEGER NOT NULL,
+                appointment_date DATETIME NOT NULL,
+                recipient TEXT NOT NULL,
+                message TEXT NOT NULL,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP,
+                UNIQUE (appointment_id, appointment_date)
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_reminder_outbox_pending ON reminder_outbox (id) WHERE sent_at IS NULL')
+
+        # Appointment status transitions, written by triggers and read by the no-show analytics
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS appointment_status_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                appointment_id INTEGER NOT NULL,
+                old_status TEXT,
+                new_status TEXT,
                 appointment_date DATETIME NOT NULL,
-                reason TEXT,
-                status TEXT DEFAULT 'Scheduled',
                 assigned_to INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (patient_id) REFERENCES patients (id),
-                FOREIGN KEY (assigned_to) REFERENCES users (id)
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_appointment_status_history_date
+            ON appointment_status_history (appointment_date, appointment_id)
+        ''')
+        # Deleting appointments clears their history by id: archived appointments are out of the foreign keys' reach
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_appointment_status_history_appointment
+            ON appointment_status_history (appointment_id)
+        ''')
+        # Appointments booked before the history existed start it at their current status
+        if cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM appointment_status_history)").fetchone()[0]:
+            for schema in ('main', 'archive'):
+                cursor.execute(f'''
+                    INSERT INTO appointment_status_history
+                        (appointment_id, old_status, new_status, appointment_date, assigned_to, changed_at)
+                    SELECT id, NULL, status, appointment_date, assigned_to, created_at FROM {schema}.appointments
+                ''')
+        for trigger in APPOINTMENT_STATUS_TRIGGERS:
+            cursor.execute(trigger)
+
+        cursor.execute(f"PRAGMA main.user_version = {SCHEMA_VERSION}")
+        cursor.execute(f"PRAGMA archive.user_version = {SCHEMA_VERSION}")
         
         self.conn.commit()
 
+        # Seed the counters for databases created before they existed
+        if cursor.execute("SELECT COUNT(*) FROM stats_counters").fetchone()[0] == 0:
+            self.reconcile_counters()
+        # File patients and staff registered before the duplicate and name search indexes existed
+        self.index_patients()
+        self.index_users()
+
+    def _create_table(self, table, definition):
+        """Create a main table, or rebuild one created before its foreign keys had ON DELETE actions"""
+        existing = self.conn.execute(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        if existing is None:
+            self.conn.execute(f"CREATE TABLE {table} ({definition})")
+            return
+        if 'ON DELETE' in existing[0].upper():
+            return
+        # SQLite can't alter a constraint, so the rows move to a table defined afresh that takes the
+        # old one's name. Foreign keys must be off, outside any transaction, for the old table to be
+        # dropped without cascading; its indexes and triggers go with it and are created again below
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self.conn.execute("PRAGMA foreign_keys = OFF")
+        # Renames only this table, without reparsing the triggers of others that mention the old one
+        self.conn.execute("PRAGMA legacy_alter_table = ON")
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.execute(f"CREATE TABLE {table}_rebuilt ({definition})")
+            wanted = {row[1] for row in self.conn.execute(f"PRAGMA main.table_info({table}_rebuilt)")}
+            columns = ', '.join(
+                row[1] for row in self.conn.execute(f"PRAGMA main.table_info({table})") if row[1] in wanted
+            )
+            self.conn.execute(f"INSERT INTO {table}_rebuilt ({columns}) SELECT {columns} FROM {table}")
+            # Ids of deleted rows stay retired: archived rows keep theirs
+            sequence = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+            self.conn.execute(f"DROP TABLE {table}")
+            self.conn.execute(f"ALTER TABLE {table}_rebuilt RENAME TO {table}")
+            if sequence:
+                self.conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+                self.conn.execute(
+                    f"INSERT INTO sqlite_sequence (name, seq) SELECT ?, MAX(?, COALESCE(MAX(id), 0)) FROM {table}",
+                    (table, sequence[0])
+                )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.execute("PRAGMA legacy_alter_table = OFF")
+            self.conn.execute("PRAGMA foreign_keys = ON")
+
+    def _add_column(self, schema, table, column, definition):
+        """Add a column to a table created before the column existed"""
+        columns = {row[1] for row in self.conn.execute(f"PRAGMA {schema}.table_info({table})")}
+        if column not in columns:
+            self.conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column} {definition}")
+
+    # Archival methods
+    def archive_old_records(self, horizon_days=None, batch_size=500):
+        """Move finances and appointments older than the horizon into the archive database"""
+        if horizon_days is None:
+            horizon_days = self.archive_horizon_days
+        cutoff = (date.today() - timedelta(days=horizon_days)).strftime('%Y-%m-%d')
+        moved = {}
+
+        for table, date_column in ARCHIVE_DATE_COLUMNS.items():
+            columns = ', '.join(ARCHIVED_COLUMNS[table])
+
+            # Publish the new horizon first so readers start unioning the archive
+            # before any row leaves the hot table
+            with self.conn:
+                self.conn.execute('''
+                    INSERT INTO archive.archive_state (table_name, archived_before)
+                    VALUES (?, ?)
+                    ON CONFLICT (table_name)
+                    DO UPDATE SET archived_before = MAX(archived_before, excluded.archived_before)
+                ''', (table, cutoff))
+
+                # Finish any batch that was copied but not removed from the hot table
+                self.conn.execute(f'''
+                    DELETE FROM main.{table}
+                    WHERE {date_column} < ? AND id IN (SELECT id FROM archive.{table})
+                ''', (cutoff,))
+
+            moved[table] = 0
+            while True:
+                with self.conn:
+                    ids = [row[0] for row in self.conn.execute(
+                        f"SELECT id FROM main.{table} WHERE {date_column} < ? ORDER BY {date_column} LIMIT ?",
+                        (cutoff, batch_size)
+                    )]
+                    if not ids:
+                        break
+                    placeholders = ', '.join('?' * len(ids))
+                    self.conn.execute(
+                        f"INSERT OR IGNORE INTO archive.{table} ({columns}) "
+                        f"SELECT {columns} FROM main.{table} WHERE id IN ({placeholders})",
+                        ids
+                    )
+                    self.conn.execute(f"DELETE FROM main.{table} WHERE id IN ({placeholders})", ids)
+                moved[table] += len(ids)
+
+        return moved
+
+    def _archive_boundary(self, table):
+        """Return the date before which rows of a table may live in the archive, or None"""
+        row = self.conn.execute(
+            "SELECT archived_before FROM archive.archive_state WHERE table_name = ?", (table,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _restore_if_recent(self, table, row_id):
+        """Move an archived row back into the hot table once it is dated inside the hot window; doesn't commit"""
+        boundary = self._archive_boundary(table)
+        if boundary is None:
+            return
+        columns = ', '.join(ARCHIVED_COLUMNS[table])
+        # Reads from the horizon on only look at the hot table, so a row dated there must live in it.
+        # The hot table's insert triggers count it again and record its current status
+        restored = self.conn.execute(f'''
+            INSERT INTO main.{table} ({columns})
+            SELECT {columns} FROM archive.{table} WHERE id = ? AND {ARCHIVE_DATE_COLUMNS[table]} >= ?
+        ''', (row_id, boundary)).rowcount
+        if restored:
+            self.conn.execute(f"DELETE FROM archive.{table} WHERE id = ?", (row_id,))
+
+    def table_source(self, table, start_date=None):
+        """Return the FROM source for a table, unioned with the archive when the range crosses the horizon"""
+        boundary = self._archive_boundary(table)
+        if boundary is None or (start_date is not None and str(start_date) >= boundary):
+            return table
+        columns = ', '.join(ARCHIVED_COLUMNS[table])
+        return (
+            f"(SELECT {columns} FROM main.{table} "
+            f"UNION ALL SELECT {columns} FROM archive.{table}) AS {table}"
+        )
+
+    def _read(self, query, params=(), schema=None):
+        """Run a SELECT into a DataFrame, typed by its schema in FRAME_SCHEMAS"""
+        frame = pd.read_sql_query(query, self.conn, params=params)
+        return typed_frame(frame, schema) if schema and self.typed_frames else frame
+
+    def _read_page(self, query, params=(), limit=None, offset=0, schema=None):
+        """Run a SELECT, or one page of it with the unpaged row count in a total_rows column"""
+        if limit is None:
+            return self._read(query, params, schema)
+        paged = f"SELECT page.*, COUNT(*) OVER () AS total_rows FROM ({query}) AS page LIMIT ? OFFSET ?"
+        return self._read(paged, (*params, limit, offset), schema)
+
+    # Dashboard counter methods
+    def get_counters(self, today=None):
+        """Return the dashboard counters with a single primary-key lookup"""
+        today = today or date.today()
+        keys = {
+            'patient_count': 'patients',
+            'staff_count': 'staff',
+            'doctor_count': 'doctors',
+            'today_appointments': f"appointments:{today.strftime('%Y-%m-%d')}",
+            'monthly_income': f"income:{today.strftime('%Y-%m')}",
+        }
+        rows = dict(self.conn.execute(
+            "SELECT counter, value FROM stats_counters WHERE counter IN (?, ?, ?, ?, ?)",
+            list(keys.values())
+        ).fetchall())
+        return {name: rows.get(key, 0) for name, key in keys.items()}
+
+    def reconcile_counters(self, conn=None):
+        """Recompute every counter from the base tables, repair drift and return what was repaired"""
+        # The write lock is held from the start, so no trigger update lands between the count and the repair
+        with self._immediate_transaction(conn) as conn:
+            expected = {key: value for key, value in conn.execute(COUNTER_RECONCILE_QUERY)}
+            stored = dict(conn.execute("SELECT counter, value FROM stats_counters").fetchall())
+            drift = {
+                key: (stored.get(key, 0), expected.get(key, 0))
+                for key in set(expected) | set(stored)
+                if abs((stored.get(key) or 0) - (expected.get(key) or 0)) > 1e-6
+            }
+            if drift or not stored:
+                conn.execute("DELETE FROM stats_counters")
+                conn.executemany(
+                    "INSERT INTO stats_counters (counter, value) VALUES (?, ?)", expected.items()
+                )
+        return drift
+
+    def start_counter_reconciler(self, interval_seconds=3600):
+        """Reconcile the counters periodically on a background thread with its own connection"""
+        def reconcile_loop():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                while not self._stop_event.wait(interval_seconds):
+                    try:
+                        drift = self.reconcile_counters(conn)
+                        if drift:
+                            print(f"Repaired dashboard counter drift: {drift}")
+                    except sqlite3.Error as e:
+                        print(f"Error reconciling counters: {e}")
+            finally:
+                conn.close()
+
+        thread = threading.Thread(target=reconcile_loop, name="counter-reconciler", daemon=True)
+        thread.start()
+        return thread
+
+    # Read replica methods
+    def _replica_paths(self, slot):
+        """Return the main and archive file paths of one replica slot"""
+        base, extension = os.path.splitext(self.replica_path)
+        return f"{base}-{slot}{extension}", f"{base}-{slot}-archive{extension}"
+
+    def refresh_replica(self, pages_per_step=REPLICA_PAGES_PER_STEP):
+        """Copy the live database into the idle replica slot with the online backup API and switch readers to it"""
+        with self._replica_lock:
+            taken_at = time.monotonic()
+            slot = 1 - self._replica_slot
+            main_path, archive_path = self._replica_paths(slot)
+            # Two slots: readers keep using the current copy while the other one is rewritten. A reader
+            # still holding the copy replaced one refresh ago keeps its connection: the backup waits for
+            # its query to finish, and its next query sees the new copy. Its connections close once
+            # the last reader lets go of it
+            for schema, path in (('main', main_path), ('archive', archive_path)):
+                target = sqlite3.connect(path)
+                try:
+                    # Each step only briefly locks the source; a write committed between steps restarts the copy
+                    self.conn.backup(target, pages=pages_per_step, name=schema)
+                finally:
+                    target.close()
+            replica = DatabaseManager(main_path, archive_path, read_only=True)
+            self._replica = replica
+            self._replica_slot = slot
+            self._replica_taken_at = taken_at
+            return replica
+
+    def replica(self):
+        """Return a read-only snapshot of the database, refreshed first if older than the staleness bound"""
+        if self.read_only:
+            return self
+        if self._replica_is_stale():
+            # Readers only queue behind a copy when the current one is too old to use
+            with self._replica_lock:
+                if self._replica_is_stale():
+                    self.refresh_replica()
+        return self._replica
+
+    def _replica_is_stale(self):
+        """Return True when there is no replica yet or it is older than the staleness bound"""
+        age = self.replica_age()
+        return age is None or age > self.replica_max_staleness
+
+    def replica_age(self):
+        """Return the age of the current replica in seconds, or None before the first copy"""
+        if self._replica_taken_at is None:
+            return None
+        return time.monotonic() - self._replica_taken_at
+
+    def start_replica_refresher(self, interval_seconds=None):
+        """Refresh the replica periodically on a background thread so readers rarely wait for a copy"""
+        interval_seconds = interval_seconds or self.replica_max_staleness / 2
+
+        def refresh_loop():
+            while not self._stop_event.is_set():
+                try:
+                    self.refresh_replica()
+                except sqlite3.Error as e:
+                    print(f"Error refreshing read replica: {e}")
+                if self._stop_event.wait(interval_seconds):
+                    break
+
+        thread = threading.Thread(target=refresh_loop, name="replica-refresher", daemon=True)
+        thread.start()
+        return thread
+
+    # Write-behind methods
+    def start_write_behind(self, batch_size=100, max_latency=0.05):
+        """Queue inserts for a single writer thread that commits them in groups"""
+        if self._writer_thread is not None:
+            return
+        # WAL lets readers keep going while the writer thread holds the write lock
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._write_queue = queue.Queue()
+        self._writer_thread = threading.Thread(
+            target=self._write_behind_loop,
+            args=(batch_size, max_latency),
+            name="write-behind",
+            daemon=True
+        )
+        self._writer_thread.start()
+
+    def stop_write_behind(self):
+        """Commit everything still queued and stop the writer thread"""
+        if self._writer_thread is None:
+            return
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        self._writer_thread = None
+        self._write_queue = None
+
+    def _write_behind_loop(self, batch_size, max_latency):
+        """Drain the write queue, committing at most batch_size writes or max_latency seconds at a time"""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA foreign_keys = ON")
+        write_queue = self._write_queue
+        stopping = False
+        try:
+            while not stopping:
+                item = write_queue.get()
+                if item is None:
+                    break
+                # Group everything already waiting; writes that arrive during the
+                # commit form the next group, so an idle queue commits immediately
+                batch = [item]
+                deadline = time.monotonic() + max_latency
+                while len(batch) < batch_size and time.monotonic() < deadline:
+                    try:
+                        item = write_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._commit_write_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit_write_batch(self, conn, batch):
+        """Apply a batch of queued writes in one transaction and resolve their futures"""
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for query, params, future in batch:
+                # A savepoint per write keeps one bad row from failing the whole group
+                conn.execute("SAVEPOINT queued_write")
+                try:
+                    cursor = conn.execute(query, params)
+                    results.append((future, cursor.lastrowid, None))
+                except sqlite3.IntegrityError as e:
+                    conn.execute("ROLLBACK TO queued_write")
+                    results.append((future, None, refused_write(e)))
+                except sqlite3.Error as e:
+                    conn.execute("ROLLBACK TO queued_write")
+                    results.append((future, None, e))
+                conn.execute("RELEASE queued_write")
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, rowid, error in results:
+            if error is None:
+                future.set_result(rowid)
+            else:
+                future.set_exception(error)
+
+    def _execute_insert(self, query, params):
+        """Run an INSERT and return its row id, or a Future for it in write-behind mode"""
+        if self._write_queue is not None:
+            future = Future()
+            self._write_queue.put((query, params, future))
+            return future
+        with self._immediate_transaction() as conn:
+            return conn.execute(query, params).lastrowid
+
     # User and role management methods
     def add_user(self, username, password, full_name, role_id, email=None, phone=None, specialty=None):
         """Add a new user (medical staff) to the database"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        with self._immediate_transaction():
+            return self._insert_user(username, password, full_name, role_id, email, phone, specialty)
+
+    def _insert_user(self, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Insert a user, file their name and return their id; doesn't commit"""
+        user_id = self.conn.execute('''
             INSERT INTO users (username, password, full_name, role_id, email, phone, specialty)
             VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (username, password, full_name, role_id, email, phone, specialty))
-        self.conn.commit()
-        return cursor.lastrowid
+        ''', (username, password, full_name, role_id, email, phone, specialty)).lastrowid
+        self._index_user(user_id, full_name)
+        return user_id
     
-    def get_users(self):
-        """Retrieve all users from the database"""
+    def get_users(self, limit=None, offset=0):
+        """Retrieve all users from the database, optionally one page at a time"""
         try:
-            return pd.read_sql_query(
+            return self._read_page(
                 '''
                 SELECT users.*, roles.role_name 
                 FROM users 
@@ -137,7 +1026,10 @@ class DatabaseManager:
                 WHERE users.active = 1
                 ORDER BY users.full_name
                 ''',
-                self.conn
+                (),
+                limit,
+                offset,
+                schema='users'
             )
         except Exception as e:
             print(f"Error fetching users: {e}")
@@ -146,53 +1038,156 @@ class DatabaseManager:
     def get_roles(self):
         """Retrieve all roles from the database"""
         try:
-            return pd.read_sql_query("SELECT * FROM roles", self.conn)
+            return self._read("SELECT * FROM roles", schema='roles')
         except Exception as e:
             print(f"Error fetching roles: {e}")
             return pd.DataFrame(columns=['id', 'role_name', 'description'])
     
-    def search_users(self, search_term):
-        """Search for users by name, username, or role"""
+    def search_users(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search for active users by name, username, or role, by close spellings of the name if nothing matches"""
         query = """
             SELECT users.*, roles.role_name 
             FROM users 
             JOIN roles ON users.role_id = roles.id
-            WHERE users.full_name LIKE ? OR users.username LIKE ? OR 
-                  users.email LIKE ? OR roles.role_name LIKE ?
+            WHERE users.active = 1 AND (
+                  users.full_name LIKE ? OR users.username LIKE ? OR 
+                  users.email LIKE ? OR roles.role_name LIKE ?)
             ORDER BY users.full_name
         """
         pattern = f"%{search_term}%"
-        return pd.read_sql_query(query, self.conn, params=(pattern, pattern, pattern, pattern))
+        exact_search = lambda limit, offset: self._read_page(
+            query, (pattern, pattern, pattern, pattern), limit, offset, schema='users'
+        )
+        if not fuzzy:
+            return exact_search(limit, offset)
+        return self._exact_or_fuzzy(exact_search, lambda: self.fuzzy_search_users(search_term), limit, offset)
+
+    def fuzzy_search_users(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find active users whose name is within a few typos of the search term, closest first"""
+        # Staff are few enough to look up by every trigram of the term
+        candidates = self.conn.execute('''
+            SELECT users.id, users.full_name
+            FROM (
+                SELECT user_id, COUNT(*) AS shared
+                FROM user_name_trigrams
+                WHERE trigram IN (SELECT value FROM json_each(?))
+                  AND user_id IN (SELECT id FROM users WHERE active = 1)
+                GROUP BY user_id
+                ORDER BY shared DESC, user_id
+                LIMIT ?
+            ) AS candidates
+            JOIN users ON users.id = candidates.user_id
+        ''', (json.dumps(search_trigrams(search_term)), FUZZY_CANDIDATES)).fetchall()
+        closest = closest_names(search_term, candidates, limit)
+        matches = self._read('''
+            SELECT users.*, roles.role_name
+            FROM users
+            JOIN roles ON users.role_id = roles.id
+            WHERE users.id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list(closest)),), schema='users')
+        return order_matches(matches, closest, 'full_name')
+
+    def _index_user(self, user_id, full_name):
+        """File a user under their name's trigrams, replacing earlier ones; doesn't commit"""
+        self.conn.execute("DELETE FROM user_name_trigrams WHERE user_id = ?", (user_id,))
+        self.conn.executemany(
+            "INSERT INTO user_name_trigrams (trigram, user_id) VALUES (?, ?)",
+            ((trigram, user_id) for trigram in name_trigrams(full_name))
+        )
+
+    def index_users(self):
+        """File users missing from the name search index, e.g. after an upgrade"""
+        missing = self.conn.execute(
+            "SELECT id, full_name FROM users WHERE id NOT IN (SELECT user_id FROM user_name_trigrams)"
+        ).fetchall()
+        with self.conn:
+            for user in missing:
+                self._index_user(*user)
+        return len(missing)
+
+    def delete_users(self, user_ids):
+        """Deactivate several users in one transaction; their history keeps pointing at them"""
+        with self.conn:
+            return self.conn.execute(
+                "UPDATE users SET active = 0 WHERE active = 1 AND id IN (SELECT value FROM json_each(?))",
+                (json.dumps([int(user_id) for user_id in user_ids]),)
+            ).rowcount
+
+    def update_user(self, user_id, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Update a user's details, keeping their password if none is given, and refile their name"""
+        with self._immediate_transaction():
+            self._update_user(user_id, username, password, full_name, role_id, email, phone, specialty)
+
+    def _update_user(self, user_id, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Update a user's row and refile their name; doesn't commit"""
+        self.conn.execute('''
+            UPDATE users
+            SET username = ?, password = COALESCE(NULLIF(?, ''), password), full_name = ?, role_id = ?,
+                email = ?, phone = ?, specialty = ?
+            WHERE id = ?
+        ''', (username, password, full_name, role_id, email, phone, specialty, user_id))
+        self._index_user(user_id, full_name)
 
     # Patient management methods
     def add_patient(self, name, contact, email, medical_history, assigned_doctor_id=None):
         """Add a new patient to the database"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO patients (name, contact, email, medical_history, assigned_doctor_id)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (name, contact, email, medical_history, assigned_doctor_id))
-        self.conn.commit()
-        return cursor.lastrowid
+        with self._immediate_transaction() as conn:
+            patient_id = conn.execute('''
+                INSERT INTO patients (name, contact, email, medical_history, assigned_doctor_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (name, contact, email, medical_history, assigned_doctor_id)).lastrowid
+            self._index_patient(patient_id, name, contact, email)
+            generations = self._patient_generations(1)
+        self._update_picker(generations, upserts=[(patient_id, name, contact)])
+        return patient_id
 
-    def get_patients(self):
-        """Retrieve all patients from the database"""
+    def update_patient(self, patient_id, name, contact, email, medical_history, assigned_doctor_id=None):
+        """Update a patient's details and refile them in the duplicate and name search indexes"""
+        with self.conn:
+            updated = self.conn.execute('''
+                UPDATE patients
+                SET name = ?, contact = ?, email = ?, medical_history = ?, assigned_doctor_id = ?
+                WHERE id = ?
+            ''', (name, contact, email, medical_history, assigned_doctor_id, patient_id)).rowcount
+            self._index_patient(patient_id, name, contact, email)
+            generations = self._patient_generations(updated)
+        self._update_picker(generations, upserts=[(patient_id, name, contact)] if updated else ())
+
+    def get_patients(self, limit=None, offset=0):
+        """Retrieve all patients from the database, optionally one page at a time"""
         try:
-            return pd.read_sql_query(
+            return self._read_page(
                 '''
                 SELECT patients.*, users.full_name as doctor_name
                 FROM patients
                 LEFT JOIN users ON patients.assigned_doctor_id = users.id
                 ORDER BY patients.name
                 ''',
-                self.conn
+                (),
+                limit,
+                offset,
+                schema='patients'
             )
         except Exception as e:
             print(f"Error fetching patients: {e}")
             return pd.DataFrame(columns=['id', 'name', 'contact', 'email', 'medical_history', 'doctor_name'])
 
-    def search_patients(self, search_term):
-        """Search for patients by name or contact information"""
+    def get_recent_patients(self, limit=5):
+        """Retrieve the most recently added patients"""
+        return self._read(
+            '''
+            SELECT patients.*, users.full_name as doctor_name
+            FROM patients
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            ORDER BY patients.id DESC
+            LIMIT ?
+            ''',
+            (limit,),
+            schema='patients'
+        )
+
+    def search_patients(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search for patients by name or contact information, by close spellings of the name if nothing matches"""
         query = """
             SELECT patients.*, users.full_name as doctor_name
             FROM patients
@@ -201,25 +1196,333 @@ class DatabaseManager:
             ORDER BY patients.name
         """
         pattern = f"%{search_term}%"
-        return pd.read_sql_query(query, self.conn, params=(pattern, pattern, pattern))
+        exact_search = lambda limit, offset: self._read_page(
+            query, (pattern, pattern, pattern), limit, offset, schema='patients'
+        )
+        if not fuzzy:
+            return exact_search(limit, offset)
+        return self._exact_or_fuzzy(exact_search, lambda: self.fuzzy_search_patients(search_term), limit, offset)
+
+    def fuzzy_search_patients(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find patients whose name is within a few typos of the search term, closest first"""
+        # Only the names sharing most of the term's rarest trigrams are ranked, never the whole register
+        candidates = self.conn.execute('''
+            WITH probes AS (
+                SELECT trigram FROM (
+                    SELECT
+                        trigram,
+                        SUM(patients) OVER (ORDER BY patients, trigram) - patients AS rarer_postings,
+                        ROW_NUMBER() OVER (ORDER BY patients, trigram) AS rarity
+                    FROM patient_trigram_counts
+                    WHERE trigram IN (SELECT value FROM json_each(?)) AND patients > 0
+                )
+                WHERE rarer_postings < ? OR rarity <= ?
+            )
+            SELECT patients.id, patients.name
+            FROM (
+                SELECT patient_id, COUNT(*) AS shared
+                FROM patient_name_trigrams
+                WHERE trigram IN (SELECT trigram FROM probes)
+                GROUP BY patient_id
+                ORDER BY shared DESC, patient_id
+                LIMIT ?
+            ) AS candidates
+            JOIN patients ON patients.id = candidates.patient_id
+        ''', (json.dumps(search_trigrams(search_term)), FUZZY_PROBE_POSTINGS, FUZZY_MIN_PROBES,
+              FUZZY_CANDIDATES)).fetchall()
+        # Full rows are read only for the few closest names
+        closest = closest_names(search_term, candidates, limit)
+        matches = self._read('''
+            SELECT patients.*, users.full_name as doctor_name
+            FROM patients
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            WHERE patients.id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list(closest)),), schema='patients')
+        return order_matches(matches, closest, 'name')
+
+    def delete_patients(self, patient_ids):
+        """Delete several patients and everything recorded against them in one transaction"""
+        patient_ids = [int(patient_id) for patient_id in patient_ids]
+        ids = json.dumps(patient_ids)
+        with self.conn:
+            self._forget_appointments('''
+                SELECT id FROM main.appointments WHERE patient_id IN (SELECT value FROM json_each(:ids))
+                UNION ALL
+                SELECT id FROM archive.appointments WHERE patient_id IN (SELECT value FROM json_each(:ids))
+            ''', ids)
+            # The archive is another database file, out of reach of the foreign keys
+            for table in ('finances', 'appointments'):
+                self.conn.execute(
+                    f"DELETE FROM archive.{table} WHERE patient_id IN (SELECT value FROM json_each(?))", (ids,)
+                )
+            for index in ('patient_block_keys', 'patient_name_trigrams'):
+                self.conn.execute(
+                    f"DELETE FROM {index} WHERE patient_id IN (SELECT value FROM json_each(?))", (ids,)
+                )
+            # Their finances, medical records, series and appointments go with them through ON DELETE CASCADE
+            deleted = self.conn.execute(
+                "DELETE FROM patients WHERE id IN (SELECT value FROM json_each(?))", (ids,)
+            ).rowcount
+            generations = self._patient_generations(deleted)
+        self._update_picker(generations, removals=patient_ids)
+        return deleted
+
+    # Duplicate patient methods
+    def _index_patient(self, patient_id, name, contact, email):
+        """File a patient under their block keys and name trigrams, replacing earlier ones; doesn't commit"""
+        self.conn.execute("DELETE FROM patient_block_keys WHERE patient_id = ?", (patient_id,))
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO patient_block_keys (block_key, patient_id) VALUES (?, ?)",
+            ((key, patient_id) for key in block_keys(name, contact, email))
+        )
+        self.conn.execute("DELETE FROM patient_name_trigrams WHERE patient_id = ?", (patient_id,))
+        self.conn.executemany(
+            "INSERT INTO patient_name_trigrams (trigram, patient_id) VALUES (?, ?)",
+            ((trigram, patient_id) for trigram in name_trigrams(name))
+        )
+
+    def index_patients(self):
+        """File patients missing from the duplicate or name search index, e.g. after an upgrade or a bulk import"""
+        missing = self.conn.execute('''
+            SELECT id, name, contact, email FROM patients
+            WHERE id NOT IN (SELECT patient_id FROM patient_block_keys)
+               OR id NOT IN (SELECT patient_id FROM patient_name_trigrams)
+        ''').fetchall()
+        with self.conn:
+            for patient in missing:
+                self._index_patient(*patient)
+        return len(missing)
+
+    def find_similar_patients(self, name, contact, email=None, limit=5):
+        """Find registered patients who may be the person being registered, best match first"""
+        # Only patients sharing a block key are compared, the ones sharing most keys first
+        candidates = self._read('''
+            SELECT patients.*, users.full_name as doctor_name
+            FROM (
+                SELECT patient_id, COUNT(*) AS shared_keys
+                FROM patient_block_keys
+                WHERE block_key IN (SELECT value FROM json_each(?))
+                GROUP BY patient_id
+                ORDER BY shared_keys DESC
+                LIMIT ?
+            ) AS candidates
+            JOIN patients ON patients.id = candidates.patient_id
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+        ''', (json.dumps(block_keys(name, contact, email)), MAX_DUPLICATE_CANDIDATES), schema='patients')
+        probe = fingerprint({'name': name, 'contact': contact, 'email': email})
+        matches = [compare_fingerprints(probe, fingerprint(candidate)) for candidate in candidates.to_dict('records')]
+        candidates['similarity'] = [match[0] if match else None for match in matches]
+        candidates['reason'] = [match[1] if match else None for match in matches]
+        candidates['certain'] = [bool(match and match[2]) for match in matches]
+        similar = candidates[candidates['reason'].notna()]
+        return similar.sort_values(['certain', 'similarity'], ascending=False).head(limit).reset_index(drop=True)
+
+    def find_duplicate_clusters(self, max_block_size=MAX_BLOCK_SIZE):
+        """Find groups of patient records that are the same person; the oldest record of each is kept"""
+        self.index_patients()
+        return self._duplicate_clusters(max_block_size)
+
+    def _duplicate_clusters(self, max_block_size, patient_ids=None):
+        """Cluster the indexed patients, or only the pairs involving patient_ids; doesn't commit"""
+        # Candidate pairs are the pairs inside each block, never the whole register squared
+        if patient_ids is None:
+            keys = "SELECT block_key FROM patient_block_keys"
+        else:
+            # Only the blocks the given patients are filed under, found through the patient_id index
+            keys = '''
+                SELECT block_key FROM patient_block_keys
+                WHERE block_key IN (
+                    SELECT block_key FROM patient_block_keys WHERE patient_id IN (SELECT value FROM json_each(:ids))
+                )
+            '''
+        pairs = self.conn.execute(f'''
+            WITH blocks AS (
+                {keys}
+                GROUP BY block_key
+                HAVING COUNT(*) BETWEEN 2 AND :max_block_size
+            )
+            SELECT DISTINCT first.patient_id, second.patient_id
+            FROM blocks
+            JOIN patient_block_keys AS first ON first.block_key = blocks.block_key
+            JOIN patient_block_keys AS second
+              ON second.block_key = blocks.block_key AND second.patient_id > first.patient_id
+            WHERE :ids IS NULL
+               OR first.patient_id IN (SELECT value FROM json_each(:ids))
+               OR second.patient_id IN (SELECT value FROM json_each(:ids))
+        ''', {'max_block_size': max_block_size,
+              'ids': None if patient_ids is None else json.dumps(patient_ids)}).fetchall()
+        candidate_ids = json.dumps(sorted({patient_id for pair in pairs for patient_id in pair}))
+        # Each patient is normalized once, not once per pair they appear in
+        patients = {
+            row[0]: fingerprint({'name': row[1], 'contact': row[2], 'email': row[3]})
+            for row in self.conn.execute(
+                "SELECT id, name, contact, email FROM patients WHERE id IN (SELECT value FROM json_each(?))",
+                (candidate_ids,)
+            )
+        }
+        reasons = {}
+        for first, second in pairs:
+            match = compare_fingerprints(patients[first], patients[second])
+            if match and match[2]:
+                reasons.setdefault((first, second), match[1])
+        clusters = cluster_pairs(reasons)
+        cluster_of = {patient_id: number for number, members in enumerate(clusters, 1) for patient_id in members}
+        survivors = {members[0] for members in clusters}
+        member_reason = {}
+        for (first, second), reason in reasons.items():
+            member_reason.setdefault(second, reason)
+
+        members = self._read('''
+            SELECT id, name, contact, email, created_at
+            FROM patients
+            WHERE id IN (SELECT value FROM json_each(?))
+            ORDER BY id
+        ''', (json.dumps(list(cluster_of)),), schema='patients')
+        members.insert(0, 'cluster', members['id'].map(lambda patient_id: cluster_of[int(patient_id)]))
+        members['keep'] = members['id'].map(lambda patient_id: int(patient_id) in survivors)
+        members['reason'] = members['id'].map(lambda patient_id: member_reason.get(int(patient_id)))
+        return members.sort_values(['cluster', 'id'], kind='mergesort').reset_index(drop=True)
+
+    def _merge_into(self, survivor_id, duplicate_ids):
+        """Move duplicates' history onto the surviving record and delete them; doesn't commit"""
+        ids = json.dumps([int(patient_id) for patient_id in duplicate_ids if int(patient_id) != survivor_id])
+        for schema in ('main', 'archive'):
+            for table in ('finances', 'appointments'):
+                self.conn.execute(
+                    f"UPDATE {schema}.{table} SET patient_id = ? WHERE patient_id IN (SELECT value FROM json_each(?))",
+                    (survivor_id, ids)
+                )
+        for table in ('medical_records', 'appointment_series'):
+            self.conn.execute(
+                f"UPDATE {table} SET patient_id = ? WHERE patient_id IN (SELECT value FROM json_each(?))",
+                (survivor_id, ids)
+            )
+        # Keep details only a duplicate had, taking the oldest duplicate's first
+        self.conn.execute('''
+            UPDATE patients SET
+                email = COALESCE(NULLIF(email, ''), (
+                    SELECT email FROM patients AS duplicate
+                    WHERE duplicate.id IN (SELECT value FROM json_each(:ids)) AND COALESCE(duplicate.email, '') != ''
+                    ORDER BY duplicate.id LIMIT 1)),
+                medical_history = COALESCE(NULLIF(medical_history, ''), (
+                    SELECT medical_history FROM patients AS duplicate
+                    WHERE duplicate.id IN (SELECT value FROM json_each(:ids))
+                      AND COALESCE(duplicate.medical_history, '') != ''
+                    ORDER BY duplicate.id LIMIT 1)),
+                assigned_doctor_id = COALESCE(assigned_doctor_id, (
+                    SELECT assigned_doctor_id FROM patients AS duplicate
+                    WHERE duplicate.id IN (SELECT value FROM json_each(:ids)) AND duplicate.assigned_doctor_id IS NOT NULL
+                    ORDER BY duplicate.id LIMIT 1))
+            WHERE id = :survivor_id
+        ''', {'ids': ids, 'survivor_id': survivor_id})
+        # Archived rows have no triggers to flag the survivor's metrics as stale
+        self.conn.execute("INSERT OR IGNORE INTO patient_metrics_dirty (patient_id) VALUES (?)", (survivor_id,))
+        for index in ('patient_block_keys', 'patient_name_trigrams'):
+            self.conn.execute(f"DELETE FROM {index} WHERE patient_id IN (SELECT value FROM json_each(?))", (ids,))
+        return self.conn.execute(
+            "DELETE FROM patients WHERE id IN (SELECT value FROM json_each(?))", (ids,)
+        ).rowcount
+
+    def merge_patients(self, survivor_id, duplicate_ids):
+        """Merge duplicate records into one patient in one transaction and return how many were removed"""
+        with self._immediate_transaction():
+            merged = self._merge_into(int(survivor_id), duplicate_ids)
+            generations = self._patient_generations(merged)
+        self._update_picker(generations, removals=[
+            int(patient_id) for patient_id in duplicate_ids if int(patient_id) != int(survivor_id)
+        ])
+        return merged
+
+    def merge_duplicate_clusters(self, clusters, max_block_size=MAX_BLOCK_SIZE):
+        """Merge clusters from find_duplicate_clusters into their kept records in one transaction and return how
+        many records were removed. A cluster whose members were edited, deleted or joined by another patient
+        since the scan no longer matches and is left for the next scan"""
+        self.index_patients()
+        listed = [int(patient_id) for patient_id in clusters['id']]
+        merged, removed = 0, []
+        with self._immediate_transaction():
+            # Checked again under the write lock, so no change lands between the check and the merge. Pairs
+            # involving the listed patients are enough: an outsider joins a cluster only by matching a member
+            current = {
+                frozenset(int(patient_id) for patient_id in members['id'])
+                for _, members in self._duplicate_clusters(max_block_size, listed).groupby('cluster')
+            }
+            for _, members in clusters.groupby('cluster'):
+                member_ids = [int(patient_id) for patient_id in members['id']]
+                if frozenset(member_ids) not in current:
+                    continue
+                survivor_id = int(members.loc[members['keep'], 'id'].iloc[0])
+                merged += self._merge_into(survivor_id, member_ids)
+                removed += [patient_id for patient_id in member_ids if patient_id != survivor_id]
+            generations = self._patient_generations(merged)
+        self._update_picker(generations, removals=removed)
+        return merged
+
+    # Patient picker methods
+    def patient_generation(self):
+        """Return the patients' data generation, moved by every insert, delete, rename or new contact from any connection"""
+        return self.conn.execute("SELECT generation FROM data_generations WHERE dataset = 'patients'").fetchone()[0]
+
+    def patient_picker(self):
+        """Return the in-process patient picker, built again when the patients changed behind its back"""
+        generation = self.patient_generation()
+        with self._picker_lock:
+            if self._picker is None or self._picker.generation != generation:
+                # Rows read after the generation are at least as new, so a change in between costs a rebuild, never a miss
+                self._picker = PatientPicker(self.conn.execute("SELECT id, name, contact FROM patients"), generation)
+            return self._picker
+
+    def pick_patients(self, text, limit=PICKER_MATCHES):
+        """Return (id, name, contact) of the first patients in name order whose name, a word of it or phone starts with text"""
+        return self.patient_picker().search(text, limit)
+
+    def _patient_generations(self, changes):
+        """Return the patients' generation before and after this transaction's own row changes; call before commit"""
+        # The transaction holds the write lock, so no other connection's change lies in between
+        after = self.patient_generation()
+        return after - changes, after
+
+    def _update_picker(self, generations, upserts=(), removals=()):
+        """Apply a committed write to the picker if it was current before it; a stale one is rebuilt on next use"""
+        before, after = generations
+        with self._picker_lock:
+            if self._picker is not None and self._picker.generation == before:
+                self._picker.apply(after, upserts, removals)
 
     # Medical records methods
     def add_medical_record(self, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
         """Add a new medical record"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO medical_records (patient_id, doctor_id, visit_date, diagnosis, treatment, notes)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (patient_id, doctor_id, visit_date, diagnosis, treatment, notes))
-        self.conn.commit()
-        return cursor.lastrowid
+        with self._immediate_transaction() as conn:
+            return conn.execute('''
+                INSERT INTO medical_records (patient_id, doctor_id, visit_date, diagnosis, treatment, notes)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (patient_id, doctor_id, visit_date, diagnosis, treatment, notes)).lastrowid
     
-    def get_medical_records(self, patient_id=None):
-        """Retrieve medical records, optionally filtered by patient"""
+    def update_medical_record(self, record_id, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
+        """Update a medical record"""
+        with self.conn:
+            self.conn.execute('''
+                UPDATE medical_records
+                SET patient_id = ?, doctor_id = ?, visit_date = ?, diagnosis = ?, treatment = ?, notes = ?
+                WHERE id = ?
+            ''', (patient_id, doctor_id, visit_date.strftime('%Y-%m-%d'), diagnosis, treatment, notes, record_id))
+
+    def delete_medical_records(self, record_ids):
+        """Delete several medical records in one transaction"""
+        with self.conn:
+            return self.conn.execute(
+                "DELETE FROM medical_records WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps([int(record_id) for record_id in record_ids]),)
+            ).rowcount
+
+    def get_medical_records(self, patient_id=None, limit=None, offset=0):
+        """Retrieve medical records, optionally filtered by patient and one page at a time"""
         query = """
             SELECT 
                 medical_records.id,
+                medical_records.patient_id,
                 patients.name as patient_name,
+                medical_records.doctor_id,
                 users.full_name as doctor_name,
                 medical_records.visit_date,
                 medical_records.diagnosis,
@@ -230,14 +1533,57 @@ class DatabaseManager:
             JOIN users ON medical_records.doctor_id = users.id
         """
         if patient_id:
-            query += " WHERE patient_id = ?"
-            return pd.read_sql_query(query, self.conn, params=(patient_id,))
-        return pd.read_sql_query(query, self.conn)
+            query += " WHERE medical_records.patient_id = ? ORDER BY medical_records.id"
+            return self._read_page(query, (patient_id,), limit, offset, schema='medical_records')
+        return self._read_page(query + " ORDER BY medical_records.id", (), limit, offset, schema='medical_records')
     
+    def get_patient_timeline(self, patient_id, cursor=None, limit=TIMELINE_PAGE_SIZE):
+        """Merge a patient's visits, appointments and payments, newest first, one keyset page at a time"""
+        params = {'patient_id': patient_id, 'limit': limit}
+        if cursor:
+            params['at'], params['kind'], params['id'] = cursor
+            params['day'] = params['at'][:10]
+        arms = []
+        for kind, table, date_column, staff_column, expressions in TIMELINE_SOURCES:
+            columns = ', '.join(f"{expression} AS {name}" for expression, name in zip(expressions, TIMELINE_COLUMNS))
+            moment = f"entry.{date_column}" if kind == 'appointment' else f"entry.{date_column} || ' 00:00:00'"
+            # Each source walks its (patient_id, date) index backwards from the cursor and stops after
+            # one page, so the merge below sorts at most a page per source however long the history is
+            after = ""
+            if cursor:
+                bound = ':at' if kind == 'appointment' else ':day'
+                after = (f"AND entry.{date_column} <= {bound} "
+                         f"AND ({moment}, '{kind}', entry.id) < (:at, :kind, :id)")
+            arms.append(f"""
+                SELECT * FROM (
+                    SELECT {moment} AS occurred_at, '{kind}' AS kind, entry.id,
+                           {columns}, users.full_name AS staff_name
+                    FROM {table} AS entry
+                    LEFT JOIN users ON users.id = entry.{staff_column}
+                    WHERE entry.patient_id = :patient_id {after}
+                    ORDER BY entry.{date_column} DESC, entry.id DESC
+                    LIMIT :limit
+                )
+            """)
+        query = f"""
+            SELECT * FROM ({' UNION ALL '.join(arms)})
+            ORDER BY occurred_at DESC, kind DESC, id DESC
+            LIMIT :limit
+        """
+        return self._read(query, params, schema='patient_timeline')
+
     # Appointment
-    def get_appointments(self, date=None, staff_id=None):
-        """Retrieve appointments, optionally filtered by date and staff"""
-        query = """
+    def add_appointment(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None):
+        """Schedule an appointment; returns its id, or a Future for it in write-behind mode"""
+        appointment_datetime = datetime.combine(appointment_date, appointment_time)
+        return self._execute_insert('''
+            INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to)
+            VALUES (?, ?, ?, ?)
+        ''', (patient_id, appointment_datetime.strftime('%Y-%m-%d %H:%M:%S'), reason, assigned_to))
+
+    def get_appointments(self, date=None, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments, optionally filtered by date and staff and one page at a time"""
+        query = f"""
             SELECT 
                 appointments.id,
                 appointments.appointment_date,
@@ -246,57 +1592,584 @@ class DatabaseManager:
                 patients.name as patient_name,
                 patients.id as patient_id,
                 users.full_name as assigned_to,
-                users.id as assigned_to_id
-            FROM appointments
+                users.id as assigned_to_id,
+                appointments.series_id
+            FROM {self.table_source('appointments', date)}
             JOIN patients ON appointments.patient_id = patients.id
             LEFT JOIN users ON appointments.assigned_to = users.id
         """
-        
-        if date and staff_id:
-            query += " WHERE DATE(appointments.appointment_date) = ? AND appointments.assigned_to = ?"
-            return pd.read_sql_query(query, self.conn, params=(date, staff_id))
-        elif date:
-            query += " WHERE DATE(appointments.appointment_date) = ?"
-            return pd.read_sql_query(query, self.conn, params=(date,))
-        elif staff_id:
-            query += " WHERE appointments.assigned_to = ?"
-            return pd.read_sql_query(query, self.conn, params=(staff_id,))
-        
-        return pd.read_sql_query(query, self.conn)
+        # Range on the raw column instead of DATE() so idx_appointments_date is used
+        day_filter = "appointments.appointment_date >= ? AND appointments.appointment_date < DATE(?, '+1 day')"
+        conditions, params = [], []
+        if date:
+            conditions.append(day_filter)
+            params += [date, date]
+        if staff_id:
+            conditions.append("appointments.assigned_to = ?")
+            params.append(staff_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY appointments.appointment_date, appointments.id"
+        return self._read_page(query, tuple(params), limit, offset, schema='appointments')
+
+    def update_appointment(self, appointment_id, patient_id, appointment_date, appointment_time, reason, status,
+                           assigned_to=None):
+        """Update an appointment, live or archived"""
+        if status not in APPOINTMENT_STATUSES:
+            raise ValueError(f"Unknown status: {status}")
+        appointment_datetime = datetime.combine(appointment_date, appointment_time).strftime('%Y-%m-%d %H:%M:%S')
+        with self.conn:
+            for schema in ('main', 'archive'):
+                self.conn.execute(f'''
+                    UPDATE {schema}.appointments
+                    SET patient_id = ?, appointment_date = ?, reason = ?, status = ?, assigned_to = ?
+                    WHERE id = ?
+                ''', (patient_id, appointment_datetime, reason, status, assigned_to, appointment_id))
+            self._restore_if_recent('appointments', appointment_id)
+
+    def _forget_appointments(self, appointment_ids_query, ids):
+        """Delete the status history and reminders of the appointments a query over :ids selects; doesn't commit"""
+        # Kept by id rather than by foreign key, since an appointment may live in the archive
+        for table in ('appointment_status_history', 'reminder_outbox'):
+            self.conn.execute(f"DELETE FROM {table} WHERE appointment_id IN ({appointment_ids_query})", {'ids': ids})
+
+    def delete_appointments(self, appointment_ids):
+        """Delete several appointments, live or archived, with their status history and reminders"""
+        ids = json.dumps([int(appointment_id) for appointment_id in appointment_ids])
+        with self.conn:
+            self._forget_appointments("SELECT value FROM json_each(:ids)", ids)
+            return sum(
+                self.conn.execute(
+                    f"DELETE FROM {schema}.appointments WHERE id IN (SELECT value FROM json_each(?))", (ids,)
+                ).rowcount
+                for schema in ('main', 'archive')
+            )
+
+    def set_appointment_status(self, status, day=None, staff_id=None, appointment_ids=None, from_status='Scheduled'):
+        """Move every appointment matching the filters to a status in one UPDATE and return how many changed"""
+        if status not in APPOINTMENT_STATUSES:
+            raise ValueError(f"Unknown status: {status}")
+        if day is None and staff_id is None and appointment_ids is None:
+            raise ValueError("Give a day, a staff member or appointment ids")
+        # Appointments already in the status are left alone, so the history only records real transitions
+        conditions, params = ["status IS NOT :status"], {'status': status}
+        if day is not None:
+            conditions.append("appointment_date >= :day AND appointment_date < DATE(:day, '+1 day')")
+            params['day'] = str(day)
+        if staff_id is not None:
+            conditions.append("assigned_to = :staff_id")
+            params['staff_id'] = staff_id
+        if appointment_ids is not None:
+            conditions.append("id IN (SELECT value FROM json_each(:ids))")
+            params['ids'] = json.dumps([int(appointment_id) for appointment_id in appointment_ids])
+        if from_status is not None:
+            conditions.append("status = :from_status")
+            params['from_status'] = from_status
+        with self.conn:
+            return self.conn.execute(
+                f"UPDATE appointments SET status = :status WHERE {' AND '.join(conditions)}", params
+            ).rowcount
+
+    def get_no_show_rates(self, start_date, end_date, by='doctor'):
+        """Count each staff member's or weekday's appointment outcomes between two dates, with the no-show rate"""
+        if by == 'doctor':
+            key_columns = "outcomes.assigned_to AS doctor_id, COALESCE(users.full_name, 'Unassigned') AS doctor_name"
+            group_order = "GROUP BY outcomes.assigned_to ORDER BY doctor_name, doctor_id"
+        elif by == 'weekday':
+            # 0 is Monday, as date.weekday() counts
+            key_columns = "(CAST(strftime('%w', outcomes.appointment_date) AS INTEGER) + 6) % 7 AS weekday"
+            group_order = "GROUP BY weekday ORDER BY weekday"
+        else:
+            raise ValueError(f"Unknown breakdown: {by}")
+        return self._read(f'''
+            WITH outcomes AS (
+                -- The last outcome of each appointment: a no-show later marked Completed counts as Completed
+                SELECT assigned_to, appointment_date, new_status,
+                       ROW_NUMBER() OVER (PARTITION BY appointment_id ORDER BY id DESC) AS latest
+                FROM appointment_status_history
+                WHERE appointment_date >= :start_date AND appointment_date < DATE(:end_date, '+1 day')
+                  AND new_status IN ('Completed', 'No-show', 'Cancelled')
+            )
+            SELECT
+                {key_columns},
+                COUNT(*) AS appointments,
+                SUM(outcomes.new_status = 'Completed') AS completed,
+                SUM(outcomes.new_status = 'No-show') AS no_shows,
+                SUM(outcomes.new_status = 'Cancelled') AS cancelled,
+                1.0 * SUM(outcomes.new_status = 'No-show')
+                    / NULLIF(SUM(outcomes.new_status IN ('Completed', 'No-show')), 0) AS no_show_rate
+            FROM outcomes
+            LEFT JOIN users ON outcomes.assigned_to = users.id
+            WHERE outcomes.latest = 1
+            {group_order}
+        ''', {'start_date': str(start_date), 'end_date': str(end_date)}, schema='no_show_rates')
+
+    def appointment_conflicts(self, occurrences, exclude_series=None):
+        """Return the Scheduled appointments clashing with (start, patient id, staff id) occurrences, in one query"""
+        return self.conn.execute('''
+            WITH occurrences (start, patient_id, staff_id) AS (
+                SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]')
+                FROM json_each(:occurrences)
+            )
+            SELECT occurrences.start, appointments.id, appointments.appointment_date, patients.name, users.full_name
+            FROM occurrences
+            JOIN appointments
+              ON appointments.appointment_date > datetime(occurrences.start, :before)
+             AND appointments.appointment_date < datetime(occurrences.start, :after)
+            LEFT JOIN patients ON appointments.patient_id = patients.id
+            LEFT JOIN users ON appointments.assigned_to = users.id
+            WHERE appointments.status = 'Scheduled'
+              AND (appointments.patient_id = occurrences.patient_id OR appointments.assigned_to = occurrences.staff_id)
+              AND (:exclude_series IS NULL OR appointments.series_id IS NOT :exclude_series)
+            ORDER BY occurrences.start, appointments.appointment_date, appointments.id
+        ''', {
+            'occurrences': json.dumps([[start, patient_id, staff_id] for start, patient_id, staff_id in occurrences]),
+            'before': f"-{APPOINTMENT_SLOT_MINUTES} minutes",
+            'after': f"+{APPOINTMENT_SLOT_MINUTES} minutes",
+            'exclude_series': exclude_series,
+        }).fetchall()
+
+    def add_appointment_series(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None,
+                               frequency='weekly', occurrences=12):
+        """Book every occurrence of a recurring series in one transaction and return the series id"""
+        starts = series_occurrences(appointment_date, appointment_time, frequency, occurrences)
+        # The write lock is held from the start, so nothing is booked between the conflict check and the inserts
+        with self._immediate_transaction() as conn:
+            conflicts = self.appointment_conflicts([(start, patient_id, assigned_to) for start in starts])
+            if conflicts:
+                raise SchedulingConflict(conflicts)
+            series_id = conn.execute('''
+                INSERT INTO appointment_series (patient_id, assigned_to, reason, starts_at, frequency, occurrences)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (patient_id, assigned_to, reason, starts[0], frequency, occurrences)).lastrowid
+            conn.execute('''
+                INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to, series_id)
+                SELECT ?, value, ?, ?, ? FROM json_each(?)
+            ''', (patient_id, reason, assigned_to, series_id, json.dumps(starts)))
+        return series_id
+
+    def update_appointment_series(self, series_id, from_date, appointment_time=None, reason=None,
+                                  assigned_to=None, status=None):
+        """Change the Scheduled occurrences of a series on or after a date in one UPDATE; returns how many changed"""
+        params = {
+            'series_id': series_id,
+            'from_date': str(from_date),
+            'at': appointment_time.strftime('%H:%M:%S') if appointment_time else None,
+            'reason': reason,
+            'assigned_to': assigned_to,
+            'status': status,
+        }
+        following = '''
+            WHERE series_id = :series_id AND appointment_date >= :from_date AND status = 'Scheduled'
+        '''
+        with self._immediate_transaction() as conn:
+            if (appointment_time or assigned_to) and status in (None, 'Scheduled'):
+                moved = conn.execute(f'''
+                    SELECT COALESCE(DATE(appointment_date) || ' ' || :at, appointment_date),
+                           patient_id, COALESCE(:assigned_to, assigned_to)
+                    FROM appointments
+                    {following}
+                ''', params).fetchall()
+                conflicts = self.appointment_conflicts(moved, exclude_series=series_id)
+                if conflicts:
+                    raise SchedulingConflict(conflicts)
+            changed = conn.execute(f'''
+                UPDATE appointments SET
+                    appointment_date = COALESCE(DATE(appointment_date) || ' ' || :at, appointment_date),
+                    reason = COALESCE(:reason, reason),
+                    assigned_to = COALESCE(:assigned_to, assigned_to),
+                    status = COALESCE(:status, status)
+                {following}
+            ''', params).rowcount
+        return changed
+
+    def get_appointments_range(self, start_date, end_date, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments between two dates (inclusive), optionally for one staff member and one page"""
+        query = f"""
+            SELECT 
+                appointments.id,
+                appointments.appointment_date,
+                appointments.reason,
+                appointments.status,
+                patients.name as patient_name,
+                patients.id as patient_id,
+                users.full_name as assigned_to,
+                users.id as assigned_to_id,
+                appointments.series_id
+            FROM {self.table_source('appointments', start_date)}
+            JOIN patients ON appointments.patient_id = patients.id
+            LEFT JOIN users ON appointments.assigned_to = users.id
+            WHERE appointments.appointment_date >= ? AND appointments.appointment_date < DATE(?, '+1 day')
+        """
+        params = [start_date, end_date]
+        if staff_id:
+            query += " AND appointments.assigned_to = ?"
+            params.append(staff_id)
+        query += " ORDER BY appointments.appointment_date, appointments.id"
+        return self._read_page(query, params, limit, offset, schema='appointments')
+
+    def get_week_calendar(self, start_of_week, staff_id=None):
+        """Pivot one week of appointments into an hourly slot x weekday grid in a single query"""
+        days = [(start_of_week + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
+        day_columns = ',\n'.join(
+            f"GROUP_CONCAT(CASE WHEN day = :day{i} THEN entry END, char(10)) AS day{i}"
+            for i in range(7)
+        )
+        staff_filter = "AND appointments.assigned_to = :staff_id" if staff_id else ""
+        query = f"""
+            WITH week AS (
+                SELECT
+                    strftime('%H:00', appointments.appointment_date) AS slot,
+                    DATE(appointments.appointment_date) AS day,
+                    strftime('%H:%M', appointments.appointment_date) || ' ' || patients.name
+                        || COALESCE(' (' || users.full_name || ')', '') AS entry
+                FROM {self.table_source('appointments', days[0])}
+                JOIN patients ON appointments.patient_id = patients.id
+                LEFT JOIN users ON appointments.assigned_to = users.id
+                WHERE appointments.appointment_date >= :day0
+                  AND appointments.appointment_date < DATE(:day6, '+1 day')
+                  {staff_filter}
+                ORDER BY appointments.appointment_date, appointments.id
+            )
+            SELECT slot,
+                {day_columns}
+            FROM week
+            GROUP BY slot
+            ORDER BY slot
+        """
+        params = {f'day{i}': day for i, day in enumerate(days)}
+        if staff_id:
+            params['staff_id'] = staff_id
+        return self._read(query, params)
+
+    def get_daily_appointment_summary(self, start_date, end_date, staff_id=None, entries_per_day=3):
+        """Count appointments per day and list the first few of each day, for the month calendar"""
+        staff_filter = "AND appointments.assigned_to = :staff_id" if staff_id else ""
+        query = f"""
+            WITH ranked AS (
+                SELECT
+                    DATE(appointments.appointment_date) AS day,
+                    strftime('%H:%M', appointments.appointment_date) || ' ' || patients.name AS entry,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY DATE(appointments.appointment_date)
+                        ORDER BY appointments.appointment_date, appointments.id
+                    ) AS position
+                FROM {self.table_source('appointments', start_date)}
+                JOIN patients ON appointments.patient_id = patients.id
+                WHERE appointments.appointment_date >= :start_date
+                  AND appointments.appointment_date < DATE(:end_date, '+1 day')
+                  {staff_filter}
+            )
+            SELECT day,
+                   COUNT(*) AS appointments,
+                   GROUP_CONCAT(CASE WHEN position <= :entries_per_day THEN entry END, char(10)) AS entries
+            FROM ranked
+            GROUP BY day
+            ORDER BY day
+        """
+        params = {'start_date': start_date, 'end_date': end_date, 'entries_per_day': entries_per_day}
+        if staff_id:
+            params['staff_id'] = staff_id
+        return self._read(query, params, schema='daily_summary')
 
     # Financial methods
     def record_income(self, date, amount, description, patient_id, recorded_by_id=None):
-        """Record a financial transaction"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        """Record a financial transaction; returns its id, or a Future for it in write-behind mode"""
+        return self._execute_insert('''
             INSERT INTO finances (date, amount, description, patient_id, recorded_by_id)
             VALUES (?, ?, ?, ?, ?)
         ''', (date.strftime('%Y-%m-%d'), amount, description, patient_id, recorded_by_id))
-        self.conn.commit()
-        return cursor.lastrowid
 
-    def get_financial_records(self, start_date=None, end_date=None):
-        """Retrieve financial records within a date range"""
-        query = """
+    def get_financial_records(self, start_date=None, end_date=None, patient_id=None, recorded_by_id=None,
+                              min_amount=None, max_amount=None, transaction_type=None,
+                              order_by='date', descending=False, limit=None, offset=0):
+        """Retrieve financial records matching all given filters; a page also carries total_rows and filtered_total"""
+        if order_by not in FINANCE_ORDERINGS:
+            raise ValueError(f"Unknown ordering: {order_by}")
+        conditions, params = [], []
+        if start_date and end_date:
+            conditions.append("finances.date BETWEEN ? AND ?")
+            params += [str(start_date), str(end_date)]
+        for column, value in (
+            ('finances.patient_id', patient_id),
+            ('finances.recorded_by_id', recorded_by_id),
+            ('finances.transaction_type', transaction_type),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if min_amount is not None:
+            conditions.append("finances.amount >= ?")
+            params.append(min_amount)
+        if max_amount is not None:
+            conditions.append("finances.amount <= ?")
+            params.append(max_amount)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # Window totals are taken over every match before LIMIT cuts out the page
+        totals = (
+            ", COUNT(*) OVER () AS total_rows, SUM(finances.amount) OVER () AS filtered_total"
+            if limit is not None else ""
+        )
+        direction = 'DESC' if descending else 'ASC'
+        query = f"""
             SELECT 
                 finances.id,
                 finances.date,
                 finances.amount,
                 finances.description,
+                finances.transaction_type,
+                finances.patient_id,
+                finances.recorded_by_id,
                 patients.name as patient_name,
                 users.full_name as recorded_by
-            FROM finances
+                {totals}
+            FROM {self.table_source('finances', start_date if end_date else None)}
             JOIN patients ON finances.patient_id = patients.id
             LEFT JOIN users ON finances.recorded_by_id = users.id
+            {where}
+            ORDER BY {FINANCE_ORDERINGS[order_by]} {direction}, finances.id {direction}
         """
-        if start_date and end_date:
-            query += " WHERE finances.date BETWEEN ? AND ?"
-            return pd.read_sql_query(query, self.conn, params=(start_date, end_date))
-        return pd.read_sql_query(query, self.conn)
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        return self._read(query, params, schema='finances')
+
+    def update_financial_record(self, record_id, date, amount, description, patient_id, recorded_by_id=None):
+        """Update a financial record, live or archived"""
+        with self.conn:
+            for schema in ('main', 'archive'):
+                self.conn.execute(f'''
+                    UPDATE {schema}.finances
+                    SET date = ?, amount = ?, description = ?, patient_id = ?, recorded_by_id = ?
+                    WHERE id = ?
+                ''', (date.strftime('%Y-%m-%d'), amount, description, patient_id, recorded_by_id, record_id))
+            self._restore_if_recent('finances', record_id)
+
+    def delete_financial_records(self, record_ids):
+        """Delete several financial records, live or archived, in one transaction"""
+        ids = json.dumps([int(record_id) for record_id in record_ids])
+        with self.conn:
+            return sum(
+                self.conn.execute(
+                    f"DELETE FROM {schema}.finances WHERE id IN (SELECT value FROM json_each(?))", (ids,)
+                ).rowcount
+                for schema in ('main', 'archive')
+            )
+
+    # Patient metrics methods
+    def refresh_patient_metrics(self, full=False):
+        """Recompute patient_metrics for patients whose rows changed since the last refresh"""
+        finances = self.table_source('finances')
+        appointments = self.table_source('appointments')
+        with self.conn:
+            if full:
+                self.conn.execute("INSERT OR IGNORE INTO patient_metrics_dirty (patient_id) SELECT id FROM patients")
+            stale = self.conn.execute("SELECT COUNT(*) FROM patient_metrics_dirty").fetchone()[0]
+            if not stale:
+                return 0
+
+            # Metrics of deleted patients go away with them
+            self.conn.execute('''
+                DELETE FROM patient_metrics
+                WHERE patient_id IN (SELECT patient_id FROM patient_metrics_dirty)
+                  AND patient_id NOT IN (SELECT id FROM patients)
+            ''')
+
+            # One grouped pass over every event of the stale patients
+            self.conn.execute(f'''
+                WITH targets AS (
+                    SELECT patient_metrics_dirty.patient_id
+                    FROM patient_metrics_dirty
+                    JOIN patients ON patients.id = patient_metrics_dirty.patient_id
+                ),
+                events AS (
+                    SELECT finances.patient_id, finances.date AS day, finances.amount,
+                           1 AS is_payment, 0 AS is_appointment, 0 AS is_visit
+                    FROM {finances}
+                    WHERE finances.patient_id IN (SELECT patient_id FROM targets)
+                    UNION ALL
+                    SELECT medical_records.patient_id, medical_records.visit_date, 0, 0, 0, 1
+                    FROM medical_records
+                    WHERE medical_records.patient_id IN (SELECT patient_id FROM targets)
+                    UNION ALL
+                    SELECT appointments.patient_id, DATE(appointments.appointment_date), 0,
+                           0, 1, appointments.status = 'Completed'
+                    FROM {appointments}
+                    WHERE appointments.patient_id IN (SELECT patient_id FROM targets)
+                ),
+                per_patient AS (
+                    SELECT patient_id,
+                           SUM(amount) AS total_revenue,
+                           SUM(is_payment) AS payment_count,
+                           SUM(is_appointment) AS appointment_count,
+                           COUNT(DISTINCT CASE WHEN is_visit THEN day END) AS visit_count,
+                           MIN(CASE WHEN is_visit THEN day END) AS first_visit,
+                           MAX(CASE WHEN is_visit THEN day END) AS last_visit
+                    FROM events
+                    GROUP BY patient_id
+                )
+                INSERT OR REPLACE INTO patient_metrics (
+                    patient_id, total_revenue, payment_count, appointment_count,
+                    visit_count, first_visit, last_visit, avg_visit_gap_days, refreshed_at
+                )
+                SELECT
+                    targets.patient_id,
+                    COALESCE(per_patient.total_revenue, 0),
+                    COALESCE(per_patient.payment_count, 0),
+                    COALESCE(per_patient.appointment_count, 0),
+                    COALESCE(per_patient.visit_count, 0),
+                    per_patient.first_visit,
+                    per_patient.last_visit,
+                    CASE WHEN per_patient.visit_count > 1
+                         THEN (julianday(per_patient.last_visit) - julianday(per_patient.first_visit))
+                              / (per_patient.visit_count - 1)
+                    END,
+                    CURRENT_TIMESTAMP
+                FROM targets
+                LEFT JOIN per_patient ON per_patient.patient_id = targets.patient_id
+            ''')
+            self.conn.execute("DELETE FROM patient_metrics_dirty")
+        return stale
+
+    def get_patient_metrics(self, patient_id=None, limit=None):
+        """Retrieve cached patient metrics, highest lifetime value first, optionally for one patient"""
+        query = """
+            SELECT
+                patients.id AS patient_id,
+                patients.name AS patient_name,
+                patient_metrics.total_revenue,
+                patient_metrics.payment_count,
+                patient_metrics.appointment_count,
+                patient_metrics.visit_count,
+                patient_metrics.first_visit,
+                patient_metrics.last_visit,
+                patient_metrics.avg_visit_gap_days,
+                CAST(julianday('now', 'localtime', 'start of day') - julianday(patient_metrics.last_visit) AS INTEGER)
+                    AS days_since_last_visit
+            FROM patient_metrics
+            JOIN patients ON patients.id = patient_metrics.patient_id
+        """
+        params = []
+        if patient_id:
+            query += " WHERE patient_metrics.patient_id = ?"
+            params.append(patient_id)
+        query += " ORDER BY patient_metrics.total_revenue DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        return self._read(query, params, schema='patient_metrics')
+
+    # Chart aggregation methods
+    def get_income_buckets(self, start_date, end_date, max_points=60):
+        """Sum income per day, week, month or year, picking the finest bucket that fits in max_points"""
+        days = (end_date - start_date).days + 1
+        bucket = next(
+            (name for name, width in BUCKET_DAYS.items() if days / width <= max_points),
+            'year'
+        )
+        query = f"""
+            SELECT
+                {INCOME_BUCKETS[bucket]} AS bucket,
+                SUM(finances.amount) AS amount,
+                COUNT(*) AS transactions
+            FROM {self.table_source('finances', start_date.strftime('%Y-%m-%d'))}
+            WHERE finances.date BETWEEN ? AND ?
+            GROUP BY bucket
+            ORDER BY bucket
+        """
+        buckets = self._read(
+            query, (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')), schema='income_buckets'
+        )
+        return bucket, buckets
+
+    def get_income_breakdown(self, start_date, end_date, by='patient', top_n=10):
+        """Sum income per patient or recording staff member, folding everyone past top_n into 'Other'"""
+        return self._income_breakdown(start_date, end_date, by, top_n).drop(columns=['key_id'])
+
+    def _income_breakdown(self, start_date, end_date, by, top_n):
+        """Income breakdown with the patient or staff id behind each label in key_id, NULL for 'Other'"""
+        if by == 'patient':
+            key_column, label_table, label_column = 'finances.patient_id', 'patients', 'name'
+        elif by == 'staff':
+            key_column, label_table, label_column = 'finances.recorded_by_id', 'users', 'full_name'
+        else:
+            raise ValueError(f"Unknown breakdown: {by}")
+
+        query = f"""
+            WITH totals AS (
+                SELECT {key_column} AS key_id, SUM(finances.amount) AS amount
+                FROM {self.table_source('finances', start_date.strftime('%Y-%m-%d'))}
+                WHERE finances.date BETWEEN :start_date AND :end_date AND {key_column} IS NOT NULL
+                GROUP BY {key_column}
+            ),
+            ranked AS (
+                SELECT key_id, amount, ROW_NUMBER() OVER (ORDER BY amount DESC) AS rank
+                FROM totals
+            )
+            SELECT
+                CASE WHEN rank <= :top_n THEN COALESCE({label_table}.{label_column}, 'Unknown')
+                     ELSE 'Other' END AS label,
+                SUM(ranked.amount) AS amount,
+                CASE WHEN MIN(rank) <= :top_n THEN MIN(ranked.key_id) END AS key_id
+            FROM ranked
+            LEFT JOIN {label_table} ON {label_table}.id = ranked.key_id
+            GROUP BY CASE WHEN rank <= :top_n THEN rank ELSE :top_n + 1 END
+            ORDER BY MIN(rank)
+        """
+        return self._read(query, {
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+            'top_n': top_n,
+        })
+
+    def data_version(self):
+        """Return a token that changes whenever the main or archive data changes, from any connection"""
+        # data_version only compares within one connection and only moves on other connections' commits,
+        # so every thread asks the same connection, which never writes
+        with self._version_lock:
+            if self._version_conn is None:
+                self._version_conn = self._connect()
+            return (
+                self._version_conn.execute("PRAGMA main.data_version").fetchone()[0],
+                self._version_conn.execute("PRAGMA archive.data_version").fetchone()[0],
+            )
+
+    def analytics(self):
+        """Return the window-function revenue analytics over this database"""
+        return FinancialAnalytics(self)
 
     def __del__(self):
-        """Close the database connection when the object is destroyed"""
+        """Close the database connections when the object is destroyed"""
         try:
-            self.conn.close()
+            self._stop_event.set()
+            self.stop_write_behind()
+            if self._replica is not None:
+                self._replica.close()
+            self.close()
         except:
-            pass
\ No newline at end of file
+            pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Nani Health Clinic database maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    archive_parser = subparsers.add_parser("archive", help="Move old finances and appointments to the archive")
+    archive_parser.add_argument("--horizon-days", type=int, default=365)
+    archive_parser.add_argument("--batch-size", type=int, default=500)
+
+    subparsers.add_parser("reconcile", help="Detect and repair drift in the dashboard counters")
+
+    args = parser.parse_args()
+    db = DatabaseManager()
+
+    if args.command == "archive":
+        moved = db.archive_old_records(args.horizon_days, args.batch_size)
+        for table, count in moved.items():
+            print(f"Archived {count} {table} rows")
+    elif args.command == "reconcile":
+        drift = db.reconcile_counters()
+        for counter, (stored, actual) in sorted(drift.items()):
+            print(f"{counter}: {stored} -> {actual}")
+        print(f"Repaired {len(drift)} counters")
@@ -0,0 +1,184 @@
+"""
+Duplicate patient detection.
+
+Every patient is indexed under a few block keys: their normalized phone number,
+their email, and MinHash bands of their name's character trigrams. Patients are
+only compared when they share a key, so checking a new registration costs a few
+index lookups instead of a scan of the register, and the batch job compares the
+pairs inside each block instead of all n² pairs.
+
+    python dedup.py               # list duplicate clusters in clinic.db
+    python dedup.py --merge       # merge each cluster into its oldest record
+"""
+import argparse
+import random
+import re
+import unicodedata
+import zlib
+
+# Phone numbers are compared on their last digits, so +254 712 345 678 and 0712-345678 match
+PHONE_DIGITS = 9
+
+# MinHash over name trigrams: BANDS bands of ROWS hashes each. Two names share a band key with
+# probability 1 - (1 - s**ROWS)**BANDS for trigram similarity s: ~0.9 at s=0.6, ~0.25 at s=0.3
+MINHASH_BANDS = 10
+MINHASH_ROWS = 3
+_MERSENNE_PRIME = (1 << 61) - 1
+_seeds = random.Random(43)
+MINHASH_PERMUTATIONS = [
+    (_seeds.randrange(1, _MERSENNE_PRIME), _seeds.randrange(_MERSENNE_PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+# Name similarity needed alongside a shared phone or email, for a near-identical name with a
+# phone one digit off, and for a name alone to be worth a warning
+LINKED_NAME_SIMILARITY = 0.5
+TYPO_NAME_SIMILARITY = 0.9
+WARN_NAME_SIMILARITY = 0.8
+
+# Blocks shared by more patients than this (a clinic switchboard number, a very common name) are
+# skipped by the batch job; they would cost quadratic comparisons and rarely hold real duplicates
+MAX_BLOCK_SIZE = 100
+
+
+def normalize_name(name):
+    """Lower-case a name, strip accents and punctuation and collapse whitespace"""
+    decomposed = unicodedata.normalize('NFKD', name if isinstance(name, str) else '')
+    letters = ''.join(char for char in decomposed if not unicodedata.combining(char)).lower()
+    return ' '.join(re.sub(r'[\W_]+', ' ', letters).split())
+
+
+def normalize_phone(contact):
+    """Return the significant trailing digits of a phone number, or '' if it has too few to compare"""
+    digits = re.sub(r'\D', '', contact if isinstance(contact, str) else '')
+    return digits[-PHONE_DIGITS:] if len(digits) >= 7 else ''
+
+
+def normalize_email(email):
+    """Lower-case and trim an email address, or return '' if it isn't one (None and NaN included)"""
+    email = email.strip().lower() if isinstance(email, str) else ''
+    return email if '@' in email else ''
+
+
+def name_trigrams(name):
+    """Return the set of character trigrams of a normalized name, padded so word edges count"""
+    padded = f" {normalize_name(name)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} if padded.strip() else set()
+
+
+def _jaccard(first, second):
+    """Jaccard similarity of two trigram sets, 0 when either is empty"""
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def name_similarity(first, second):
+    """Jaccard similarity of two names' trigram sets, from 0 (nothing shared) to 1 (same name)"""
+    return _jaccard(name_trigrams(first), name_trigrams(second))
+
+
+def minhash_bands(trigrams):
+    """Return one hash per MinHash band of a trigram set"""
+    hashes = [zlib.crc32(trigram.encode()) for trigram in trigrams]
+    signature = [min((a * value + b) % _MERSENNE_PRIME for value in hashes) for a, b in MINHASH_PERMUTATIONS]
+    return [
+        zlib.crc32(repr(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]).encode())
+        for band in range(MINHASH_BANDS)
+    ]
+
+
+def block_keys(name, contact, email):
+    """Return the index keys a patient is filed under"""
+    keys = []
+    phone = normalize_phone(contact)
+    if phone:
+        keys.append(f"phone:{phone}")
+    email = normalize_email(email)
+    if email:
+        keys.append(f"email:{email}")
+    trigrams = name_trigrams(name)
+    if trigrams:
+        keys += [f"name{band}:{value:08x}" for band, value in enumerate(minhash_bands(trigrams))]
+    return keys
+
+
+def _one_digit_apart(first, second):
+    """Whether two normalized phone numbers differ in exactly one position"""
+    return len(first) == len(second) and sum(a != b for a, b in zip(first, second)) == 1
+
+
+def fingerprint(patient):
+    """Normalize a patient mapping with name, contact and email once, for repeated comparisons"""
+    return name_trigrams(patient['name']), normalize_phone(patient['contact']), normalize_email(patient.get('email'))
+
+
+def compare_fingerprints(first, second):
+    """
+    Compare two patients' fingerprints.
+
+    Returns (similarity, reason, certain), or None when they don't look alike. Certain matches
+    are safe to merge; the rest are only worth a warning. Namesakes with different phones and
+    emails are never certain.
+    """
+    (first_trigrams, first_phone, first_email), (second_trigrams, second_phone, second_email) = first, second
+    similarity = _jaccard(first_trigrams, second_trigrams)
+    if first_phone and first_phone == second_phone and similarity >= LINKED_NAME_SIMILARITY:
+        return similarity, 'same phone', True
+    if first_email and first_email == second_email and similarity >= LINKED_NAME_SIMILARITY:
+        return similarity, 'same email', True
+    if similarity >= TYPO_NAME_SIMILARITY and _one_digit_apart(first_phone, second_phone):
+        return similarity, 'phone one digit apart', True
+    if similarity >= WARN_NAME_SIMILARITY:
+        return similarity, 'similar name', False
+    return None
+
+
+def compare_patients(first, second):
+    """Compare two patients given as mappings with name, contact and email; see compare_fingerprints"""
+    return compare_fingerprints(fingerprint(first), fingerprint(second))
+
+
+def cluster_pairs(pairs):
+    """Group matched (id, id) pairs into clusters with union-find; returns lists of ids, smallest first"""
+    parent = {}
+
+    def root(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for first, second in pairs:
+        first, second = root(first), root(second)
+        if first != second:
+            parent[max(first, second)] = min(first, second)
+    clusters = {}
+    for node in parent:
+        clusters.setdefault(root(node), []).append(node)
+    return sorted(sorted(members) for members in clusters.values())
+
+
+if __name__ == "__main__":
+    from database import DatabaseManager, archive_path_for
+
+    parser = argparse.ArgumentParser(description="Nani Health Clinic duplicate patient detection")
+    parser.add_argument("--db", default="clinic.db", help="Database to scan")
+    parser.add_argument("--archive", help="Its archive database (default: named after --db, e.g. clinic_archive.db)")
+    parser.add_argument("--merge", action="store_true", help="Merge every cluster into its oldest record")
+    parser.add_argument("--max-block-size", type=int, default=MAX_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    # Merging re-points archived payments and appointments too, so the archive must be this database's own
+    db = DatabaseManager(db_path=args.db, archive_path=args.archive or archive_path_for(args.db))
+    clusters = db.find_duplicate_clusters(args.max_block_size)
+    for cluster_id, members in clusters.groupby('cluster', sort=True):
+        print(f"Cluster {cluster_id}:")
+        for member in members.itertuples():
+            detail = "keep, oldest record" if member.keep else f"merge, {member.reason}"
+            print(f"  #{member.id} {member.name!r} {member.contact!r} {normalize_email(member.email)} ({detail})")
+    if clusters.empty:
+        print("No duplicates found")
+    elif args.merge:
+        print(f"Merged {db.merge_duplicate_clusters(clusters, args.max_block_size)} duplicate patient(s)")
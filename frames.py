@@ -0,0 +1,67 @@
+"""
+Typed query results: the column types each query's DataFrame is converted to after reading.
+"""
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+
+# Column types of each query's result: low-cardinality text (statuses, kinds, roles, staff names) becomes
+# categorical, dates are parsed once into datetime64, and ids and counts shrink to the smallest integer type
+# that holds them. Patient names are nearly unique per row, so they stay plain strings
+FRAME_SCHEMAS = {
+    'users': {'id': 'integer', 'role_id': 'integer', 'role_name': 'category', 'specialty': 'category',
+              'active': 'integer', 'created_at': 'timestamp', 'total_rows': 'integer', 'distance': 'integer'},
+    'roles': {'id': 'integer', 'role_name': 'category'},
+    'patients': {'id': 'integer', 'assigned_doctor_id': 'integer', 'doctor_name': 'category',
+                 'created_at': 'timestamp', 'total_rows': 'integer', 'distance': 'integer'},
+    'medical_records': {'id': 'integer', 'patient_id': 'integer', 'doctor_id': 'integer', 'doctor_name': 'category',
+                        'visit_date': 'date'},
+    'appointments': {'id': 'integer', 'appointment_date': 'timestamp', 'status': 'category',
+                     'patient_id': 'integer', 'assigned_to': 'category',
+                     'assigned_to_id': 'integer', 'series_id': 'integer', 'total_rows': 'integer'},
+    'patient_timeline': {'occurred_at': 'timestamp', 'kind': 'category', 'id': 'integer', 'status': 'category',
+                         'staff_name': 'category'},
+    'daily_summary': {'day': 'date', 'appointments': 'integer'},
+    'no_show_rates': {'doctor_id': 'integer', 'doctor_name': 'category', 'weekday': 'integer',
+                      'appointments': 'integer', 'completed': 'integer', 'no_shows': 'integer',
+                      'cancelled': 'integer'},
+    'finances': {'id': 'integer', 'date': 'date', 'transaction_type': 'category', 'patient_id': 'integer',
+                 'recorded_by_id': 'integer', 'recorded_by': 'category',
+                 'total_rows': 'integer'},
+    'patient_metrics': {'patient_id': 'integer', 'payment_count': 'integer', 'appointment_count': 'integer',
+                        'visit_count': 'integer', 'first_visit': 'date', 'last_visit': 'date',
+                        'days_since_last_visit': 'integer'},
+    'income_buckets': {'bucket': 'date', 'transactions': 'integer'},
+    'rolling_revenue': {'day': 'date'},
+    'month_over_month': {'month': 'date', 'transactions': 'integer'},
+    'revenue_per_doctor': {'doctor_id': 'integer', 'doctor_name': 'category', 'transactions': 'integer',
+                           'patients': 'integer', 'rank': 'integer'},
+}
+
+# Columns holding a calendar date rather than a moment, for writing typed frames back out as text
+DATE_COLUMNS = {
+    column for schema in FRAME_SCHEMAS.values() for column, kind in schema.items() if kind == 'date'
+}
+
+
+def typed_frame(frame, schema):
+    """Convert a query result's columns to the types declared for it in FRAME_SCHEMAS"""
+    for column, kind in FRAME_SCHEMAS[schema].items():
+        if column not in frame.columns:
+            continue
+        values = frame[column]
+        if kind == 'category':
+            frame[column] = values.astype('category')
+        elif kind in ('date', 'timestamp'):
+            frame[column] = pd.to_datetime(values)
+        elif values.isna().any():
+            # Optional ids (no doctor, no recorder) keep NULL as <NA> rather than turning the column float
+            frame[column] = pd.to_numeric(values.astype('Int64'), downcast='integer')
+        else:
+            frame[column] = pd.to_numeric(values, downcast='integer')
+    return frame
+
+
+def frame_memory(frame):
+    """Return the bytes a DataFrame holds, string contents included"""
+    return int(frame.memory_usage(deep=True).sum())
@@ -0,0 +1,87 @@
+"""
+Typo-tolerant name search.
+
+Names are filed in a trigram index (patient_name_trigrams, user_name_trigrams). A
+search looks up the names sharing most trigrams with the search term, then ranks
+those few candidates by edit distance: the fewest single-character insertions,
+deletions and substitutions that turn the term into part of the name. So
+"wanjru kamau" finds "Wanjiru Kamau" without comparing against every name.
+
+On the patient register only the term's rarest trigrams are looked up: a common
+one like "an " is filed under a tenth of all patients and says little about
+which of them was meant, while reading its entries would cost most of the search.
+"""
+from dedup import name_trigrams, normalize_name
+
+# Results a fuzzy search returns, and the candidates it ranks to find them
+FUZZY_MATCH_LIMIT = 20
+FUZZY_CANDIDATES = 300
+
+# Patient index entries read per search: the rarest trigrams are looked up until their entries
+# reach this many, and at least FUZZY_MIN_PROBES of them whatever their count
+FUZZY_PROBE_POSTINGS = 10_000
+FUZZY_MIN_PROBES = 2
+
+
+def max_edits(search_term):
+    """Typos tolerated in a search term: none below 3 characters, 1 up to 5 and 2 from 6"""
+    length = len(normalize_name(search_term))
+    return 0 if length < 3 else 1 if length < 6 else 2
+
+
+def search_trigrams(search_term):
+    """Return the trigrams to look a search term up by, none if it is too short to search fuzzily"""
+    if not max_edits(search_term):
+        # Too short to tell a typo from a different name
+        return []
+    return sorted(name_trigrams(search_term))
+
+
+def substring_distance(search_term, text):
+    """Edit distance from a search term to the closest part of text, both already normalized"""
+    # Myers' bit-parallel form of Sellers' algorithm: bit i of the vectors holds whether the edit
+    # distance column goes up (positive) or down (negative) at term position i, so each character
+    # of text costs a handful of integer operations instead of a column of the distance table
+    if not search_term:
+        return 0
+    all_bits = (1 << len(search_term)) - 1
+    last_bit = 1 << (len(search_term) - 1)
+    matches = {}
+    for position, char in enumerate(search_term):
+        matches[char] = matches.get(char, 0) | 1 << position
+    positive, negative = all_bits, 0
+    distance = best = len(search_term)
+    for char in text:
+        equal = matches.get(char, 0)
+        vertical = equal | negative
+        horizontal = (((equal & positive) + positive) ^ positive) | equal
+        horizontal_positive = negative | ~(horizontal | positive) & all_bits
+        horizontal_negative = positive & horizontal
+        if horizontal_positive & last_bit:
+            distance += 1
+        elif horizontal_negative & last_bit:
+            distance -= 1
+        # Not shifting a 1 in lets the match start anywhere in text
+        horizontal_positive = horizontal_positive << 1 & all_bits
+        horizontal_negative = horizontal_negative << 1 & all_bits
+        positive = horizontal_negative | ~(vertical | horizontal_positive) & all_bits
+        negative = horizontal_positive & vertical
+        if distance < best:
+            best = distance
+    return best
+
+
+def closest_names(search_term, candidates, limit=FUZZY_MATCH_LIMIT):
+    """Rank (id, name) candidates by edit distance to the term; return the closest within max_edits as {id: distance}"""
+    term, allowed = normalize_name(search_term), max_edits(search_term)
+    ranked = sorted(
+        (distance, name, row_id) for row_id, name in candidates
+        if (distance := substring_distance(term, normalize_name(name))) <= allowed
+    )
+    return {row_id: distance for distance, name, row_id in ranked[:limit]}
+
+
+def order_matches(frame, closest, column):
+    """Put the rows of the closest names in ranking order, with their edit distance in a distance column"""
+    frame['distance'] = frame['id'].map(lambda row_id: closest[int(row_id)])
+    return frame.sort_values(['distance', column, 'id'], kind='mergesort').reset_index(drop=True)
@@ -0,0 +1,27 @@
+import importlib
+import sys
+
+
+class LazyModule:
+    """Stand-in for a module that imports it on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for attributes the proxy itself doesn't have
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def is_loaded(self):
+        """Return True once the real module has been imported"""
+        return self._module is not None
+
+
+def lazy_import(name):
+    """Return a module, deferring its import until one of its attributes is first used"""
+    # The proxy stays out of sys.modules: tools that scan every loaded module
+    # (inspect.getmodule, which Streamlit calls per element) would import it
+    return sys.modules.get(name) or LazyModule(name)
@@ -1,18 +1,153 @@
 import streamlit as st
 from database import DatabaseManager
-import pandas as pd
+from backup import BACKUP_DIR, BackupManager
+from recurrence import MAX_SERIES_OCCURRENCES, SERIES_FREQUENCIES, SchedulingConflict
+from reminders import ReminderScheduler
+from repository import APPOINTMENT_STATUSES, TIMELINE_PAGE_SIZE, open_repository, timeline_cursor
+from sharding import ShardedRepository
 from datetime import datetime, date, timedelta
-import plotly.express as px
+from lazy_imports import lazy_import
+import calendar
+import html
 import os
 
+# Imported on first use, so the sidebar renders before pandas and plotly load
+pd = lazy_import('pandas')
+px = lazy_import('plotly.express')
+
+# Chart limits: points per time series and named slices before "Other"
+MAX_CHART_POINTS = 60
+TOP_N_BREAKDOWN = 10
+BUCKET_TITLES = {'day': 'Daily', 'week': 'Weekly', 'month': 'Monthly', 'year': 'Yearly'}
+# Rows per page in the selectable list grids
+PAGE_SIZE = 50
+# How each kind of patient timeline entry is marked
+TIMELINE_ICONS = {'visit': '🩺', 'appointment': '📅', 'payment': '💰'}
+# Finance record orderings offered in the search form: (order_by, descending)
+FINANCE_SORT_OPTIONS = {
+    'Newest first': ('date', True),
+    'Oldest first': ('date', False),
+    'Largest amount': ('amount', True),
+    'Patient name': ('patient', False),
+}
+
+@st.cache_resource
+def get_database():
+    """
+    Open the repository once per server process and share it across sessions and reruns;
+    SQLite gives each session thread its own connection
+    """
+    db = open_repository()
+    api_port = os.environ.get('CLINIC_API_PORT')
+    if api_port:
+        # Same process, so the API shares this repository and one result cache across its clients
+        from api import start_api_server
+        start_api_server(db, int(api_port))
+    if isinstance(db, ShardedRepository):
+        # Sharded reads go to the live branches, so there is no replica to refresh
+        for branch_id, branch in db.branches.items():
+            branch.start_counter_reconciler()
+            ReminderScheduler(branch.db_path).start_scheduler()
+            # Each branch rotates its own generations, so one branch's backups never push out another's
+            BackupManager(
+                branch.db_path, branch.archive_path, os.path.join(BACKUP_DIR, f"branch-{branch_id}")
+            ).start_scheduler()
+        # The directory alone links a patient's registrations at several branches; it has no archive
+        BackupManager(db.directory_path, None, os.path.join(BACKUP_DIR, 'directory')).start_scheduler()
+    if not isinstance(db, DatabaseManager):
+        # The archive, snapshot replica, backups and reminder outbox are SQLite-file features
+        return db
+    db.start_counter_reconciler()
+    db.start_replica_refresher()
+    # Queues tomorrow's appointment reminders in the outbox; `python reminders.py schedule` does the same standalone
+    ReminderScheduler(db.db_path).start_scheduler()
+    # Backups copy through their own connection; a copy that keeps being restarted by writes finishes in one step
+    BackupManager(db.db_path, db.archive_path).start_scheduler()
+    return db
+
+def calendar_table(header, rows):
+    """
+    Build one HTML table for a calendar grid; cells are already escaped HTML
+    """
+    cell_style = "border:1px solid #ddd;padding:4px;vertical-align:top;font-size:0.85em"
+    head = "".join(f'<th style="{cell_style}">{cell}</th>' for cell in header)
+    body = "".join(
+        "<tr>" + "".join(f'<td style="{cell_style}">{cell}</td>' for cell in row) + "</tr>"
+        for row in rows
+    )
+    return (
+        '<table style="width:100%;border-collapse:collapse;table-layout:fixed">'
+        f"<thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>"
+    )
+
+def option_index(ids, selected_id):
+    """
+    Position of an id among a selectbox's id options, or 0 when it is missing or NULL
+    """
+    if pd.isna(selected_id):
+        return 0
+    matches = (ids == selected_id).to_numpy().nonzero()[0]
+    return int(matches[0]) if len(matches) else 0
+
+class RequestContext:
+    """
+    Reference datasets shared by every section of a page during one script run
+    """
+    def __init__(self, db):
+        self.db = db
+        self._datasets = {}
+        # Calls the page sections asked for, i.e. DB calls without the snapshot
+        self.requested_calls = 0
+        # DB calls actually made
+        self.db_calls = 0
+
+    def _get(self, name, loader):
+        """
+        Return a dataset, loading it from the database on first use
+        """
+        self.requested_calls += 1
+        if name not in self._datasets:
+            self.db_calls += 1
+            self._datasets[name] = loader()
+        return self._datasets[name]
+
+    def users(self):
+        return self._get('users', self.db.get_users)
+
+    def roles(self):
+        return self._get('roles', self.db.get_roles)
+
+    def invalidate(self, *names):
+        """
+        Drop datasets after a write so later sections of the page reload them
+        """
+        for name in names:
+            self._datasets.pop(name, None)
+
 class MedicalPracticeApp:
     def __init__(self):
         """
-        Initialize the application with database connection and styling
+        Initialize the application styling; the database connects on first use
         """
-        self.db = DatabaseManager()
+        self._db = None
+        self.data = None
         self.setup_streamlit()
-        
+
+    @property
+    def db(self):
+        """
+        Shared database manager, connected the first time a page needs it
+        """
+        if self._db is None:
+            self._db = get_database()
+        return self._db
+
+    @property
+    def reports(self):
+        """
+        Read-only snapshot for dashboard charts, analysis and exports, so they never hold up writes
+        """
+        return self.db.replica()
 
     def setup_streamlit(self):
         """
@@ -24,19 +159,31 @@ class MedicalPracticeApp:
             initial_sidebar_state="expanded"
         )
 
-    def run(self):
+    def render_sidebar(self):
         """
-        Run the main application
+        Draw the sidebar navigation and return the selected page label
         """
-        #  sidebar navigation
         with st.sidebar:
             st.title("Nani Health Clinic")
             st.subheader("Clinic Dashboard")
-            page = st.radio(
-                "",  # Empty label for cleaner look
-                ["📊 Dashboard", "🏥 Patient Management", "👨‍⚕️ Staff Management", "📅 Appointments", "💰 Financial Records"]
+            # Hidden rather than empty label: Streamlit's empty-label warning walks the
+            # stack with inspect, which would import every lazily loaded module
+            return st.radio(
+                "Navigation",
+                ["📊 Dashboard", "🏥 Patient Management", "👨‍⚕️ Staff Management", "📅 Appointments", "💰 Financial Records"],
+                label_visibility="collapsed"
             )
 
+    def run(self):
+        """
+        Run the main application
+        """
+        #  sidebar navigation, drawn before the database is touched
+        page = self.render_sidebar()
+
+        # Fresh snapshot of reference data for this script run
+        self.data = RequestContext(self.db)
+
         #  page matching
         page = page.split(" ")[1]
 
@@ -51,6 +198,98 @@ class MedicalPracticeApp:
         elif page == "Financial":
             self.financial_records_page()
 
+        self.show_data_access_stats(page)
+
+    def show_data_access_stats(self, page):
+        """
+        Record and show how many reference-data DB calls the page made
+        """
+        stats = st.session_state.setdefault('db_call_stats', {})
+        stats[page] = {
+            'without_snapshot': self.data.requested_calls,
+            'with_snapshot': self.data.db_calls,
+        }
+        st.sidebar.caption(
+            f"Reference data: {self.data.db_calls} DB calls "
+            f"({self.data.requested_calls} without per-run snapshot)"
+        )
+
+    def selectable_grid(self, key, load_page, columns, column_config=None, scope=None):
+        """
+        Show one page of rows as a multi-row selectable grid and return the page and the selected rows;
+        load_page(offset, limit) returns the page with the unpaged row count in total_rows
+        """
+        page_key, scope_key, version_key = f"{key}_page", f"{key}_scope", f"{key}_version"
+        version = st.session_state.setdefault(version_key, 0)
+        # A new search or filter starts again from the first page with nothing selected
+        if st.session_state.get(scope_key) != scope:
+            st.session_state[scope_key] = scope
+            st.session_state[page_key] = 1
+            version = st.session_state[version_key] = version + 1
+
+        page = st.session_state.get(page_key, 1)
+        rows = load_page((page - 1) * PAGE_SIZE, PAGE_SIZE)
+        if rows.empty and page > 1:
+            page = 1
+            rows = load_page(0, PAGE_SIZE)
+        if rows.empty:
+            return rows, rows
+
+        total = int(rows['total_rows'].iloc[0])
+        page_count = -(-total // PAGE_SIZE)
+        st.session_state[page_key] = page = min(page, page_count)
+
+        event = st.dataframe(
+            rows[columns],
+            column_config=column_config,
+            hide_index=True,
+            on_select="rerun",
+            selection_mode="multi-row",
+            key=f"{key}_grid_{version}_{page}"
+        )
+
+        info_col, page_col = st.columns([3, 1])
+        with info_col:
+            first = (page - 1) * PAGE_SIZE + 1
+            st.caption(f"Rows {first}–{first + len(rows) - 1} of {total}")
+        with page_col:
+            st.number_input("Page", min_value=1, max_value=page_count, step=1, key=page_key)
+
+        return rows, rows.iloc[event.selection.rows]
+
+    def selection_actions(self, key, selected, edit_state, delete_rows, noun):
+        """
+        Edit and bulk-delete buttons acting on the rows selected in a grid
+        """
+        edit_col, delete_col, _ = st.columns([1, 2, 3])
+        with edit_col:
+            if st.button("Edit", key=f"{key}_edit", disabled=len(selected) != 1):
+                st.session_state[edit_state] = int(selected['id'].iloc[0])
+        with delete_col:
+            if st.button(f"Delete selected ({len(selected)})", key=f"{key}_delete", disabled=selected.empty):
+                deleted = delete_rows(selected['id'].tolist())
+                st.session_state[f"{key}_version"] += 1
+                st.session_state.pop(edit_state, None)
+                st.success(f"{deleted} {noun} deleted successfully!")
+                st.rerun()
+
+    def patient_options(self, key, selected=None):
+        """
+        Draw a patient search box and return its first matches as {id: label} options for a patient
+        selectbox, so no selectbox lists the whole register. The box must sit outside any form to
+        narrow the options as the user types; selected, the (id, name) of the record being edited,
+        stays the first option
+        """
+        text = st.text_input("🔍 Find patient", key=f"{key}_patient_search", placeholder="Name or phone number")
+        options = {}
+        if selected is not None and pd.notna(selected[0]):
+            options[int(selected[0])] = selected[1]
+        for patient_id, name, contact in self.db.pick_patients(text):
+            options.setdefault(patient_id, f"{name} ({contact})")
+        if text and not options:
+            st.caption("No patient's name or phone number starts with that.")
+        return options
+
     def dashboard_page(self):
         """
         Dashboard Page with summary metrics and visualizations
@@ -59,68 +298,41 @@ class MedicalPracticeApp:
         
         # Summary metrics
         st.subheader("Summary Metrics")
-        col1, col2, col3, col4 = st.columns(4)
+        col1, col2, col3, col4, col5 = st.columns(5)
         
-        # Get patient count
-        patients = self.db.get_patients()
-        patient_count = len(patients) if not patients.empty else 0
-        
-        # Get staff count
-        staff = self.db.get_users()
-        staff_count = len(staff) if not staff.empty else 0
-        
-        # Get doctor count
-        doctors_count = len(staff[staff['role_name'] == 'doctor']) if not staff.empty else 0
-        
-        # Get appointment count for today
-        today_appointments = self.db.get_appointments(date.today().strftime('%Y-%m-%d'))
-        appointment_count = len(today_appointments) if not today_appointments.empty else 0
-        
-        # Get financial data for the current month
-        first_day = date.today().replace(day=1)
-        monthly_finances = self.db.get_financial_records(
-            first_day.strftime('%Y-%m-%d'),
-            date.today().strftime('%Y-%m-%d')
-        )
-        
-        monthly_income = monthly_finances['amount'].sum() if not monthly_finances.empty else 0
+        # Counters are maintained by database triggers, so this is a single lookup
+        counters = self.db.get_counters()
         
         with col1:
-            st.metric("Total Patients", patient_count)
+            st.metric("Total Patients", counters['patient_count'])
         
         with col2:
-            st.metric("Medical Staff", staff_count)
+            st.metric("Medical Staff", counters['staff_count'])
             
         with col3:
-            st.metric("Today's Appointments", appointment_count)
-        
+            st.metric("Doctors", counters['doctor_count'])
+            
         with col4:
-            st.metric("Monthly Income", f"${monthly_income:.2f}")
+            st.metric("Today's Appointments", counters['today_appointments'])
+        
+        with col5:
+            st.metric("Monthly Income", f"${counters['monthly_income']:.2f}")
         
         # Charts and visualizations
         st.subheader("Financial Overview")
         
-        # Get data for the last 30 days
+        # Get data for the last 30 days, aggregated in SQL
         thirty_days_ago = date.today() - timedelta(days=30)
-        financial_data = self.db.get_financial_records(
-            thirty_days_ago.strftime('%Y-%m-%d'),
-            date.today().strftime('%Y-%m-%d')
-        )
+        bucket, income = self.reports.get_income_buckets(thirty_days_ago, date.today())
         
-        if not financial_data.empty:
-            # Convert date strings to datetime objects
-            financial_data['date'] = pd.to_datetime(financial_data['date'])
-            
-            # Group by date and sum amounts
-            daily_income = financial_data.groupby('date')['amount'].sum().reset_index()
-            
-            # Create a bar chart of daily income
+        if not income.empty:
+            # Create a bar chart of income per bucket
             fig = px.bar(
-                daily_income, 
-                x='date', 
+                income, 
+                x='bucket', 
                 y='amount',
-                labels={'date': 'Date', 'amount': 'Amount ($)'},
-                title='Daily Income (Last 30 Days)'
+                labels={'bucket': 'Date', 'amount': 'Amount ($)'},
+                title=f'{BUCKET_TITLES[bucket]} Income (Last 30 Days)'
             )
             
             st.plotly_chart(fig, use_container_width=True)
@@ -130,13 +342,12 @@ class MedicalPracticeApp:
             
             with col1:
                 # Patient distribution pie chart
-                patient_distribution = financial_data.groupby('patient_name')['amount'].sum().reset_index()
-                patient_distribution = patient_distribution.sort_values('amount', ascending=False).head(10)
+                patient_distribution = self.reports.get_income_breakdown(thirty_days_ago, date.today(), 'patient', 10)
                 
                 fig2 = px.pie(
                     patient_distribution, 
                     values='amount', 
-                    names='patient_name',
+                    names='label',
                     title='Top 10 Patients by Revenue'
                 )
                 
@@ -144,14 +355,13 @@ class MedicalPracticeApp:
             
             with col2:
                 # Staff performance if recorded_by data is available
-                if 'recorded_by' in financial_data.columns and financial_data['recorded_by'].notna().any():
-                    staff_performance = financial_data.groupby('recorded_by')['amount'].sum().reset_index()
-                    staff_performance = staff_performance.sort_values('amount', ascending=False)
-                    
+                staff_performance = self.reports.get_income_breakdown(thirty_days_ago, date.today(), 'staff', 10)
+                if not staff_performance.empty:
                     fig3 = px.bar(
                         staff_performance,
-                        x='recorded_by',
+                        x='label',
                         y='amount',
+                        labels={'label': 'Recorded By', 'amount': 'Amount ($)'},
                         title='Staff Performance (Revenue Recorded)'
                     )
                     
@@ -161,9 +371,8 @@ class MedicalPracticeApp:
             
         # Recent patients
         st.subheader("Recent Patients")
-        if not patients.empty:
-            # Sort by most recently added
-            recent_patients = patients.sort_values('id', ascending=False).head(5)
+        recent_patients = self.db.get_recent_patients(5)
+        if not recent_patients.empty:
             st.dataframe(
                 recent_patients[['name', 'contact', 'email', 'doctor_name']],
                 use_container_width=True,
@@ -174,9 +383,9 @@ class MedicalPracticeApp:
             
         # Today's appointments
         st.subheader("Today's Appointments")
+        today_appointments = self.db.get_appointments(date.today().strftime('%Y-%m-%d'))
         if not today_appointments.empty:
             # Format the appointment_date column for better display
-            today_appointments['appointment_date'] = pd.to_datetime(today_appointments['appointment_date'])
             today_appointments['time'] = today_appointments['appointment_date'].dt.strftime('%I:%M %p')
             
             st.dataframe(
@@ -205,8 +414,15 @@ class MedicalPracticeApp:
                 with cols[1]:
                     medical_history = st.text_area("Medical History")
                     
+                    # Sharded mode: new patients are registered at one branch
+                    branch_args = {}
+                    if len(getattr(self.db, 'branches', ())) > 1:
+                        branch_args['branch_id'] = st.selectbox(
+                            "Branch", options=list(self.db.branches), format_func=lambda b: f"Branch {b}"
+                        )
+
                     # Add doctor assignment dropdown
-                    doctors = self.db.get_users()
+                    doctors = self.data.users()
                     if not doctors.empty:
                         # Filter to only doctors
                         doctors = doctors[doctors['role_name'] == 'doctor']
@@ -225,138 +441,226 @@ class MedicalPracticeApp:
                 submit = st.form_submit_button("Add Patient")
                 
                 if submit and name and contact:
-                    self.db.add_patient(name, contact, email, medical_history, doctor_id)
-                    st.success("✅ Patient added successfully!")
+                    new_patient = dict(name=name, contact=contact, email=email, medical_history=medical_history,
+                                       assigned_doctor_id=doctor_id, **branch_args)
+                    # Checked against the duplicate index, not the whole register
+                    if self.db.find_similar_patients(name, contact, email).empty:
+                        self.db.add_patient(**new_patient)
+                        st.success("✅ Patient added successfully!")
+                    else:
+                        st.session_state.pending_patient = new_patient
+
+            # A registration that looks like an existing patient waits for confirmation
+            pending = st.session_state.get('pending_patient')
+            if pending:
+                similar = self.db.find_similar_patients(pending['name'], pending['contact'], pending['email'])
+                st.warning(f"⚠️ {pending['name']} may already be registered:")
+                st.dataframe(
+                    similar[['name', 'contact', 'email', 'doctor_name', 'reason']],
+                    column_config={'name': 'Name', 'contact': 'Contact', 'email': 'Email',
+                                   'doctor_name': 'Doctor', 'reason': 'Match'},
+                    hide_index=True
+                )
+                confirm_col, cancel_col = st.columns(2)
+                with confirm_col:
+                    if st.button("Add as a new patient anyway"):
+                        self.db.add_patient(**st.session_state.pop('pending_patient'))
+                        st.success("✅ Patient added successfully!")
+                with cancel_col:
+                    if st.button("Don't add"):
+                        del st.session_state.pending_patient
+                        st.rerun()
+
+        # Batch duplicate detection over the whole register, where the backend can merge records
+        if hasattr(self.db, 'find_duplicate_clusters'):
+            with st.expander("🧬 Duplicate Patients"):
+                if st.button("Scan for duplicates"):
+                    st.session_state.duplicate_clusters = self.db.find_duplicate_clusters()
+                clusters = st.session_state.get('duplicate_clusters')
+                if clusters is not None and clusters.empty:
+                    st.info("No duplicate patients found.")
+                elif clusters is not None:
+                    st.write(f"{clusters['cluster'].nunique()} group(s) of records for the same person; "
+                             "the oldest record of each group is kept and takes over the others' history.")
+                    st.dataframe(
+                        clusters,
+                        column_config={'cluster': 'Group', 'id': 'ID', 'name': 'Name', 'contact': 'Contact',
+                                       'email': 'Email', 'created_at': 'Registered', 'keep': 'Keep',
+                                       'reason': 'Match'},
+                        hide_index=True
+                    )
+                    if st.button("Merge all groups"):
+                        merged = self.db.merge_duplicate_clusters(clusters)
+                        del st.session_state.duplicate_clusters
+                        st.success(f"✅ Merged {merged} duplicate record(s).")
+                        skipped = int((~clusters['keep']).sum()) - merged
+                        if skipped:
+                            st.warning(f"{skipped} record(s) changed since the scan and were left as they are; "
+                                       "scan again to review them.")
+
+        # Sharded mode: the directory links one person's registrations at several branches
+        if len(getattr(self.db, 'branches', ())) > 1:
+            with st.expander("🌐 Patients Across Branches"):
+                directory_term = st.text_input("Find a patient at any branch", placeholder="Name, contact or email...",
+                                               key="directory_search")
+                people = self.db.find_patients(directory_term) if directory_term else None
+                if people is not None and people.empty:
+                    st.info("No patient at any branch matches your search.")
+                elif people is not None:
+                    st.dataframe(
+                        people[['name', 'contact', 'email', 'home_branch', 'branches']],
+                        column_config={'name': 'Name', 'contact': 'Contact', 'email': 'Email',
+                                       'home_branch': 'Home Branch', 'branches': 'Registered At'},
+                        hide_index=True
+                    )
+                    with st.form("register_visit_form"):
+                        person = st.selectbox(
+                            "Patient", options=people.index.tolist(),
+                            format_func=lambda row: f"{people.at[row, 'name']} ({people.at[row, 'contact']})"
+                        )
+                        visit_branch = st.selectbox(
+                            "Visiting branch", options=list(self.db.branches), format_func=lambda b: f"Branch {b}"
+                        )
+                        if st.form_submit_button("Register Visit"):
+                            # Any of the person's registrations leads to the same directory entry
+                            registered_id = int(people.at[person, 'patient_ids'].split(',')[0])
+                            local_id = self.db.register_visit(registered_id, visit_branch)
+                            st.success(f"✅ {people.at[person, 'name']} is registered at Branch {visit_branch} "
+                                       f"as patient #{local_id}; record their visit there under that registration.")
 
         #  search interface
         st.subheader("🔍 Search Patients")
         search_col1, search_col2 = st.columns([3, 1])
         with search_col1:
-            search_term = st.text_input("", placeholder="Search by name or contact...", key="patient_search")
+            search_term = st.text_input("Search patients", placeholder="Search by name or contact...", key="patient_search", label_visibility="collapsed")
         
         if search_term:
-            results = self.db.search_patients(search_term)
-            if not results.empty:
-                # Display patients with edit and delete buttons
-                for index, row in results.iterrows():
-                    with st.container():
-                        col1, col2, col3 = st.columns([4, 1, 1])
-                        with col1:
-                            st.write(f"**{row['name']}** - {row['contact']} ({row['email']})")
-                        with col2:
-                            if st.button("Edit", key=f"edit_{row['id']}"):
-                                st.session_state.patient_to_edit = row['id']
-                        with col3:
-                            if st.button("Delete", key=f"delete_{row['id']}"):
-                                self.db.delete_patient(row['id'])
-                                st.success(f"Patient {row['name']} deleted successfully!")
-                                st.rerun()
+            load_page = lambda offset, limit: self.db.search_patients(search_term, limit, offset)
+            load_all = lambda: self.reports.search_patients(search_term)
+        else:
+            st.subheader("All Patients")
+            load_page = lambda offset, limit: self.db.get_patients(limit, offset)
+            load_all = self.reports.get_patients
+
+        # One selectable grid per page of patients instead of a row of buttons per patient
+        results, selected = self.selectable_grid(
+            "patients",
+            load_page,
+            ['name', 'contact', 'email', 'doctor_name'],
+            column_config={'name': 'Name', 'contact': 'Contact', 'email': 'Email', 'doctor_name': 'Doctor'},
+            scope=search_term
+        )
+        if not results.empty:
+            self.selection_actions("patients", selected, 'patient_to_edit', self.db.delete_patients, "patient(s)")
+
+            # Edit form for the chosen patient while it is on the current page
+            patient_id = st.session_state.get('patient_to_edit')
+            if patient_id in results['id'].values:
+                patient_data = results[results['id'] == patient_id].iloc[0]
                 
-                # Display patient edit form if selected
-                if hasattr(st.session_state, 'patient_to_edit'):
-                    patient_id = st.session_state.patient_to_edit
-                    patient_data = results[results['id'] == patient_id].iloc[0]
+                st.subheader(f"Edit Patient: {patient_data['name']}")
+                if len(getattr(self.db, 'branches', ())) > 1:
+                    registrations = self.db.patient_branches(patient_id)
+                    others = registrations[registrations['patient_id'] != patient_id]
+                    if not others.empty:
+                        st.caption("Also registered at " + ", ".join(
+                            f"Branch {row.branch_id} (#{row.patient_id})" for row in others.itertuples()
+                        ))
+                with st.form("edit_patient_form"):
+                    cols = st.columns([1, 1])
+                    with cols[0]:
+                        edit_name = st.text_input("Full Name", value=patient_data['name'])
+                        edit_contact = st.text_input("Contact Number", value=patient_data['contact'])
+                        edit_email = st.text_input("Email Address", value=patient_data['email'])
                     
-                    st.subheader(f"Edit Patient: {patient_data['name']}")
-                    with st.form("edit_patient_form"):
-                        cols = st.columns([1, 1])
-                        with cols[0]:
-                            edit_name = st.text_input("Full Name", value=patient_data['name'])
-                            edit_contact = st.text_input("Contact Number", value=patient_data['contact'])
-                            edit_email = st.text_input("Email Address", value=patient_data['email'])
+                    with cols[1]:
+                        edit_medical_history = st.text_area("Medical History", value=patient_data['medical_history'] if 'medical_history' in patient_data else "")
                         
-                        with cols[1]:
-                            edit_medical_history = st.text_area("Medical History", value=patient_data['medical_history'] if 'medical_history' in patient_data else "")
-                            
-                            # Doctor assignment dropdown
-                            doctors = self.db.get_users()
+                        # Doctor assignment dropdown
+                        doctors = self.data.users()
+                        if not doctors.empty:
+                            # Filter to only doctors
+                            doctors = doctors[doctors['role_name'] == 'doctor']
                             if not doctors.empty:
-                                # Filter to only doctors
-                                doctors = doctors[doctors['role_name'] == 'doctor']
-                                if not doctors.empty:
-                                    current_doctor_id = patient_data['doctor_id'] if 'doctor_id' in patient_data else None
-                                    edit_doctor_id = st.selectbox(
-                                        "Assign Doctor",
-                                        options=doctors['id'].tolist(),
-                                        format_func=lambda x: doctors[doctors['id'] == x]['full_name'].iloc[0],
-                                        index=doctors['id'].tolist().index(current_doctor_id) if current_doctor_id in doctors['id'].tolist() else 0
-                                    )
-                                else:
-                                    edit_doctor_id = None
+                                current_doctor_id = patient_data['assigned_doctor_id']
+                                edit_doctor_id = st.selectbox(
+                                    "Assign Doctor",
+                                    options=doctors['id'].tolist(),
+                                    format_func=lambda x: doctors[doctors['id'] == x]['full_name'].iloc[0],
+                                    index=option_index(doctors['id'], current_doctor_id)
+                                )
                             else:
                                 edit_doctor_id = None
-                        
-                        save_changes = st.form_submit_button("Save Changes")
-                        cancel = st.form_submit_button("Cancel")
-                        
-                        if save_changes:
-                            self.db.update_patient(
-                                patient_id, 
-                                edit_name, 
-                                edit_contact, 
-                                edit_email, 
-                                edit_medical_history, 
-                                edit_doctor_id
-                            )
-                            st.success("✅ Patient updated successfully!")
-                            del st.session_state.patient_to_edit
-                            st.rerun()
-                        
-                        if cancel:
-                            del st.session_state.patient_to_edit
-                            st.rerun()
-                
-                # Generate patient report
-                st.download_button(
-                    label="📄 Generate Patient Report",
-                    data=results.to_csv().encode('utf-8'),
-                    file_name=f'patient_report_{date.today()}.csv',
-                    mime='text/csv',
-                )
-            else:
-                st.info("No patients found matching your search.")
+                        else:
+                            edit_doctor_id = None
+                    
+                    save_changes = st.form_submit_button("Save Changes")
+                    cancel = st.form_submit_button("Cancel")
+                    
+                    if save_changes:
+                        self.db.update_patient(
+                            patient_id, 
+                            edit_name, 
+                            edit_contact, 
+                            edit_email, 
+                            edit_medical_history, 
+                            edit_doctor_id
+                        )
+                        st.success("✅ Patient updated successfully!")
+                        del st.session_state.patient_to_edit
+                        st.rerun()
+                    
+                    if cancel:
+                        del st.session_state.patient_to_edit
+                        st.rerun()
+
+            # Built from the full result set only when the button is clicked
+            st.download_button(
+                label="📄 Generate Patient Report",
+                data=lambda: load_all().to_csv().encode('utf-8'),
+                file_name=f'patient_report_{date.today()}.csv',
+                mime='text/csv',
+                on_click="ignore",
+            )
+        elif search_term:
+            st.info("No patients found matching your search.")
+        else:
+            st.warning("No patients found in the system.")
         
-        # Display all patients if no search term
+        # Lifetime value and visit frequency, refreshed for patients changed since the last run
+        st.subheader("Patient Value & Visit Frequency")
+        self.db.refresh_patient_metrics()
+        top_patients = self.db.get_patient_metrics(limit=20)
+        if not top_patients.empty:
+            st.dataframe(
+                top_patients.drop(columns=['patient_id']),
+                column_config={
+                    'patient_name': 'Patient',
+                    'total_revenue': st.column_config.NumberColumn('Lifetime Value', format="$%.2f"),
+                    'payment_count': 'Payments',
+                    'appointment_count': 'Appointments',
+                    'visit_count': 'Visits',
+                    'first_visit': st.column_config.DateColumn('First Visit'),
+                    'last_visit': st.column_config.DateColumn('Last Visit'),
+                    'avg_visit_gap_days': st.column_config.NumberColumn('Avg. Days Between Visits', format="%.1f"),
+                    'days_since_last_visit': 'Days Since Last Visit',
+                },
+                use_container_width=True,
+                hide_index=True
+            )
         else:
-            all_patients = self.db.get_patients()
-            if not all_patients.empty:
-                st.subheader("All Patients")
-                
-                # Display patients with edit and delete buttons
-                for index, row in all_patients.iterrows():
-                    with st.container():
-                        col1, col2, col3 = st.columns([4, 1, 1])
-                        with col1:
-                            st.write(f"**{row['name']}** - {row['contact']} ({row['email']})")
-                        with col2:
-                            if st.button("Edit", key=f"edit_all_{row['id']}"):
-                                st.session_state.patient_to_edit = row['id']
-                        with col3:
-                            if st.button("Delete", key=f"delete_all_{row['id']}"):
-                                self.db.delete_patient(row['id'])
-                                st.success(f"Patient {row['name']} deleted successfully!")
-                                st.rerun()
-                
-                # Generate report button
-                st.download_button(
-                    label="📄 Generate All Patients Report",
-                    data=all_patients.to_csv().encode('utf-8'),
-                    file_name=f'all_patients_report_{date.today()}.csv',
-                    mime='text/csv',
-                )
-            else:
-                st.warning("No patients found in the system.")
+            st.info("No patient metrics available yet.")
         
         # Medical Records Section
         st.subheader("Medical Records")
         
         # Add medical record form
         with st.expander("➕ Add Medical Record"):
+            patient_choices = self.patient_options("new_medical_record")
             with st.form("new_medical_record_form"):
-                patients = self.db.get_patients()
-                doctors = self.db.get_users()
+                doctors = self.data.users()
                 
-                if not patients.empty and not doctors.empty:
+                if patient_choices and not doctors.empty:
                     # Filter to only doctors
                     doctors = doctors[doctors['role_name'] == 'doctor']
                     
@@ -365,8 +669,8 @@ class MedicalPracticeApp:
                     with col1:
                         patient_id = st.selectbox(
                             "Select Patient",
-                            options=patients['id'].tolist(),
-                            format_func=lambda x: patients[patients['id'] == x]['name'].iloc[0]
+                            options=list(patient_choices),
+                            format_func=patient_choices.get
                         )
                         
                         visit_date = st.date_input("Visit Date", value=date.today())
@@ -399,54 +703,73 @@ class MedicalPracticeApp:
                     submit = st.form_submit_button("Add Medical Record", disabled=True)
                     
         # View medical records
-        patients = self.db.get_patients()
-        if not patients.empty:
+        patient_choices = self.patient_options("view_records")
+        if patient_choices:
             selected_patient = st.selectbox(
                 "Select Patient to View Records",
-                options=patients['id'].tolist(),
-                format_func=lambda x: patients[patients['id'] == x]['name'].iloc[0]
+                options=list(patient_choices),
+                format_func=patient_choices.get
             )
             
+            # Cached lifetime metrics for the selected patient
+            patient_metrics = self.db.get_patient_metrics(selected_patient)
+            if not patient_metrics.empty:
+                metrics = patient_metrics.iloc[0]
+                metric_col1, metric_col2, metric_col3, metric_col4 = st.columns(4)
+                with metric_col1:
+                    st.metric("Lifetime Value", f"${metrics['total_revenue']:.2f}")
+                with metric_col2:
+                    st.metric("Visits", int(metrics['visit_count']))
+                with metric_col3:
+                    last_visit = metrics['last_visit']
+                    st.metric("Last Visit", f"{last_visit:%Y-%m-%d}" if pd.notna(last_visit) else "—")
+                with metric_col4:
+                    gap = metrics['avg_visit_gap_days']
+                    st.metric("Avg. Days Between Visits", f"{gap:.1f}" if pd.notna(gap) else "—")
+            
+            self.patient_timeline(selected_patient)
+            
             records = self.db.get_medical_records(selected_patient)
             if not records.empty:
                 for index, record in records.iterrows():
                     with st.container():
                         col1, col2, col3 = st.columns([4, 1, 1])
                         with col1:
-                            st.write(f"**Visit Date:** {record['visit_date']} - **Dr.** {record['doctor_name']}")
+                            st.write(f"**Visit Date:** {record['visit_date']:%Y-%m-%d} - **Dr.** {record['doctor_name']}")
                             st.write(f"**Diagnosis:** {record['diagnosis']}")
                             with st.expander("Treatment and Notes"):
                                 st.write(f"**Treatment:** {record['treatment']}")
                                 st.write(f"**Notes:** {record['notes']}")
                         with col2:
                             if st.button("Edit", key=f"edit_record_{record['id']}"):
-                                st.session_state.record_to_edit = record['id']
+                                st.session_state.record_to_edit = int(record['id'])
                         with col3:
                             if st.button("Delete", key=f"delete_record_{record['id']}"):
-                                self.db.delete_medical_record(record['id'])
+                                self.db.delete_medical_records([int(record['id'])])
+                                st.session_state.pop('record_to_edit', None)
                                 st.success("Medical record deleted successfully!")
                                 st.rerun()
                 
-                # Edit medical record form if a record is selected
-                if hasattr(st.session_state, 'record_to_edit'):
-                    record_id = st.session_state.record_to_edit
+                # Edit medical record form if one of this patient's records is selected
+                record_id = st.session_state.get('record_to_edit')
+                if record_id in records['id'].values:
                     record_data = records[records['id'] == record_id].iloc[0]
                     
                     st.subheader(f"Edit Medical Record")
                     with st.form("edit_medical_record_form"):
                         cols = st.columns([1, 1])
                         with cols[0]:
-                            doctors = self.db.get_users()
+                            doctors = self.data.users()
                             doctors = doctors[doctors['role_name'] == 'doctor']
                             
                             edit_doctor_id = st.selectbox(
                                 "Doctor",
                                 options=doctors['id'].tolist(),
                                 format_func=lambda x: doctors[doctors['id'] == x]['full_name'].iloc[0],
-                                index=doctors['id'].tolist().index(record_data['doctor_id']) if record_data['doctor_id'] in doctors['id'].tolist() else 0
+                                index=option_index(doctors['id'], record_data['doctor_id'])
                             )
                             
-                            edit_visit_date = st.date_input("Visit Date", value=pd.to_datetime(record_data['visit_date']).date())
+                            edit_visit_date = st.date_input("Visit Date", value=record_data['visit_date'].date())
                         
                         with cols[1]:
                             edit_diagnosis = st.text_area("Diagnosis", value=record_data['diagnosis'])
@@ -460,7 +783,7 @@ class MedicalPracticeApp:
                         if save_changes:
                             self.db.update_medical_record(
                                 record_id,
-                                record_data['patient_id'],
+                                int(record_data['patient_id']),
                                 edit_doctor_id,
                                 edit_visit_date,
                                 edit_diagnosis,
@@ -478,7 +801,7 @@ class MedicalPracticeApp:
                 st.download_button(
                     label="📄 Generate Medical Records Report",
                     data=records.to_csv().encode('utf-8'),
-                    file_name=f'medical_records_{patients[patients.id == selected_patient].name.iloc[0]}_{date.today()}.csv',
+                    file_name=f'medical_records_{records["patient_name"].iloc[0]}_{date.today()}.csv',
                     mime='text/csv',
                 )
             else:
@@ -486,6 +809,56 @@ class MedicalPracticeApp:
         else:
             st.warning("No patients available. Please add patients first.")
 
+    def patient_timeline(self, patient_id):
+        """
+        A patient's visits, appointments and payments as one scrolling timeline, newest first, read a
+        page at a time: "Load more" fetches only the entries after the last one shown
+        """
+        st.subheader("Timeline")
+        version = self.db.data_version()
+        timeline = st.session_state.get('patient_timeline')
+        if timeline is None or timeline['patient_id'] != patient_id:
+            entries = self.db.get_patient_timeline(patient_id)
+            timeline = st.session_state['patient_timeline'] = {
+                'patient_id': patient_id, 'version': version, 'entries': entries,
+                'more': len(entries) == TIMELINE_PAGE_SIZE,
+            }
+        elif version is None or timeline['version'] != version:
+            # Something may have been recorded since: read the entries shown so far again in one query
+            shown = max(len(timeline['entries']), TIMELINE_PAGE_SIZE)
+            timeline['entries'] = self.db.get_patient_timeline(patient_id, limit=shown)
+            timeline['version'] = version
+            timeline['more'] = len(timeline['entries']) == shown
+
+        entries = timeline['entries']
+        if entries.empty:
+            st.info("Nothing recorded for this patient yet.")
+            return
+
+        with st.container(height=400):
+            for entry in entries.itertuples():
+                # Visits and payments are dated by day only
+                when = f"{entry.occurred_at:%Y-%m-%d %H:%M}" if entry.kind == 'appointment' else f"{entry.occurred_at:%Y-%m-%d}"
+                title = entry.title if pd.notna(entry.title) and entry.title else entry.kind.capitalize()
+                line = f"{TIMELINE_ICONS[entry.kind]} **{when}** — {title}"
+                if entry.kind == 'payment':
+                    line += f" · ${entry.amount:.2f}"
+                elif entry.kind == 'appointment':
+                    line += f" · {entry.status}"
+                elif pd.notna(entry.detail) and entry.detail:
+                    line += f" · {entry.detail}"
+                if pd.notna(entry.staff_name):
+                    line += f" · {entry.staff_name}"
+                st.markdown(line)
+            if timeline['more']:
+                if st.button("Load more", key="patient_timeline_more"):
+                    page = self.db.get_patient_timeline(patient_id, timeline_cursor(entries))
+                    timeline['entries'] = pd.concat([entries, page], ignore_index=True)
+                    timeline['more'] = len(page) == TIMELINE_PAGE_SIZE
+                    st.rerun()
+            else:
+                st.caption(f"{len(entries)} entries, back to the first one recorded.")
+
     def staff_management_page(self):
         """
         Staff Management Page for managing medical staff (users)
@@ -502,7 +875,7 @@ class MedicalPracticeApp:
                     full_name = st.text_input("Full Name")
                     
                     # Get roles for dropdown
-                    roles = self.db.get_roles()
+                    roles = self.data.roles()
                     if not roles.empty:
                         role_id = st.selectbox(
                             "Role",
@@ -522,128 +895,102 @@ class MedicalPracticeApp:
                 
                 if submit and username and password and full_name and role_id:
                     self.db.add_user(username, password, full_name, role_id, email, phone, specialty)
+                    self.data.invalidate('users')
                     st.success("✅ Staff member added successfully!")
         
         # Search staff
         st.subheader("🔍 Search Staff")
         search_col1, search_col2 = st.columns([3, 1])
         with search_col1:
-            search_term = st.text_input("", placeholder="Search by name, username, or role...", key="staff_search")
+            search_term = st.text_input("Search staff", placeholder="Search by name, username, or role...", key="staff_search", label_visibility="collapsed")
         
         if search_term:
-            results = self.db.search_users(search_term)
-            if not results.empty:
-                # Display staff with edit and delete buttons
-                for index, row in results.iterrows():
-                    with st.container():
-                        col1, col2, col3 = st.columns([4, 1, 1])
-                        with col1:
-                            st.write(f"**{row['full_name']}** - {row['role_name']} ({row['email']})")
-                        with col2:
-                            if st.button("Edit", key=f"edit_staff_{row['id']}"):
-                                st.session_state.staff_to_edit = row['id']
-                        with col3:
-                            if st.button("Delete", key=f"delete_staff_{row['id']}"):
-                                self.db.delete_user(row['id'])
-                                st.success(f"Staff member {row['full_name']} deleted successfully!")
-                                st.rerun()
+            load_page = lambda offset, limit: self.db.search_users(search_term, limit, offset)
+            load_all = lambda: self.reports.search_users(search_term)
+        else:
+            st.subheader("All Staff Members")
+            load_page = lambda offset, limit: self.db.get_users(limit, offset)
+            load_all = self.reports.get_users
+
+        results, selected = self.selectable_grid(
+            "staff",
+            load_page,
+            ['full_name', 'role_name', 'email', 'phone', 'specialty'],
+            column_config={
+                'full_name': 'Name',
+                'role_name': 'Role',
+                'email': 'Email',
+                'phone': 'Phone',
+                'specialty': 'Specialty',
+            },
+            scope=search_term
+        )
+        if not results.empty:
+            self.selection_actions("staff", selected, 'staff_to_edit', self.db.delete_users, "staff member(s)")
+
+            # Edit form for the chosen staff member while they are on the current page
+            staff_id = st.session_state.get('staff_to_edit')
+            if staff_id in results['id'].values:
+                staff_data = results[results['id'] == staff_id].iloc[0]
                 
-                # Display staff edit form if selected
-                if hasattr(st.session_state, 'staff_to_edit'):
-                    staff_id = st.session_state.staff_to_edit
-                    staff_data = results[results['id'] == staff_id].iloc[0]
-                    
-                    st.subheader(f"Edit Staff Member: {staff_data['full_name']}")
-                    with st.form("edit_staff_form"):
-                        cols = st.columns([1, 1])
-                        with cols[0]:
-                            edit_username = st.text_input("Username", value=staff_data['username'])
-                            edit_password = st.text_input("Password (leave blank to keep current)", type="password")
-                            edit_full_name = st.text_input("Full Name", value=staff_data['full_name'])
-                            
-                            # Get roles for dropdown
-                            roles = self.db.get_roles()
-                            if not roles.empty:
-                                edit_role_id = st.selectbox(
-                                    "Role",
-                                    options=roles['id'].tolist(),
-                                    format_func=lambda x: roles[roles['id'] == x]['role_name'].iloc[0],
-                                    index=roles['id'].tolist().index(staff_data['role_id']) if staff_data['role_id'] in roles['id'].tolist() else 0
-                                )
-                            else:
-                                edit_role_id = None
-                        
-                        with cols[1]:
-                            edit_email = st.text_input("Email", value=staff_data['email'])
-                            edit_phone = st.text_input("Phone", value=staff_data['phone'])
-                            edit_specialty = st.text_input("Specialty", value=staff_data['specialty'] if 'specialty' in staff_data else "")
+                st.subheader(f"Edit Staff Member: {staff_data['full_name']}")
+                with st.form("edit_staff_form"):
+                    cols = st.columns([1, 1])
+                    with cols[0]:
+                        edit_username = st.text_input("Username", value=staff_data['username'])
+                        edit_password = st.text_input("Password (leave blank to keep current)", type="password")
+                        edit_full_name = st.text_input("Full Name", value=staff_data['full_name'])
                         
-                        save_changes = st.form_submit_button("Save Changes")
-                        cancel = st.form_submit_button("Cancel")
-                        
-                        if save_changes:
-                            self.db.update_user(
-                                staff_id,
-                                edit_username,
-                                edit_password,
-                                edit_full_name,
-                                edit_role_id,
-                                edit_email,
-                                edit_phone,
-                                edit_specialty
+                        # Get roles for dropdown
+                        roles = self.data.roles()
+                        if not roles.empty:
+                            edit_role_id = st.selectbox(
+                                "Role",
+                                options=roles['id'].tolist(),
+                                format_func=lambda x: roles[roles['id'] == x]['role_name'].iloc[0],
+                                index=option_index(roles['id'], staff_data['role_id'])
                             )
-                            st.success("✅ Staff member updated successfully!")
-                            del st.session_state.staff_to_edit
-                            st.rerun()
-                        
-                        if cancel:
-                            del st.session_state.staff_to_edit
-                            st.rerun()
-                
-                st.download_button(
-                    label="📄 Generate Staff Report",
-                    data=results.to_csv().encode('utf-8'),
-                    file_name=f'staff_report_{date.today()}.csv',
-                    mime='text/csv',
-                )
-            else:
-                st.info("No staff members found matching your search.")
-        
-        # Display all staff if no search term
+                        else:
+                            edit_role_id = None
+                    
+                    with cols[1]:
+                        edit_email = st.text_input("Email", value=staff_data['email'])
+                        edit_phone = st.text_input("Phone", value=staff_data['phone'])
+                        edit_specialty = st.text_input("Specialty", value=staff_data['specialty'] if 'specialty' in staff_data else "")
+                    
+                    save_changes = st.form_submit_button("Save Changes")
+                    cancel = st.form_submit_button("Cancel")
+                    
+                    if save_changes:
+                        self.db.update_user(
+                            staff_id,
+                            edit_username,
+                            edit_password,
+                            edit_full_name,
+                            edit_role_id,
+                            edit_email,
+                            edit_phone,
+                            edit_specialty
+                        )
+                        st.success("✅ Staff member updated successfully!")
+                        del st.session_state.staff_to_edit
+                        st.rerun()
+                    
+                    if cancel:
+                        del st.session_state.staff_to_edit
+                        st.rerun()
+
+            st.download_button(
+                label="📄 Generate Staff Report",
+                data=lambda: load_all().to_csv().encode('utf-8'),
+                file_name=f'staff_report_{date.today()}.csv',
+                mime='text/csv',
+                on_click="ignore",
+            )
+        elif search_term:
+            st.info("No staff members found matching your search.")
         else:
-            all_users = self.db.get_users()
-            if not all_users.empty:
-                st.subheader("All Staff Members")
-                
-                # Group staff by role
-                role_groups = all_users.groupby('role_name')
-                
-                for role_name, group in role_groups:
-                    with st.expander(f"{role_name.capitalize()} ({len(group)})"):
-                        for index, row in group.iterrows():
-                            with st.container():
-                                col1, col2, col3 = st.columns([4, 1, 1])
-                                with col1:
-                                    st.write(f"**{row['full_name']}** - {row['email']} ({row['phone']})")
-                                    if row['specialty']:
-                                        st.write(f"*Specialty: {row['specialty']}*")
-                                with col2:
-                                    if st.button("Edit", key=f"edit_all_staff_{row['id']}"):
-                                        st.session_state.staff_to_edit = row['id']
-                                with col3:
-                                    if st.button("Delete", key=f"delete_all_staff_{row['id']}"):
-                                        self.db.delete_user(row['id'])
-                                        st.success(f"Staff member {row['full_name']} deleted successfully!")
-                                        st.rerun()
-                
-                st.download_button(
-                    label="📄 Generate Complete Staff Report",
-                    data=all_users.to_csv().encode('utf-8'),
-                    file_name=f'all_staff_report_{date.today()}.csv',
-                    mime='text/csv',
-                )
-            else:
-                st.warning("No staff members found in the system.")
+            st.warning("No staff members found in the system.")
 
     def appointments_page(self):
         """
@@ -654,19 +1001,19 @@ class MedicalPracticeApp:
         # appointment scheduling form
         cols = st.columns([2, 1])
         with cols[0]:
+            st.subheader("Schedule New Appointment")
+            patient_choices = self.patient_options("new_appointment")
             with st.form("new_appointment_form"):
-                st.subheader("Schedule New Appointment")
-                patients = self.db.get_patients()
-                staff = self.db.get_users()
+                staff = self.data.users()
                 
-                if not patients.empty and not staff.empty:
+                if patient_choices and not staff.empty:
                     # Filter to only doctors and nurses
                     medical_staff = staff[(staff['role_name'] == 'doctor') | (staff['role_name'] == 'nurse')]
                     
                     patient_id = st.selectbox(
                         "Select Patient",
-                        options=patients['id'].tolist(),
-                        format_func=lambda x: patients[patients['id'] == x]['name'].iloc[0]
+                        options=list(patient_choices),
+                        format_func=patient_choices.get
                     )
                     
                     assigned_to = st.selectbox(
@@ -681,10 +1028,33 @@ class MedicalPracticeApp:
                     with time_col:
                         appointment_time = st.time_input("Time")
                     
+                    repeat_col, occurrences_col = st.columns(2)
+                    with repeat_col:
+                        repeat = st.selectbox("Repeat", options=["Does not repeat", *SERIES_FREQUENCIES],
+                                              format_func=str.capitalize)
+                    with occurrences_col:
+                        occurrences = st.number_input("Occurrences", min_value=2, max_value=MAX_SERIES_OCCURRENCES,
+                                                      value=12, help="Appointments booked when the visit repeats")
+                    
                     reason = st.text_area("Reason for Visit")
                     submit = st.form_submit_button("Schedule Appointment")
                     
-                    if submit:
+                    if submit and repeat in SERIES_FREQUENCIES:
+                        # Booked all at once, or not at all when any occurrence clashes
+                        try:
+                            self.db.add_appointment_series(
+                                patient_id,
+                                appointment_date,
+                                appointment_time,
+                                reason,
+                                assigned_to,
+                                repeat,
+                                int(occurrences)
+                            )
+                            st.success(f"✅ {int(occurrences)} {repeat} appointments scheduled successfully!")
+                        except SchedulingConflict as e:
+                            st.error(f"Nothing was scheduled: {e}")
+                    elif submit:
                         self.db.add_appointment(
                             patient_id,
                             appointment_date,
@@ -706,8 +1076,9 @@ class MedicalPracticeApp:
             view_date = st.date_input("Select Date", key="view_appointment_date")
         
         # Staff filter
+        staff_filter = -1
         with col2:
-            staff = self.db.get_users()
+            staff = self.data.users()
             if not staff.empty:
                 medical_staff = staff[(staff['role_name'] == 'doctor') | (staff['role_name'] == 'nurse')]
                 
@@ -721,70 +1092,108 @@ class MedicalPracticeApp:
                     format_func=lambda x: filter_staff[filter_staff['id'] == x]['full_name'].iloc[0] if x != -1 else "All Staff"
                 )
         
-        # Get appointments based on filters
-        if staff_filter == -1:  # All staff
-            appointments = self.db.get_appointments(view_date.strftime('%Y-%m-%d'))
-        else:
-            appointments = self.db.get_appointments(view_date.strftime('%Y-%m-%d'), staff_filter)
-            if not appointments.empty:
+        # Get appointments based on filters, one page at a time
+        view_day = view_date.strftime('%Y-%m-%d')
+        staff_id = None if staff_filter == -1 else staff_filter
+
+        def load_page(offset, limit):
+            page = self.db.get_appointments(view_day, staff_id, limit, offset)
             # Format the appointment_date column for better display
-                appointments['appointment_date'] = pd.to_datetime(appointments['appointment_date'])
-            appointments['time'] = appointments['appointment_date'].dt.strftime('%I:%M %p')
-            appointments['date'] = appointments['appointment_date'].dt.strftime('%Y-%m-%d')
-            
-            # Display appointments with edit and delete buttons
-            for index, row in appointments.iterrows():
-                with st.container():
-                    col1, col2, col3 = st.columns([4, 1, 1])
-                    with col1:
-                        st.write(f"**{row['time']}** - {row['patient_name']}")
-                        st.write(f"**Reason:** {row['reason']}")
-                        st.write(f"**Assigned to:** {row['assigned_to']}")
-                        st.write(f"**Status:** {row['status']}")
-                    with col2:
-                        if st.button("Edit", key=f"edit_appt_{row['id']}"):
-                            st.session_state.appointment_to_edit = row['id']
-                    with col3:
-                        if st.button("Delete", key=f"delete_appt_{row['id']}"):
-                            self.db.delete_appointment(row['id'])
-                            st.success(f"Appointment deleted successfully!")
-                            st.rerun()
-            
-            # Edit appointment form if an appointment is selected
-            if hasattr(st.session_state, 'appointment_to_edit'):
-                appt_id = st.session_state.appointment_to_edit
+            appointment_dates = page['appointment_date']
+            page['time'] = appointment_dates.dt.strftime('%I:%M %p')
+            page['date'] = appointment_dates.dt.strftime('%Y-%m-%d')
+            return page
+
+        appointments, selected = self.selectable_grid(
+            "appointments",
+            load_page,
+            ['time', 'patient_name', 'reason', 'assigned_to', 'status'],
+            column_config={
+                'time': 'Time',
+                'patient_name': 'Patient',
+                'reason': 'Reason',
+                'assigned_to': 'Assigned to',
+                'status': 'Status',
+            },
+            scope=(view_day, staff_id)
+        )
+        if not appointments.empty:
+            self.selection_actions(
+                "appointments", selected, 'appointment_to_edit', self.db.delete_appointments, "appointment(s)"
+            )
+
+            # End of day: one status change for the selected rows, or for everything still Scheduled
+            status_col, selected_col, remaining_col = st.columns([1, 1, 2])
+            with status_col:
+                new_status = st.selectbox("Mark as", options=APPOINTMENT_STATUSES[1:], key="appointments_new_status",
+                                          label_visibility="collapsed")
+            with selected_col:
+                mark_selected = st.button(f"Mark selected ({len(selected)})", disabled=selected.empty)
+            with remaining_col:
+                mark_remaining = st.button(
+                    f"Mark all still Scheduled on {view_date:%d %b}" + (" for this staff member" if staff_id else "")
+                )
+            if mark_selected or mark_remaining:
+                if mark_selected:
+                    changed = self.db.set_appointment_status(
+                        new_status, appointment_ids=selected['id'].tolist(), from_status=None
+                    )
+                else:
+                    changed = self.db.set_appointment_status(new_status, day=view_day, staff_id=staff_id)
+                st.session_state["appointments_version"] += 1
+                st.success(f"{changed} appointment(s) marked {new_status}!")
+                st.rerun()
+
+            # Edit form for the chosen appointment while it is on the current page
+            appt_id = st.session_state.get('appointment_to_edit')
+            if appt_id in appointments['id'].values:
                 appt_data = appointments[appointments['id'] == appt_id].iloc[0]
                 
                 st.subheader(f"Edit Appointment")
+                # Series occurrences can be changed together from this one on. Chosen outside the form, so the
+                # fields a series change can't carry are locked before anything is typed into them
+                in_series = not pd.isna(appt_data.get('series_id'))
+                scope = st.radio(
+                    "Apply to",
+                    options=["This appointment", "This and following"],
+                    horizontal=True,
+                    key=f"edit_scope_{appt_id}",
+                    help="This and following changes the time, staff member, reason and status of every "
+                         "scheduled visit of the series from this date on; the patient and date stay as they are",
+                ) if in_series else "This appointment"
+                whole_series = scope == "This and following"
+                patient_choices = self.patient_options(
+                    "edit_appointment", selected=(appt_data['patient_id'], appt_data['patient_name'])
+                )
                 with st.form("edit_appointment_form"):
-                    patients = self.db.get_patients()
-                    staff = self.db.get_users()
+                    staff = self.data.users()
                     medical_staff = staff[(staff['role_name'] == 'doctor') | (staff['role_name'] == 'nurse')]
                     
                     edit_patient_id = st.selectbox(
                         "Select Patient",
-                        options=patients['id'].tolist(),
-                        format_func=lambda x: patients[patients['id'] == x]['name'].iloc[0],
-                        index=patients['id'].tolist().index(appt_data['patient_id']) if appt_data['patient_id'] in patients['id'].tolist() else 0
+                        options=list(patient_choices),
+                        format_func=patient_choices.get,
+                        disabled=whole_series
                     )
                     
                     edit_assigned_to = st.selectbox(
                         "Assign to Staff Member",
                         options=medical_staff['id'].tolist(),
                         format_func=lambda x: f"{medical_staff[medical_staff['id'] == x]['full_name'].iloc[0]} ({medical_staff[medical_staff['id'] == x]['role_name'].iloc[0]})",
-                        index=medical_staff['id'].tolist().index(appt_data['assigned_to_id']) if 'assigned_to_id' in appt_data and appt_data['assigned_to_id'] in medical_staff['id'].tolist() else 0
+                        index=option_index(medical_staff['id'], appt_data.get('assigned_to_id'))
                     )
                     
                     edit_date_col, edit_time_col, edit_status_col = st.columns(3)
                     with edit_date_col:
-                        edit_appointment_date = st.date_input("Date", value=pd.to_datetime(appt_data['date']).date())
+                        edit_appointment_date = st.date_input("Date", value=pd.to_datetime(appt_data['date']).date(),
+                                                              disabled=whole_series)
                     with edit_time_col:
                         edit_appointment_time = st.time_input("Time", value=pd.to_datetime(appt_data['time']).time())
                     with edit_status_col:
                         edit_status = st.selectbox(
                             "Status",
-                            options=["Scheduled", "Completed", "Cancelled", "No-show"],
-                            index=["Scheduled", "Completed", "Cancelled", "No-show"].index(appt_data['status']) if appt_data['status'] in ["Scheduled", "Completed", "Cancelled", "No-show"] else 0
+                            options=APPOINTMENT_STATUSES,
+                            index=APPOINTMENT_STATUSES.index(appt_data['status']) if appt_data['status'] in APPOINTMENT_STATUSES else 0
                         )
                     
                     edit_reason = st.text_area("Reason for Visit", value=appt_data['reason'])
@@ -792,7 +1201,22 @@ class MedicalPracticeApp:
                     save_changes = st.form_submit_button("Save Changes")
                     cancel = st.form_submit_button("Cancel")
                     
-                    if save_changes:
+                    if save_changes and whole_series:
+                        try:
+                            changed = self.db.update_appointment_series(
+                                int(appt_data['series_id']),
+                                pd.to_datetime(appt_data['date']).date(),
+                                edit_appointment_time,
+                                edit_reason,
+                                edit_assigned_to,
+                                edit_status
+                            )
+                            st.success(f"✅ {changed} appointment(s) of the series updated successfully!")
+                            del st.session_state.appointment_to_edit
+                            st.rerun()
+                        except SchedulingConflict as e:
+                            st.error(f"Nothing was changed: {e}")
+                    elif save_changes:
                         self.db.update_appointment(
                             appt_id,
                             edit_patient_id,
@@ -809,59 +1233,135 @@ class MedicalPracticeApp:
                     if cancel:
                         del st.session_state.appointment_to_edit
                         st.rerun()
-            
+
             # Generate appointment report
             st.download_button(
                 label="📄 Generate Appointments Report",
-                data=appointments.to_csv().encode('utf-8'),
+                data=lambda: self.reports.get_appointments(view_day, staff_id).to_csv().encode('utf-8'),
                 file_name=f'appointments_report_{view_date}.csv',
                 mime='text/csv',
+                on_click="ignore",
             )
-        
+        else:
             st.info(f"No appointments found for {view_date}.")
             
-        # Weekly calendar view
-        st.subheader("Weekly Calendar")
-        
-        # Calculate start and end of week
-        today = date.today()
-        start_of_week = today - timedelta(days=today.weekday())
-        end_of_week = start_of_week + timedelta(days=6)
+        # Calendar view, rendered as one HTML table whatever the number of appointments
+        st.subheader("Calendar")
         
-        # Get appointments for the week
-        weekly_appointments = self.db.get_appointments_range(
-            start_of_week.strftime('%Y-%m-%d'),
-            end_of_week.strftime('%Y-%m-%d')
-        )
+        view_col, anchor_col, staff_col = st.columns(3)
+        with view_col:
+            calendar_view = st.radio("View", ["Week", "Month"], horizontal=True, key="calendar_view")
+        with anchor_col:
+            anchor_date = st.date_input("Show period containing", value=date.today(), key="calendar_anchor")
+        with staff_col:
+            staff = self.data.users()
+            medical_staff = staff[(staff['role_name'] == 'doctor') | (staff['role_name'] == 'nurse')]
+            calendar_staff = st.selectbox(
+                "Calendar Staff",
+                options=[-1] + medical_staff['id'].tolist(),
+                format_func=lambda x: "All Staff" if x == -1 else medical_staff[medical_staff['id'] == x]['full_name'].iloc[0],
+                key="calendar_staff"
+            )
+        calendar_staff = None if calendar_staff == -1 else calendar_staff
         
-        if not weekly_appointments.empty:
-            # Group appointments by date
-            weekly_appointments['appointment_date'] = pd.to_datetime(weekly_appointments['appointment_date'])
-            weekly_appointments['date_str'] = weekly_appointments['appointment_date'].dt.strftime('%Y-%m-%d')
-            weekly_appointments['time'] = weekly_appointments['appointment_date'].dt.strftime('%I:%M %p')
-            
-            date_groups = weekly_appointments.groupby('date_str')
-            
-            # Create a 7-column layout for the week
-            weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-            cols = st.columns(7)
-            
-            for i, day in enumerate(weekdays):
-                current_date = start_of_week + timedelta(days=i)
-                date_str = current_date.strftime('%Y-%m-%d')
-                
-                with cols[i]:
-                    st.write(f"**{day}**")
-                    st.write(f"{current_date.strftime('%m/%d')}")
-                    
-                    if date_str in date_groups.groups:
-                        day_appointments = date_groups.get_group(date_str)
-                        for _, appt in day_appointments.iterrows():
-                            st.write(f"**{appt['time']}**")
-                            st.write(f"{appt['patient_name']}")
-                            st.write(f"*{appt['assigned_to']}*")
+        if calendar_view == "Week":
+            self.week_calendar(anchor_date - timedelta(days=anchor_date.weekday()), calendar_staff)
         else:
+            self.month_calendar(anchor_date.replace(day=1), calendar_staff)
+
+        self.no_show_rates()
+
+    def no_show_rates(self):
+        """
+        No-show rates per staff member and per weekday over a chosen period, from the status history
+        """
+        st.subheader("No-show Rates")
+        period = st.date_input(
+            "Period", value=(date.today() - timedelta(days=90), date.today()), key="no_show_period"
+        )
+        if len(period) != 2:
+            return
+        start, end = period
+        by_doctor = self.reports.get_no_show_rates(start, end, 'doctor')
+        if by_doctor.empty:
+            st.info("No completed, missed or cancelled appointments in this period.")
+            return
+
+        rate_config = {
+            'no_show_rate': st.column_config.ProgressColumn("No-show rate", format="percent", min_value=0, max_value=1),
+            'completed': 'Completed',
+            'no_shows': 'No-shows',
+            'cancelled': 'Cancelled',
+        }
+        doctor_col, weekday_col = st.columns(2)
+        with doctor_col:
+            st.dataframe(
+                by_doctor[['doctor_name', 'no_show_rate', 'no_shows', 'completed', 'cancelled']],
+                column_config={'doctor_name': 'Staff member', **rate_config},
+                hide_index=True
+            )
+        with weekday_col:
+            by_weekday = self.reports.get_no_show_rates(start, end, 'weekday')
+            by_weekday['day'] = by_weekday['weekday'].map(lambda weekday: calendar.day_name[weekday])
+            st.dataframe(
+                by_weekday[['day', 'no_show_rate', 'no_shows', 'completed', 'cancelled']],
+                column_config={'day': 'Weekday', **rate_config},
+                hide_index=True
+            )
+
+    def week_calendar(self, start_of_week, staff_id=None):
+        """
+        Time-slot x weekday grid for one week
+        """
+        grid = self.db.get_week_calendar(start_of_week, staff_id)
+        if grid.empty:
             st.info("No appointments scheduled for this week.")
+            return
+        
+        header = [""] + [
+            f"{(start_of_week + timedelta(days=i)).strftime('%A')}<br>{(start_of_week + timedelta(days=i)).strftime('%m/%d')}"
+            for i in range(7)
+        ]
+        rows = [
+            [f"<b>{html.escape(row['slot'])}</b>"] + [
+                html.escape(row[f'day{i}']).replace("\n", "<br>") if isinstance(row[f'day{i}'], str) else ""
+                for i in range(7)
+            ]
+            for row in grid.to_dict('records')
+        ]
+        st.markdown(calendar_table(header, rows), unsafe_allow_html=True)
+
+    def month_calendar(self, first_day, staff_id=None):
+        """
+        Week x weekday grid for one month with a per-day count and the first appointments of each day
+        """
+        last_day = (first_day + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        summary = self.db.get_daily_appointment_summary(
+            first_day.strftime('%Y-%m-%d'),
+            last_day.strftime('%Y-%m-%d'),
+            staff_id
+        )
+        days = {row['day'].date(): row for row in summary.to_dict('records')}
+        
+        header = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+        rows = []
+        for week in calendar.Calendar().monthdatescalendar(first_day.year, first_day.month):
+            cells = []
+            for day in week:
+                if day.month != first_day.month:
+                    cells.append("")
+                    continue
+                cell = f"<b>{day.day}</b>"
+                entry = days.get(day)
+                if entry:
+                    cell += f" &middot; {entry['appointments']} appt"
+                    cell += "<br>" + html.escape(entry['entries'] or "").replace("\n", "<br>")
+                    shown = (entry['entries'] or "").count("\n") + 1
+                    if entry['appointments'] > shown:
+                        cell += f"<br><i>+{entry['appointments'] - shown} more</i>"
+                cells.append(cell)
+            rows.append(cells)
+        st.markdown(calendar_table(header, rows), unsafe_allow_html=True)
 
     def financial_records_page(self):
         """
@@ -870,26 +1370,26 @@ class MedicalPracticeApp:
         st.title("Financial Records")
         
         # Record income form with columns
+        st.subheader("Record Payment")
+        patient_choices = self.patient_options("income")
         with st.form("income_form"):
-            st.subheader("Record Payment")
             cols = st.columns([1, 1, 1])
             
             with cols[0]:
                 amount = st.number_input("Amount ($)", min_value=0.0, format="%.2f")
             
-            patients = self.db.get_patients()
-            if not patients.empty:
+            if patient_choices:
                 with cols[1]:
                     patient_id = st.selectbox(
                         "Select Patient",
-                        options=patients['id'].tolist(),
-                        format_func=lambda x: patients[patients['id'] == x]['name'].iloc[0]
+                        options=list(patient_choices),
+                        format_func=patient_choices.get
                     )
                 with cols[2]:
                     description = st.text_input("Payment Description")
                     
                     # Add staff who recorded the payment
-                    staff = self.db.get_users()
+                    staff = self.data.users()
                     if not staff.empty:
                         recorded_by_id = st.selectbox(
                             "Recorded By",
@@ -918,6 +1418,7 @@ class MedicalPracticeApp:
         st.subheader("Financial Records Search")
         
         # Search form for financial records
+        patient_choices = self.patient_options("financial_search")
         with st.form("financial_search_form"):
             col1, col2 = st.columns(2)
             with col1:
@@ -925,95 +1426,112 @@ class MedicalPracticeApp:
             with col2:
                 end_date = st.date_input("End Date", value=date.today())
             
-            # Additional search options
+            # Additional search options, by id so namesakes stay apart
             search_col1, search_col2 = st.columns(2)
             with search_col1:
                 patient_filter = st.selectbox(
                     "Filter by Patient",
-                    options=["All Patients"] + patients['name'].tolist() if not patients.empty else ["All Patients"]
+                    options=[None] + list(patient_choices),
+                    format_func=lambda x: "All Patients" if x is None else f"{patient_choices[x]} #{x}"
                 )
             
             with search_col2:
-                staff = self.db.get_users()
-                if not staff.empty:
-                    staff_filter = st.selectbox(
-                        "Filter by Staff",
-                        options=["All Staff"] + staff['full_name'].tolist()
-                    )
-                else:
-                    staff_filter = "All Staff"
+                staff = self.data.users()
+                staff_names = dict(zip(staff['id'], staff['full_name'])) if not staff.empty else {}
+                staff_filter = st.selectbox(
+                    "Filter by Staff",
+                    options=[None] + list(staff_names),
+                    format_func=lambda x: "All Staff" if x is None else staff_names[x]
+                )
+            
+            amount_col1, amount_col2, order_col = st.columns(3)
+            with amount_col1:
+                min_amount = st.number_input("Min Amount ($)", min_value=0.0, value=None, format="%.2f")
+            with amount_col2:
+                max_amount = st.number_input("Max Amount ($)", min_value=0.0, value=None, format="%.2f")
+            with order_col:
+                ordering = st.selectbox("Sort By", options=list(FINANCE_SORT_OPTIONS))
             
             search_button = st.form_submit_button("Search Records")
         
-        if search_button and start_date <= end_date:
-            # Get financial records filtered by date
-            records = self.db.get_financial_records(
-                start_date.strftime('%Y-%m-%d'),
-                end_date.strftime('%Y-%m-%d')
+        # The search is kept so selecting rows, which reruns the page, keeps the results
+        if search_button and start_date > end_date:
+            st.session_state.pop('finance_search', None)
+            st.error("Start date must be before end date.")
+        elif search_button and min_amount is not None and max_amount is not None and min_amount > max_amount:
+            st.session_state.pop('finance_search', None)
+            st.error("Min amount must not exceed max amount.")
+        elif search_button:
+            order_by, descending = FINANCE_SORT_OPTIONS[ordering]
+            st.session_state.finance_search = {
+                'start_date': start_date.strftime('%Y-%m-%d'),
+                'end_date': end_date.strftime('%Y-%m-%d'),
+                'patient_id': patient_filter,
+                'recorded_by_id': staff_filter,
+                'min_amount': min_amount,
+                'max_amount': max_amount,
+                'order_by': order_by,
+                'descending': descending,
+            }
+        
+        if 'finance_search' in st.session_state:
+            search = st.session_state.finance_search
+            # Filters, order and paging all run in one SQL query; the page carries the filtered total
+            total_slot = st.empty()
+            records_page, selected = self.selectable_grid(
+                "finances",
+                lambda offset, limit: self.db.get_financial_records(**search, limit=limit, offset=offset),
+                ['date', 'amount', 'patient_name', 'description', 'recorded_by'],
+                column_config={
+                    'date': st.column_config.DateColumn('Date'),
+                    'amount': st.column_config.NumberColumn('Amount', format='$%.2f'),
+                    'patient_name': 'Patient',
+                    'description': 'Description',
+                    'recorded_by': 'Recorded by',
+                },
+                scope=search
             )
             
-            # Apply additional filters if selected
-            if not records.empty:
-                if patient_filter != "All Patients":
-                    records = records[records['patient_name'] == patient_filter]
-                
-                if staff_filter != "All Staff":
-                    records = records[records['recorded_by'] == staff_filter]
-                
+            if not records_page.empty:
                 # Display total income
-                total_income = records['amount'].sum()
-                st.metric("Total Income", f"${total_income:.2f}")
-                
-                # Display financial records with edit and delete buttons
-                for index, row in records.iterrows():
-                    with st.container():
-                        col1, col2, col3 = st.columns([4, 1, 1])
-                        with col1:
-                            st.write(f"**${row['amount']:.2f}** - {row['date']} - {row['patient_name']}")
-                            st.write(f"**Description:** {row['description']}")
-                            if 'recorded_by' in row and row['recorded_by']:
-                                st.write(f"*Recorded by: {row['recorded_by']}*")
-                        with col2:
-                            if st.button("Edit", key=f"edit_finance_{row['id']}"):
-                                st.session_state.finance_to_edit = row['id']
-                        with col3:
-                            if st.button("Delete", key=f"delete_finance_{row['id']}"):
-                                self.db.delete_financial_record(row['id'])
-                                st.success("Financial record deleted successfully!")
-                                st.rerun()
+                total_slot.metric("Total Income", f"${records_page['filtered_total'].iloc[0]:.2f}")
+                self.selection_actions(
+                    "finances", selected, 'finance_to_edit', self.db.delete_financial_records, "financial record(s)"
+                )
                 
-                # Edit financial record form if a record is selected
-                if hasattr(st.session_state, 'finance_to_edit'):
-                    finance_id = st.session_state.finance_to_edit
-                    finance_data = records[records['id'] == finance_id].iloc[0]
+                # Edit form for the chosen record while it is on the current page
+                finance_id = st.session_state.get('finance_to_edit')
+                if finance_id in records_page['id'].values:
+                    finance_data = records_page[records_page['id'] == finance_id].iloc[0]
                     
                     st.subheader(f"Edit Financial Record")
+                    patient_choices = self.patient_options(
+                        "edit_finance", selected=(finance_data['patient_id'], finance_data['patient_name'])
+                    )
                     with st.form("edit_finance_form"):
                         cols = st.columns([1, 1, 1])
                         with cols[0]:
                             edit_amount = st.number_input("Amount ($)", min_value=0.0, format="%.2f", value=finance_data['amount'])
-                            edit_date = st.date_input("Date", value=pd.to_datetime(finance_data['date']).date())
+                            edit_date = st.date_input("Date", value=finance_data['date'].date())
                         
                         with cols[1]:
-                            patients = self.db.get_patients()
                             edit_patient_id = st.selectbox(
                                 "Select Patient",
-                                options=patients['id'].tolist(),
-                                format_func=lambda x: patients[patients['id'] == x]['name'].iloc[0],
-                                index=patients['id'].tolist().index(finance_data['patient_id']) if finance_data['patient_id'] in patients['id'].tolist() else 0
+                                options=list(patient_choices),
+                                format_func=patient_choices.get
                             )
                         
                         with cols[2]:
                             edit_description = st.text_input("Payment Description", value=finance_data['description'])
                             
                             # Staff who recorded the payment
-                            staff = self.db.get_users()
+                            staff = self.data.users()
                             if not staff.empty and 'recorded_by_id' in finance_data:
                                 edit_recorded_by_id = st.selectbox(
                                     "Recorded By",
                                     options=staff['id'].tolist(),
                                     format_func=lambda x: staff[staff['id'] == x]['full_name'].iloc[0],
-                                    index=staff['id'].tolist().index(finance_data['recorded_by_id']) if finance_data['recorded_by_id'] in staff['id'].tolist() else 0
+                                    index=option_index(staff['id'], finance_data['recorded_by_id'])
                                 )
                             else:
                                 edit_recorded_by_id = None
@@ -1038,17 +1556,16 @@ class MedicalPracticeApp:
                             del st.session_state.finance_to_edit
                             st.rerun()
                 
-                # Generate financial report
+                # Generate financial report with every matching record, not just this page
                 st.download_button(
                     label="📄 Generate Financial Report",
-                    data=records.to_csv().encode('utf-8'),
-                    file_name=f'financial_report_{start_date}_to_{end_date}.csv',
+                    data=lambda: self.reports.get_financial_records(**search).to_csv().encode('utf-8'),
+                    file_name=f"financial_report_{search['start_date']}_to_{search['end_date']}.csv",
                     mime='text/csv',
+                    on_click="ignore",
                 )
             else:
-                st.info(f"No financial records found between {start_date} and {end_date}.")
-        elif search_button:
-            st.error("Start date must be before end date.")
+                st.info(f"No financial records match the search between {search['start_date']} and {search['end_date']}.")
         
         # Financial analysis section
         st.subheader("Financial Analysis")
@@ -1061,18 +1578,18 @@ class MedicalPracticeApp:
             analysis_end_date = st.date_input("Analysis End Date", value=date.today())
         
         if analysis_start_date <= analysis_end_date:
-            # Get data for analysis
-            analysis_data = self.db.get_financial_records(
-                analysis_start_date.strftime('%Y-%m-%d'),
-                analysis_end_date.strftime('%Y-%m-%d')
+            reports = self.reports
+            st.caption(f"Figures from a snapshot taken {self.db.replica_age():.0f}s ago")
+            # Aggregate in SQL; the bucket widens with the range so the chart stays small
+            bucket, income = reports.get_income_buckets(
+                analysis_start_date,
+                analysis_end_date,
+                max_points=MAX_CHART_POINTS
             )
             
-            if not analysis_data.empty:
-                # Convert date strings to datetime objects
-                analysis_data['date'] = pd.to_datetime(analysis_data['date'])
-                
+            if not income.empty:
                 # Display key metrics
-                total_income = analysis_data['amount'].sum()
+                total_income = income['amount'].sum()
                 avg_daily_income = total_income / max((analysis_end_date - analysis_start_date).days, 1)
                 
                 metric_col1, metric_col2, metric_col3 = st.columns(3)
@@ -1081,58 +1598,114 @@ class MedicalPracticeApp:
                 with metric_col2:
                     st.metric("Avg. Daily Income", f"${avg_daily_income:.2f}")
                 with metric_col3:
-                    st.metric("Transaction Count", f"{len(analysis_data)}")
+                    st.metric("Transaction Count", f"{income['transactions'].sum()}")
                 
                 # Charts row
                 chart_col1, chart_col2 = st.columns(2)
                 
                 with chart_col1:
-                    # Group by date and sum amounts
-                    daily_income = analysis_data.groupby(analysis_data['date'].dt.date)['amount'].sum().reset_index()
-                    
-                    # Create a bar chart of daily income
+                    # Create a bar chart of income per bucket
                     fig1 = px.bar(
-                        daily_income, 
-                        x='date', 
+                        income, 
+                        x='bucket', 
                         y='amount',
-                        labels={'date': 'Date', 'amount': 'Income ($)'},
-                        title='Daily Income'
+                        labels={'bucket': 'Date', 'amount': 'Income ($)'},
+                        title=f'{BUCKET_TITLES[bucket]} Income'
                     )
                     
                     st.plotly_chart(fig1, use_container_width=True)
                 
                 with chart_col2:
-                    # Patient distribution pie chart
-                    patient_distribution = analysis_data.groupby('patient_name')['amount'].sum().reset_index()
-                    patient_distribution = patient_distribution.sort_values('amount', ascending=False).head(10)
+                    # Patient distribution pie chart, top patients plus "Other"
+                    patient_distribution = reports.get_income_breakdown(
+                        analysis_start_date, analysis_end_date, 'patient', TOP_N_BREAKDOWN
+                    )
                     
                     fig2 = px.pie(
                         patient_distribution, 
                         values='amount', 
-                        names='patient_name',
+                        names='label',
                         title='Income by Patient'
                     )
                     
                     st.plotly_chart(fig2, use_container_width=True)
                 
                 # Staff performance if recorded_by data is available
-                if 'recorded_by' in analysis_data.columns and analysis_data['recorded_by'].notna().any():
-                    staff_performance = analysis_data.groupby('recorded_by')['amount'].sum().reset_index()
-                    staff_performance = staff_performance.sort_values('amount', ascending=False)
-                    
+                staff_performance = reports.get_income_breakdown(
+                    analysis_start_date, analysis_end_date, 'staff', TOP_N_BREAKDOWN
+                )
+                if not staff_performance.empty:
                     fig3 = px.bar(
                         staff_performance,
-                        x='recorded_by',
+                        x='label',
                         y='amount',
+                        labels={'label': 'Recorded By', 'amount': 'Income ($)'},
                         title='Revenue by Staff Member'
                     )
                     
                     st.plotly_chart(fig3, use_container_width=True)
+                
+                self.revenue_trends_section(analysis_start_date, analysis_end_date)
             else:
                 st.info(f"No financial data available between {analysis_start_date} and {analysis_end_date}.")
         else:
             st.error("Analysis start date must be before end date.")
 
+    def revenue_trends_section(self, start_date, end_date):
+        """
+        Rolling revenue, month-over-month change and revenue per doctor for the analysis range
+        """
+        st.subheader("Revenue Trends")
+        analytics = self.reports.analytics()
+        
+        # Rolling averages, thinned so the line stays within the chart point budget
+        rolling = analytics.rolling_revenue(start_date, end_date)
+        step = max(1, len(rolling) // MAX_CHART_POINTS)
+        fig = px.line(
+            rolling.iloc[::step],
+            x='day',
+            y=['rolling_7d_avg', 'rolling_30d_avg'],
+            labels={'day': 'Date', 'value': 'Avg. Daily Income ($)', 'variable': 'Window'},
+            title='Rolling Average Daily Income (7 and 30 days)'
+        )
+        st.plotly_chart(fig, use_container_width=True)
+        
+        trend_col1, trend_col2 = st.columns(2)
+        
+        with trend_col1:
+            st.write("**Month over Month**")
+            st.dataframe(
+                analytics.month_over_month(start_date, end_date),
+                column_config={
+                    'month': st.column_config.DateColumn('Month', format="MMM YYYY"),
+                    'revenue': st.column_config.NumberColumn('Revenue', format="$%.2f"),
+                    'transactions': 'Transactions',
+                    'previous_revenue': st.column_config.NumberColumn('Previous Month', format="$%.2f"),
+                    'change': st.column_config.NumberColumn('Change', format="$%.2f"),
+                    'change_pct': st.column_config.NumberColumn('Change %', format="%.1f%%"),
+                },
+                use_container_width=True,
+                hide_index=True
+            )
+        
+        with trend_col2:
+            st.write("**Revenue per Doctor**")
+            st.dataframe(
+                analytics.revenue_per_doctor(start_date, end_date)[
+                    ['rank', 'doctor_name', 'revenue', 'share_pct', 'patients', 'transactions']
+                ],
+                column_config={
+                    'rank': 'Rank',
+                    'doctor_name': 'Doctor',
+                    'revenue': st.column_config.NumberColumn('Revenue', format="$%.2f"),
+                    'share_pct': st.column_config.NumberColumn('Share', format="%.1f%%"),
+                    'patients': 'Patients',
+                    'transactions': 'Transactions',
+                },
+                use_container_width=True,
+                hide_index=True
+            )
+
     # Additional methods for database operations
 
     def get_db(self):
@@ -0,0 +1,278 @@
+"""
+Type-ahead patient picker.
+
+Patients are filed in an in-process prefix trie under their normalized name, each
+later word of it (so "kamau" finds "Wanjiru Kamau") and the digits of their phone
+number: as written, without the country or trunk prefix, and as dialled locally.
+The trie is path compressed, so a node stands for a run of characters rather than
+one, and every node holding more than PICKER_MATCHES patients below it caches its
+first PICKER_MATCHES in name order: a lookup walks the typed prefix and slices
+that list, whatever the size of the register.
+"""
+import bisect
+import gc
+import re
+import threading
+from operator import itemgetter
+from types import MappingProxyType
+
+from dedup import normalize_name, normalize_phone
+
+# Matches a picker offers, and so the number of patients each busy trie node remembers
+PICKER_MATCHES = 20
+
+# Sorts after any character of a normalized name or phone number
+_LAST_CHAR = chr(0x10FFFF)
+
+# Shared by every leaf: most nodes are leaves, and a dict and list of their own would triple the
+# objects a large trie allocates and the garbage collector keeps scanning
+_NO_CHILDREN = MappingProxyType({})
+
+
+class _Node:
+    __slots__ = ('label', 'children', 'entries', 'count', 'top')
+
+    def __init__(self, label='', entries=()):
+        self.label = label
+        self.children = _NO_CHILDREN
+        # (rank, patient id) of the keys ending here
+        self.entries = entries
+        # Keys ending here or below
+        self.count = len(entries)
+        # The first PICKER_MATCHES entries below, cached on busy nodes; None until needed again
+        self.top = None
+
+
+class PrefixTrie:
+    """Path-compressed trie of string keys to ranked entries, answering 'first k entries under a prefix'"""
+
+    def __init__(self, limit=PICKER_MATCHES):
+        self.limit = limit
+        self.root = _Node()
+
+    @classmethod
+    def build(cls, items, limit=PICKER_MATCHES):
+        """Build a trie from (key, entry) pairs at once, about twice as fast as inserting them one by one"""
+        trie = cls(limit)
+        items = sorted(items, key=itemgetter(0))
+        # Nothing built here is garbage, yet every few hundred new nodes would start a collection
+        # scanning them, and together those cost as much as the build itself
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            trie._fill(trie.root, [key for key, _ in items], [entry for _, entry in items], 0, len(items), 0)
+        finally:
+            if collecting:
+                gc.enable()
+        return trie
+
+    def _fill(self, node, keys, entries, low, high, depth):
+        """Hang the sorted keys[low:high], which share their first depth characters, below node"""
+        node.count = high - low
+        start = low
+        while low < high and len(keys[low]) == depth:
+            low += 1
+        node.entries = tuple(entries[start:low])
+        children = {}
+        while low < high:
+            first = keys[low]
+            end = bisect.bisect_left(keys, first[:depth + 1] + _LAST_CHAR, low, high)
+            if end == low + 1:
+                # Most keys end in a leaf of their own
+                children[first[depth]] = _Node(first[depth:], (entries[low],))
+            else:
+                # Sorted, so the keys in between share at least what the first and last share
+                shared = depth + 1 + _shared_prefix(first[depth + 1:], keys[end - 1][depth + 1:])
+                child = children[first[depth]] = _Node(first[depth:shared])
+                self._fill(child, keys, entries, low, end, shared)
+            low = end
+        if children:
+            node.children = children
+        # Cached now, so the first keystroke doesn't walk the whole trie
+        if node.count > self.limit:
+            self._top(node)
+
+    def insert(self, key, entry):
+        """File an entry, a (rank, id) tuple, under a key"""
+        node, rest = self.root, key
+        while True:
+            node.count += 1
+            if node.top is not None and entry not in node.top and (
+                    len(node.top) < self.limit or entry < node.top[-1]):
+                node.top.insert(_insertion_point(node.top, entry), entry)
+                del node.top[self.limit:]
+            if not rest:
+                node.entries += (entry,)
+                return
+            child = node.children.get(rest[0])
+            if child is None:
+                if node.children is _NO_CHILDREN:
+                    node.children = {}
+                node.children[rest[0]] = _Node(rest, (entry,))
+                return
+            shared = _shared_prefix(child.label, rest)
+            if shared < len(child.label):
+                # Split the edge where the new key leaves it
+                middle = node.children[rest[0]] = _Node(child.label[:shared])
+                child.label = child.label[shared:]
+                middle.children = {child.label[0]: child}
+                middle.count = child.count
+                child = middle
+            node, rest = child, rest[shared:]
+
+    def remove(self, key, entry):
+        """Take an entry filed under a key out again"""
+        path, node, rest = [self.root], self.root, key
+        while rest:
+            node = node.children.get(rest[0])
+            if node is None or not rest.startswith(node.label):
+                return
+            path.append(node)
+            rest = rest[len(node.label):]
+        if entry not in node.entries:
+            return
+        entries = list(node.entries)
+        entries.remove(entry)
+        node.entries = tuple(entries)
+        for visited in path:
+            visited.count -= 1
+            if visited.top is not None and entry in visited.top:
+                visited.top = None
+        # Drop the emptied leaf and fold a parent left with one child and nothing of its own into it
+        for depth in range(len(path) - 1, 0, -1):
+            node, parent = path[depth], path[depth - 1]
+            if node.count == 0:
+                del parent.children[node.label[0]]
+            elif not node.entries and len(node.children) == 1:
+                (child,) = node.children.values()
+                child.label = node.label + child.label
+                parent.children[node.label[0]] = child
+            else:
+                break
+
+    def first(self, prefix):
+        """Return the first entries, in rank order, of the keys starting with prefix"""
+        node, rest = self.root, prefix
+        while rest:
+            node = node.children.get(rest[0])
+            if node is None:
+                return []
+            if rest.startswith(node.label):
+                rest = rest[len(node.label):]
+            elif node.label.startswith(rest):
+                break
+            else:
+                return []
+        return self._top(node)
+
+    def _top(self, node):
+        """The first entries below a node: cached on busy nodes, gathered from the few below otherwise"""
+        if node.top is not None:
+            return node.top
+        # Busy nodes below answer with their cached list, quiet ones hold only a few entries each. A
+        # patient filed under two keys in this subtree (name and surname) has the same entry twice
+        candidates, pending = set(), [node]
+        while pending:
+            below = pending.pop()
+            if below.top is not None:
+                candidates.update(below.top)
+            else:
+                candidates.update(below.entries)
+                pending.extend(below.children.values())
+        top = sorted(candidates)[:self.limit]
+        if node.count > self.limit:
+            node.top = top
+        return top
+
+
+def _shared_prefix(first, second):
+    """Length of the common prefix of two strings"""
+    length = min(len(first), len(second))
+    for position in range(length):
+        if first[position] != second[position]:
+            return position
+    return length
+
+
+def _insertion_point(entries, entry):
+    """Position that keeps a short sorted list sorted"""
+    for position, other in enumerate(entries):
+        if entry < other:
+            return position
+    return len(entries)
+
+
+def patient_keys(name, contact):
+    """Return the trie keys a patient is found by: their normalized name, each later word of it and their phone digits"""
+    words = name.split(' ')
+    keys = {' '.join(words[start:]) for start in range(len(words))}
+    digits = re.sub(r'\D', '', contact if isinstance(contact, str) else '')
+    phone = normalize_phone(contact)
+    # As written, without the country or trunk prefix, and as dialled locally (+254 712... as 0712...)
+    keys.update(key for key in (digits, phone, phone and f"0{phone}") if key)
+    keys.discard('')
+    return keys
+
+
+def picker_query(text):
+    """Normalize typed text like the names in the trie, or to its digits when it is a phone number"""
+    text = text or ''
+    if re.fullmatch(r'[\d\s+().-]*\d[\d\s+().-]*', text):
+        return re.sub(r'\D', '', text)
+    return normalize_name(text)
+
+
+class PatientPicker:
+    """Prefix trie over one database's patients, tagged with the patient data generation it reflects"""
+
+    def __init__(self, patients=(), generation=None):
+        """Build the trie from (id, name, contact) rows"""
+        self.generation = generation
+        self._patients = {}
+        self._lock = threading.Lock()
+        items = []
+        for patient_id, name, contact in patients:
+            patient_id = int(patient_id)
+            self._patients[patient_id] = (name, contact)
+            normalized = normalize_name(name)
+            entry = (normalized, patient_id), patient_id
+            items += [(key, entry) for key in patient_keys(normalized, contact)]
+        self._trie = PrefixTrie.build(items)
+
+    def __len__(self):
+        return len(self._patients)
+
+    def _add(self, patient_id, name, contact):
+        patient_id = int(patient_id)
+        self._patients[patient_id] = (name, contact)
+        normalized = normalize_name(name)
+        # Ranked by normalized name, then id
+        entry = (normalized, patient_id), patient_id
+        for key in patient_keys(normalized, contact):
+            self._trie.insert(key, entry)
+
+    def _remove(self, patient_id):
+        patient_id = int(patient_id)
+        if patient_id not in self._patients:
+            return
+        name, contact = self._patients.pop(patient_id)
+        normalized = normalize_name(name)
+        entry = (normalized, patient_id), patient_id
+        for key in patient_keys(normalized, contact):
+            self._trie.remove(key, entry)
+
+    def apply(self, generation, upserts=(), removals=()):
+        """Apply one write's patient changes; (id, name, contact) rows replace any earlier version"""
+        with self._lock:
+            for patient_id in removals:
+                self._remove(patient_id)
+            for patient_id, name, contact in upserts:
+                self._remove(patient_id)
+                self._add(patient_id, name, contact)
+            self.generation = generation
+
+    def search(self, text, limit=PICKER_MATCHES):
+        """Return (id, name, contact) of the first patients in name order whose name, a word of it or phone starts with text"""
+        with self._lock:
+            entries = self._trie.first(picker_query(text))[:limit]
+            return [(patient_id, *self._patients[patient_id]) for _, patient_id in entries]
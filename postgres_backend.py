@@ -0,0 +1,1202 @@
+"""
+PostgreSQL implementation of the clinic repository.
+
+Selected by pointing CLINIC_DATABASE_URL at a server, e.g.
+``CLINIC_DATABASE_URL=postgresql://clinic@localhost/clinic streamlit run main.py``.
+Needs the optional psycopg driver: ``pip install "psycopg[binary]"``.
+"""
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from dedup import name_trigrams
+from frames import typed_frame
+from fuzzy import (FUZZY_CANDIDATES, FUZZY_MATCH_LIMIT, FUZZY_MIN_PROBES, FUZZY_PROBE_POSTINGS, closest_names,
+                   order_matches, search_trigrams)
+from lazy_imports import lazy_import
+from recurrence import APPOINTMENT_SLOT_MINUTES, SchedulingConflict, series_occurrences
+from repository import APPOINTMENT_STATUSES, TIMELINE_PAGE_SIZE, ClinicRepository, ConstraintViolation, InvalidValue
+
+try:
+    import psycopg
+    from psycopg import sql
+except ImportError:  # optional dependency, only needed for this backend
+    psycopg = None
+
+pd = lazy_import('pandas')
+
+# Same buckets and widths as the SQLite backend, as Postgres expressions over finances.date
+INCOME_BUCKETS = {
+    'day': "finances.date",
+    'week': "date_trunc('week', finances.date)::date",
+    'month': "date_trunc('month', finances.date)::date",
+    'year': "date_trunc('year', finances.date)::date",
+}
+BUCKET_DAYS = {'day': 1, 'week': 7, 'month': 30.44, 'year': 365.25}
+
+# Orderings get_financial_records accepts, as in the SQLite backend
+FINANCE_ORDERINGS = {
+    'date': 'finances.date',
+    'amount': 'finances.amount',
+    'patient': 'patients.name COLLATE "C"',
+    'id': 'finances.id',
+}
+
+# Per-patient sources merged into the timeline, as in the SQLite backend (which also reads its archive)
+TIMELINE_SOURCES = (
+    ('visit', 'medical_records', 'visit_date', 'doctor_id',
+     ('entry.diagnosis', 'entry.treatment', 'entry.notes', 'NULL', 'NULL::double precision')),
+    ('appointment', 'appointments', 'appointment_date', 'assigned_to',
+     ('entry.reason', 'NULL', 'NULL', 'entry.status', 'NULL::double precision')),
+    ('payment', 'finances', 'date', 'recorded_by_id',
+     ('entry.description', 'entry.transaction_type', 'NULL', 'NULL', 'entry.amount')),
+)
+TIMELINE_COLUMNS = ('title', 'detail', 'notes', 'status', 'amount')
+
+DEFAULT_ROLES = [
+    ('doctor', 'Medical doctor with full patient access'),
+    ('nurse', 'Nursing staff with limited patient data access'),
+    ('admin', 'Administrative staff with financial access'),
+    ('receptionist', 'Front desk staff'),
+]
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS roles (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        role_name TEXT NOT NULL UNIQUE,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        password TEXT NOT NULL,
+        full_name TEXT NOT NULL,
+        role_id INTEGER REFERENCES roles (id),
+        email TEXT,
+        phone TEXT,
+        specialty TEXT,
+        active INTEGER DEFAULT 1,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS patients (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT NOT NULL,
+        contact TEXT NOT NULL,
+        email TEXT,
+        medical_history TEXT,
+        assigned_doctor_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS finances (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        date DATE NOT NULL,
+        amount DOUBLE PRECISION NOT NULL,
+        description TEXT,
+        patient_id INTEGER REFERENCES patients (id) ON DELETE CASCADE,
+        recorded_by_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        transaction_type TEXT DEFAULT 'payment',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS medical_records (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients (id) ON DELETE CASCADE,
+        doctor_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        visit_date DATE NOT NULL,
+        diagnosis TEXT,
+        treatment TEXT,
+        notes TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS appointment_series (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients (id) ON DELETE CASCADE,
+        assigned_to INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        reason TEXT,
+        starts_at TIMESTAMP NOT NULL,
+        frequency TEXT NOT NULL,
+        occurrences INTEGER NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS appointments (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        patient_id INTEGER REFERENCES patients (id) ON DELETE CASCADE,
+        appointment_date TIMESTAMP NOT NULL,
+        reason TEXT,
+        status TEXT DEFAULT 'Scheduled',
+        assigned_to INTEGER REFERENCES users (id) ON DELETE SET NULL,
+        series_id INTEGER REFERENCES appointment_series (id) ON DELETE SET NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Tables created before appointment series existed
+    'ALTER TABLE appointments ADD COLUMN IF NOT EXISTS series_id INTEGER '
+    'REFERENCES appointment_series (id) ON DELETE SET NULL',
+    # Tables created before their foreign keys had ON DELETE actions get them, as in the SQLite backend
+    '''
+    DO $$
+    DECLARE
+        wanted record;
+        existing name;
+    BEGIN
+        FOR wanted IN SELECT * FROM (VALUES
+            ('patients', 'assigned_doctor_id', 'users', 'SET NULL'),
+            ('finances', 'patient_id', 'patients', 'CASCADE'),
+            ('finances', 'recorded_by_id', 'users', 'SET NULL'),
+            ('medical_records', 'patient_id', 'patients', 'CASCADE'),
+            ('medical_records', 'doctor_id', 'users', 'SET NULL'),
+            ('appointment_series', 'patient_id', 'patients', 'CASCADE'),
+            ('appointment_series', 'assigned_to', 'users', 'SET NULL'),
+            ('appointments', 'patient_id', 'patients', 'CASCADE'),
+            ('appointments', 'assigned_to', 'users', 'SET NULL'),
+            ('appointments', 'series_id', 'appointment_series', 'SET NULL')
+        ) AS foreign_keys (tbl, col, ref, action) LOOP
+            SELECT conname INTO existing FROM pg_constraint
+            WHERE contype = 'f' AND conrelid = wanted.tbl::regclass
+              AND conkey = ARRAY[(SELECT attnum FROM pg_attribute
+                                  WHERE attrelid = wanted.tbl::regclass AND attname = wanted.col)]
+              AND confdeltype::text <> CASE wanted.action WHEN 'CASCADE' THEN 'c' ELSE 'n' END;
+            IF existing IS NOT NULL THEN
+                EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I, ADD CONSTRAINT %I FOREIGN KEY (%I) '
+                               'REFERENCES %I (id) ON DELETE ' || wanted.action,
+                               wanted.tbl, existing, existing, wanted.col, wanted.ref);
+            END IF;
+        END LOOP;
+    END
+    $$
+    ''',
+    # Fuzzy name search indexes, filled by the repository since pg_trgm is an optional extension
+    '''
+    CREATE TABLE IF NOT EXISTS patient_name_trigrams (
+        trigram TEXT NOT NULL,
+        patient_id INTEGER NOT NULL REFERENCES patients (id) ON DELETE CASCADE,
+        PRIMARY KEY (trigram, patient_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_name_trigrams (
+        trigram TEXT NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        PRIMARY KEY (trigram, user_id)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_patient_name_trigrams_patient ON patient_name_trigrams (patient_id)',
+    'CREATE INDEX IF NOT EXISTS idx_user_name_trigrams_user ON user_name_trigrams (user_id)',
+    # Same access paths as the SQLite indexes; INCLUDE keeps the finance aggregates index-only
+    'CREATE INDEX IF NOT EXISTS idx_finances_date_covering ON finances (date) INCLUDE (amount, patient_id, recorded_by_id)',
+    'CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments (appointment_date)',
+    'CREATE INDEX IF NOT EXISTS idx_finances_patient ON finances (patient_id, date)',
+    'CREATE INDEX IF NOT EXISTS idx_finances_recorded_by ON finances (recorded_by_id, date)',
+    'CREATE INDEX IF NOT EXISTS idx_medical_records_patient ON medical_records (patient_id, visit_date)',
+    'CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments (patient_id, appointment_date)',
+    'CREATE INDEX IF NOT EXISTS idx_appointment_series_patient ON appointment_series (patient_id)',
+    'CREATE INDEX IF NOT EXISTS idx_appointments_series ON appointments (series_id, appointment_date) '
+    'WHERE series_id IS NOT NULL',
+    'CREATE INDEX IF NOT EXISTS idx_appointments_staff ON appointments (assigned_to, appointment_date)',
+    # Appointment status transitions, written by a trigger and read by the no-show analytics
+    '''
+    CREATE TABLE IF NOT EXISTS appointment_status_history (
+        id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        appointment_id INTEGER NOT NULL,
+        old_status TEXT,
+        new_status TEXT,
+        appointment_date TIMESTAMP NOT NULL,
+        assigned_to INTEGER,
+        changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_appointment_status_history_date '
+    'ON appointment_status_history (appointment_date, appointment_id)',
+    'CREATE INDEX IF NOT EXISTS idx_appointment_status_history_appointment '
+    'ON appointment_status_history (appointment_id)',
+    # Appointments booked before the history existed start it at their current status
+    '''
+    INSERT INTO appointment_status_history (appointment_id, old_status, new_status, appointment_date, assigned_to,
+                                            changed_at)
+    SELECT id, NULL, status, appointment_date, assigned_to, created_at FROM appointments
+    WHERE NOT EXISTS (SELECT 1 FROM appointment_status_history)
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION record_appointment_status() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM NEW.status THEN
+            INSERT INTO appointment_status_history (appointment_id, old_status, new_status, appointment_date,
+                                                    assigned_to)
+            VALUES (NEW.id, CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END, NEW.status, NEW.appointment_date,
+                    NEW.assigned_to);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    '''
+    CREATE OR REPLACE TRIGGER trg_status_history_appointments
+    AFTER INSERT OR UPDATE OF status ON appointments
+    FOR EACH ROW EXECUTE FUNCTION record_appointment_status()
+    ''',
+]
+
+# Name search indexes: (table, index table, its id column, the name column indexed)
+NAME_INDEXES = [
+    ('patients', 'patient_name_trigrams', 'patient_id', 'name'),
+    ('users', 'user_name_trigrams', 'user_id', 'full_name'),
+]
+
+# Select lists that return timestamps and dates as the same text the SQLite backend returns
+USER_COLUMNS = '''
+    users.id, users.username, users.password, users.full_name, users.role_id, users.email,
+    users.phone, users.specialty, users.active,
+    to_char(users.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at, roles.role_name
+'''
+PATIENT_COLUMNS = '''
+    patients.id, patients.name, patients.contact, patients.email, patients.medical_history,
+    patients.assigned_doctor_id, to_char(patients.created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+    users.full_name AS doctor_name
+'''
+APPOINTMENT_COLUMNS = '''
+    appointments.id,
+    to_char(appointments.appointment_date, 'YYYY-MM-DD HH24:MI:SS') AS appointment_date,
+    appointments.reason,
+    appointments.status,
+    patients.name AS patient_name,
+    patients.id AS patient_id,
+    users.full_name AS assigned_to,
+    users.id AS assigned_to_id,
+    appointments.series_id
+'''
+
+
+class PostgresRepository(ClinicRepository):
+    """Clinic repository on a PostgreSQL server, returning the same frames as DatabaseManager"""
+
+    # Set to False to get the rows as the driver returns them, without FRAME_SCHEMAS typing
+    typed_frames = True
+
+    def __init__(self, dsn, schema=None):
+        """Connect, select the schema (created if needed) and create tables if they don't exist"""
+        if psycopg is None:
+            raise ImportError('The PostgreSQL backend needs psycopg: pip install "psycopg[binary]"')
+        self.dsn = dsn
+        self.schema = schema
+        self.conn = psycopg.connect(dsn, autocommit=True)
+        # One connection shared by every session: statements and transactions take turns
+        self._lock = threading.RLock()
+        if schema:
+            self.conn.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(schema)))
+            self.conn.execute(sql.SQL("SET search_path TO {}").format(sql.Identifier(schema)))
+        self.create_tables()
+
+    def create_tables(self):
+        """Create all tables and indexes if they don't exist and seed the default roles"""
+        with self._lock, self._transaction():
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            with self.conn.cursor() as cursor:
+                cursor.executemany(
+                    "INSERT INTO roles (role_name, description) VALUES (%s, %s) ON CONFLICT (role_name) DO NOTHING",
+                    DEFAULT_ROLES
+                )
+            # Names stored before the search indexes existed
+            for table, index, owner, name in NAME_INDEXES:
+                missing = self.conn.execute(
+                    f"SELECT id, {name} FROM {table} WHERE id NOT IN (SELECT {owner} FROM {index})"
+                ).fetchall()
+                for row_id, text in missing:
+                    self._index_name(index, owner, row_id, text)
+
+    @contextmanager
+    def _transaction(self):
+        """Run a block in a transaction, rolled back on error, raising the backend-neutral error for a refused write"""
+        try:
+            with self.conn.transaction():
+                yield self.conn
+        except psycopg.IntegrityError as e:
+            raise ConstraintViolation(str(e)) from e
+        except psycopg.DataError as e:
+            raise InvalidValue(str(e)) from e
+
+    def _read(self, query, params=None, schema=None):
+        """Run a SELECT and return the rows as a DataFrame, typed by its schema in FRAME_SCHEMAS"""
+        with self._lock, self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            frame = pd.DataFrame(cursor.fetchall(), columns=[column.name for column in cursor.description])
+        return typed_frame(frame, schema) if schema and self.typed_frames else frame
+
+    def _fetch(self, query, params=None):
+        """Run a SELECT and return the rows as tuples"""
+        with self._lock, self.conn.cursor() as cursor:
+            return cursor.execute(query, params).fetchall()
+
+    def _read_page(self, query, params=None, limit=None, offset=0, schema=None):
+        """Run a SELECT, or one page of it with the unpaged row count in a total_rows column"""
+        if limit is None:
+            return self._read(query, params, schema)
+        paged = f"SELECT page.*, COUNT(*) OVER () AS total_rows FROM ({query}) AS page LIMIT %(limit)s OFFSET %(offset)s"
+        return self._read(paged, {**(params or {}), 'limit': limit, 'offset': offset}, schema)
+
+    def _insert(self, query, params):
+        """Run an INSERT in its own transaction and return the new row's id"""
+        with self._lock, self._transaction():
+            return self.conn.execute(query + " RETURNING id", params).fetchone()[0]
+
+    def _index_name(self, index, owner, row_id, name):
+        """File a row under its name's trigrams in a name search index, replacing earlier ones"""
+        self.conn.execute(f"DELETE FROM {index} WHERE {owner} = %s", (row_id,))
+        with self.conn.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {index} (trigram, {owner}) VALUES (%s, %s)",
+                [(trigram, row_id) for trigram in name_trigrams(name)]
+            )
+
+    def _delete_ids(self, table, ids):
+        """Delete rows by id in one transaction and return how many were removed"""
+        with self._lock, self._transaction():
+            return self.conn.execute(
+                f"DELETE FROM {table} WHERE id = ANY(%s)", ([int(row_id) for row_id in ids],)
+            ).rowcount
+
+    # User management methods
+    def add_user(self, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Add a new user (medical staff) to the database"""
+        with self._lock, self._transaction():
+            user_id = self.conn.execute('''
+                INSERT INTO users (username, password, full_name, role_id, email, phone, specialty)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (username, password, full_name, role_id, email, phone, specialty)).fetchone()[0]
+            self._index_name('user_name_trigrams', 'user_id', user_id, full_name)
+            return user_id
+
+    def get_users(self, limit=None, offset=0):
+        """Retrieve all users from the database, optionally one page at a time"""
+        return self._read_page(f'''
+            SELECT {USER_COLUMNS}
+            FROM users
+            JOIN roles ON users.role_id = roles.id
+            WHERE users.active = 1
+            ORDER BY users.full_name COLLATE "C", users.id
+        ''', None, limit, offset, schema='users')
+
+    def get_roles(self):
+        """Retrieve all roles from the database"""
+        return self._read('''
+            SELECT id, role_name, description, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at
+            FROM roles ORDER BY id
+        ''', schema='roles')
+
+    def search_users(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search for active users by name, username, or role, by close spellings of the name if nothing matches"""
+        exact_search = lambda limit, offset: self._read_page(f'''
+            SELECT {USER_COLUMNS}
+            FROM users
+            JOIN roles ON users.role_id = roles.id
+            WHERE users.active = 1 AND (
+                  users.full_name ILIKE %(pattern)s OR users.username ILIKE %(pattern)s OR
+                  users.email ILIKE %(pattern)s OR roles.role_name ILIKE %(pattern)s)
+            ORDER BY users.full_name COLLATE "C", users.id
+        ''', {'pattern': f"%{search_term}%"}, limit, offset, schema='users')
+        if not fuzzy:
+            return exact_search(limit, offset)
+        return self._exact_or_fuzzy(exact_search, lambda: self.fuzzy_search_users(search_term), limit, offset)
+
+    def fuzzy_search_users(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find active users whose name is within a few typos of the search term, closest first"""
+        candidates = self._fetch('''
+            SELECT users.id, users.full_name
+            FROM (
+                SELECT user_id, COUNT(*) AS shared
+                FROM user_name_trigrams
+                WHERE trigram = ANY(%s) AND user_id IN (SELECT id FROM users WHERE active = 1)
+                GROUP BY user_id
+                ORDER BY shared DESC, user_id
+                LIMIT %s
+            ) AS candidates
+            JOIN users ON users.id = candidates.user_id
+        ''', (search_trigrams(search_term), FUZZY_CANDIDATES))
+        closest = closest_names(search_term, candidates, limit)
+        matches = self._read(f'''
+            SELECT {USER_COLUMNS}
+            FROM users
+            JOIN roles ON users.role_id = roles.id
+            WHERE users.id = ANY(%s)
+        ''', (list(closest),), schema='users')
+        return order_matches(matches, closest, 'full_name')
+
+    def delete_users(self, user_ids):
+        """Deactivate several users in one transaction; their history keeps pointing at them"""
+        with self._lock, self._transaction():
+            return self.conn.execute(
+                "UPDATE users SET active = 0 WHERE active = 1 AND id = ANY(%s)",
+                ([int(user_id) for user_id in user_ids],)
+            ).rowcount
+
+    def update_user(self, user_id, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Update a user's details, keeping their password if none is given, and refile their name"""
+        with self._lock, self._transaction():
+            self.conn.execute('''
+                UPDATE users
+                SET username = %s, password = COALESCE(NULLIF(%s, ''), password), full_name = %s, role_id = %s,
+                    email = %s, phone = %s, specialty = %s
+                WHERE id = %s
+            ''', (username, password, full_name, role_id, email, phone, specialty, user_id))
+            self._index_name('user_name_trigrams', 'user_id', user_id, full_name)
+
+    # Patient management methods
+    def add_patient(self, name, contact, email, medical_history, assigned_doctor_id=None):
+        """Add a new patient to the database"""
+        with self._lock, self._transaction():
+            patient_id = self.conn.execute('''
+                INSERT INTO patients (name, contact, email, medical_history, assigned_doctor_id)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (name, contact, email, medical_history, assigned_doctor_id)).fetchone()[0]
+            self._index_name('patient_name_trigrams', 'patient_id', patient_id, name)
+            return patient_id
+
+    def get_patients(self, limit=None, offset=0):
+        """Retrieve all patients from the database, optionally one page at a time"""
+        return self._read_page(f'''
+            SELECT {PATIENT_COLUMNS}
+            FROM patients
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            ORDER BY patients.name COLLATE "C", patients.id
+        ''', None, limit, offset, schema='patients')
+
+    def get_recent_patients(self, limit=5):
+        """Retrieve the most recently added patients"""
+        return self._read(f'''
+            SELECT {PATIENT_COLUMNS}
+            FROM patients
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            ORDER BY patients.id DESC
+            LIMIT %s
+        ''', (limit,), schema='patients')
+
+    def search_patients(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search for patients by name or contact information, by close spellings of the name if nothing matches"""
+        exact_search = lambda limit, offset: self._read_page(f'''
+            SELECT {PATIENT_COLUMNS}
+            FROM patients
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            WHERE patients.name ILIKE %(pattern)s OR patients.contact ILIKE %(pattern)s
+               OR patients.email ILIKE %(pattern)s
+            ORDER BY patients.name COLLATE "C", patients.id
+        ''', {'pattern': f"%{search_term}%"}, limit, offset, schema='patients')
+        if not fuzzy:
+            return exact_search(limit, offset)
+        return self._exact_or_fuzzy(exact_search, lambda: self.fuzzy_search_patients(search_term), limit, offset)
+
+    def fuzzy_search_patients(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find patients whose name is within a few typos of the search term, closest first"""
+        # The rarest trigrams are picked as in the SQLite backend, counted from the index directly
+        candidates = self._fetch('''
+            WITH frequencies AS (
+                SELECT trigram, COUNT(*) AS patients
+                FROM patient_name_trigrams
+                WHERE trigram = ANY(%(trigrams)s)
+                GROUP BY trigram
+            ),
+            probes AS (
+                SELECT trigram FROM (
+                    SELECT
+                        trigram,
+                        SUM(patients) OVER (ORDER BY patients, trigram COLLATE "C") - patients AS rarer_postings,
+                        ROW_NUMBER() OVER (ORDER BY patients, trigram COLLATE "C") AS rarity
+                    FROM frequencies
+                ) AS ranked
+                WHERE rarer_postings < %(postings)s OR rarity <= %(min_probes)s
+            )
+            SELECT patients.id, patients.name
+            FROM (
+                SELECT patient_id, COUNT(*) AS shared
+                FROM patient_name_trigrams
+                WHERE trigram IN (SELECT trigram FROM probes)
+                GROUP BY patient_id
+                ORDER BY shared DESC, patient_id
+                LIMIT %(candidates)s
+            ) AS candidates
+            JOIN patients ON patients.id = candidates.patient_id
+        ''', {'trigrams': search_trigrams(search_term), 'postings': FUZZY_PROBE_POSTINGS,
+              'min_probes': FUZZY_MIN_PROBES, 'candidates': FUZZY_CANDIDATES})
+        closest = closest_names(search_term, candidates, limit)
+        matches = self._read(f'''
+            SELECT {PATIENT_COLUMNS}
+            FROM patients
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            WHERE patients.id = ANY(%s)
+        ''', (list(closest),), schema='patients')
+        return order_matches(matches, closest, 'name')
+
+    def update_patient(self, patient_id, name, contact, email, medical_history, assigned_doctor_id=None):
+        """Update a patient's details and refile them in the name search index"""
+        with self._lock, self._transaction():
+            self.conn.execute('''
+                UPDATE patients
+                SET name = %s, contact = %s, email = %s, medical_history = %s, assigned_doctor_id = %s
+                WHERE id = %s
+            ''', (name, contact, email, medical_history, assigned_doctor_id, patient_id))
+            self._index_name('patient_name_trigrams', 'patient_id', patient_id, name)
+
+    def delete_patients(self, patient_ids):
+        """Delete several patients and everything recorded against them in one transaction"""
+        ids = [int(patient_id) for patient_id in patient_ids]
+        with self._lock, self._transaction():
+            self.conn.execute('''
+                DELETE FROM appointment_status_history
+                WHERE appointment_id IN (SELECT id FROM appointments WHERE patient_id = ANY(%s))
+            ''', (ids,))
+            # Their finances, medical records, series and appointments go with them through ON DELETE CASCADE
+            return self.conn.execute("DELETE FROM patients WHERE id = ANY(%s)", (ids,)).rowcount
+
+    # Medical records methods
+    def add_medical_record(self, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
+        """Add a new medical record"""
+        return self._insert('''
+            INSERT INTO medical_records (patient_id, doctor_id, visit_date, diagnosis, treatment, notes)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (patient_id, doctor_id, visit_date, diagnosis, treatment, notes))
+
+    def update_medical_record(self, record_id, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
+        """Update a medical record"""
+        with self._lock, self._transaction():
+            self.conn.execute('''
+                UPDATE medical_records
+                SET patient_id = %s, doctor_id = %s, visit_date = %s, diagnosis = %s, treatment = %s, notes = %s
+                WHERE id = %s
+            ''', (patient_id, doctor_id, visit_date, diagnosis, treatment, notes, record_id))
+
+    def delete_medical_records(self, record_ids):
+        """Delete several medical records in one transaction"""
+        return self._delete_ids('medical_records', record_ids)
+
+    def get_medical_records(self, patient_id=None, limit=None, offset=0):
+        """Retrieve medical records, optionally filtered by patient and one page at a time"""
+        query = """
+            SELECT
+                medical_records.id,
+                medical_records.patient_id,
+                patients.name AS patient_name,
+                medical_records.doctor_id,
+                users.full_name AS doctor_name,
+                to_char(medical_records.visit_date, 'YYYY-MM-DD') AS visit_date,
+                medical_records.diagnosis,
+                medical_records.treatment,
+                medical_records.notes
+            FROM medical_records
+            JOIN patients ON medical_records.patient_id = patients.id
+            JOIN users ON medical_records.doctor_id = users.id
+        """
+        if patient_id:
+            return self._read_page(query + " WHERE medical_records.patient_id = %(patient_id)s ORDER BY medical_records.id",
+                                   {'patient_id': patient_id}, limit, offset, schema='medical_records')
+        return self._read_page(query + " ORDER BY medical_records.id", None, limit, offset, schema='medical_records')
+
+    def get_patient_timeline(self, patient_id, cursor=None, limit=TIMELINE_PAGE_SIZE):
+        """Merge a patient's visits, appointments and payments, newest first, one keyset page at a time"""
+        params = {'patient_id': patient_id, 'limit': limit}
+        if cursor:
+            params['at'], params['kind'], params['id'] = cursor
+        arms = []
+        for kind, table, date_column, staff_column, expressions in TIMELINE_SOURCES:
+            columns = ', '.join(f"{expression} AS {name}" for expression, name in zip(expressions, TIMELINE_COLUMNS))
+            moment = f"entry.{date_column}::timestamp"
+            # Each source walks its (patient_id, date) index backwards from the cursor for one page
+            after = ""
+            if cursor:
+                bound = '%(at)s::timestamp' if kind == 'appointment' else '%(at)s::date'
+                after = (f"AND entry.{date_column} <= {bound} "
+                         f"AND ({moment}, '{kind}', entry.id) < (%(at)s::timestamp, %(kind)s, %(id)s)")
+            arms.append(f"""
+                (SELECT {moment} AS occurred_at, '{kind}' AS kind, entry.id,
+                        {columns}, users.full_name AS staff_name
+                 FROM {table} AS entry
+                 LEFT JOIN users ON users.id = entry.{staff_column}
+                 WHERE entry.patient_id = %(patient_id)s {after}
+                 ORDER BY entry.{date_column} DESC, entry.id DESC
+                 LIMIT %(limit)s)
+            """)
+        query = f"""
+            SELECT to_char(occurred_at, 'YYYY-MM-DD HH24:MI:SS') AS occurred_at, kind, id,
+                   {', '.join(TIMELINE_COLUMNS)}, staff_name
+            FROM ({' UNION ALL '.join(arms)}) AS timeline
+            ORDER BY timeline.occurred_at DESC, kind DESC, id DESC
+            LIMIT %(limit)s
+        """
+        return self._read(query, params, schema='patient_timeline')
+
+    # Appointment methods
+    def add_appointment(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None):
+        """Schedule an appointment"""
+        return self._insert('''
+            INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to)
+            VALUES (%s, %s, %s, %s)
+        ''', (patient_id, datetime.combine(appointment_date, appointment_time), reason, assigned_to))
+
+    def get_appointments(self, date=None, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments, optionally filtered by date and staff and one page at a time"""
+        conditions, params = [], {}
+        if date:
+            conditions.append("appointments.appointment_date >= %(day)s::date "
+                              "AND appointments.appointment_date < %(day)s::date + 1")
+            params['day'] = date
+        if staff_id:
+            conditions.append("appointments.assigned_to = %(staff_id)s")
+            params['staff_id'] = staff_id
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._read_page(f'''
+            SELECT {APPOINTMENT_COLUMNS}
+            FROM appointments
+            JOIN patients ON appointments.patient_id = patients.id
+            LEFT JOIN users ON appointments.assigned_to = users.id
+            {where}
+            ORDER BY appointments.appointment_date, appointments.id
+        ''', params, limit, offset, schema='appointments')
+
+    def get_appointments_range(self, start_date, end_date, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments between two dates (inclusive), optionally for one staff member and one page"""
+        staff_filter = "AND appointments.assigned_to = %(staff_id)s" if staff_id else ""
+        return self._read_page(f'''
+            SELECT {APPOINTMENT_COLUMNS}
+            FROM appointments
+            JOIN patients ON appointments.patient_id = patients.id
+            LEFT JOIN users ON appointments.assigned_to = users.id
+            WHERE appointments.appointment_date >= %(start_date)s::date
+              AND appointments.appointment_date < %(end_date)s::date + 1
+              {staff_filter}
+            ORDER BY appointments.appointment_date, appointments.id
+        ''', {'start_date': str(start_date), 'end_date': str(end_date), 'staff_id': staff_id}, limit, offset,
+            schema='appointments')
+
+    def get_week_calendar(self, start_of_week, staff_id=None):
+        """Pivot one week of appointments into an hourly slot x weekday grid in a single query"""
+        day_columns = ',\n'.join(
+            f"string_agg(entry, chr(10) ORDER BY at, id) FILTER (WHERE day = %(start)s::date + {i}) AS day{i}"
+            for i in range(7)
+        )
+        staff_filter = "AND appointments.assigned_to = %(staff_id)s" if staff_id else ""
+        return self._read(f'''
+            WITH week AS (
+                SELECT
+                    to_char(appointments.appointment_date, 'HH24:00') AS slot,
+                    appointments.appointment_date::date AS day,
+                    appointments.appointment_date AS at,
+                    appointments.id,
+                    to_char(appointments.appointment_date, 'HH24:MI') || ' ' || patients.name
+                        || COALESCE(' (' || users.full_name || ')', '') AS entry
+                FROM appointments
+                JOIN patients ON appointments.patient_id = patients.id
+                LEFT JOIN users ON appointments.assigned_to = users.id
+                WHERE appointments.appointment_date >= %(start)s::date
+                  AND appointments.appointment_date < %(start)s::date + 7
+                  {staff_filter}
+            )
+            SELECT slot,
+                {day_columns}
+            FROM week
+            GROUP BY slot
+            ORDER BY slot
+        ''', {'start': start_of_week.strftime('%Y-%m-%d'), 'staff_id': staff_id})
+
+    def get_daily_appointment_summary(self, start_date, end_date, staff_id=None, entries_per_day=3):
+        """Count appointments per day and list the first few of each day, for the month calendar"""
+        staff_filter = "AND appointments.assigned_to = %(staff_id)s" if staff_id else ""
+        return self._read(f'''
+            WITH ranked AS (
+                SELECT
+                    appointments.appointment_date::date AS day,
+                    appointments.appointment_date AS at,
+                    appointments.id,
+                    to_char(appointments.appointment_date, 'HH24:MI') || ' ' || patients.name AS entry,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY appointments.appointment_date::date
+                        ORDER BY appointments.appointment_date, appointments.id
+                    ) AS position
+                FROM appointments
+                JOIN patients ON appointments.patient_id = patients.id
+                WHERE appointments.appointment_date >= %(start_date)s::date
+                  AND appointments.appointment_date < %(end_date)s::date + 1
+                  {staff_filter}
+            )
+            SELECT to_char(day, 'YYYY-MM-DD') AS day,
+                   COUNT(*) AS appointments,
+                   string_agg(entry, chr(10) ORDER BY at, id) FILTER (WHERE position <= %(entries_per_day)s) AS entries
+            FROM ranked
+            GROUP BY day
+            ORDER BY day
+        ''', {'start_date': str(start_date), 'end_date': str(end_date),
+              'staff_id': staff_id, 'entries_per_day': entries_per_day}, schema='daily_summary')
+
+    def update_appointment(self, appointment_id, patient_id, appointment_date, appointment_time, reason, status,
+                           assigned_to=None):
+        """Update an appointment"""
+        if status not in APPOINTMENT_STATUSES:
+            raise ValueError(f"Unknown status: {status}")
+        with self._lock, self._transaction():
+            self.conn.execute('''
+                UPDATE appointments
+                SET patient_id = %s, appointment_date = %s, reason = %s, status = %s, assigned_to = %s
+                WHERE id = %s
+            ''', (patient_id, datetime.combine(appointment_date, appointment_time), reason, status, assigned_to,
+                  appointment_id))
+
+    def delete_appointments(self, appointment_ids):
+        """Delete several appointments and their status history in one transaction"""
+        ids = [int(appointment_id) for appointment_id in appointment_ids]
+        with self._lock, self._transaction():
+            self.conn.execute("DELETE FROM appointment_status_history WHERE appointment_id = ANY(%s)", (ids,))
+            return self.conn.execute("DELETE FROM appointments WHERE id = ANY(%s)", (ids,)).rowcount
+
+    def set_appointment_status(self, status, day=None, staff_id=None, appointment_ids=None, from_status='Scheduled'):
+        """Move every appointment matching the filters to a status in one UPDATE and return how many changed"""
+        if status not in APPOINTMENT_STATUSES:
+            raise ValueError(f"Unknown status: {status}")
+        if day is None and staff_id is None and appointment_ids is None:
+            raise ValueError("Give a day, a staff member or appointment ids")
+        conditions, params = ["status IS DISTINCT FROM %(status)s"], {'status': status}
+        if day is not None:
+            conditions.append("appointment_date >= %(day)s::date AND appointment_date < %(day)s::date + 1")
+            params['day'] = str(day)
+        if staff_id is not None:
+            conditions.append("assigned_to = %(staff_id)s")
+            params['staff_id'] = staff_id
+        if appointment_ids is not None:
+            conditions.append("id = ANY(%(ids)s)")
+            params['ids'] = [int(appointment_id) for appointment_id in appointment_ids]
+        if from_status is not None:
+            conditions.append("status = %(from_status)s")
+            params['from_status'] = from_status
+        with self._lock, self._transaction():
+            return self.conn.execute(
+                f"UPDATE appointments SET status = %(status)s WHERE {' AND '.join(conditions)}", params
+            ).rowcount
+
+    def get_no_show_rates(self, start_date, end_date, by='doctor'):
+        """Count each staff member's or weekday's appointment outcomes between two dates, with the no-show rate"""
+        if by == 'doctor':
+            key_columns = "outcomes.assigned_to AS doctor_id, COALESCE(users.full_name, 'Unassigned') AS doctor_name"
+            group_order = '''
+                GROUP BY outcomes.assigned_to, users.full_name
+                ORDER BY COALESCE(users.full_name, 'Unassigned') COLLATE "C", outcomes.assigned_to
+            '''
+        elif by == 'weekday':
+            key_columns = "extract(isodow FROM outcomes.appointment_date)::integer - 1 AS weekday"
+            group_order = "GROUP BY weekday ORDER BY weekday"
+        else:
+            raise ValueError(f"Unknown breakdown: {by}")
+        return self._read(f'''
+            WITH outcomes AS (
+                SELECT assigned_to, appointment_date, new_status,
+                       ROW_NUMBER() OVER (PARTITION BY appointment_id ORDER BY id DESC) AS latest
+                FROM appointment_status_history
+                WHERE appointment_date >= %(start_date)s::date AND appointment_date < %(end_date)s::date + 1
+                  AND new_status IN ('Completed', 'No-show', 'Cancelled')
+            )
+            SELECT
+                {key_columns},
+                COUNT(*) AS appointments,
+                COUNT(*) FILTER (WHERE outcomes.new_status = 'Completed') AS completed,
+                COUNT(*) FILTER (WHERE outcomes.new_status = 'No-show') AS no_shows,
+                COUNT(*) FILTER (WHERE outcomes.new_status = 'Cancelled') AS cancelled,
+                COUNT(*) FILTER (WHERE outcomes.new_status = 'No-show')::float
+                    / NULLIF(COUNT(*) FILTER (WHERE outcomes.new_status IN ('Completed', 'No-show')), 0)
+                    AS no_show_rate
+            FROM outcomes
+            LEFT JOIN users ON outcomes.assigned_to = users.id
+            WHERE outcomes.latest = 1
+            {group_order}
+        ''', {'start_date': str(start_date), 'end_date': str(end_date)}, schema='no_show_rates')
+
+    def appointment_conflicts(self, occurrences, exclude_series=None):
+        """Return the Scheduled appointments clashing with (start, patient id, staff id) occurrences, in one query"""
+        starts, patient_ids, staff_ids = zip(*occurrences) if occurrences else ((), (), ())
+        return self._fetch('''
+            SELECT
+                to_char(occurrences.start, 'YYYY-MM-DD HH24:MI:SS'),
+                appointments.id,
+                to_char(appointments.appointment_date, 'YYYY-MM-DD HH24:MI:SS'),
+                patients.name,
+                users.full_name
+            FROM unnest(%(starts)s::timestamp[], %(patient_ids)s::integer[], %(staff_ids)s::integer[])
+                AS occurrences (start, patient_id, staff_id)
+            JOIN appointments
+              ON appointments.appointment_date > occurrences.start - %(slot)s * interval '1 minute'
+             AND appointments.appointment_date < occurrences.start + %(slot)s * interval '1 minute'
+            LEFT JOIN patients ON appointments.patient_id = patients.id
+            LEFT JOIN users ON appointments.assigned_to = users.id
+            WHERE appointments.status = 'Scheduled'
+              AND (appointments.patient_id = occurrences.patient_id OR appointments.assigned_to = occurrences.staff_id)
+              AND (%(exclude_series)s::integer IS NULL OR appointments.series_id IS DISTINCT FROM %(exclude_series)s)
+            ORDER BY occurrences.start, appointments.appointment_date, appointments.id
+        ''', {'starts': list(starts), 'patient_ids': list(patient_ids), 'staff_ids': list(staff_ids),
+              'slot': APPOINTMENT_SLOT_MINUTES, 'exclude_series': exclude_series})
+
+    def add_appointment_series(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None,
+                               frequency='weekly', occurrences=12):
+        """Book every occurrence of a recurring series in one transaction and return the series id"""
+        starts = series_occurrences(appointment_date, appointment_time, frequency, occurrences)
+        with self._lock, self._transaction():
+            # Other sessions' bookings wait until this one commits, so none lands after the conflict check
+            self.conn.execute("LOCK TABLE appointments IN SHARE ROW EXCLUSIVE MODE")
+            conflicts = self.appointment_conflicts([(start, patient_id, assigned_to) for start in starts])
+            if conflicts:
+                raise SchedulingConflict(conflicts)
+            series_id = self.conn.execute('''
+                INSERT INTO appointment_series (patient_id, assigned_to, reason, starts_at, frequency, occurrences)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (patient_id, assigned_to, reason, starts[0], frequency, occurrences)).fetchone()[0]
+            self.conn.execute('''
+                INSERT INTO appointments (patient_id, appointment_date, reason, assigned_to, series_id)
+                SELECT %s, start, %s, %s, %s FROM unnest(%s::timestamp[]) AS start
+            ''', (patient_id, reason, assigned_to, series_id, starts))
+        return series_id
+
+    def update_appointment_series(self, series_id, from_date, appointment_time=None, reason=None,
+                                  assigned_to=None, status=None):
+        """Change the Scheduled occurrences of a series on or after a date in one UPDATE; returns how many changed"""
+        params = {
+            'series_id': series_id,
+            'from_date': str(from_date),
+            'at': appointment_time.strftime('%H:%M:%S') if appointment_time else None,
+            'reason': reason,
+            'assigned_to': assigned_to,
+            'status': status,
+        }
+        following = '''
+            WHERE series_id = %(series_id)s AND appointment_date >= %(from_date)s::date AND status = 'Scheduled'
+        '''
+        with self._lock, self._transaction():
+            if (appointment_time or assigned_to) and status in (None, 'Scheduled'):
+                self.conn.execute("LOCK TABLE appointments IN SHARE ROW EXCLUSIVE MODE")
+                moved = self._fetch(f'''
+                    SELECT to_char(COALESCE(appointment_date::date + %(at)s::time, appointment_date),
+                                   'YYYY-MM-DD HH24:MI:SS'),
+                           patient_id, COALESCE(%(assigned_to)s, assigned_to)
+                    FROM appointments
+                    {following}
+                ''', params)
+                conflicts = self.appointment_conflicts(moved, exclude_series=series_id)
+                if conflicts:
+                    raise SchedulingConflict(conflicts)
+            return self.conn.execute(f'''
+                UPDATE appointments SET
+                    appointment_date = COALESCE(appointment_date::date + %(at)s::time, appointment_date),
+                    reason = COALESCE(%(reason)s, reason),
+                    assigned_to = COALESCE(%(assigned_to)s, assigned_to),
+                    status = COALESCE(%(status)s, status)
+                {following}
+            ''', params).rowcount
+
+    # Financial methods
+    def record_income(self, date, amount, description, patient_id, recorded_by_id=None):
+        """Record a financial transaction"""
+        return self._insert('''
+            INSERT INTO finances (date, amount, description, patient_id, recorded_by_id)
+            VALUES (%s, %s, %s, %s, %s)
+        ''', (date, amount, description, patient_id, recorded_by_id))
+
+    def get_financial_records(self, start_date=None, end_date=None, patient_id=None, recorded_by_id=None,
+                              min_amount=None, max_amount=None, transaction_type=None,
+                              order_by='date', descending=False, limit=None, offset=0):
+        """Retrieve financial records matching all given filters; a page also carries total_rows and filtered_total"""
+        if order_by not in FINANCE_ORDERINGS:
+            raise ValueError(f"Unknown ordering: {order_by}")
+        conditions, params = [], {}
+        if start_date and end_date:
+            conditions.append("finances.date BETWEEN %(start_date)s::date AND %(end_date)s::date")
+            params.update(start_date=str(start_date), end_date=str(end_date))
+        for column, name, value in (
+            ('finances.patient_id', 'patient_id', patient_id),
+            ('finances.recorded_by_id', 'recorded_by_id', recorded_by_id),
+            ('finances.transaction_type', 'transaction_type', transaction_type),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = %({name})s")
+                params[name] = value
+        if min_amount is not None:
+            conditions.append("finances.amount >= %(min_amount)s")
+            params['min_amount'] = min_amount
+        if max_amount is not None:
+            conditions.append("finances.amount <= %(max_amount)s")
+            params['max_amount'] = max_amount
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        totals = (
+            ", COUNT(*) OVER () AS total_rows, SUM(finances.amount) OVER () AS filtered_total"
+            if limit is not None else ""
+        )
+        direction = 'DESC' if descending else 'ASC'
+        query = f"""
+            SELECT
+                finances.id,
+                to_char(finances.date, 'YYYY-MM-DD') AS date,
+                finances.amount,
+                finances.description,
+                finances.transaction_type,
+                finances.patient_id,
+                finances.recorded_by_id,
+                patients.name AS patient_name,
+                users.full_name AS recorded_by
+                {totals}
+            FROM finances
+            JOIN patients ON finances.patient_id = patients.id
+            LEFT JOIN users ON finances.recorded_by_id = users.id
+            {where}
+            ORDER BY {FINANCE_ORDERINGS[order_by]} {direction}, finances.id {direction}
+        """
+        if limit is not None:
+            query += " LIMIT %(limit)s OFFSET %(offset)s"
+            params.update(limit=limit, offset=offset)
+        return self._read(query, params, schema='finances')
+
+    def update_financial_record(self, record_id, date, amount, description, patient_id, recorded_by_id=None):
+        """Update a financial record"""
+        with self._lock, self._transaction():
+            self.conn.execute('''
+                UPDATE finances
+                SET date = %s, amount = %s, description = %s, patient_id = %s, recorded_by_id = %s
+                WHERE id = %s
+            ''', (date, amount, description, patient_id, recorded_by_id, record_id))
+
+    def delete_financial_records(self, record_ids):
+        """Delete several financial records in one transaction"""
+        return self._delete_ids('finances', record_ids)
+
+    # Dashboard and analytics methods
+    def get_counters(self, today=None):
+        """Return the dashboard counters; the server counts from the indexes directly"""
+        today = today or date.today()
+        month_start = today.replace(day=1)
+        row = self._read('''
+            SELECT
+                (SELECT COUNT(*) FROM patients) AS patient_count,
+                (SELECT COUNT(*) FROM users JOIN roles ON users.role_id = roles.id
+                 WHERE users.active = 1) AS staff_count,
+                (SELECT COUNT(*) FROM users JOIN roles ON users.role_id = roles.id
+                 WHERE users.active = 1 AND roles.role_name = 'doctor') AS doctor_count,
+                (SELECT COUNT(*) FROM appointments
+                 WHERE appointment_date >= %(today)s AND appointment_date < %(today)s + 1) AS today_appointments,
+                (SELECT COALESCE(SUM(amount), 0) FROM finances
+                 WHERE date >= %(month_start)s AND date < %(month_start)s + interval '1 month') AS monthly_income
+        ''', {'today': today, 'month_start': month_start}).iloc[0]
+        return {name: value.item() if hasattr(value, 'item') else value for name, value in row.items()}
+
+    def get_income_buckets(self, start_date, end_date, max_points=60):
+        """Sum income per day, week, month or year, picking the finest bucket that fits in max_points"""
+        days = (end_date - start_date).days + 1
+        bucket = next(
+            (name for name, width in BUCKET_DAYS.items() if days / width <= max_points),
+            'year'
+        )
+        buckets = self._read(f'''
+            SELECT to_char({INCOME_BUCKETS[bucket]}, 'YYYY-MM-DD') AS bucket,
+                   SUM(finances.amount) AS amount,
+                   COUNT(*) AS transactions
+            FROM finances
+            WHERE finances.date BETWEEN %s AND %s
+            GROUP BY 1
+            ORDER BY 1
+        ''', (start_date, end_date), schema='income_buckets')
+        return bucket, buckets
+
+    def get_income_breakdown(self, start_date, end_date, by='patient', top_n=10):
+        """Sum income per patient or recording staff member, folding everyone past top_n into 'Other'"""
+        if by == 'patient':
+            key_column, label_table, label_column = 'finances.patient_id', 'patients', 'name'
+        elif by == 'staff':
+            key_column, label_table, label_column = 'finances.recorded_by_id', 'users', 'full_name'
+        else:
+            raise ValueError(f"Unknown breakdown: {by}")
+
+        return self._read(f'''
+            WITH totals AS (
+                SELECT {key_column} AS key_id, SUM(finances.amount) AS amount
+                FROM finances
+                WHERE finances.date BETWEEN %(start_date)s AND %(end_date)s AND {key_column} IS NOT NULL
+                GROUP BY {key_column}
+            ),
+            ranked AS (
+                SELECT key_id, amount, ROW_NUMBER() OVER (ORDER BY amount DESC) AS rank
+                FROM totals
+            )
+            SELECT
+                CASE WHEN MIN(rank) <= %(top_n)s THEN COALESCE(MIN({label_table}.{label_column}), 'Unknown')
+                     ELSE 'Other' END AS label,
+                SUM(ranked.amount) AS amount
+            FROM ranked
+            LEFT JOIN {label_table} ON {label_table}.id = ranked.key_id
+            GROUP BY CASE WHEN rank <= %(top_n)s THEN rank ELSE %(top_n)s + 1 END
+            ORDER BY MIN(rank)
+        ''', {'start_date': start_date, 'end_date': end_date, 'top_n': top_n})
+
+    def refresh_patient_metrics(self, full=False):
+        """Nothing is cached on this backend: get_patient_metrics computes from the base tables"""
+        return 0
+
+    def get_patient_metrics(self, patient_id=None, limit=None):
+        """Compute patient lifetime value and visit metrics, highest lifetime value first"""
+        patient_filter = "WHERE patients.id = %(patient_id)s" if patient_id else ""
+        limit_clause = "LIMIT %(limit)s" if limit else ""
+        return self._read(f'''
+            WITH events AS (
+                SELECT patient_id, date AS day, amount, 1 AS is_payment, 0 AS is_appointment, FALSE AS is_visit
+                FROM finances
+                UNION ALL
+                SELECT patient_id, visit_date, 0, 0, 0, TRUE
+                FROM medical_records
+                UNION ALL
+                SELECT patient_id, appointment_date::date, 0, 0, 1, status = 'Completed'
+                FROM appointments
+            ),
+            per_patient AS (
+                SELECT patient_id,
+                       SUM(amount) AS total_revenue,
+                       SUM(is_payment) AS payment_count,
+                       SUM(is_appointment) AS appointment_count,
+                       COUNT(DISTINCT day) FILTER (WHERE is_visit) AS visit_count,
+                       MIN(day) FILTER (WHERE is_visit) AS first_visit,
+                       MAX(day) FILTER (WHERE is_visit) AS last_visit
+                FROM events
+                GROUP BY patient_id
+            )
+            SELECT
+                patients.id AS patient_id,
+                patients.name AS patient_name,
+                COALESCE(per_patient.total_revenue, 0) AS total_revenue,
+                COALESCE(per_patient.payment_count, 0) AS payment_count,
+                COALESCE(per_patient.appointment_count, 0) AS appointment_count,
+                COALESCE(per_patient.visit_count, 0) AS visit_count,
+                to_char(per_patient.first_visit, 'YYYY-MM-DD') AS first_visit,
+                to_char(per_patient.last_visit, 'YYYY-MM-DD') AS last_visit,
+                CASE WHEN per_patient.visit_count > 1
+                     THEN (per_patient.last_visit - per_patient.first_visit)::float8 / (per_patient.visit_count - 1)
+                END AS avg_visit_gap_days,
+                CURRENT_DATE - per_patient.last_visit AS days_since_last_visit
+            FROM patients
+            LEFT JOIN per_patient ON per_patient.patient_id = patients.id
+            {patient_filter}
+            ORDER BY total_revenue DESC
+            {limit_clause}
+        ''', {'patient_id': patient_id, 'limit': limit}, schema='patient_metrics')
+
+    def analytics(self):
+        """Return the revenue analytics over this database"""
+        return PostgresFinancialAnalytics(self)
+
+    def __del__(self):
+        """Close the server connection when the object is destroyed"""
+        try:
+            self.conn.close()
+        except:
+            pass
+
+
+class PostgresFinancialAnalytics:
+    """Revenue analytics computed with window functions on PostgreSQL, matching FinancialAnalytics"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def rolling_revenue(self, start_date, end_date, windows=(7, 30)):
+        """Daily revenue with trailing rolling sums and averages, one row per day including empty days"""
+        lead_start = start_date - timedelta(days=max(windows) - 1)
+        rolling_columns = ',\n'.join(
+            f"SUM(revenue) OVER (ORDER BY day ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW) "
+            f"AS rolling_{window}d,\n"
+            f"SUM(revenue) OVER (ORDER BY day ROWS BETWEEN {window - 1} PRECEDING AND CURRENT ROW) "
+            f"/ {window}.0 AS rolling_{window}d_avg"
+            for window in windows
+        )
+        return self.db._read(f'''
+            WITH days AS (
+                SELECT generate_series(%(lead_start)s::date, %(end_date)s::date, interval '1 day')::date AS day
+            ),
+            daily AS (
+                SELECT finances.date AS day, SUM(finances.amount) AS revenue
+                FROM finances
+                WHERE finances.date BETWEEN %(lead_start)s AND %(end_date)s
+                GROUP BY finances.date
+            ),
+            rolled AS (
+                SELECT days.day, COALESCE(daily.revenue, 0) AS revenue
+                FROM days
+                LEFT JOIN daily ON daily.day = days.day
+            )
+            SELECT to_char(day, 'YYYY-MM-DD') AS day, revenue,
+            {rolling_columns}
+            FROM rolled
+            ORDER BY rolled.day
+            OFFSET %(lead_days)s
+        ''', {'lead_start': lead_start, 'end_date': end_date, 'lead_days': (start_date - lead_start).days},
+            schema='rolling_revenue')
+
+    def month_over_month(self, start_date, end_date):
+        """Monthly revenue with the change against the previous month, including empty months"""
+        first_month = start_date.replace(day=1)
+        lead_start = (first_month - timedelta(days=1)).replace(day=1)
+        return self.db._read('''
+            WITH months AS (
+                SELECT generate_series(%(lead_start)s::date, %(end_date)s::date, interval '1 month')::date AS month
+            ),
+            monthly AS (
+                SELECT date_trunc('month', finances.date)::date AS month,
+                       SUM(finances.amount) AS revenue,
+                       COUNT(*) AS transactions
+                FROM finances
+                WHERE finances.date BETWEEN %(lead_start)s AND %(end_date)s
+                GROUP BY 1
+            ),
+            compared AS (
+                SELECT months.month,
+                       COALESCE(monthly.revenue, 0) AS revenue,
+                       COALESCE(monthly.transactions, 0) AS transactions,
+                       LAG(COALESCE(monthly.revenue, 0)) OVER (ORDER BY months.month) AS previous_revenue
+                FROM months
+                LEFT JOIN monthly ON monthly.month = months.month
+            )
+            SELECT to_char(month, 'YYYY-MM-DD') AS month, revenue, transactions, previous_revenue,
+                   revenue - previous_revenue AS change,
+                   ROUND((100.0 * (revenue - previous_revenue) / NULLIF(previous_revenue, 0))::numeric, 1)::float8
+                       AS change_pct
+            FROM compared
+            WHERE month >= %(first_month)s
+            ORDER BY compared.month
+        ''', {'lead_start': lead_start, 'first_month': first_month, 'end_date': end_date},
+            schema='month_over_month')
+
+    def revenue_per_doctor(self, start_date, end_date):
+        """Revenue attributed to each patient's assigned doctor, with share of total and rank"""
+        return self.db._read('''
+            WITH per_patient AS (
+                SELECT finances.patient_id, SUM(finances.amount) AS revenue, COUNT(*) AS transactions
+                FROM finances
+                WHERE finances.date BETWEEN %s AND %s
+                GROUP BY finances.patient_id
+            )
+            SELECT
+                patients.assigned_doctor_id AS doctor_id,
+                COALESCE(MIN(users.full_name), 'Unassigned') AS doctor_name,
+                SUM(per_patient.revenue) AS revenue,
+                SUM(per_patient.transactions) AS transactions,
+                COUNT(*) AS patients,
+                ROUND((100.0 * SUM(per_patient.revenue) / SUM(SUM(per_patient.revenue)) OVER ())::numeric, 1)::float8
+                    AS share_pct,
+                RANK() OVER (ORDER BY SUM(per_patient.revenue) DESC) AS rank
+            FROM per_patient
+            JOIN patients ON per_patient.patient_id = patients.id
+            LEFT JOIN users ON patients.assigned_doctor_id = users.id
+            GROUP BY patients.assigned_doctor_id
+            ORDER BY rank, patients.assigned_doctor_id
+        ''', (start_date, end_date), schema='revenue_per_doctor')
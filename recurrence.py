@@ -0,0 +1,56 @@
+"""
+Recurring appointment series.
+
+A series is stored once as its rule (start, frequency and number of occurrences)
+and expanded into one appointments row per occurrence, each tagged with the
+series id. Booking checks every occurrence against the patient's and the staff
+member's other appointments in a single query, and edits to "this and following"
+occurrences are single UPDATEs over the series.
+"""
+import calendar
+from datetime import datetime, timedelta
+
+# Days between occurrences per frequency; monthly series keep the day of the month instead
+SERIES_FREQUENCIES = {'daily': 1, 'weekly': 7, 'fortnightly': 14, 'monthly': None}
+
+# Most occurrences a series books: a year of weekly visits
+MAX_SERIES_OCCURRENCES = 52
+
+# Appointments starting closer together than this, for the same patient or staff member, clash
+APPOINTMENT_SLOT_MINUTES = 30
+
+
+class SchedulingConflict(Exception):
+    """Raised when occurrences clash with existing appointments; nothing is booked or changed"""
+
+    def __init__(self, conflicts):
+        # (occurrence, appointment id, appointment date, patient name, staff name) rows
+        self.conflicts = conflicts
+        clashes = ', '.join(
+            f"{occurrence[:16]} ({patient}{f' with {staff}' if staff else ''})"
+            for occurrence, _, _, patient, staff in conflicts[:5]
+        )
+        more = f" and {len(conflicts) - 5} more" if len(conflicts) > 5 else ""
+        super().__init__(f"{len(conflicts)} occurrence(s) clash with existing appointments: {clashes}{more}")
+
+
+def _add_months(moment, months):
+    """Same day and time some months later, or the month's last day when it is shorter"""
+    month = moment.month - 1 + months
+    year, month = moment.year + month // 12, month % 12 + 1
+    return moment.replace(year=year, month=month, day=min(moment.day, calendar.monthrange(year, month)[1]))
+
+
+def series_occurrences(appointment_date, appointment_time, frequency='weekly', occurrences=12):
+    """Return the 'YYYY-MM-DD HH:MM:SS' start of every occurrence of a series"""
+    if frequency not in SERIES_FREQUENCIES:
+        raise ValueError(f"Unknown frequency: {frequency}")
+    if not 1 <= occurrences <= MAX_SERIES_OCCURRENCES:
+        raise ValueError(f"A series has between 1 and {MAX_SERIES_OCCURRENCES} occurrences, got {occurrences}")
+    start = datetime.combine(appointment_date, appointment_time)
+    days = SERIES_FREQUENCIES[frequency]
+    return [
+        (_add_months(start, number) if days is None else start + timedelta(days=days * number))
+        .strftime('%Y-%m-%d %H:%M:%S')
+        for number in range(occurrences)
+    ]
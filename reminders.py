@@ -0,0 +1,230 @@
+"""
+Appointment reminders.
+
+A scheduler looks up the Scheduled appointments starting within the next
+REMINDER_LEAD_HOURS, renders a reminder for each and queues it in the
+reminder_outbox table, where a messaging gateway (or ``drain``) picks it up. An
+appointment is reminded once per start time: the outbox's unique key is the
+appointment and its date, so a rerun queues nothing twice while a rescheduled
+appointment gets a fresh reminder.
+
+Runs read the appointment date index in batches, each resuming after the last
+appointment of the one before, so memory stays bounded however many appointments
+are due and the app's writers are never locked out for a whole run.
+
+    python reminders.py run                   # queue the reminders due now
+    python reminders.py schedule --interval 900
+    python reminders.py pending               # list queued, unsent reminders
+    python reminders.py drain outbox.jsonl    # hand them over as JSON lines and mark them sent
+"""
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Appointments starting within this many hours are reminded
+REMINDER_LEAD_HOURS = 24
+REMINDER_INTERVAL = 15 * 60
+
+# Appointments read, rendered and queued per transaction, and the pause between batches that
+# lets the app's writers in: a busy writer polls for the lock and would otherwise keep missing it
+REMINDER_BATCH_SIZE = 500
+REMINDER_BATCH_PAUSE = 0.02
+
+REMINDER_TEMPLATE = (
+    "Hello {patient}, this is a reminder of your appointment at Nani Health Clinic on {day} at {time}"
+    "{with_staff}. Please reply to this message if you need to reschedule."
+)
+
+# The next batch of due appointments without a reminder, in date index order after (date, id)
+DUE_APPOINTMENTS_QUERY = '''
+    SELECT
+        appointments.id,
+        appointments.appointment_date,
+        patients.name,
+        patients.contact,
+        users.full_name
+    FROM appointments
+    JOIN patients ON patients.id = appointments.patient_id
+    LEFT JOIN users ON users.id = appointments.assigned_to
+    WHERE (appointments.appointment_date, appointments.id) > (:after_date, :after_id)
+      AND appointments.appointment_date < :until
+      AND appointments.status = 'Scheduled'
+      AND NOT EXISTS (
+          SELECT 1 FROM reminder_outbox
+          WHERE reminder_outbox.appointment_id = appointments.id
+            AND reminder_outbox.appointment_date = appointments.appointment_date
+      )
+    ORDER BY appointments.appointment_date, appointments.id
+    LIMIT :batch_size
+'''
+
+
+def render_reminder(patient, appointment_date, staff=None):
+    """Return the reminder text for an appointment at an 'YYYY-MM-DD HH:MM:SS' date"""
+    start = datetime.fromisoformat(appointment_date)
+    return REMINDER_TEMPLATE.format(
+        patient=patient,
+        day=f"{start:%A %d %B}",
+        time=f"{start:%H:%M}",
+        with_staff=f" with {staff}" if staff else "",
+    )
+
+
+class ReminderScheduler:
+    """Queues reminders for upcoming appointments in the database's reminder outbox"""
+
+    def __init__(self, db_path='clinic.db', lead_hours=REMINDER_LEAD_HOURS, batch_size=REMINDER_BATCH_SIZE,
+                 batch_pause=REMINDER_BATCH_PAUSE):
+        self.db_path = db_path
+        self.lead_hours = lead_hours
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+
+    def _connect(self):
+        """Open a connection of our own, so a run never borrows or blocks the app's connection"""
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def run(self, now=None):
+        """Queue a reminder for every due appointment not reminded yet; return what the run did"""
+        now = now or datetime.now()
+        started = time.perf_counter()
+        queued = batches = 0
+        # Appointments already under way are not reminded
+        after = (now.strftime('%Y-%m-%d %H:%M:%S'), 0)
+        until = (now + timedelta(hours=self.lead_hours)).strftime('%Y-%m-%d %H:%M:%S')
+        conn = self._connect()
+        try:
+            while True:
+                due = conn.execute(DUE_APPOINTMENTS_QUERY, {
+                    'after_date': after[0], 'after_id': after[1], 'until': until, 'batch_size': self.batch_size,
+                }).fetchall()
+                if not due:
+                    break
+                # Rendered before taking the write lock, which is then held only for the inserts
+                reminders = [
+                    (appointment_id, appointment_date, contact, render_reminder(patient, appointment_date, staff))
+                    for appointment_id, appointment_date, patient, contact, staff in due
+                ]
+                with conn:
+                    # A concurrent run may have queued some of these since; the unique key skips them
+                    queued += conn.executemany('''
+                        INSERT OR IGNORE INTO reminder_outbox (appointment_id, appointment_date, recipient, message)
+                        VALUES (?, ?, ?, ?)
+                    ''', reminders).rowcount
+                batches += 1
+                after = (due[-1][1], due[-1][0])
+                time.sleep(self.batch_pause)
+        finally:
+            conn.close()
+        return {'queued': queued, 'batches': batches, 'seconds': time.perf_counter() - started}
+
+    def pending(self, limit=None):
+        """Return queued reminders not handed over yet, oldest first, as (id, recipient, message, appointment_date)"""
+        conn = self._connect()
+        try:
+            return conn.execute('''
+                SELECT id, recipient, message, appointment_date FROM reminder_outbox
+                WHERE sent_at IS NULL
+                ORDER BY id
+                LIMIT ?
+            ''', (-1 if limit is None else limit,)).fetchall()
+        finally:
+            conn.close()
+
+    def drain(self, path):
+        """Append every pending reminder to a JSON lines file and mark it sent; return how many were handed over"""
+        sent = 0
+        after_id = 0
+        conn = self._connect()
+        try:
+            with open(path, 'a', encoding='utf-8') as outbox:
+                while True:
+                    batch = conn.execute('''
+                        SELECT id, appointment_id, appointment_date, recipient, message FROM reminder_outbox
+                        WHERE sent_at IS NULL AND id > ?
+                        ORDER BY id
+                        LIMIT ?
+                    ''', (after_id, self.batch_size)).fetchall()
+                    if not batch:
+                        break
+                    for reminder_id, appointment_id, appointment_date, recipient, message in batch:
+                        outbox.write(json.dumps({
+                            'id': reminder_id, 'appointment_id': appointment_id,
+                            'appointment_date': appointment_date, 'to': recipient, 'message': message,
+                        }) + '\n')
+                    # Written out before being marked, so a crash in between sends twice rather than never
+                    outbox.flush()
+                    with conn:
+                        conn.execute('''
+                            UPDATE reminder_outbox SET sent_at = CURRENT_TIMESTAMP
+                            WHERE id IN (SELECT value FROM json_each(?))
+                        ''', (json.dumps([row[0] for row in batch]),))
+                    sent += len(batch)
+                    after_id = batch[-1][0]
+                    time.sleep(self.batch_pause)
+        finally:
+            conn.close()
+        return sent
+
+    def start_scheduler(self, interval_seconds=REMINDER_INTERVAL, stop_event=None):
+        """Queue due reminders every interval on a background thread until stop_event is set"""
+        stop_event = stop_event or threading.Event()
+
+        def reminder_loop():
+            while True:
+                try:
+                    result = self.run()
+                    if result['queued']:
+                        print(f"Queued {result['queued']} appointment reminders in {result['seconds']:.2f}s")
+                except sqlite3.Error as e:
+                    print(f"Error queueing reminders: {e}")
+                if stop_event.wait(interval_seconds):
+                    return
+
+        thread = threading.Thread(target=reminder_loop, name="reminder-scheduler", daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    from database import DatabaseManager, archive_path_for
+
+    parser = argparse.ArgumentParser(description="Nani Health Clinic appointment reminders")
+    parser.add_argument("--db", default="clinic.db", help="Database to remind from")
+    parser.add_argument("--archive", help="Its archive database (default: named after --db, e.g. clinic_archive.db)")
+    parser.add_argument("--lead-hours", type=float, default=REMINDER_LEAD_HOURS)
+    parser.add_argument("--batch-size", type=int, default=REMINDER_BATCH_SIZE)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("run", help="Queue the reminders due now")
+    schedule_parser = subparsers.add_parser("schedule", help="Queue due reminders periodically until interrupted")
+    schedule_parser.add_argument("--interval", type=int, default=REMINDER_INTERVAL, help="Seconds between runs")
+    pending_parser = subparsers.add_parser("pending", help="List queued reminders not handed over yet")
+    pending_parser.add_argument("--limit", type=int, default=50)
+    drain_parser = subparsers.add_parser("drain", help="Append pending reminders to a JSON lines file, marking them sent")
+    drain_parser.add_argument("path")
+
+    args = parser.parse_args()
+    # Creates the outbox on databases that predate it, migrating the database's own archive alongside
+    DatabaseManager(db_path=args.db, archive_path=args.archive or archive_path_for(args.db))
+    reminders = ReminderScheduler(args.db, args.lead_hours, args.batch_size)
+
+    if args.command == "run":
+        result = reminders.run()
+        print(f"Queued {result['queued']} reminders in {result['batches']} batches, {result['seconds']:.2f}s")
+    elif args.command == "schedule":
+        stop = threading.Event()
+        reminders.start_scheduler(args.interval, stop)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            stop.set()
+    elif args.command == "pending":
+        for reminder_id, recipient, message, appointment_date in reminders.pending(args.limit):
+            print(f"#{reminder_id} {appointment_date} to {recipient}: {message}")
+    elif args.command == "drain":
+        print(f"Handed over {reminders.drain(args.path)} reminders to {args.path}")
@@ -0,0 +1,293 @@
+import os
+from abc import ABC, abstractmethod
+
+from fuzzy import FUZZY_MATCH_LIMIT
+from picker import PICKER_MATCHES
+
+# Statuses an appointment moves between; it is booked Scheduled
+APPOINTMENT_STATUSES = ('Scheduled', 'Completed', 'Cancelled', 'No-show')
+
+# Entries per page of a patient's timeline
+TIMELINE_PAGE_SIZE = 20
+
+
+def timeline_cursor(page):
+    """Return the cursor continuing a patient timeline after the last entry of a page"""
+    last = page.iloc[-1]
+    # Formatted the same whether occurred_at was read as text or parsed into a timestamp
+    return str(last['occurred_at'])[:19], last['kind'], int(last['id'])
+
+
+class ConstraintViolation(Exception):
+    """A write the database refused as breaking a constraint: a taken username, or a reference to a missing row"""
+
+
+class InvalidValue(ValueError):
+    """A write the database refused because a value doesn't fit its column, such as text for an id"""
+
+
+class ClinicRepository(ABC):
+    """Storage operations the clinic pages rely on, independent of the database engine.
+
+    Reads return pandas DataFrames with the same columns on every backend, typed as declared in
+    frames.FRAME_SCHEMAS: dates and appointment times as datetime64, low-cardinality text as
+    categoricals and ids as compact integers. Writes the database refuses raise ConstraintViolation
+    or InvalidValue whatever the engine, after rolling back.
+    """
+
+    # User management
+    @abstractmethod
+    def add_user(self, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Add a staff member and return their id"""
+
+    @abstractmethod
+    def get_users(self, limit=None, offset=0):
+        """Retrieve active staff by name, optionally one page at a time with the count in total_rows"""
+
+    @abstractmethod
+    def get_roles(self):
+        """Retrieve all roles"""
+
+    @abstractmethod
+    def search_users(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search active staff by name, username, email or role; with fuzzy, misspelled names still match"""
+
+    @abstractmethod
+    def fuzzy_search_users(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find active staff whose name is within a few typos of the term, closest first, with a distance column"""
+
+    @abstractmethod
+    def update_user(self, user_id, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Update a staff member's details; a blank password keeps the current one"""
+
+    @abstractmethod
+    def delete_users(self, user_ids):
+        """Deactivate several staff members in one transaction and return how many changed"""
+
+    # Patient management
+    @abstractmethod
+    def add_patient(self, name, contact, email, medical_history, assigned_doctor_id=None):
+        """Add a patient and return their id"""
+
+    @abstractmethod
+    def get_patients(self, limit=None, offset=0):
+        """Retrieve patients by name, optionally one page at a time with the count in total_rows"""
+
+    @abstractmethod
+    def get_recent_patients(self, limit=5):
+        """Retrieve the most recently added patients"""
+
+    @abstractmethod
+    def search_patients(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search patients by name, contact or email; with fuzzy, misspelled names still match"""
+
+    @abstractmethod
+    def fuzzy_search_patients(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find patients whose name is within a few typos of the term, closest first, with a distance column"""
+
+    @abstractmethod
+    def update_patient(self, patient_id, name, contact, email, medical_history, assigned_doctor_id=None):
+        """Update a patient's details"""
+
+    @abstractmethod
+    def delete_patients(self, patient_ids):
+        """Delete several patients and everything recorded against them in one transaction.
+
+        Their medical records, payments, appointments (archived ones included), appointment series,
+        status history and reminders all go; returns how many patients were deleted.
+        """
+
+    def find_similar_patients(self, name, contact, email=None, limit=5):
+        """Find patients who may be the person being registered; backends without a duplicate index find none"""
+        # An empty page of patients, with the columns a duplicate match adds
+        return self.get_patients(limit=0).drop(columns=['total_rows']).assign(similarity=None, reason=None, certain=False)
+
+    def pick_patients(self, text, limit=PICKER_MATCHES):
+        """Return (id, name, contact) of the first patients in name order matching typed text, for a patient picker"""
+        # Backends without an in-process picker search the database on every keystroke
+        matches = self.search_patients(text, limit=limit, fuzzy=False) if text else self.get_patients(limit=limit)
+        return [(int(row.id), row.name, row.contact) for row in matches.itertuples()]
+
+    # Medical records
+    @abstractmethod
+    def add_medical_record(self, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
+        """Add a medical record and return its id"""
+
+    @abstractmethod
+    def update_medical_record(self, record_id, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
+        """Update a medical record"""
+
+    @abstractmethod
+    def delete_medical_records(self, record_ids):
+        """Delete several medical records in one transaction and return how many were removed"""
+
+    @abstractmethod
+    def get_medical_records(self, patient_id=None, limit=None, offset=0):
+        """Retrieve medical records in id order, optionally for one patient and one page at a time with total_rows"""
+
+    @abstractmethod
+    def get_patient_timeline(self, patient_id, cursor=None, limit=TIMELINE_PAGE_SIZE):
+        """Merge a patient's visits, appointments and payments into one stream, newest first, a page at a time.
+
+        Rows are occurred_at, kind ('visit', 'appointment' or 'payment'), id, title, detail, notes,
+        status, amount and staff_name; visits and payments fall at midnight of their day. Pass
+        timeline_cursor(page) as cursor to read the entries after a page.
+        """
+
+    # Appointments
+    @abstractmethod
+    def add_appointment(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None):
+        """Schedule an appointment and return its id"""
+
+    @abstractmethod
+    def get_appointments(self, date=None, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments in time order, optionally for one day and staff member"""
+
+    @abstractmethod
+    def get_appointments_range(self, start_date, end_date, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments between two dates (inclusive) in time order, optionally one page at a time"""
+
+    @abstractmethod
+    def get_week_calendar(self, start_of_week, staff_id=None):
+        """Pivot one week of appointments into an hourly slot x weekday grid (slot, day0 .. day6)"""
+
+    @abstractmethod
+    def get_daily_appointment_summary(self, start_date, end_date, staff_id=None, entries_per_day=3):
+        """Count appointments per day and list the first few of each day"""
+
+    @abstractmethod
+    def update_appointment(self, appointment_id, patient_id, appointment_date, appointment_time, reason, status,
+                           assigned_to=None):
+        """Update an appointment; status is one of APPOINTMENT_STATUSES"""
+
+    @abstractmethod
+    def delete_appointments(self, appointment_ids):
+        """Delete several appointments and their status history in one transaction; returns how many were removed"""
+
+    @abstractmethod
+    def set_appointment_status(self, status, day=None, staff_id=None, appointment_ids=None, from_status='Scheduled'):
+        """Move the appointments of a day, staff member or id list that are in from_status (any, if None) to a status.
+
+        Runs as one UPDATE and returns how many appointments changed; every transition is kept in the
+        appointment status history.
+        """
+
+    @abstractmethod
+    def get_no_show_rates(self, start_date, end_date, by='doctor'):
+        """Count appointment outcomes per staff member ('doctor') or weekday (0 is Monday) from the status history.
+
+        Each appointment counts once, by its last outcome: completed, no_shows and cancelled, with
+        no_show_rate the share of no-shows among the completed and no-show appointments.
+        """
+
+    @abstractmethod
+    def appointment_conflicts(self, occurrences, exclude_series=None):
+        """Return the Scheduled appointments clashing with (start, patient id, staff id) occurrences.
+
+        Rows are (occurrence start, id, appointment_date, patient name, staff name); with exclude_series,
+        that series' own appointments never clash, so it can be moved over itself.
+        """
+
+    @abstractmethod
+    def add_appointment_series(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None,
+                               frequency='weekly', occurrences=12):
+        """Book every occurrence of a recurring series, or raise SchedulingConflict; returns the series id"""
+
+    @abstractmethod
+    def update_appointment_series(self, series_id, from_date, appointment_time=None, reason=None,
+                                  assigned_to=None, status=None):
+        """Change the Scheduled occurrences of a series on or after a date; returns how many changed"""
+
+    def cancel_appointment_series(self, series_id, from_date):
+        """Cancel the Scheduled occurrences of a series on or after a date; returns how many were cancelled"""
+        return self.update_appointment_series(series_id, from_date, status='Cancelled')
+
+    # Finances
+    @abstractmethod
+    def record_income(self, date, amount, description, patient_id, recorded_by_id=None):
+        """Record a payment and return its id"""
+
+    @abstractmethod
+    def get_financial_records(self, start_date=None, end_date=None, patient_id=None, recorded_by_id=None,
+                              min_amount=None, max_amount=None, transaction_type=None,
+                              order_by='date', descending=False, limit=None, offset=0):
+        """Retrieve financial records matching all given filters, ordered by date, amount, patient or id.
+
+        With a limit, returns one page with the match count in total_rows and the sum of every
+        matching amount in filtered_total.
+        """
+
+    @abstractmethod
+    def update_financial_record(self, record_id, date, amount, description, patient_id, recorded_by_id=None):
+        """Update a financial record"""
+
+    @abstractmethod
+    def delete_financial_records(self, record_ids):
+        """Delete several financial records in one transaction and return how many were removed"""
+
+    # Dashboard and analytics
+    @abstractmethod
+    def get_counters(self, today=None):
+        """Return patient, staff and doctor counts, today's appointments and this month's income"""
+
+    @abstractmethod
+    def get_income_buckets(self, start_date, end_date, max_points=60):
+        """Sum income per day, week, month or year, picking the finest bucket that fits in max_points"""
+
+    @abstractmethod
+    def get_income_breakdown(self, start_date, end_date, by='patient', top_n=10):
+        """Sum income per patient or recording staff member, folding everyone past top_n into 'Other'"""
+
+    @abstractmethod
+    def refresh_patient_metrics(self, full=False):
+        """Bring cached patient metrics up to date and return how many patients were recomputed"""
+
+    @abstractmethod
+    def get_patient_metrics(self, patient_id=None, limit=None):
+        """Retrieve patient lifetime value and visit metrics, highest value first"""
+
+    @abstractmethod
+    def analytics(self):
+        """Return the revenue analytics (rolling revenue, month over month, revenue per doctor)"""
+
+    # Search
+    @staticmethod
+    def _exact_or_fuzzy(exact_search, fuzzy_search, limit, offset):
+        """Page through exact matches or, when nothing matches exactly, through the fuzzy matches"""
+        exact = exact_search(limit, offset)
+        # An empty later page may just be past the last exact match
+        if not exact.empty or (offset and not exact_search(1, 0).empty):
+            return exact
+        matches = fuzzy_search().drop(columns=['distance'])
+        if limit is None:
+            return matches
+        return matches.iloc[offset:offset + limit].reset_index(drop=True).assign(total_rows=len(matches))
+
+    # Read routing
+    def replica(self):
+        """Return the repository that heavy reads should use; backends without a snapshot use themselves"""
+        return self
+
+    def replica_age(self):
+        """Return how many seconds the data returned by replica() may lag behind"""
+        return 0.0
+
+    # Caching
+    def data_version(self):
+        """Return a token that changes whenever the data may have changed, or None if the backend can't tell"""
+        return None
+
+
+def open_repository():
+    """Open the configured backend: a PostgreSQL server, branch databases, or clinic.db by default"""
+    database_url = os.environ.get('CLINIC_DATABASE_URL', '')
+    if database_url.startswith(('postgres://', 'postgresql://')):
+        # Imported here so the SQLite default never needs the Postgres driver
+        from postgres_backend import PostgresRepository
+        return PostgresRepository(database_url)
+    branches = os.environ.get('CLINIC_BRANCHES')
+    if branches:
+        from sharding import ShardedRepository, open_branches, parse_branches
+        return ShardedRepository(open_branches(parse_branches(branches)))
+    from database import DatabaseManager
+    return DatabaseManager()
@@ -0,0 +1,718 @@
+"""
+Multi-branch sharding: one SQLite database per branch behind the clinic repository interface.
+
+Each branch keeps its own patients, medical records, appointments and finances.
+Staff are shared and copied to every branch with the same ids. Writes go to the
+patient's branch; cross-branch reads run on every branch in parallel and are
+merged. A directory database lists every patient once, with the branches they
+are registered at.
+
+Enable it in the app with, e.g.
+``CLINIC_BRANCHES="0=clinic.db,1=clinic-north.db" streamlit run main.py``.
+"""
+import heapq
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+
+from database import FINANCE_ORDERINGS, DatabaseManager, archive_path_for
+from dedup import normalize_name
+from fuzzy import FUZZY_MATCH_LIMIT
+from lazy_imports import lazy_import
+from picker import PICKER_MATCHES
+from recurrence import SchedulingConflict, series_occurrences
+from repository import TIMELINE_PAGE_SIZE, ClinicRepository, InvalidValue
+
+pd = lazy_import('pandas')
+
+DIRECTORY_PATH = 'clinic_directory.db'
+
+# Each branch allocates row ids from its own range (branch * BRANCH_ID_SPACE upwards), so an id
+# names its branch. Branch 0 keeps ids from 1, so an existing clinic.db can join as branch 0.
+# Ids stay below 2**53 for the first 9000 branches and survive the browser's number type.
+BRANCH_ID_SPACE = 10 ** 12
+
+# Tables whose ids come from the branch's range; users and roles are shared and keep their ids
+BRANCH_TABLES = ('patients', 'medical_records', 'appointments', 'appointment_series', 'finances')
+
+# A top_n larger than any staff list, for per-branch breakdowns that must not fold into 'Other'
+UNFOLDED = 10 ** 9
+
+
+def parse_branches(spec):
+    """Parse "0=clinic.db,1=clinic-north.db" into {branch_id: database path}"""
+    branches = {}
+    for item in spec.split(','):
+        branch_id, path = item.split('=', 1)
+        branches[int(branch_id)] = path.strip()
+    return branches
+
+
+def open_branches(paths, **kwargs):
+    """Open a DatabaseManager per branch, with the archive and replica files named after the branch file"""
+    branches = {}
+    for branch_id, path in paths.items():
+        base, ext = os.path.splitext(path)
+        branches[branch_id] = DatabaseManager(
+            path, archive_path=archive_path_for(path), replica_path=f"{base}_replica{ext}", **kwargs
+        )
+    return branches
+
+
+def _merge_entries(cells, keep=None):
+    """Merge calendar cells from several branches into one, in time order (each line starts with HH:MM)"""
+    lines = sorted(
+        (line for cell in cells if isinstance(cell, str) for line in cell.split('\n')),
+        key=lambda line: line[:5]
+    )
+    return '\n'.join(lines[:keep]) if lines else None
+
+
+class ShardedRepository(ClinicRepository):
+    """Routes clinic reads and writes over one DatabaseManager per branch"""
+
+    def __init__(self, branches, directory_path=DIRECTORY_PATH, default_branch=None, max_workers=None):
+        """Take {branch_id: DatabaseManager}, reserve each branch's id range and sync staff and the directory"""
+        if not branches:
+            raise ValueError("At least one branch is required")
+        self.branches = dict(sorted(branches.items()))
+        self.default_branch = min(self.branches) if default_branch is None else default_branch
+        self.staff_branch = self.branches[self.default_branch]
+        # One worker per branch, so a fan-out waits for the slowest branch rather than the sum of them
+        self._pool = ThreadPoolExecutor(max_workers=max_workers or len(self.branches),
+                                        thread_name_prefix='branch-read')
+        self._directory_lock = threading.Lock()
+        self.directory_path = directory_path
+        self.directory = sqlite3.connect(directory_path, check_same_thread=False)
+        self._create_directory()
+        for branch_id, branch in self.branches.items():
+            self._reserve_id_range(branch_id, branch)
+            self._sync_staff(branch)
+            self._sync_directory(branch_id, branch)
+
+    # Setup
+    def _create_directory(self):
+        """Create the global patient directory tables if they don't exist"""
+        with self.directory:
+            self.directory.execute('''
+                CREATE TABLE IF NOT EXISTS patient_directory (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    contact TEXT NOT NULL,
+                    email TEXT,
+                    home_branch INTEGER NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # One row per branch registration; patient_id is the branch's patients.id, unique across branches
+            self.directory.execute('''
+                CREATE TABLE IF NOT EXISTS patient_branches (
+                    patient_id INTEGER PRIMARY KEY,
+                    directory_id INTEGER NOT NULL,
+                    branch_id INTEGER NOT NULL,
+                    FOREIGN KEY (directory_id) REFERENCES patient_directory (id)
+                )
+            ''')
+            self.directory.execute(
+                'CREATE INDEX IF NOT EXISTS idx_patient_branches_directory ON patient_branches (directory_id)'
+            )
+            self.directory.execute('CREATE INDEX IF NOT EXISTS idx_patient_directory_contact ON patient_directory (contact)')
+
+    @staticmethod
+    def _reserve_id_range(branch_id, branch):
+        """Move the branch's AUTOINCREMENT counters to the start of its id range"""
+        if branch_id < 0:
+            raise ValueError(f"Branch ids must be non-negative, got {branch_id}")
+        base = branch_id * BRANCH_ID_SPACE
+        with branch.conn:
+            for table in BRANCH_TABLES:
+                branch.conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT ?, 0 "
+                    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+                    (table, table)
+                )
+                branch.conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (base, table))
+
+    def _sync_staff(self, branch):
+        """Copy staff a branch is missing from the staff branch, keeping their ids"""
+        if branch is self.staff_branch:
+            return
+        users = self.staff_branch.conn.execute('''
+            SELECT id, username, password, full_name, role_id, email, phone, specialty, active, created_at
+            FROM users
+        ''').fetchall()
+        with branch.conn:
+            branch.conn.executemany('''
+                INSERT OR IGNORE INTO users
+                    (id, username, password, full_name, role_id, email, phone, specialty, active, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', users)
+
+    def _sync_directory(self, branch_id, branch):
+        """List a branch's patients that are not in the directory yet, e.g. after it joins the shard set"""
+        listed = {row[0] for row in self.directory.execute(
+            "SELECT patient_id FROM patient_branches WHERE branch_id = ?", (branch_id,)
+        )}
+        patients = [
+            row for row in branch.conn.execute("SELECT id, name, contact, email FROM patients")
+            if row[0] not in listed
+        ]
+        with self._directory_lock, self.directory:
+            for patient_id, name, contact, email in patients:
+                self._list_patient(patient_id, branch_id, name, contact, email)
+
+    def _list_patient(self, patient_id, branch_id, name, contact, email, directory_id=None):
+        """Record a branch registration in the directory, creating the directory entry if needed"""
+        if directory_id is None:
+            directory_id = self.directory.execute(
+                "INSERT INTO patient_directory (name, contact, email, home_branch) VALUES (?, ?, ?, ?)",
+                (name, contact, email, branch_id)
+            ).lastrowid
+        self.directory.execute(
+            "INSERT OR REPLACE INTO patient_branches (patient_id, directory_id, branch_id) VALUES (?, ?, ?)",
+            (patient_id, directory_id, branch_id)
+        )
+        return directory_id
+
+    # Routing
+    def branch(self, branch_id=None):
+        """Return the DatabaseManager of a branch, or of the default branch"""
+        branch_id = self.default_branch if branch_id is None else branch_id
+        if branch_id not in self.branches:
+            raise KeyError(f"Unknown branch {branch_id}")
+        return self.branches[branch_id]
+
+    @staticmethod
+    def branch_id_of(row_id):
+        """Return the branch a patient, record, appointment or payment id belongs to"""
+        try:
+            return int(row_id) // BRANCH_ID_SPACE
+        except (TypeError, ValueError):
+            raise InvalidValue(f"{row_id!r} is not an id")
+
+    def _branch_of(self, row_id):
+        """Return the DatabaseManager holding a row id"""
+        return self.branch(self.branch_id_of(row_id))
+
+    def _branch_of_record(self, row_id, patient_id):
+        """Return the branch holding a record, which must also hold the patient it is filed under"""
+        if self.branch_id_of(row_id) != self.branch_id_of(patient_id):
+            raise ValueError("A record can't be moved to a patient registered at another branch")
+        return self._branch_of(row_id)
+
+    def _by_branch(self, row_ids):
+        """Group row ids by the branch that holds them"""
+        groups = {}
+        for row_id in row_ids:
+            groups.setdefault(self.branch_id_of(row_id), []).append(int(row_id))
+        return groups
+
+    def _fan_out(self, read):
+        """Run read(branch) on every branch in parallel and return the results in branch order"""
+        return list(self._pool.map(read, self.branches.values()))
+
+    @staticmethod
+    def _concat(frames, sort_by=None, ascending=True):
+        """Concatenate branch frames, optionally sorted the way the single-database query orders them"""
+        non_empty = [frame for frame in frames if not frame.empty]
+        merged = pd.concat(non_empty or frames[:1], ignore_index=True)
+        # Branches categorize their own values, and concat falls back to plain strings when categories differ
+        for column, dtype in frames[0].dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype) and not isinstance(merged[column].dtype, pd.CategoricalDtype):
+                merged[column] = merged[column].astype('category')
+        if sort_by:
+            merged = merged.sort_values(sort_by, ascending=ascending, kind='mergesort')
+        return merged.reset_index(drop=True)
+
+    def _paged(self, read, sort_by, limit, offset, ascending=True):
+        """Scatter a paged read to every branch and gather one globally ordered page"""
+        if limit is None:
+            return self._concat(self._fan_out(lambda branch: read(branch, None, 0)), sort_by, ascending)
+        # A branch's first offset + limit rows hold every row it can contribute to the global page
+        frames = self._fan_out(lambda branch: read(branch, offset + limit, 0))
+        # Every match count and sum the branches put on their pages adds up across branches
+        totals = {
+            # As Python numbers: a branch's compact int8 count would wrap around when added up
+            column: sum(frame[column].iloc[0].item() for frame in frames if not frame.empty)
+            for column in ('total_rows', 'filtered_total') if column in frames[0].columns
+        }
+        page = self._concat(frames, sort_by, ascending).iloc[offset:offset + limit].reset_index(drop=True)
+        for column, total in totals.items():
+            page[column] = total
+        return page
+
+    # User management: staff are shared, so writes go to every branch and reads to one
+    @contextmanager
+    def _staff_transaction(self):
+        """Hold every branch's write lock for a staff change, committing it only once every branch has made it"""
+        # Locks are taken in branch order, so concurrent staff changes queue rather than deadlock
+        with ExitStack() as transactions:
+            for branch in self.branches.values():
+                transactions.enter_context(branch._immediate_transaction())
+            yield
+
+    def add_user(self, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Add a staff member to every branch and return their id, which is the same everywhere"""
+        with self._staff_transaction():
+            user_ids = {
+                branch._insert_user(username, password, full_name, role_id, email, phone, specialty)
+                for branch in self.branches.values()
+            }
+            # Raised before anything is committed, so no branch keeps the staff member
+            if len(user_ids) != 1:
+                raise RuntimeError(f"Staff ids diverged across branches: {sorted(user_ids)}")
+        return user_ids.pop()
+
+    def get_users(self, limit=None, offset=0):
+        """Retrieve active staff, optionally one page at a time"""
+        return self.staff_branch.get_users(limit, offset)
+
+    def get_roles(self):
+        """Retrieve all roles"""
+        return self.staff_branch.get_roles()
+
+    def search_users(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search active staff by name, username, email or role"""
+        return self.staff_branch.search_users(search_term, limit, offset, fuzzy)
+
+    def fuzzy_search_users(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find active staff whose name is within a few typos of the term"""
+        return self.staff_branch.fuzzy_search_users(search_term, limit)
+
+    def update_user(self, user_id, username, password, full_name, role_id, email=None, phone=None, specialty=None):
+        """Update a staff member on every branch"""
+        with self._staff_transaction():
+            for branch in self.branches.values():
+                branch._update_user(user_id, username, password, full_name, role_id, email, phone, specialty)
+
+    def delete_users(self, user_ids):
+        """Deactivate staff members on every branch and return how many changed"""
+        counts = [branch.delete_users(user_ids) for branch in self.branches.values()]
+        return counts[0]
+
+    # Patient management
+    def add_patient(self, name, contact, email, medical_history, assigned_doctor_id=None, branch_id=None):
+        """Register a patient at a branch (the default branch if none is given) and list them in the directory"""
+        branch_id = self.default_branch if branch_id is None else branch_id
+        patient_id = self.branch(branch_id).add_patient(name, contact, email, medical_history, assigned_doctor_id)
+        # Not atomic with the branch insert: a patient missed here is listed by _sync_directory on next start
+        with self._directory_lock, self.directory:
+            self._list_patient(patient_id, branch_id, name, contact, email)
+        return patient_id
+
+    def get_patients(self, limit=None, offset=0):
+        """Retrieve patients of every branch by name, optionally one page at a time"""
+        return self._paged(lambda branch, limit, offset: branch.get_patients(limit, offset),
+                           ['name', 'id'], limit, offset)
+
+    def get_recent_patients(self, limit=5):
+        """Retrieve the most recently added patients across branches"""
+        frames = self._fan_out(lambda branch: branch.get_recent_patients(limit))
+        return self._concat(frames, ['created_at', 'id'], ascending=False).head(limit)
+
+    def search_patients(self, search_term, limit=None, offset=0, fuzzy=True):
+        """Search patients of every branch by name, contact or email"""
+        # Exact matches at any branch win over fuzzy ones, so branches must not fall back on their own
+        exact_search = lambda limit, offset: self._paged(
+            lambda branch, limit, offset: branch.search_patients(search_term, limit, offset, fuzzy=False),
+            ['name', 'id'], limit, offset
+        )
+        if not fuzzy:
+            return exact_search(limit, offset)
+        return self._exact_or_fuzzy(exact_search, lambda: self.fuzzy_search_patients(search_term), limit, offset)
+
+    def fuzzy_search_patients(self, search_term, limit=FUZZY_MATCH_LIMIT):
+        """Find patients at any branch whose name is within a few typos of the term, closest first"""
+        frames = self._fan_out(lambda branch: branch.fuzzy_search_patients(search_term, limit))
+        return self._concat(frames, ['distance', 'name', 'id']).head(limit)
+
+    def pick_patients(self, text, limit=PICKER_MATCHES):
+        """Merge the first matches of every branch's patient picker in name order"""
+        # In-process lookups take microseconds, less than handing them to the branch read pool
+        matches = heapq.merge(
+            *(branch.pick_patients(text, limit) for branch in self.branches.values()),
+            key=lambda match: (normalize_name(match[1]), match[0])
+        )
+        return list(islice(matches, limit))
+
+    def update_patient(self, patient_id, name, contact, email, medical_history, assigned_doctor_id=None):
+        """Update a patient on their branch and in the directory"""
+        self._branch_of(patient_id).update_patient(patient_id, name, contact, email, medical_history,
+                                                   assigned_doctor_id)
+        with self._directory_lock, self.directory:
+            self.directory.execute('''
+                UPDATE patient_directory SET name = ?, contact = ?, email = ?
+                WHERE id = (SELECT directory_id FROM patient_branches WHERE patient_id = ?)
+            ''', (name, contact, email, int(patient_id)))
+
+    def find_similar_patients(self, name, contact, email=None, limit=5):
+        """Find patients at any branch who may be the person being registered, best match first"""
+        frames = self._fan_out(lambda branch: branch.find_similar_patients(name, contact, email, limit))
+        return self._concat(frames, ['certain', 'similarity'], ascending=False).head(limit)
+
+    def delete_patients(self, patient_ids):
+        """Delete patients on their branches, with their history, and drop them from the directory"""
+        deleted = sum(
+            self.branch(branch_id).delete_patients(ids) for branch_id, ids in self._by_branch(patient_ids).items()
+        )
+        with self._directory_lock, self.directory:
+            self.directory.executemany(
+                "DELETE FROM patient_branches WHERE patient_id = ?", ((int(patient_id),) for patient_id in patient_ids)
+            )
+            self.directory.execute('''
+                DELETE FROM patient_directory
+                WHERE id NOT IN (SELECT directory_id FROM patient_branches)
+            ''')
+        return deleted
+
+    # Global patient directory
+    def find_patients(self, search_term, limit=50):
+        """Search the directory for a person across branches, with their registration at each branch"""
+        pattern = f"%{search_term}%"
+        # Registrations are concatenated in branch order, so branches and patient_ids line up
+        with self._directory_lock:
+            return pd.read_sql_query('''
+                SELECT
+                    directory_id, name, contact, email, home_branch,
+                    GROUP_CONCAT(branch_id) AS branches,
+                    GROUP_CONCAT(patient_id) AS patient_ids
+                FROM (
+                    SELECT
+                        patient_directory.id AS directory_id,
+                        patient_directory.name,
+                        patient_directory.contact,
+                        patient_directory.email,
+                        patient_directory.home_branch,
+                        patient_branches.branch_id,
+                        patient_branches.patient_id
+                    FROM patient_directory
+                    JOIN patient_branches ON patient_branches.directory_id = patient_directory.id
+                    WHERE patient_directory.name LIKE ? OR patient_directory.contact LIKE ?
+                       OR patient_directory.email LIKE ?
+                    ORDER BY patient_directory.id, patient_branches.branch_id
+                )
+                GROUP BY directory_id
+                ORDER BY name, directory_id
+                LIMIT ?
+            ''', self.directory, params=(pattern, pattern, pattern, limit))
+
+    def patient_branches(self, patient_id):
+        """Return every branch registration of the person behind a patient id"""
+        with self._directory_lock:
+            return pd.read_sql_query('''
+                SELECT others.branch_id, others.patient_id
+                FROM patient_branches AS this
+                JOIN patient_branches AS others ON others.directory_id = this.directory_id
+                WHERE this.patient_id = ?
+                ORDER BY others.branch_id
+            ''', self.directory, params=(int(patient_id),))
+
+    def register_visit(self, patient_id, branch_id):
+        """Register a patient at another branch they visit and return their patient id at that branch"""
+        patient_id = int(patient_id)
+        with self._directory_lock:
+            link = self.directory.execute(
+                "SELECT directory_id FROM patient_branches WHERE patient_id = ?", (patient_id,)
+            ).fetchone()
+            if link is None:
+                raise KeyError(f"Patient {patient_id} is not in the directory")
+            existing = self.directory.execute(
+                "SELECT patient_id FROM patient_branches WHERE directory_id = ? AND branch_id = ?",
+                (link[0], branch_id)
+            ).fetchone()
+            if existing:
+                return existing[0]
+            name, contact, email, medical_history, assigned_doctor_id = self._branch_of(patient_id).conn.execute(
+                "SELECT name, contact, email, medical_history, assigned_doctor_id FROM patients WHERE id = ?",
+                (patient_id,)
+            ).fetchone()
+            local_id = self.branch(branch_id).add_patient(name, contact, email, medical_history, assigned_doctor_id)
+            with self.directory:
+                self._list_patient(local_id, branch_id, name, contact, email, directory_id=link[0])
+            return local_id
+
+    # Medical records, appointments and finances live on the patient's branch
+    def add_medical_record(self, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
+        """Add a medical record on the patient's branch"""
+        return self._branch_of(patient_id).add_medical_record(
+            patient_id, doctor_id, visit_date, diagnosis, treatment, notes
+        )
+
+    def update_medical_record(self, record_id, patient_id, doctor_id, visit_date, diagnosis, treatment, notes):
+        """Update a medical record on the branch that holds it"""
+        self._branch_of_record(record_id, patient_id).update_medical_record(
+            record_id, patient_id, doctor_id, visit_date, diagnosis, treatment, notes
+        )
+
+    def delete_medical_records(self, record_ids):
+        """Delete medical records on the branches that hold them"""
+        return sum(
+            self.branch(branch_id).delete_medical_records(ids)
+            for branch_id, ids in self._by_branch(record_ids).items()
+        )
+
+    def get_medical_records(self, patient_id=None, limit=None, offset=0):
+        """Retrieve medical records of one patient, or of every branch, optionally one page at a time"""
+        if patient_id:
+            return self._branch_of(patient_id).get_medical_records(patient_id, limit, offset)
+        return self._paged(lambda branch, limit, offset: branch.get_medical_records(None, limit, offset),
+                           ['id'], limit, offset)
+
+    def get_patient_timeline(self, patient_id, cursor=None, limit=TIMELINE_PAGE_SIZE):
+        """Read a patient's timeline from their branch, which holds all of it"""
+        return self._branch_of(patient_id).get_patient_timeline(patient_id, cursor, limit)
+
+    def add_appointment(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None):
+        """Schedule an appointment on the patient's branch"""
+        return self._branch_of(patient_id).add_appointment(
+            patient_id, appointment_date, appointment_time, reason, assigned_to
+        )
+
+    def get_appointments(self, date=None, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments of every branch in time order, optionally one page at a time"""
+        return self._paged(lambda branch, limit, offset: branch.get_appointments(date, staff_id, limit, offset),
+                           ['appointment_date', 'id'], limit, offset)
+
+    def get_appointments_range(self, start_date, end_date, staff_id=None, limit=None, offset=0):
+        """Retrieve appointments of every branch between two dates (inclusive), optionally one page at a time"""
+        return self._paged(
+            lambda branch, limit, offset: branch.get_appointments_range(start_date, end_date, staff_id, limit, offset),
+            ['appointment_date', 'id'], limit, offset
+        )
+
+    def get_week_calendar(self, start_of_week, staff_id=None):
+        """Merge the branches' hourly week grids cell by cell"""
+        frames = self._fan_out(lambda branch: branch.get_week_calendar(start_of_week, staff_id))
+        merged = self._concat(frames)
+        return merged.groupby('slot', as_index=False).agg(_merge_entries) if not merged.empty else merged
+
+    def get_daily_appointment_summary(self, start_date, end_date, staff_id=None, entries_per_day=3):
+        """Add up the branches' daily counts and keep the earliest entries of each day"""
+        frames = self._fan_out(lambda branch: branch.get_daily_appointment_summary(
+            start_date, end_date, staff_id, entries_per_day
+        ))
+        merged = self._concat(frames)
+        if merged.empty:
+            return merged
+        return merged.groupby('day', as_index=False).agg(
+            appointments=('appointments', 'sum'),
+            entries=('entries', lambda cells: _merge_entries(cells, entries_per_day)),
+        )
+
+    def update_appointment(self, appointment_id, patient_id, appointment_date, appointment_time, reason, status,
+                           assigned_to=None):
+        """Update an appointment on the branch that holds it"""
+        self._branch_of_record(appointment_id, patient_id).update_appointment(
+            appointment_id, patient_id, appointment_date, appointment_time, reason, status, assigned_to
+        )
+
+    def delete_appointments(self, appointment_ids):
+        """Delete appointments on the branches that hold them"""
+        return sum(
+            self.branch(branch_id).delete_appointments(ids)
+            for branch_id, ids in self._by_branch(appointment_ids).items()
+        )
+
+    def set_appointment_status(self, status, day=None, staff_id=None, appointment_ids=None, from_status='Scheduled'):
+        """Change the matching appointments' status on the branches that hold them, one UPDATE per branch"""
+        if appointment_ids is not None:
+            return sum(
+                self.branch(branch_id).set_appointment_status(status, day, staff_id, ids, from_status)
+                for branch_id, ids in self._by_branch(appointment_ids).items()
+            )
+        return sum(self._fan_out(
+            lambda branch: branch.set_appointment_status(status, day, staff_id, None, from_status)
+        ))
+
+    def get_no_show_rates(self, start_date, end_date, by='doctor'):
+        """Add up the branches' appointment outcomes per staff member or weekday and rate the totals"""
+        frames = self._fan_out(lambda branch: branch.get_no_show_rates(start_date, end_date, by))
+        merged = self._concat(frames)
+        if merged.empty:
+            return merged
+        counts = ['appointments', 'completed', 'no_shows', 'cancelled']
+        if by == 'doctor':
+            merged = merged.groupby('doctor_id', as_index=False, dropna=False).agg(
+                doctor_name=('doctor_name', 'first'), **{column: (column, 'sum') for column in counts}
+            ).sort_values(['doctor_name', 'doctor_id'], kind='mergesort')
+        else:
+            merged = merged.groupby('weekday', as_index=False)[counts].sum()
+        decided = merged['completed'] + merged['no_shows']
+        merged['no_show_rate'] = merged['no_shows'] / decided.where(decided != 0)
+        return merged.reset_index(drop=True)
+
+    def appointment_conflicts(self, occurrences, exclude_series=None):
+        """Gather the clashing appointments of every branch, since staff work on more than one"""
+        conflicts = self._fan_out(lambda branch: branch.appointment_conflicts(occurrences, exclude_series))
+        return sorted((row for rows in conflicts for row in rows), key=lambda row: (row[0], row[2], row[1]))
+
+    def add_appointment_series(self, patient_id, appointment_date, appointment_time, reason, assigned_to=None,
+                               frequency='weekly', occurrences=12):
+        """Book a series on the patient's branch once the staff member is free on every other branch"""
+        home = self._branch_of(patient_id)
+        if assigned_to is not None:
+            # The patient's own appointments, and the staff member's on home, are checked by home as it books
+            starts = series_occurrences(appointment_date, appointment_time, frequency, occurrences)
+            elsewhere = self._fan_out(lambda branch: [] if branch is home else branch.appointment_conflicts(
+                [(start, None, assigned_to) for start in starts]
+            ))
+            conflicts = [row for rows in elsewhere for row in rows]
+            if conflicts:
+                raise SchedulingConflict(sorted(conflicts, key=lambda row: (row[0], row[2], row[1])))
+        return home.add_appointment_series(
+            patient_id, appointment_date, appointment_time, reason, assigned_to, frequency, occurrences
+        )
+
+    def update_appointment_series(self, series_id, from_date, appointment_time=None, reason=None,
+                                  assigned_to=None, status=None):
+        """Change the Scheduled occurrences of a series from a date on, on the branch that holds it"""
+        return self._branch_of(series_id).update_appointment_series(
+            series_id, from_date, appointment_time, reason, assigned_to, status
+        )
+
+    def record_income(self, date, amount, description, patient_id, recorded_by_id=None):
+        """Record a payment on the patient's branch"""
+        return self._branch_of(patient_id).record_income(date, amount, description, patient_id, recorded_by_id)
+
+    def get_financial_records(self, start_date=None, end_date=None, patient_id=None, recorded_by_id=None,
+                              min_amount=None, max_amount=None, transaction_type=None,
+                              order_by='date', descending=False, limit=None, offset=0):
+        """Retrieve financial records from the patient's branch, or merged from every branch"""
+        filters = dict(start_date=start_date, end_date=end_date, patient_id=patient_id,
+                       recorded_by_id=recorded_by_id, min_amount=min_amount, max_amount=max_amount,
+                       transaction_type=transaction_type, order_by=order_by, descending=descending)
+        if order_by not in FINANCE_ORDERINGS:
+            raise ValueError(f"Unknown ordering: {order_by}")
+        if patient_id:
+            return self._branch_of(patient_id).get_financial_records(**filters, limit=limit, offset=offset)
+        sort_by = {'date': ['date', 'id'], 'amount': ['amount', 'id'], 'patient': ['patient_name', 'id'],
+                   'id': ['id']}[order_by]
+        return self._paged(
+            lambda branch, limit, offset: branch.get_financial_records(**filters, limit=limit, offset=offset),
+            sort_by, limit, offset, ascending=not descending
+        )
+
+    def update_financial_record(self, record_id, date, amount, description, patient_id, recorded_by_id=None):
+        """Update a financial record on the branch that holds it"""
+        self._branch_of_record(record_id, patient_id).update_financial_record(
+            record_id, date, amount, description, patient_id, recorded_by_id
+        )
+
+    def delete_financial_records(self, record_ids):
+        """Delete financial records on the branches that hold them"""
+        return sum(
+            self.branch(branch_id).delete_financial_records(ids)
+            for branch_id, ids in self._by_branch(record_ids).items()
+        )
+
+    # Dashboard and analytics
+    def get_counters(self, today=None):
+        """Add up the branches' counters; staff counts are shared, so they come from one branch"""
+        counters = self._fan_out(lambda branch: branch.get_counters(today))
+        merged = dict(counters[0])
+        for name in ('patient_count', 'today_appointments', 'monthly_income'):
+            merged[name] = sum(branch_counters[name] for branch_counters in counters)
+        return merged
+
+    def get_income_buckets(self, start_date, end_date, max_points=60):
+        """Add up the branches' income buckets; every branch picks the same bucket for the same range"""
+        results = self._fan_out(lambda branch: branch.get_income_buckets(start_date, end_date, max_points))
+        merged = self._concat([buckets for _, buckets in results])
+        return results[0][0], merged.groupby('bucket', as_index=False)[['amount', 'transactions']].sum()
+
+    def get_income_breakdown(self, start_date, end_date, by='patient', top_n=10):
+        """Merge the branches' breakdowns into one top_n, folding everyone else into 'Other'"""
+        if by == 'staff':
+            # Staff take payments at several branches, so rank on totals gathered from all of them. Grouped by
+            # id, as the single database does: namesakes, and the 'Unknown' staff behind missing ids, stay apart
+            frames = self._fan_out(lambda branch: branch._income_breakdown(start_date, end_date, by, UNFOLDED))
+            ranked = self._concat(frames).groupby('key_id', sort=False).agg(
+                label=('label', 'first'), amount=('amount', 'sum')
+            ).reset_index(drop=True)
+            other = 0.0
+        elif by == 'patient':
+            # A patient id belongs to one branch, so the global top_n is among the branches' own top_n
+            frames = self._fan_out(lambda branch: branch.get_income_breakdown(start_date, end_date, by, top_n))
+            other = sum(frame['amount'].iloc[-1] for frame in frames if len(frame) > top_n)
+            ranked = self._concat([frame.iloc[:top_n] for frame in frames])
+        else:
+            raise ValueError(f"Unknown breakdown: {by}")
+        ranked = ranked.sort_values('amount', ascending=False, kind='mergesort')
+        folded = len(ranked) > top_n or any(len(frame) > top_n for frame in frames)
+        other += ranked['amount'].iloc[top_n:].sum()
+        ranked = ranked.iloc[:top_n]
+        if folded:
+            ranked = pd.concat([ranked, pd.DataFrame({'label': ['Other'], 'amount': [other]})])
+        return ranked.reset_index(drop=True)
+
+    def refresh_patient_metrics(self, full=False):
+        """Refresh cached patient metrics on every branch"""
+        return sum(self._fan_out(lambda branch: branch.refresh_patient_metrics(full)))
+
+    def get_patient_metrics(self, patient_id=None, limit=None):
+        """Retrieve patient metrics of one patient, or the highest-value patients across branches"""
+        if patient_id:
+            return self._branch_of(patient_id).get_patient_metrics(patient_id)
+        frames = self._fan_out(lambda branch: branch.get_patient_metrics(limit=limit))
+        merged = self._concat(frames, 'total_revenue', ascending=False)
+        return merged.head(limit) if limit else merged
+
+    def data_version(self):
+        """Return the branches' and the directory's data versions together, so a write to any of them changes it"""
+        # The directory's connection is also its writer, and data_version only moves on other connections' commits
+        with self._directory_lock:
+            directory_version = (self.directory.execute("PRAGMA data_version").fetchone()[0],
+                                 self.directory.total_changes)
+        return tuple(branch.data_version() for branch in self.branches.values()) + (directory_version,)
+
+    def analytics(self):
+        """Return revenue analytics merged across branches"""
+        return ShardedFinancialAnalytics(self)
+
+    def close(self):
+        """Stop the read workers and close every branch and the directory"""
+        self._pool.shutdown(wait=True)
+        for branch in self.branches.values():
+            branch.close()
+        self.directory.close()
+
+
+class ShardedFinancialAnalytics:
+    """Revenue analytics over several branches, merged from each branch's FinancialAnalytics"""
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def rolling_revenue(self, start_date, end_date, windows=(7, 30)):
+        """Daily revenue with rolling sums and averages; the rolling figures of a sum are sums of rolling figures"""
+        frames = self.repo._fan_out(lambda branch: branch.analytics().rolling_revenue(start_date, end_date, windows))
+        return self.repo._concat(frames).groupby('day', as_index=False).sum()
+
+    def month_over_month(self, start_date, end_date):
+        """Monthly revenue of all branches with the change against the previous month"""
+        frames = self.repo._fan_out(lambda branch: branch.analytics().month_over_month(start_date, end_date))
+        merged = self.repo._concat(frames).groupby('month', as_index=False)[
+            ['revenue', 'transactions', 'previous_revenue', 'change']
+        ].sum(min_count=1)
+        previous = merged['previous_revenue'].where(merged['previous_revenue'] != 0)
+        merged['change_pct'] = (100.0 * merged['change'] / previous).round(1)
+        return merged
+
+    def revenue_per_doctor(self, start_date, end_date):
+        """Revenue per assigned doctor across branches, with share of total and rank"""
+        frames = self.repo._fan_out(lambda branch: branch.analytics().revenue_per_doctor(start_date, end_date))
+        merged = self.repo._concat(frames)
+        if merged.empty:
+            return merged
+        merged = merged.groupby('doctor_id', as_index=False, dropna=False).agg(
+            doctor_name=('doctor_name', 'first'),
+            revenue=('revenue', 'sum'),
+            transactions=('transactions', 'sum'),
+            patients=('patients', 'sum'),
+        )
+        merged['share_pct'] = (100.0 * merged['revenue'] / merged['revenue'].sum()).round(1)
+        merged['rank'] = merged['revenue'].rank(method='min', ascending=False).astype(int)
+        return merged.sort_values(['rank', 'doctor_id'], kind='mergesort').reset_index(drop=True)